@@ -9,15 +9,14 @@ import logging
 import os
 import time
 
-import nidaqmx
 import numpy as np
 import tifffile as skimtiff
 from nidaqmx.constants import AcquisitionType
-from nidaqmx.stream_readers import AnalogSingleChannelReader
-from nidaqmx.stream_writers import AnalogMultiChannelWriter
 
-from ..NIDAQ import wavegenerator
+from ..NIDAQ import daq_backend, raster_cache, static_outputs
+from ..NIDAQ.pmt_reconstruction import PMTReconstruction, lag_samples
 from ..PI_ObjectiveMotor.focuser import PIMotor
+from ..PI_ObjectiveMotor.zstack_pipeline import PlanePipeline
 
 
 class RasterScan:
@@ -29,10 +28,22 @@ class RasterScan:
         average_number=1,
         continuous=False,
         return_image=True,
+        bidirectional=False,
+        x_pixels=None,
+        y_pixels=None,
+        y_edge_volt=None,
+        x_offset=0,
+        y_offset=0,
+        rotation=0,
+        line_scan=False,
     ):
         """
         Object to run raster PMT scanning.
 
+        By default a square frame from -edge_volt to edge_volt is scanned.
+        A smaller rectangular sub-region, or a single line scanned over and
+        over, gives a higher frame or line rate for voltage imaging.
+
         Parameters
         Daq_sample_rate : int
             Sampling rate used to generate the waveforms.
@@ -46,6 +57,30 @@ class RasterScan:
             Whether to do continuous scanning or not. The default is False.
         return_image : TYPE, optional
             Whether return the processed image. The default is True.
+        bidirectional : bool, optional
+            Whether to record on both directions of a triangle wave instead
+            of a sawtooth, which gives shorter lines at the same pixel dwell
+            time. The lag is measured from the line phase of the first scan
+            at a sample rate. The default is False.
+        x_pixels : int, optional
+            Number of pixels along x. The default is pixel_number.
+        y_pixels : int, optional
+            Number of pixels along y, or the number of lines in a line
+            scan. The default is pixel_number.
+        y_edge_volt : float, optional
+            Half of the y scan range. The default keeps the pixels square,
+            edge_volt * y_pixels / x_pixels.
+        x_offset : float, optional
+            Center of the region in x, in volt. The default is 0.
+        y_offset : float, optional
+            Center of the region in y, in volt. The default is 0.
+        rotation : float, optional
+            Rotation of the region around its center in degrees, see
+            wavegenerator.rotateXandY. The default is 0.
+        line_scan : bool, optional
+            Whether to scan the same line from x_offset - edge_volt to
+            x_offset + edge_volt at y_offset, y_pixels times. The image is
+            then a kymograph of the line. The default is False.
 
         Returns
         None.
@@ -59,42 +94,108 @@ class RasterScan:
         self.pixel_number = pixel_number
         self.flag_continuous = continuous
         self.flag_return_image = return_image
-
-        # Generate galvo samples
-        self.samples_X, self.samples_Y = wavegenerator.waveRecPic(
+        self.bidirectional = bidirectional
+        self.line_scan = line_scan
+
+        self.x_pixels = pixel_number if x_pixels is None else int(x_pixels)
+        self.y_pixels = pixel_number if y_pixels is None else int(y_pixels)
+        if y_edge_volt is None:
+            y_edge_volt = self.edge_volt * self.y_pixels / self.x_pixels
+        if self.line_scan is True:
+            # The y galvo stays on the line.
+            y_edge_volt = 0
+        self.y_edge_volt = y_edge_volt
+
+        # Galvo samples, generated once per setting and shared between scans
+        raster = raster_cache.get_raster(
             sampleRate=self.Daq_sample_rate,
-            imAngle=0,
-            voltXMin=-1 * self.edge_volt,
-            voltXMax=self.edge_volt,
-            voltYMin=-1 * self.edge_volt,
-            voltYMax=self.edge_volt,
-            xPixels=self.pixel_number,
-            yPixels=self.pixel_number,
-            sawtooth=True,
+            voltXMin=x_offset - self.edge_volt,
+            voltXMax=x_offset + self.edge_volt,
+            voltYMin=y_offset - self.y_edge_volt,
+            voltYMax=y_offset + self.y_edge_volt,
+            xPixels=self.x_pixels,
+            yPixels=self.y_pixels,
+            imAngle=rotation,
+            sawtooth=not self.bidirectional,
+            averagenum=self.averagenum,
         )
+        self.samples_X = raster.samples_X
+        self.samples_Y = raster.samples_Y
         # Calculate number of all samples to feed to daq.
-        self.Totalscansamples = len(self.samples_X) * self.averagenum
+        self.Totalscansamples = raster.galvo_samples.shape[1]
         # Number of samples of each individual line of x scanning, including fly backs.
-        # Devided by pixel number as it's repeated for each y line.
-        self.total_X_sample_number = int(
-            len(self.samples_X) / self.pixel_number
+        self.total_X_sample_number = raster.line_size
+
+        self.Galvo_samples = raster.galvo_samples
+
+        # Gather index of the image pixels in the recorded samples.
+        self.reconstruction = PMTReconstruction(
+            raster.pmt_index,
+            raster.frame_size,
+            self.averagenum,
+            lag_samples(
+                self.Daq_sample_rate,
+                self.x_pixels,
+                sawtooth=not self.bidirectional,
+            ),
+            bidirectional=self.bidirectional,
+            sampleRate=self.Daq_sample_rate,
         )
 
-        self.repeated_samples_X = np.tile(self.samples_X, self.averagenum)
-        self.repeated_samples_Y = np.tile(self.samples_Y, self.averagenum)
+    @property
+    def line_rate(self):
+        """Number of lines scanned per second."""
+        return self.Daq_sample_rate / self.total_X_sample_number
 
-        self.Galvo_samples = np.vstack(
-            (self.repeated_samples_X, self.repeated_samples_Y)
-        )
+    @property
+    def frame_rate(self):
+        """Number of frames scanned per second."""
+        return self.Daq_sample_rate / self.reconstruction.frame_size
+
+    def kymograph(self, output):
+        """
+        Pixels over time of recorded samples, without averaging.
+
+        For line scans every line is a time point at line_rate, otherwise
+        every frame at frame_rate.
+
+        Returns
+        kymograph : np.ndarray
+            Array of shape (time, pixels).
+
+        """
+        return self.reconstruction.kymograph(output, lines=self.line_scan)
 
     def run(self):
         """
         Starts writing a waveform continuously while reading
         the buffer periodically
         """
+        output = self.acquire()
+
+        if self.flag_return_image is True:
+            # Average the frames and cut off the flying back part.
+            self.image_PMT = self.reconstruction.reconstruct(output)
+
+            return self.image_PMT
+
+    def acquire(self):
+        """
+        Scan once and return the recorded PMT samples.
+
+        The samples are reconstructed with self.reconstruction, which can
+        happen on another thread while the next scan runs.
+
+        Returns
+        output : np.ndarray
+            The recorded samples of all frames.
+
+        """
 
-        with nidaqmx.Task() as slave_Task, nidaqmx.Task() as master_Task:
-            slave_Task.ao_channels.add_ao_voltage_chan("/Dev1/ao0:1")
+        daq = daq_backend.get_backend()
+        with static_outputs.timed_output_task(
+            "/Dev1/ao0:1"
+        ) as slave_Task, daq.Task() as master_Task:
             master_Task.ai_channels.add_ai_voltage_chan("/Dev1/ai0")
 
             if self.flag_continuous is False:
@@ -127,8 +228,8 @@ class RasterScan:
                     samps_per_chan=self.Totalscansamples,
                 )
 
-            reader = AnalogSingleChannelReader(master_Task.in_stream)
-            writer = AnalogMultiChannelWriter(slave_Task.out_stream)
+            reader = daq.AnalogSingleChannelReader(master_Task.in_stream)
+            writer = daq.AnalogMultiChannelWriter(slave_Task.out_stream)
 
             reader.auto_start = False
             writer.auto_start = False
@@ -150,30 +251,11 @@ class RasterScan:
                 number_of_samples_per_channel=self.Totalscansamples,
             )
 
-            Dataholder_average = np.mean(
-                output.reshape(self.averagenum, -1), axis=0
-            )
-
-            if self.flag_return_image is True:
-                # Calculate the mean of average frames.
-                self.data_PMT = np.reshape(
-                    Dataholder_average,
-                    (self.pixel_number, self.total_X_sample_number),
-                )
+        # Measure the lag of bidirectional scans on the first frame, before
+        # the samples are handed to other threads.
+        self.reconstruction.update_line_phase(output)
 
-                # Cut off the flying back part.
-                if self.Daq_sample_rate == 500000:
-                    if self.pixel_number == 500:
-                        self.image_PMT = self.data_PMT[:, 50:550] * -1
-                    elif self.pixel_number == 256:
-                        self.image_PMT = self.data_PMT[:, 70:326] * -1
-                elif self.Daq_sample_rate == 250000:
-                    if self.pixel_number == 500:
-                        self.image_PMT = self.data_PMT[:, 25:525] * -1
-                    elif self.pixel_number == 256:
-                        self.image_PMT = self.data_PMT[:, 25:525] * -1
-
-                return self.image_PMT
+        return output
 
 
 class PMT_zscan:
@@ -257,49 +339,93 @@ class PMT_zscan:
             imaging_conditions["edge_volt"],
             imaging_conditions["pixel_number"],
             imaging_conditions["average_number"],
+            bidirectional=imaging_conditions.get("bidirectional", False),
         )
 
     def start_scan(self):
-        for self.each_pos_index in range(len(self.z_stack_positions)):
-            if self.scanning_flag is True:
-                # Go through each position and get image.
-                self.make_PMT_iamge(
-                    round(self.z_stack_positions[self.each_pos_index], 6)
-                )
-            else:
-                break
+        # The planes are reconstructed and saved on worker threads, while the
+        # objective moves on and the next plane is scanned.
+        with PlanePipeline(
+            self.save_PMT_image, workers=2, max_pending=2
+        ) as pipeline:
+            for self.each_pos_index in range(len(self.z_stack_positions)):
+                if self.scanning_flag is True:
+                    # Go through each position and get image.
+                    self.make_PMT_iamge(
+                        round(self.z_stack_positions[self.each_pos_index], 6),
+                        pipeline=pipeline,
+                    )
+                else:
+                    break
 
         self.pi_device_instance.CloseMotorConnection()
 
     def stop_scan(self):
         self.scanning_flag = False
 
-    def make_PMT_iamge(self, obj_position=None):
+    def make_PMT_iamge(self, obj_position=None, pipeline=None):
         """
         Take PMT image at certain objective position.
 
         Parameters
         obj_position : float, optional
             The target objective position. The default is None.
+        pipeline : PlanePipeline, optional
+            Pipeline to reconstruct and save the image on. The default is
+            None, which does it before returning.
 
         """
-
+        plane_start = time.perf_counter()
         if obj_position is not None:
             self.pi_device_instance.move(obj_position)
 
-        # Get the image.
-        self.galvo_image = self.RasterScanins.run()
+        # Get the samples, the move to the next plane can start after this.
+        scan_start = time.perf_counter()
+        samples = self.RasterScanins.acquire()
+        scan_end = time.perf_counter()
 
-        meta_infor = (
-            "index_" + str(self.each_pos_index) + "_pos_" + str(obj_position)
+        if pipeline is None:
+            self.save_PMT_image(self.each_pos_index, obj_position, samples)
+        else:
+            # Blocks while the workers are behind.
+            pipeline.submit(self.each_pos_index, obj_position, samples)
+
+        logging.info(
+            "Plane {} took {:.3f} s, of which {:.3f} s scanning.".format(
+                self.each_pos_index,
+                time.perf_counter() - plane_start,
+                scan_end - scan_start,
+            )
         )
 
-        if True:
-            with skimtiff.TiffWriter(
-                os.path.join(self.saving_dir, meta_infor + ".tif")
-            ) as tif:
-                tif.save(self.galvo_image.astype("float32"), compress=0)
-        time.sleep(0.5)
+    def save_PMT_image(self, pos_index, obj_position, samples):
+        """
+        Reconstruct the image of a plane and save it.
+
+        Parameters
+        pos_index : int
+            Index of the plane in the stack.
+        obj_position : float
+            The objective position of the plane.
+        samples : np.ndarray
+            Samples recorded by RasterScan.acquire.
+
+        Returns
+        galvo_image : np.ndarray
+            The reconstructed image.
+
+        """
+        galvo_image = self.RasterScanins.reconstruction.reconstruct(samples)
+
+        meta_infor = "index_" + str(pos_index) + "_pos_" + str(obj_position)
+
+        with skimtiff.TiffWriter(
+            os.path.join(self.saving_dir, meta_infor + ".tif")
+        ) as tif:
+            tif.save(galvo_image.astype("float32"), compress=0)
+
+        self.galvo_image = galvo_image
+        return galvo_image
 
 
 if __name__ == "__main__":
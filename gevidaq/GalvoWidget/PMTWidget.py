@@ -13,14 +13,16 @@ import numpy as np
 import pyqtgraph as pg
 from PIL import Image
 from PyQt5 import QtWidgets
-from PyQt5.QtCore import QPoint, Qt, pyqtSignal
+from PyQt5.QtCore import QPoint, QPointF, Qt, pyqtSignal
 from PyQt5.QtGui import QColor, QFont, QPen
 from PyQt5.QtWidgets import (
+    QCheckBox,
     QComboBox,
     QDoubleSpinBox,
     QGridLayout,
     QLabel,
     QMessageBox,
+    QPushButton,
     QSpinBox,
     QTabWidget,
     QWidget,
@@ -28,6 +30,7 @@ from PyQt5.QtWidgets import (
 
 from .. import StylishQT
 from ..GeneralUsage.ThreadingFunc import run_in_thread
+from ..NIDAQ import contour_route, galvo_trajectory, pmt_reconstruction
 from ..NIDAQ.constants import HardwareConstants
 from ..NIDAQ.DAQoperator import DAQmission
 from .GalvoScan_backend import PMT_zscan
@@ -126,9 +129,11 @@ class PMTWidgetUI(QWidget):
         self.pmtContourLayout.addWidget(self.pmt_handlenum_Label, 1, 0)
 
         self.contour_strategy = QComboBox()
-        self.contour_strategy.addItems(["Evenly between", "Uniform"])
+        self.contour_strategy.addItems(
+            ["Evenly between", "Uniform", "Time optimal"]
+        )
         self.contour_strategy.setToolTip(
-            "Even in-between: points evenly distribute inbetween handles; Uniform: evenly distribute regardless of handles"
+            "Even in-between: points evenly distribute inbetween handles; Uniform: evenly distribute regardless of handles; Time optimal: fastest smooth contour through the handles within the galvo limits, the number of points follows from the sampling rate"
         )
         self.pmtContourLayout.addWidget(self.contour_strategy, 1, 1)
 
@@ -148,6 +153,13 @@ class PMTWidgetUI(QWidget):
         self.pmtContourLayout.addWidget(self.contour_samprate, 2, 1)
         self.pmtContourLayout.addWidget(QLabel("Sampling rate:"), 2, 0)
 
+        self.contour_route_checkbox = QCheckBox("Plan route")
+        self.contour_route_checkbox.setChecked(True)
+        self.contour_route_checkbox.setToolTip(
+            "Order multiple contours, their start points and directions for the shortest galvo jumps, with speed and acceleration limited moves in between"
+        )
+        self.pmtContourLayout.addWidget(self.contour_route_checkbox, 2, 2)
+
         self.pmtContourLayout.addWidget(QLabel("Contour index:"), 3, 0)
         self.roi_index_spinbox = QSpinBox(self)
         self.roi_index_spinbox.setMinimum(1)
@@ -261,11 +273,11 @@ Left drag + Shift + Ctrl scales the ROI with size snapping"
         controlLayout = QGridLayout()
 
         self.pmt_fps_Label = QLabel("Per frame: ")
-        controlLayout.addWidget(self.pmt_fps_Label, 5, 0)
+        controlLayout.addWidget(self.pmt_fps_Label, 6, 0)
 
         self.saveButton_pmt = StylishQT.saveButton()
         self.saveButton_pmt.clicked.connect(lambda: self.saveimage_pmt())
-        controlLayout.addWidget(self.saveButton_pmt, 5, 1)
+        controlLayout.addWidget(self.saveButton_pmt, 6, 1)
 
         self.startButton_pmt = StylishQT.runButton("")
         self.startButton_pmt.setFixedHeight(32)
@@ -275,7 +287,7 @@ Left drag + Shift + Ctrl scales the ROI with size snapping"
         )
         self.startButton_pmt.clicked.connect(lambda: self.measure_pmt())
 
-        controlLayout.addWidget(self.startButton_pmt, 6, 0)
+        controlLayout.addWidget(self.startButton_pmt, 7, 0)
 
         self.stopButton = StylishQT.stop_deleteButton()
         self.stopButton.setFixedHeight(32)
@@ -284,9 +296,28 @@ Left drag + Shift + Ctrl scales the ROI with size snapping"
         )
         self.stopButton.clicked.connect(lambda: self.stopMeasurement_pmt())
         self.stopButton.setEnabled(False)
-        controlLayout.addWidget(self.stopButton, 6, 1)
+        controlLayout.addWidget(self.stopButton, 7, 1)
 
         # === Galvo scanning ===
+        self.continuous_scanning_bidirectional_checkbox = QCheckBox(
+            "Bidirectional"
+        )
+        self.continuous_scanning_bidirectional_checkbox.setToolTip(
+            "Record on both directions of a triangle wave, the line phase is measured on the first frame."
+        )
+        controlLayout.addWidget(
+            self.continuous_scanning_bidirectional_checkbox, 0, 0
+        )
+
+        self.remeasure_line_phase_button = QPushButton("Measure phase")
+        self.remeasure_line_phase_button.setToolTip(
+            "Measure the line phase of bidirectional scans again on the next frame."
+        )
+        self.remeasure_line_phase_button.clicked.connect(
+            self.remeasure_line_phase
+        )
+        controlLayout.addWidget(self.remeasure_line_phase_button, 0, 1)
+
         self.continuous_scanning_sr_spinbox = QSpinBox(self)
         self.continuous_scanning_sr_spinbox.setMinimum(0)
         self.continuous_scanning_sr_spinbox.setMaximum(1000000)
@@ -320,6 +351,18 @@ Left drag + Shift + Ctrl scales the ROI with size snapping"
         controlLayout.addWidget(self.continuous_scanning_average_spinbox, 4, 1)
         controlLayout.addWidget(QLabel("average over:"), 4, 0)
 
+        self.continuous_scanning_averaging_combobox = QComboBox()
+        self.continuous_scanning_averaging_combobox.addItems(
+            ["sliding", "exponential"]
+        )
+        self.continuous_scanning_averaging_combobox.setToolTip(
+            "sliding: mean of the last frames; exponential: older frames fade out. Updated after every frame."
+        )
+        controlLayout.addWidget(
+            self.continuous_scanning_averaging_combobox, 5, 1
+        )
+        controlLayout.addWidget(QLabel("Averaging:"), 5, 0)
+
         Continuous_widget.setLayout(controlLayout)
 
         # === stack scanning ===
@@ -336,6 +379,11 @@ Left drag + Shift + Ctrl scales the ROI with size snapping"
         )
         Zstack_Layout.addWidget(QLabel("Sampling rate:"), 1, 0)
 
+        self.stack_scanning_bidirectional_checkbox = QCheckBox("Bidirectional")
+        Zstack_Layout.addWidget(
+            self.stack_scanning_bidirectional_checkbox, 0, 0
+        )
+
         self.stack_scanning_Vrange_spinbox = QSpinBox(self)
         self.stack_scanning_Vrange_spinbox.setMinimum(-10)
         self.stack_scanning_Vrange_spinbox.setMaximum(10)
@@ -554,8 +602,13 @@ Left drag + Shift + Ctrl scales the ROI with size snapping"
                 self.Value_xPixels,
                 Value_yPixels,
                 self.averagenum,
+                self.continuous_scanning_averaging_combobox.currentText(),
+                self.continuous_scanning_bidirectional_checkbox.isChecked(),
+            )
+            # The running average is updated after every single frame.
+            time_per_frame_pmt = (
+                Totalscansamples / self.averagenum / self.Daq_sample_rate_pmt
             )
-            time_per_frame_pmt = Totalscansamples / self.Daq_sample_rate_pmt
 
             self.pmtTest.pmtimagingThread.measurement.connect(
                 self.update_pmt_Graphs
@@ -698,6 +751,7 @@ Left drag + Shift + Ctrl scales the ROI with size snapping"
 
         if len(self.contour_ROI_signals_dict) == 1:
             # With only one roi in list
+            self.contour_route = None
             self.final_stacked_voltage_signals = self.contour_ROI_signals_dict[
                 "roi_1"
             ]
@@ -709,9 +763,23 @@ Left drag + Shift + Ctrl scales the ROI with size snapping"
                     self.contour_ROI_signals_dict[each_roi_coordinate]
                 )
 
-            self.final_stacked_voltage_signals = np.concatenate(
-                temp_list, axis=1
-            )
+            if self.contour_route_checkbox.isChecked():
+                # Scan the rois in the order with the shortest jumps.
+                self.contour_route = contour_route.plan_contour_route(
+                    temp_list, sampleRate=int(self.contour_samprate.value())
+                )
+                self.final_stacked_voltage_signals = self.contour_route.signals
+                logging.info(
+                    "Contour route: order {}, {} transition samples".format(
+                        self.contour_route.order,
+                        self.contour_route.transition_samples_number,
+                    )
+                )
+            else:
+                self.contour_route = None
+                self.final_stacked_voltage_signals = np.concatenate(
+                    temp_list, axis=1
+                )
 
         # Number of points in single round of contour scan
         self.points_per_round = len(self.final_stacked_voltage_signals[0])
@@ -818,24 +886,16 @@ Left drag + Shift + Ctrl scales the ROI with size snapping"
                 node_position_array=self.handle_scene_coordinate_position_array,
             )
 
+            # The handles share the points, with a remainder the voltages
+            # are resampled to contour_point_number.
             self.handle_viewbox_coordinate_position_array_expanded = np.zeros(
-                (contour_point_number, 2)
+                self.handle_scene_coordinate_position_array_expanded.shape
             )  # n rows, 2 columns
             # Maps from scene coordinates to the coordinate system displayed inside the ViewBox
-            for i in range(contour_point_number):
-                qpoint_Scene = QPoint(
-                    int(
-                        self.handle_scene_coordinate_position_array_expanded[
-                            i
-                        ][0]
-                    ),
-                    int(
-                        self.handle_scene_coordinate_position_array_expanded[
-                            i
-                        ][1]
-                    ),
-                )
-                qpoint_viewbox = self.pmtvb.mapSceneToView(qpoint_Scene)
+            for i, (x, y) in enumerate(
+                self.handle_scene_coordinate_position_array_expanded
+            ):
+                qpoint_viewbox = self.pmtvb.mapSceneToView(QPointF(x, y))
                 self.handle_viewbox_coordinate_position_array_expanded[
                     i
                 ] = np.array([qpoint_viewbox.x(), qpoint_viewbox.y()])
@@ -871,397 +931,33 @@ Left drag + Shift + Ctrl scales the ROI with size snapping"
         # === Uniform ===
 
         if self.contour_strategy.currentText() == "Uniform":
-            # Calculate the total distance
-            self.total_distance = 0
-            for i in range(self.ROIhandles_nubmer):
-                if i != (self.ROIhandles_nubmer - 1):
-                    Interpolation_x_diff = (
-                        self.handle_scene_coordinate_position_array[i + 1][0]
-                        - self.handle_scene_coordinate_position_array[i][0]
-                    )
-                    Interpolation_y_diff = (
-                        self.handle_scene_coordinate_position_array[i + 1][1]
-                        - self.handle_scene_coordinate_position_array[i][1]
-                    )
-                    distance_vector = (
-                        Interpolation_x_diff**2 + Interpolation_y_diff**2
-                    ) ** (0.5)
-                    self.total_distance = self.total_distance + distance_vector
-                else:
-                    Interpolation_x_diff = (
-                        self.handle_scene_coordinate_position_array[0][0]
-                        - self.handle_scene_coordinate_position_array[-1][0]
-                    )
-                    Interpolation_y_diff = (
-                        self.handle_scene_coordinate_position_array[0][1]
-                        - self.handle_scene_coordinate_position_array[-1][1]
-                    )
-                    distance_vector = (
-                        Interpolation_x_diff**2 + Interpolation_y_diff**2
-                    ) ** (0.5)
-                    self.total_distance = self.total_distance + distance_vector
-
-            self.averaged_uniform_step = (
-                self.total_distance / contour_point_number
+            # Points evenly spaced by arc length along the whole contour,
+            # regardless of the handles, so the scan speed is constant.
+            self.handle_scene_coordinate_position_array_expanded_uniform = (
+                galvo_trajectory.resample_evenly(
+                    self.handle_scene_coordinate_position_array.T,
+                    contour_point_number,
+                ).T
             )
 
-            logging.info(self.averaged_uniform_step)
-            logging.info(self.handle_scene_coordinate_position_array)
-
-            for i in range(self.ROIhandles_nubmer):
-                if i == 0:
-                    Interpolation_x_diff = (
-                        self.handle_scene_coordinate_position_array[i + 1][0]
-                        - self.handle_scene_coordinate_position_array[i][0]
-                    )
-                    Interpolation_y_diff = (
-                        self.handle_scene_coordinate_position_array[i + 1][1]
-                        - self.handle_scene_coordinate_position_array[i][1]
-                    )
-                    distance_vector = (
-                        Interpolation_x_diff**2 + Interpolation_y_diff**2
-                    ) ** (0.5)
-                    num_of_Interpolation = (
-                        distance_vector // self.averaged_uniform_step
-                    )
-
-                    self.Interpolation_remaining_fornextround = (
-                        self.averaged_uniform_step
-                        * (
-                            1
-                            - (
-                                distance_vector / self.averaged_uniform_step
-                                - num_of_Interpolation
-                            )
-                        )
-                    )
-                    logging.info(
-                        "Interpolation_remaining_fornextround: "
-                        + str(self.Interpolation_remaining_fornextround)
-                    )
-                    self.Interpolation_x_step = Interpolation_x_diff / (
-                        distance_vector / self.averaged_uniform_step
-                    )
-                    self.Interpolation_y_step = Interpolation_y_diff / (
-                        distance_vector / self.averaged_uniform_step
-                    )
-
-                    Interpolation_temp = np.array(
-                        [
-                            [
-                                self.handle_scene_coordinate_position_array[i][
-                                    0
-                                ],
-                                self.handle_scene_coordinate_position_array[i][
-                                    1
-                                ],
-                            ],
-                            [
-                                self.handle_scene_coordinate_position_array[
-                                    i + 1
-                                ][0],
-                                self.handle_scene_coordinate_position_array[
-                                    i + 1
-                                ][1],
-                            ],
-                        ]
-                    )
-
-                    for j in range(int(num_of_Interpolation)):
-                        Interpolation_temp = np.insert(
-                            Interpolation_temp,
-                            -1,
-                            [
-                                self.handle_scene_coordinate_position_array[i][
-                                    0
-                                ]
-                                + (j + 1) * self.Interpolation_x_step,
-                                self.handle_scene_coordinate_position_array[
-                                    i + 1
-                                ][1]
-                                + (j + 1) * self.Interpolation_y_step,
-                            ],
-                            axis=0,
-                        )
-                    Interpolation_temp = np.delete(
-                        Interpolation_temp, -1, axis=0
-                    )
-
-                    self.handle_scene_coordinate_position_array_expanded_uniform = (
-                        Interpolation_temp
-                    )
-
-                elif i != (self.ROIhandles_nubmer - 1):
-                    Interpolation_x_diff = (
-                        self.handle_scene_coordinate_position_array[i + 1][0]
-                        - self.handle_scene_coordinate_position_array[i][0]
-                    )
-                    Interpolation_y_diff = (
-                        self.handle_scene_coordinate_position_array[i + 1][1]
-                        - self.handle_scene_coordinate_position_array[i][1]
-                    )
-                    distance_vector = (
-                        Interpolation_x_diff**2 + Interpolation_y_diff**2
-                    ) ** (0.5)
-                    num_of_Interpolation = (
-                        distance_vector
-                        - self.Interpolation_remaining_fornextround
-                    ) // self.averaged_uniform_step
-                    logging.info(
-                        "Interpolation_remaining_fornextround: "
-                        + str(self.Interpolation_remaining_fornextround)
-                    )
-
-                    if self.Interpolation_remaining_fornextround != 0:
-                        self.Interpolation_remaining_fornextround_x = (
-                            Interpolation_x_diff
-                            / (
-                                distance_vector
-                                / self.Interpolation_remaining_fornextround
-                            )
-                        )
-                        self.Interpolation_remaining_fornextround_y = (
-                            Interpolation_y_diff
-                            / (
-                                distance_vector
-                                / self.Interpolation_remaining_fornextround
-                            )
-                        )
-                    else:
-                        self.Interpolation_remaining_fornextround_x = 0
-                        self.Interpolation_remaining_fornextround_y = 0
-
-                    # Reset the starting point
-                    Interpolation_x_diff = (
-                        self.handle_scene_coordinate_position_array[i + 1][0]
-                        - self.handle_scene_coordinate_position_array[i][0]
-                        - self.Interpolation_remaining_fornextround_x
-                    )
-                    Interpolation_y_diff = (
-                        self.handle_scene_coordinate_position_array[i + 1][1]
-                        - self.handle_scene_coordinate_position_array[i][1]
-                        - self.Interpolation_remaining_fornextround_y
-                    )
-
-                    self.Interpolation_x_step = Interpolation_x_diff / (
-                        (
-                            distance_vector
-                            - self.Interpolation_remaining_fornextround
-                        )
-                        / self.averaged_uniform_step
-                    )
-                    self.Interpolation_y_step = Interpolation_y_diff / (
-                        (
-                            distance_vector
-                            - self.Interpolation_remaining_fornextround
-                        )
-                        / self.averaged_uniform_step
-                    )
-
-                    Interpolation_temp = np.array(
-                        [
-                            [
-                                self.handle_scene_coordinate_position_array[i][
-                                    0
-                                ]
-                                + self.Interpolation_remaining_fornextround_x,
-                                self.handle_scene_coordinate_position_array[i][
-                                    1
-                                ]
-                                + self.Interpolation_remaining_fornextround_y,
-                            ],
-                            [
-                                self.handle_scene_coordinate_position_array[
-                                    i + 1
-                                ][0],
-                                self.handle_scene_coordinate_position_array[
-                                    i + 1
-                                ][1],
-                            ],
-                        ]
-                    )
-
-                    for j in range(int(num_of_Interpolation)):
-                        Interpolation_temp = np.insert(
-                            Interpolation_temp,
-                            -1,
-                            [
-                                self.handle_scene_coordinate_position_array[i][
-                                    0
-                                ]
-                                + self.Interpolation_remaining_fornextround_x
-                                + (j + 1) * self.Interpolation_x_step,
-                                self.handle_scene_coordinate_position_array[i][
-                                    1
-                                ]
-                                + self.Interpolation_remaining_fornextround_y
-                                + (j + 1) * self.Interpolation_y_step,
-                            ],
-                            axis=0,
-                        )
-                    Interpolation_temp = np.delete(
-                        Interpolation_temp, -1, axis=0
-                    )
-
-                    self.handle_scene_coordinate_position_array_expanded_uniform = np.append(
-                        self.handle_scene_coordinate_position_array_expanded_uniform,
-                        Interpolation_temp,
-                        axis=0,
-                    )
-
-                    self.Interpolation_remaining_fornextround = (
-                        self.averaged_uniform_step
-                        * (
-                            1
-                            - (
-                                (
-                                    distance_vector
-                                    - self.Interpolation_remaining_fornextround
-                                )
-                                / self.averaged_uniform_step
-                                - num_of_Interpolation
-                            )
-                        )
-                    )
-
-                else:  # connect the first and the last
-                    Interpolation_x_diff = (
-                        self.handle_scene_coordinate_position_array[0][0]
-                        - self.handle_scene_coordinate_position_array[-1][0]
-                    )
-                    Interpolation_y_diff = (
-                        self.handle_scene_coordinate_position_array[0][1]
-                        - self.handle_scene_coordinate_position_array[-1][1]
-                    )
-                    distance_vector = (
-                        Interpolation_x_diff**2 + Interpolation_y_diff**2
-                    ) ** (0.5)
-                    num_of_Interpolation = (
-                        distance_vector
-                        - self.Interpolation_remaining_fornextround
-                    ) // self.averaged_uniform_step
-
-                    self.Interpolation_remaining_fornextround_x = (
-                        self.Interpolation_remaining_fornextround
-                        / distance_vector
-                    ) * Interpolation_x_diff
-                    self.Interpolation_remaining_fornextround_y = (
-                        self.Interpolation_remaining_fornextround
-                        / distance_vector
-                    ) * Interpolation_y_diff
-
-                    # Reset the starting point
-                    Interpolation_x_diff = (
-                        self.handle_scene_coordinate_position_array[0][0]
-                        - self.handle_scene_coordinate_position_array[i][0]
-                        + self.Interpolation_remaining_fornextround_x
-                    )
-                    Interpolation_y_diff = (
-                        self.handle_scene_coordinate_position_array[0][1]
-                        - self.handle_scene_coordinate_position_array[i][1]
-                        + self.Interpolation_remaining_fornextround_y
-                    )
-
-                    self.Interpolation_x_step = Interpolation_x_diff / (
-                        (
-                            distance_vector
-                            - self.Interpolation_remaining_fornextround
-                        )
-                        / self.averaged_uniform_step
-                    )
-                    self.Interpolation_y_step = Interpolation_y_diff / (
-                        (
-                            distance_vector
-                            - self.Interpolation_remaining_fornextround
-                        )
-                        / self.averaged_uniform_step
-                    )
-
-                    Interpolation_temp = np.array(
-                        [
-                            [
-                                self.handle_scene_coordinate_position_array[
-                                    -1
-                                ][0]
-                                + self.Interpolation_remaining_fornextround_x,
-                                self.handle_scene_coordinate_position_array[
-                                    -1
-                                ][1]
-                                + self.Interpolation_remaining_fornextround_y,
-                            ],
-                            [
-                                self.handle_scene_coordinate_position_array[0][
-                                    0
-                                ],
-                                self.handle_scene_coordinate_position_array[0][
-                                    1
-                                ],
-                            ],
-                        ]
-                    )
-
-                    for j in range(int(num_of_Interpolation)):
-                        Interpolation_temp = np.insert(
-                            Interpolation_temp,
-                            -1,
-                            [
-                                self.handle_scene_coordinate_position_array[
-                                    -1
-                                ][0]
-                                + self.Interpolation_remaining_fornextround_x
-                                + (j + 1) * self.Interpolation_x_step,
-                                self.handle_scene_coordinate_position_array[
-                                    -1
-                                ][1]
-                                + self.Interpolation_remaining_fornextround_y
-                                + (j + 1) * self.Interpolation_y_step,
-                            ],
-                            axis=0,
-                        )
-                    Interpolation_temp = np.delete(
-                        Interpolation_temp, -1, axis=0
-                    )
-
-                    self.handle_scene_coordinate_position_array_expanded_uniform = np.append(
-                        self.handle_scene_coordinate_position_array_expanded_uniform,
-                        Interpolation_temp,
-                        axis=0,
-                    )
-
-            logging.info(
-                self.handle_scene_coordinate_position_array_expanded_uniform
-            )
-            logging.info(
-                self.handle_scene_coordinate_position_array_expanded_uniform.shape
-            )
-            # %%
-
             self.handle_viewbox_coordinate_position_array_expanded = np.zeros(
                 (contour_point_number, 2)
             )  # n rows, 2 columns
             # Maps from scene coordinates to the coordinate system displayed inside the ViewBox
-            for i in range(contour_point_number):
-                qpoint_Scene = QPoint(
-                    self.handle_scene_coordinate_position_array_expanded_uniform[
-                        i
-                    ][
-                        0
-                    ],
-                    self.handle_scene_coordinate_position_array_expanded_uniform[
-                        i
-                    ][
-                        1
-                    ],
-                )
-                qpoint_viewbox = self.pmtvb.mapSceneToView(qpoint_Scene)
+            for i, (x, y) in enumerate(
+                self.handle_scene_coordinate_position_array_expanded_uniform
+            ):
+                qpoint_viewbox = self.pmtvb.mapSceneToView(QPointF(x, y))
                 self.handle_viewbox_coordinate_position_array_expanded[
                     i
                 ] = np.array([qpoint_viewbox.x(), qpoint_viewbox.y()])
 
             """Transform into Voltages to galvos"""
 
-            self.handle_viewbox_coordinate_position_array_expanded_x,
-            self.handle_viewbox_coordinate_position_array_expanded_y = self.convert_coordinates_to_voltage(
+            (
+                self.handle_viewbox_coordinate_position_array_expanded_x,
+                self.handle_viewbox_coordinate_position_array_expanded_y,
+            ) = self.convert_coordinates_to_voltage(
                 Value_xPixels=self.Value_xPixels,
                 Value_voltXMax=self.Value_voltXMax,
                 contour_point_number=contour_point_number,
@@ -1283,6 +979,50 @@ Left drag + Shift + Ctrl scales the ROI with size snapping"
                 self.handle_viewbox_coordinate_position_array_expanded_y,
             )
 
+        # === Time optimal ===
+
+        if self.contour_strategy.currentText() == "Time optimal":
+            handle_viewbox_coordinates = np.zeros((self.ROIhandles_nubmer, 2))
+            for i in range(self.ROIhandles_nubmer):
+                qpoint_viewbox = self.pmtvb.mapSceneToView(
+                    self.handle_scene_coordinate_position_raw_list[i][1]
+                )
+                handle_viewbox_coordinates[i] = np.array(
+                    [qpoint_viewbox.x(), qpoint_viewbox.y()]
+                )
+
+            (
+                handle_voltage_x,
+                handle_voltage_y,
+            ) = self.convert_coordinates_to_voltage(
+                Value_xPixels=self.Value_xPixels,
+                Value_voltXMax=self.Value_voltXMax,
+                contour_point_number=self.ROIhandles_nubmer,
+                handle_viewbox_coordinates=handle_viewbox_coordinates,
+            )
+
+            # Spline through the handles, scanned as fast as the galvos can.
+            trajectory = galvo_trajectory.plan_trajectory(
+                np.vstack((handle_voltage_x, handle_voltage_y)),
+                self.Daq_sample_rate_pmt,
+                closed=True,
+                spline=True,
+            )
+            current_stacked_voltage_signals = np.around(
+                trajectory.signals, decimals=3
+            )
+            logging.info(
+                "Time optimal contour: {} points, {:.1f} rounds/s".format(
+                    trajectory.signals.shape[1], trajectory.repetition_rate
+                )
+            )
+            self.MessageToMainGUI(
+                "Time optimal contour: {} points, {:.1f} Hz".format(
+                    trajectory.signals.shape[1], trajectory.repetition_rate
+                )
+                + "\n"
+            )
+
         resequenced_stacked_voltage_signals = current_stacked_voltage_signals
         logging.info(resequenced_stacked_voltage_signals)
 
@@ -1292,7 +1032,9 @@ Left drag + Shift + Ctrl scales the ROI with size snapping"
         self, node_number, point_num_per_line, node_position_array
     ):
         """
-        Interpolate evenly in between roi handles
+        Interpolate evenly in between roi handles, every line between two
+        handles gets the same number of points. For points evenly spaced
+        along the whole contour see galvo_trajectory.resample_evenly.
 
         Parameters
         node_number : int
@@ -1300,113 +1042,28 @@ Left drag + Shift + Ctrl scales the ROI with size snapping"
         point_num_per_line : int
             Number of points per line desired.
         node_position_array : np.array
-            DESCRIPTION.
+            Handle positions, (n,2), 2 columns.
 
         Returns
         interpolated_array. (n,2), 2 columns
 
         """
-        # === Interpolation from first to last ===
-        for i in range(node_number - 1):
-            Interpolation_x_diff = (
-                node_position_array[i + 1][0] - node_position_array[i][0]
-            )
-            Interpolation_y_diff = (
-                node_position_array[i + 1][1] - node_position_array[i][1]
-            )
-
-            Interpolation_x_step = Interpolation_x_diff / point_num_per_line
-            Interpolation_y_step = Interpolation_y_diff / point_num_per_line
-
-            Interpolation_temp = np.array(
-                [
-                    [
-                        node_position_array[i][0],
-                        node_position_array[i][1],
-                    ],
-                    [
-                        node_position_array[i + 1][0],
-                        node_position_array[i + 1][1],
-                    ],
-                ]
-            )
-
-            for j in range(point_num_per_line - 1):
-                Interpolation_temp = np.insert(
-                    Interpolation_temp,
-                    1,
-                    [
-                        node_position_array[i + 1][0]
-                        - (j + 1) * Interpolation_x_step,
-                        node_position_array[i + 1][1]
-                        - (j + 1) * Interpolation_y_step,
-                    ],
-                    axis=0,
-                )
-            Interpolation_temp = np.delete(Interpolation_temp, 0, 0)
-            if i == 0:
-                interpolated_array = Interpolation_temp
-            else:
-                interpolated_array = np.append(
-                    interpolated_array,
-                    Interpolation_temp,
-                    axis=0,
-                )
-
-        # Interpolation between last and first
-        Interpolation_x_diff = (
-            node_position_array[0][0] - node_position_array[-1][0]
-        )
-        Interpolation_y_diff = (
-            node_position_array[0][1] - node_position_array[-1][1]
-        )
-
-        Interpolation_x_step = Interpolation_x_diff / point_num_per_line
-        Interpolation_y_step = Interpolation_y_diff / point_num_per_line
-
-        Interpolation_temp = np.array(
-            [
-                [
-                    node_position_array[-1][0],
-                    node_position_array[-1][1],
-                ],
-                [
-                    node_position_array[0][0],
-                    node_position_array[0][1],
-                ],
-            ]
-        )
-
-        for j in range(point_num_per_line - 1):
-            Interpolation_temp = np.insert(
-                Interpolation_temp,
-                1,
-                [
-                    node_position_array[0][0] - (j + 1) * Interpolation_x_step,
-                    node_position_array[0][1] - (j + 1) * Interpolation_y_step,
-                ],
-                axis=0,
-            )
-        Interpolation_temp = np.delete(Interpolation_temp, 0, 0)
-        # Interpolation_temp = np.flip(Interpolation_temp, 0)
-
-        interpolated_array = np.append(
-            interpolated_array,
-            Interpolation_temp,
-            axis=0,
-        )
-
-        # === The first placed handle is at the end, put back to front. ===
+        # Every line goes from a handle to the next one, the last line back
+        # to the first handle. A line has its start handle and the points
+        # up to the next handle.
+        start_nodes = np.asarray(node_position_array, dtype=float)[
+            :node_number
+        ]
+        end_nodes = np.roll(start_nodes, -1, axis=0)
+        fractions = np.arange(point_num_per_line) / point_num_per_line
 
-        interpolated_array_modified = np.zeros(
-            [interpolated_array.shape[0], interpolated_array.shape[1]]
+        interpolated_array = (
+            start_nodes[:, np.newaxis, :]
+            + fractions[np.newaxis, :, np.newaxis]
+            * (end_nodes - start_nodes)[:, np.newaxis, :]
         )
-        interpolated_array_modified[0, :] = interpolated_array[-1, :]
-        interpolated_array_modified[
-            1 : interpolated_array.shape[0], :
-        ] = interpolated_array[0 : interpolated_array.shape[0] - 1, :]
 
-        return interpolated_array_modified
+        return interpolated_array.reshape(-1, 2)
 
     def convert_coordinates_to_voltage(
         self,
@@ -1444,25 +1101,28 @@ Left drag + Shift + Ctrl scales the ROI with size snapping"
                 handle_viewbox_coordinates[:, 1] = (
                     (handle_viewbox_coordinates[:, 1]) / 500
                 ) * 6 - 3
+                # Exactly contour_point_number points, evenly spaced along
+                # the contour if there are more or fewer coordinates.
+                if handle_viewbox_coordinates.shape[0] != contour_point_number:
+                    handle_viewbox_coordinates = (
+                        galvo_trajectory.resample_evenly(
+                            handle_viewbox_coordinates.T, contour_point_number
+                        ).T
+                    )
                 handle_viewbox_coordinates = np.around(
                     handle_viewbox_coordinates,
                     decimals=3,
                 )
                 # shape into (n,) and stack
-                transformed_x = np.resize(
-                    handle_viewbox_coordinates[:, 0],
-                    (contour_point_number,),
-                )
-                transformed_y = np.resize(
-                    handle_viewbox_coordinates[:, 1],
-                    (contour_point_number,),
-                )
+                transformed_x = handle_viewbox_coordinates[:, 0]
+                transformed_y = handle_viewbox_coordinates[:, 1]
 
         return transformed_x, transformed_y
 
     def speed_acceleration_check(self, sampling_rate, trace_x, trace_y):
         """
-        Check the speed and acceleration of galvos
+        Check the speed and acceleration of galvos, if they are too high
+        the warning tells how fast the contour can be scanned.
 
         Parameters
         sampling_rate : int
@@ -1476,45 +1136,48 @@ Left drag + Shift + Ctrl scales the ROI with size snapping"
         None.
 
         """
-        time_gap = 1 / sampling_rate
-        contour_x_speed = np.diff(trace_x) / time_gap
-        contour_y_speed = np.diff(trace_y) / time_gap
-
-        contour_x_acceleration = np.diff(contour_x_speed) / time_gap
-        contour_y_acceleration = np.diff(contour_y_speed) / time_gap
+        speed, acceleration = galvo_trajectory.measure_limits(
+            np.vstack((trace_x, trace_y)), sampling_rate
+        )
 
         constants = HardwareConstants()
         speedGalvo = constants.maxGalvoSpeed  # Volt/s
         aGalvo = constants.maxGalvoAccel  # Acceleration galvo in volt/s^2
 
         logging.info(
-            str(np.mean(abs(contour_x_speed)))
-            + " and mean y speed:"
-            + str(np.mean(abs(contour_y_speed)))
+            "Max x speed: {} and max y speed: {}".format(speed[0], speed[1])
         )
         logging.info(
-            str(np.mean(abs(contour_x_acceleration)))
-            + " and mean y acceleration:"
-            + str(np.mean(abs(contour_y_acceleration)))
+            "Max x acceleration: {} and max y acceleration: {}".format(
+                acceleration[0], acceleration[1]
+            )
         )
 
-        if speedGalvo > np.amax(abs(contour_x_speed)) and speedGalvo > np.amax(
-            abs(contour_y_speed)
-        ):
+        speed_ok = np.all(speed < speedGalvo)
+        acceleration_ok = np.all(acceleration < aGalvo)
+        if speed_ok:
             logging.info("Contour speed is OK")
             self.MessageToMainGUI("Contour speed is OK" + "\n")
-        else:
-            QMessageBox.warning(
-                self, "OverLoad", "Speed too high!", QMessageBox.Ok
-            )
-        if aGalvo > np.amax(abs(contour_x_acceleration)) and aGalvo > np.amax(
-            abs(contour_y_acceleration)
-        ):
+        if acceleration_ok:
             logging.info("Contour acceleration is OK")
             self.MessageToMainGUI("Contour acceleration is OK" + "\n")
-        else:
+
+        if not (speed_ok and acceleration_ok):
+            # Tell how fast the same contour can go.
+            trajectory = galvo_trajectory.plan_trajectory(
+                np.vstack((trace_x, trace_y)), sampling_rate, closed=True
+            )
             QMessageBox.warning(
-                self, "OverLoad", "Acceleration too high!", QMessageBox.Ok
+                self,
+                "OverLoad",
+                "{} too high! Within the galvo limits the contour takes at "
+                "least {} points, {:.1f} rounds/s, or use the Time optimal "
+                "contour.".format(
+                    "Speed" if not speed_ok else "Acceleration",
+                    trajectory.signals.shape[1],
+                    trajectory.repetition_rate,
+                ),
+                QMessageBox.Ok,
             )
 
     def emit_contour_signal(self):
@@ -1551,6 +1214,7 @@ Left drag + Shift + Ctrl scales the ROI with size snapping"
             "edge_volt": self.stack_scanning_Vrange_spinbox.value(),
             "pixel_number": self.stack_scanning_Pnumber_spinbox.value(),
             "average_number": self.stack_scanning_Avgnumber_spinbox.value(),
+            "bidirectional": self.stack_scanning_bidirectional_checkbox.isChecked(),
         }
 
         self.zstack_ins = PMT_zscan(
@@ -1568,6 +1232,13 @@ Left drag + Shift + Ctrl scales the ROI with size snapping"
         """Stop the seal test."""
         self.pmtTest.aboutToQuitHandler()
 
+    def remeasure_line_phase(self):
+        """Forget the measured line phases, also of a running scan."""
+        pmt_reconstruction.LINE_PHASE_LAG_SAMPLES.clear()
+        thread = getattr(self.pmtTest, "pmtimagingThread", None)
+        if thread is not None:
+            thread.reconstruction.remeasure_line_phase()
+
     def stopMeasurement_pmt_contour(self):
         """Stop the seal test."""
         self.pmtTest_contour.aboutToQuitHandler()
@@ -11,11 +11,14 @@ import logging
 
 import nidaqmx
 import numpy as np
-from nidaqmx.stream_readers import AnalogSingleChannelReader
-from nidaqmx.stream_writers import AnalogMultiChannelWriter
 from PyQt5.QtCore import QThread, pyqtSignal
 
-from ..NIDAQ import wavegenerator
+from ..NIDAQ import daq_backend, raster_cache, static_outputs
+from ..NIDAQ.pmt_reconstruction import (
+    PMTReconstruction,
+    RollingAverage,
+    lag_samples,
+)
 
 # For continuous raster scanning
 
@@ -32,13 +35,18 @@ class pmtimaging_continuous_Thread(QThread):
         readNumber,
         averagenumber,
         ScanArrayXnum,
+        reconstruction=None,
+        averaging="sliding",
         *args,
         **kwargs,
     ):
         """
         wave is the output data
         sampleRate is the sampleRate of the DAQ
-        readNumber is the
+        readNumber is the number of samples of all averaged frames
+        reconstruction is the PMTReconstruction of the raster, by default
+        a square image is assumed
+        averaging is the RollingAverage mode, "sliding" or "exponential"
         """
         super().__init__(*args, **kwargs)
 
@@ -50,6 +58,17 @@ class pmtimaging_continuous_Thread(QThread):
             (self.readNumber / self.averagenumber) / self.ScanArrayXnum
         )
 
+        if reconstruction is None:
+            reconstruction = PMTReconstruction.from_line_geometry(
+                self.sampleRate,
+                self.ScanArrayXnum,
+                self.ypixelnumber,
+                self.ypixelnumber,
+                averagenum=self.averagenumber,
+            )
+        self.reconstruction = reconstruction
+        self.averaging = averaging
+
         self.wave = wave
 
     def run(self):
@@ -59,9 +78,11 @@ class pmtimaging_continuous_Thread(QThread):
         """
 
         # DAQ
-        with nidaqmx.Task() as slave_Task3, nidaqmx.Task() as master_Task:
+        daq = daq_backend.get_backend()
+        with static_outputs.timed_output_task(
+            "/Dev1/ao0:1"
+        ) as slave_Task3, daq.Task() as master_Task:
             # slave_Task3 = nidaqmx.Task()
-            slave_Task3.ao_channels.add_ao_voltage_chan("/Dev1/ao0:1")
             master_Task.ai_channels.add_ai_voltage_chan("/Dev1/ai0")
 
             slave_Task3.timing.cfg_samp_clk_timing(
@@ -77,8 +98,8 @@ class pmtimaging_continuous_Thread(QThread):
                 samps_per_chan=self.readNumber,
             )
 
-            reader = AnalogSingleChannelReader(master_Task.in_stream)
-            writer = AnalogMultiChannelWriter(slave_Task3.out_stream)
+            reader = daq.AnalogSingleChannelReader(master_Task.in_stream)
+            writer = daq.AnalogMultiChannelWriter(slave_Task3.out_stream)
 
             reader.auto_start = False
             writer.auto_start = False
@@ -90,35 +111,31 @@ class pmtimaging_continuous_Thread(QThread):
             This way the task will have to wait slightly longer for incoming samples. And leaves the buffer
             entirely clean. This way we always know the correct numpy size and are always left with an empty
             buffer (and the buffer will not slowly fill up)."""
-            output = np.zeros(self.readNumber)
+            # Read one frame at a time and show the running average of the
+            # last frames after each, instead of waiting for all frames to
+            # average. All buffers are allocated once.
+            frame_size = self.reconstruction.frame_size
+            output = np.zeros(frame_size)
+            frame = np.zeros(self.reconstruction.shape)
+            average = RollingAverage(
+                self.reconstruction.shape,
+                window=self.averagenumber,
+                mode=self.averaging,
+            )
             slave_Task3.start()  # Will wait for the readtask to start so it can use its clock
             master_Task.start()
             while not self.isInterruptionRequested():
                 reader.read_many_sample(
-                    data=output, number_of_samples_per_channel=self.readNumber
+                    data=output, number_of_samples_per_channel=frame_size
                 )
 
-                # Emiting the data just received as a signal
-
-                Dataholder_average = np.mean(
-                    output.reshape(self.averagenumber, -1), axis=0
-                )
-
-                self.data_PMT = np.reshape(
-                    Dataholder_average, (self.ypixelnumber, self.ScanArrayXnum)
-                )
-
-                if self.sampleRate == 500000:
-                    if self.ypixelnumber == 500:
-                        self.data_PMT = self.data_PMT[:, 50:550] * -1
-                    elif self.ypixelnumber == 256:
-                        self.data_PMT = self.data_PMT[:, 70:326] * -1
-                elif self.sampleRate == 250000:
-                    if self.ypixelnumber == 500:
-                        self.data_PMT = self.data_PMT[:, 25:525] * -1
-                    elif self.ypixelnumber == 256:
-                        self.data_PMT = self.data_PMT[:, 25:525] * -1
+                # Measure the lag of bidirectional scans on the first frame.
+                self.reconstruction.update_line_phase(output)
+                # Cut off the flying back part and update the average.
+                self.reconstruction.reconstruct_frame(output, out=frame)
+                self.data_PMT = average.add(frame)
 
+                # Emiting the data just received as a signal
                 self.measurement.emit(self.data_PMT)
 
 
@@ -136,6 +153,8 @@ class pmtimagingTest:
         Value_xPixels,
         Value_yPixels,
         averagenum,
+        averaging="sliding",
+        bidirectional=False,
     ):
         self.Daq_sample_rate = Daq_sample_rate
         self.averagenum = averagenum
@@ -144,34 +163,38 @@ class pmtimagingTest:
         self.offsetsamples_galvo = []
 
         # Generate galvo samples
-        self.samples_1, self.samples_2 = wavegenerator.waveRecPic(
+        raster = raster_cache.get_raster(
             sampleRate=self.Daq_sample_rate,
-            imAngle=0,
             voltXMin=Value_voltXMin,
             voltXMax=Value_voltXMax,
             voltYMin=Value_voltYMin,
             voltYMax=Value_voltYMax,
             xPixels=Value_xPixels,
             yPixels=Value_yPixels,
-            sawtooth=True,
-        )
-        # ScanArrayX = wavegenerator.xValuesSingleSawtooth(sampleRate = Daq_sample_rate, voltXMin = Value_voltXMin, voltXMax = Value_voltXMax, xPixels = Value_xPixels, sawtooth = True)
-        self.Totalscansamples = (
-            len(self.samples_1) * self.averagenum
-        )  # Calculate number of samples to feed to scanner, by default it's one frame
-        self.ScanArrayXnum = int(
-            len(self.samples_1) / Value_yPixels
-        )  # number of samples of each individual line of x scanning
-        # print(self.ScanArrayXnum)
-        # print(self.Digital_container_feeder[:, 0])
-
-        self.repeated_samples_1 = np.tile(self.samples_1, self.averagenum)
-        self.repeated_samples_2_yaxis = np.tile(
-            self.samples_2, self.averagenum
+            imAngle=0,
+            sawtooth=not bidirectional,
+            averagenum=self.averagenum,
         )
-
-        self.Galvo_samples = np.vstack(
-            (self.repeated_samples_1, self.repeated_samples_2_yaxis)
+        self.samples_1 = raster.samples_X
+        self.samples_2 = raster.samples_Y
+        # Calculate number of samples to feed to scanner, by default it's one frame
+        self.Totalscansamples = raster.galvo_samples.shape[1]
+        # number of samples of each individual line of x scanning
+        self.ScanArrayXnum = raster.line_size
+
+        self.Galvo_samples = raster.galvo_samples
+
+        reconstruction = PMTReconstruction(
+            raster.pmt_index,
+            raster.frame_size,
+            self.averagenum,
+            lag_samples(
+                self.Daq_sample_rate,
+                Value_xPixels,
+                sawtooth=not bidirectional,
+            ),
+            bidirectional=bidirectional,
+            sampleRate=self.Daq_sample_rate,
         )
 
         self.pmtimagingThread = pmtimaging_continuous_Thread(
@@ -180,6 +203,8 @@ class pmtimagingTest:
             self.Totalscansamples,
             self.averagenum,
             self.ScanArrayXnum,
+            reconstruction,
+            averaging,
         )
         # self.pmtimagingThread.wave = self.Galvo_samples
         return self.Totalscansamples
@@ -244,9 +269,11 @@ class pmtimaging_continuous_Thread_contour(QThread):
         """
 
         # DAQ
-        with nidaqmx.Task() as slave_Task3, nidaqmx.Task() as master_Task:
+        daq = daq_backend.get_backend()
+        with static_outputs.timed_output_task(
+            "/Dev1/ao0:1"
+        ) as slave_Task3, daq.Task() as master_Task:
             # slave_Task3 = nidaqmx.Task()
-            slave_Task3.ao_channels.add_ao_voltage_chan("/Dev1/ao0:1")
             master_Task.ai_channels.add_ai_voltage_chan("/Dev1/ai0")
 
             slave_Task3.timing.cfg_samp_clk_timing(
@@ -262,8 +289,8 @@ class pmtimaging_continuous_Thread_contour(QThread):
                 samps_per_chan=self.readNumber,
             )
 
-            reader = AnalogSingleChannelReader(master_Task.in_stream)
-            writer = AnalogMultiChannelWriter(slave_Task3.out_stream)
+            reader = daq.AnalogSingleChannelReader(master_Task.in_stream)
+            writer = daq.AnalogMultiChannelWriter(slave_Task3.out_stream)
 
             reader.auto_start = False
             writer.auto_start = False
@@ -6,16 +6,12 @@ Created on Wed May 27 17:14:53 2020
 @author: xinmeng
 """
 import ctypes
-import importlib.resources
 import logging
-import sys
 import threading
 import time
 
-import numpy as np
-import tifffile as skimtiff
-
 from . import HamamatsuDCAM
+from .frame_recorder import FrameRecorder
 
 # Script based Hamamatsu camera operations
 
@@ -48,15 +44,14 @@ class CamActuator:
         self.isLiving = False
         self.isStreaming = False
         self.isSaving = False
+        self.recorder = None
         self.metaData = "Hamamatsu C13440-20CU "
 
     def initializeCamera(self):
         # Initialize the camera
         # Set default camera properties.
-        files = importlib.resources.files(sys.modules[__package__])
-        traversable = files.joinpath("19_12/dcamapi.dll")
-        with importlib.resources.as_file(traversable) as path:
-            self.dcam = ctypes.WinDLL(str(path))
+        # dcamapi.dll, or the simulator selected by GEVIDAQ_DCAM_BACKEND.
+        self.dcam = HamamatsuDCAM.dcam
 
         paraminit = HamamatsuDCAM.DCAMAPI_INIT(0, 0, 0, 0, None, None)
         paraminit.size = ctypes.sizeof(paraminit)
@@ -176,15 +171,13 @@ class CamActuator:
                 dims,
             ] = (
                 self.hcam.getFrames()
-            )  # frames is a list with HCamData type, with np_array being the image.
+            )  # frames is a list of 2D views into the camera buffers.
             for aframe in frames:
-                video_list.append(aframe.np_array)
+                video_list.append(aframe)
                 imageCount += 1
 
-        if len(video_list) > 1:
-            ImageSnapped = np.resize(video_list[-1], (dims[1], dims[0]))
-        else:
-            ImageSnapped = np.resize(video_list[0], (dims[1], dims[0]))
+        # Copy the image out of the camera buffers before they are released.
+        ImageSnapped = video_list[-1].copy()
 
         self.hcam.stopAcquisition()
 
@@ -202,10 +195,8 @@ class CamActuator:
                 dims,
             ] = (
                 self.hcam.getFrames()
-            )  # frames is a list with HCamData type, with np_array being the image.
-            self.Live_image = np.resize(
-                frames[-1].np_array, (dims[1], dims[0])
-            )
+            )  # frames is a list of 2D views into the camera buffers.
+            self.Live_image = frames[-1].copy()
 
             self.subarray_vsize = dims[1]
             self.subarray_hsize = dims[0]
@@ -215,10 +206,12 @@ class CamActuator:
         # Stop the acquisition
         self.hcam.stopAcquisition()
 
-    def StartStreaming(self, BufferNumber, **kwargs):
+    def StartStreaming(self, BufferNumber, saving_dir=None, **kwargs):
         # Start the camera video streaming.
         # - trigger_source: specify the camera trigger mode.
         # - BufferNumber: number of frames assigned for video.
+        # - saving_dir: tif file the frames are written to while acquiring,
+        # see frame_recorder. Without it the frames are kept in video_list.
         # - **kwargs can be set as camera property name and desired value pairs,
         # like: trigger_active = "SYNCREADOUT"
 
@@ -233,6 +226,13 @@ class CamActuator:
         self.hcam.setACQMode("fixed_length", number_frames=BufferNumber)
         # Get propreties and stored as metadata
         self.GetKeyCameraProperties()
+
+        self.recorder = None
+        if saving_dir is not None:
+            self.recorder = FrameRecorder(
+                saving_dir, description=self.metaData
+            )
+
         self.hcam.startAcquisition()
         self.isStreaming = True
 
@@ -244,16 +244,23 @@ class CamActuator:
     def pullFrames(self, BufferNumber):
         # Start pulling out frames from buffer
         self.video_list = []
+        self.video_stamps = []
         self.imageCount = 0  # The actual frame number that gets recorded.
         while self.isStreaming is True:  # Record for range() number of images.
             [
                 frames,
                 self.dims,
-            ] = (
-                self.hcam.getFrames()
-            )  # frames is a list with HCamData type, with np_array being the image.
-            for aframe in frames:
-                self.video_list.append(aframe.np_array)
+                stamps,
+            ] = self.hcam.getFrames(
+                stamps=True
+            )  # frames is a list of 2D views into the camera buffers.
+            for aframe, stamp in zip(frames, stamps):
+                if self.recorder is not None:
+                    self.recorder.add(aframe, stamp)
+                else:
+                    # The buffers are reused by the next acquisition.
+                    self.video_list.append(aframe.copy())
+                    self.video_stamps.append(stamp)
                 self.imageCount += 1
 
             if self.imageCount >= BufferNumber:
@@ -261,21 +268,45 @@ class CamActuator:
 
     def StopStreaming(self, saving_dir=None):
         # Stop the streaming and save the file.
-        # - saving_dir: directory in which the video is saved.
+        # - saving_dir: directory in which the video is saved, if it was not
+        # given to StartStreaming.
         self.isStreaming = False
+        # Let the last frames be pulled before the buffers are released.
+        self.getFrames_Thread.join()
         # Stop the acquisition
         self.hcam.stopAcquisition()
+        # Frame counts of the camera, saved with the recording.
+        self.metrics = self.hcam.getAcquisitionMetrics()
 
-        if saving_dir is not None:
+        if self.recorder is None and saving_dir is not None:
+            self.isSaving = True
+            self.recorder = FrameRecorder(
+                saving_dir, description=self.metaData, timeout=None
+            )
+            for eachframe in range(self.imageCount):
+                self.recorder.add(
+                    self.video_list[eachframe], self.video_stamps[eachframe]
+                )
+
+        recorder = self.recorder
+        self.recorder = None
+        if recorder is not None:
             self.isSaving = True
-            # Save the file.
-            with skimtiff.TiffWriter(saving_dir, append=True) as tif:
-                for eachframe in range(self.imageCount):
-                    image = np.resize(
-                        self.video_list[eachframe],
-                        (self.dims[1], self.dims[0]),
+            # Write the frames still waiting for the disk.
+            try:
+                recorder.close(self.metrics)
+            finally:
+                self.isSaving = False
+            self.frames_written = recorder.frames_written
+            self.frames_dropped = recorder.frames_dropped
+            if recorder.error is not None:
+                raise RuntimeError(
+                    "Recording to {} failed, {} of {} frames written".format(
+                        recorder.path,
+                        recorder.frames_written,
+                        recorder.frames_added,
                     )
-                    tif.save(image, compress=0, description=self.metaData)
+                ) from recorder.error
         self.isSaving = False
 
     def Exit(self):
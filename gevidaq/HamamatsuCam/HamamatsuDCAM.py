@@ -19,6 +19,7 @@ import ctypes
 import ctypes.util
 import importlib.resources
 import logging
+import os
 import sys
 import time
 
@@ -74,14 +75,9 @@ DCAMBUF_ATTACHKIND_FRAME = 0
 DCAMBUF_ATTACHKIND_TIMESTAMP = 1
 DCAMBUF_ATTACHKIND_FRAMESTAMP = 2
 
-# Specify dcam-api location
-try:
-    files = importlib.resources.files(sys.modules[__package__])
-    traversable = files.joinpath("19_12/dcamapi.dll")
-    with importlib.resources.as_file(traversable) as path:
-        dcam = ctypes.WinDLL(str(path))
-except Exception as exc:
-    logging.critical("could not load dll", exc_info=exc)
+# The environment variable that selects the simulator in dcam_simulator
+# instead of dcamapi.dll.
+BACKEND_VARIABLE = "GEVIDAQ_DCAM_BACKEND"
 
 
 # Hamamatsu structures.
@@ -207,6 +203,17 @@ class DCAMBUF_ATTACH(ctypes.Structure):
     ]
 
 
+# DCAM_TIMESTAMP
+#
+# The dcam timestamp structure
+#
+class DCAM_TIMESTAMP(ctypes.Structure):
+    _fields_ = [
+        ("sec", ctypes.c_uint32),
+        ("microsec", ctypes.c_int32),
+    ]
+
+
 # DCAMBUF_FRAME
 #
 # The dcam buffer frame structure
@@ -224,7 +231,7 @@ class DCAMBUF_FRAME(ctypes.Structure):
         ("height", ctypes.c_int32),
         ("left", ctypes.c_int32),
         ("top", ctypes.c_int32),
-        ("timestamp", ctypes.c_int32),
+        ("timestamp", DCAM_TIMESTAMP),
         ("framestamp", ctypes.c_int32),
         ("camerastamp", ctypes.c_int32),
     ]
@@ -296,6 +303,50 @@ class DCAMException(BaseException):
     pass
 
 
+# Hardware frame number and time in s of every frame.
+FRAME_STAMP_DTYPE = numpy.dtype(
+    [("framestamp", numpy.int64), ("timestamp", numpy.float64)]
+)
+
+
+def load_dcam():
+    """
+    Load the DCAM-API, dcamapi.dll or the simulator if BACKEND_VARIABLE is
+    "simulated".
+    """
+    name = os.environ.get(BACKEND_VARIABLE, "dcamapi")
+    if name == "simulated":
+        from . import dcam_simulator
+
+        return dcam_simulator.SimulatedDCAM()
+    elif name != "dcamapi":
+        raise ValueError(
+            f"Unknown DCAM backend {name!r} in {BACKEND_VARIABLE}"
+        )
+
+    # Specify dcam-api location
+    files = importlib.resources.files(sys.modules[__package__])
+    traversable = files.joinpath("19_12/dcamapi.dll")
+    with importlib.resources.as_file(traversable) as path:
+        return ctypes.WinDLL(str(path))
+
+
+def set_dcam(api):
+    """
+    Use api, like a dcam_simulator.SimulatedDCAM, for all cameras opened
+    from now on.
+    """
+    global dcam
+    dcam = api
+
+
+dcam = None
+try:
+    dcam = load_dcam()
+except Exception as exc:
+    logging.critical("could not load dll", exc_info=exc)
+
+
 class HCamData(object):
     """
     Hamamatsu camera data object.
@@ -338,6 +389,108 @@ class HCamData(object):
         # Here it's the pointer to attached memory buffers(RAM) to receive streaming images.
 
 
+class HCamBufferSlab(object):
+    """
+    Camera frame buffers in one contiguous, page aligned block of memory.
+
+    Allocating thousands of separate numpy arrays made every acquisition
+    start slow and consumers copied each frame to get a 2D image. The slab
+    is allocated once and reused while the frame geometry stays the same.
+    Every frame starts on a page boundary, and frames are numpy views of
+    shape (frame_y, frame_x) into the slab, which are only valid until the
+    camera writes to that buffer again.
+    """
+
+    page_size = 4096
+
+    def __init__(self, frame_x, frame_y, frame_bytes, number, **kwds):
+        """
+        Allocate number frame buffers of frame_bytes each.
+        """
+        super().__init__(**kwds)
+        self.frame_x = frame_x
+        self.frame_y = frame_y
+        self.frame_bytes = frame_bytes
+        self.number = number
+
+        # Rows can be padded by the camera.
+        row_bytes = frame_bytes // frame_y
+        self.stride = -(-frame_bytes // self.page_size) * self.page_size
+
+        self.memory = numpy.empty(
+            number * self.stride + self.page_size, dtype=numpy.uint8
+        )
+        self.offset = -self.memory.ctypes.data % self.page_size
+        self.address = self.memory.ctypes.data + self.offset
+
+        self.frames = numpy.ndarray(
+            shape=(number, frame_y, frame_x),
+            dtype=numpy.uint16,
+            buffer=self.memory,
+            offset=self.offset,
+            strides=(self.stride, row_bytes, 2),
+        )
+
+        # The camera writes the DCAM_TIMESTAMP and framestamp of every
+        # frame next to its buffer.
+        self.timestamps = numpy.zeros(
+            number, dtype=[("sec", numpy.uint32), ("microsec", numpy.int32)]
+        )
+        self.framestamps = numpy.zeros(number, dtype=numpy.int32)
+
+    def fits(self, frame_x, frame_y, frame_bytes, number):
+        """
+        Whether the slab can be reused for an acquisition.
+        """
+        return (
+            self.frame_x == frame_x
+            and self.frame_y == frame_y
+            and self.frame_bytes == frame_bytes
+            and self.number >= number
+        )
+
+    def getPointers(self, number):
+        """
+        The ctypes array of the addresses of the first number frames, for
+        dcambuf_attach.
+        """
+        end = self.address + number * self.stride
+        return (ctypes.c_void_p * number)(
+            *range(self.address, end, self.stride)
+        )
+
+    def getStampPointers(self, number):
+        """
+        The ctypes arrays of the addresses of the timestamps and framestamps
+        of the first number frames, for dcambuf_attach.
+        """
+        timestamps = self.timestamps.ctypes.data
+        framestamps = self.framestamps.ctypes.data
+        return (
+            (ctypes.c_void_p * number)(
+                *range(timestamps, timestamps + number * 8, 8)
+            ),
+            (ctypes.c_void_p * number)(
+                *range(framestamps, framestamps + number * 4, 4)
+            ),
+        )
+
+    def getStamps(self, indices):
+        """
+        Framestamps and timestamps in s of the frames at indices.
+        """
+        stamps = numpy.empty(len(indices), dtype=FRAME_STAMP_DTYPE)
+        stamps["framestamp"] = self.framestamps[indices]
+        stamps["timestamp"] = (
+            self.timestamps["sec"][indices]
+            + self.timestamps["microsec"][indices] * 1e-6
+        )
+        return stamps
+
+    def __getitem__(self, index):
+        return self.frames[index]
+
+
 class HamamatsuCamera(object):
     """
     Basic camera interface class.
@@ -362,8 +515,9 @@ class HamamatsuCamera(object):
         self.frame_y = 0
         self.last_frame_number = 0
         self.properties = None
-        self.max_backlog = 0
         self.number_image_buffers = 0
+        self.stamps_attached = False
+        self.resetFrameMetrics()
 
         self.acquisition_mode = "run_till_abort"
         self.number_frames = 0
@@ -406,6 +560,7 @@ class HamamatsuCamera(object):
         """
         self.buffer_index = -1
         self.last_frame_number = 0
+        self.resetFrameMetrics()
 
         # Set sub array mode.
         self.setSubArrayMode()
@@ -415,6 +570,69 @@ class HamamatsuCamera(object):
         self.frame_y = self.getPropertyValue("image_height")[0]
         self.frame_bytes = self.getPropertyValue("image_framebytes")[0]
 
+    def resetFrameMetrics(self):
+        """
+        Reset the frame counts of getAcquisitionMetrics for a new
+        acquisition.
+        """
+        self.backlog = 0
+        self.max_backlog = 0
+        self.frames_received = 0
+        self.frames_lost = 0
+        self.first_stamp = None
+        self.last_stamp = None
+
+    def countFrames(self, stamps):
+        """
+        Count the frames taken out of the buffers, and the frames lost
+        before them from the gaps in their framestamps.
+        """
+        if len(stamps) == 0:
+            return
+
+        if not self.stamps_attached:
+            # Without hardware stamps the time is when the frames are read.
+            stamps["timestamp"] = time.time()
+        else:
+            framestamps = stamps["framestamp"]
+            if self.last_stamp is not None:
+                framestamps = numpy.concatenate(
+                    ([self.last_stamp["framestamp"]], framestamps)
+                )
+            gaps = numpy.diff(framestamps) - 1
+            self.frames_lost += int(gaps[gaps > 0].sum())
+
+        if self.first_stamp is None:
+            self.first_stamp = stamps[0].copy()
+        self.last_stamp = stamps[-1].copy()
+        self.frames_received += len(stamps)
+
+    def getAcquisitionMetrics(self):
+        """
+        Frame counts of the current or last acquisition.
+
+        frames: frames taken out of the buffers.
+        frames_lost: frames overwritten in the buffers before they were
+            taken out, from the framestamps if the camera provides them.
+        backlog: frames waiting in the buffers at the last check.
+        max_backlog: largest backlog of the acquisition.
+        fps: frames taken out per second of camera time.
+        """
+        fps = 0.0
+        if self.frames_received > 1:
+            duration = (
+                self.last_stamp["timestamp"] - self.first_stamp["timestamp"]
+            )
+            if duration > 0:
+                fps = float((self.frames_received - 1) / duration)
+        return {
+            "frames": self.frames_received,
+            "frames_lost": self.frames_lost,
+            "backlog": self.backlog,
+            "max_backlog": self.max_backlog,
+            "fps": fps,
+        }
+
     def checkStatus(self, fn_return, fn_name="unknown"):
         """
         Check return value of the dcam function call.
@@ -498,18 +716,22 @@ class HamamatsuCamera(object):
 
         return properties
 
-    def getFrames(self):
+    def getFrames(self, stamps=False):
         """
         Gets all of the available frames.
 
         This will block waiting for new frames even if
         there new frames available when it is called.
+
+        The frames are numpy arrays of shape (frame_y, frame_x). With
+        stamps, a FRAME_STAMP_DTYPE array with the hardware framestamp and
+        timestamp of every frame is returned as well.
         """
         frames = []
-        for n in self.newFrames():
-            paramlock = DCAMBUF_FRAME(
-                0, 0, 0, n, None, 0, 0, 0, 0, 0, 0, 0, 0, 0
-            )
+        new_frames = self.newFrames()
+        frame_stamps = numpy.zeros(len(new_frames), dtype=FRAME_STAMP_DTYPE)
+        for i, n in enumerate(new_frames):
+            paramlock = DCAMBUF_FRAME(0, 0, 0, n)
             paramlock.size = ctypes.sizeof(paramlock)
 
             # Lock the frame in the camera buffer & get address.
@@ -524,8 +746,17 @@ class HamamatsuCamera(object):
             hc_data = HCamData(self.frame_bytes)
             hc_data.copyData(paramlock.buf)
 
-            frames.append(hc_data)
+            frames.append(
+                hc_data.np_array.reshape(self.frame_y, -1)[:, : self.frame_x]
+            )
+            frame_stamps[i] = (
+                paramlock.framestamp,
+                paramlock.timestamp.sec + paramlock.timestamp.microsec * 1e-6,
+            )
 
+        self.countFrames(frame_stamps)
+        if stamps:
+            return [frames, [self.frame_x, self.frame_y], frame_stamps]
         return [frames, [self.frame_x, self.frame_y]]
 
     def getModelInfo(self, camera_id):
@@ -751,12 +982,16 @@ class HamamatsuCamera(object):
             0, DCAMCAP_TRANSFERKIND_FRAME, 0, 0
         )
         paramtransfer.size = ctypes.sizeof(paramtransfer)
-        self.checkStatus(
+        fn_return = self.checkStatus(
             dcam.dcamcap_transferinfo(
                 self.camera_handle, ctypes.byref(paramtransfer)
             ),
             "dcamcap_transferinfo",
         )
+        # DCAM errors are negative, like when the buffers were released by
+        # stopping the acquisition from another thread.
+        if fn_return <= DCAMERR_ERROR:
+            return []
         cur_buffer_index = paramtransfer.nNewestFrameIndex
         cur_frame_number = paramtransfer.nFrameCount
 
@@ -769,6 +1004,9 @@ class HamamatsuCamera(object):
             logging.info(
                 ">> Warning! hamamatsu camera frame buffer overrun detected!"
             )
+            if not self.stamps_attached:
+                self.frames_lost += backlog - self.number_image_buffers
+        self.backlog = backlog
         if backlog > self.max_backlog:
             self.max_backlog = backlog  # Update the number of frames accumulated in the buffer.
         self.last_frame_number = cur_frame_number
@@ -907,6 +1145,8 @@ class HamamatsuCamera(object):
             ),
             "dcambuf_alloc",
         )
+        # dcambuf_lockframe() gives the stamps of every frame.
+        self.stamps_attached = True
 
         # Start acquisition.
         if self.acquisition_mode == "run_till_abort":
@@ -929,9 +1169,9 @@ class HamamatsuCamera(object):
         self.checkStatus(dcam.dcamcap_stop(self.camera_handle), "dcamcap_stop")
 
         logging.info(
-            f"max camera backlog was {self.max_backlog} of {self.number_image_buffers}"
+            f"max camera backlog was {self.max_backlog} of "
+            f"{self.number_image_buffers}, {self.frames_lost} frames lost"
         )
-        self.max_backlog = 0
 
         # Free image buffers.
         self.number_image_buffers = 0
@@ -964,8 +1204,8 @@ class HamamatsuCameraMR(HamamatsuCamera):
     Memory recycling camera class.
 
     This version allocates "user memory" for the Hamamatsu camera
-    buffers. This memory is also the location of the storage for
-    the np_array element of a HCamData() class. The memory is
+    buffers. This memory is a HCamBufferSlab, and getFrames returns
+    views of it without copying. The memory is
     allocated once at the beginning, then recycled. This means
     that there is a lot less memory allocation & shuffling compared
     to the basic class, which performs one allocation and (I believe)
@@ -983,13 +1223,12 @@ class HamamatsuCameraMR(HamamatsuCamera):
     def __init__(self, **kwds):
         super().__init__(**kwds)
 
-        self.hcam_data = []
+        self.hcam_slab = None
         self.hcam_ptr = False
-        self.old_frame_bytes = -1
 
         self.setPropertyValue("output_trigger_kind[0]", 2)
 
-    def getFrames(self):
+    def getFrames(self, stamps=False):
         """
         Gets all of the available frames.
 
@@ -998,15 +1237,23 @@ class HamamatsuCameraMR(HamamatsuCamera):
 
         FIXME: It does not always seem to block? The length of frames can
                be zero. Are frames getting dropped? Some sort of race condition?
+
+        The frames are numpy views of shape (frame_y, frame_x) into the
+        camera buffers, copy them to keep them after the camera has used
+        the buffer again. With stamps, a FRAME_STAMP_DTYPE array with the
+        hardware framestamp and timestamp of every frame is returned as well.
         """
         frames = []
-        for (
-            n
-        ) in (
+        new_frames = (
             self.newFrames()
-        ):  # self.newFrames typically looks like a list with integers like [0] and [1] in next frame.
-            frames.append(self.hcam_data[n])
-
+        )  # self.newFrames typically looks like a list with integers like [0] and [1] in next frame.
+        for n in new_frames:
+            frames.append(self.hcam_slab[n])
+
+        frame_stamps = self.hcam_slab.getStamps(new_frames)
+        self.countFrames(frame_stamps)
+        if stamps:
+            return [frames, [self.frame_x, self.frame_y], frame_stamps]
         return [frames, [self.frame_x, self.frame_y]]
 
     def startAcquisition(self):
@@ -1016,64 +1263,53 @@ class HamamatsuCameraMR(HamamatsuCamera):
         self.captureSetup()
 
         # Allocate new image buffers if necessary. This will allocate
-        # as many frames as can fit in 2GB of memory, or 2000 frames,
+        # as many frames as will fit in 4GB of memory, or 4000 frames,
         # which ever is smaller. The problem is that if the frame size
-        # is small than a lot of buffers can fit in 2GB. Assuming that
-        # the camera maximum speed is something like 1KHz 2000 frames
-        # should be enough for 2 seconds of storage, which will hopefully
+        # is small than a lot of buffers can fit in 4GB. Assuming that
+        # the camera maximum speed is something like 1KHz 4000 frames
+        # should be enough for 4 seconds of storage, which will hopefully
         # be long enough.
         #
-        if (self.old_frame_bytes != self.frame_bytes) or (
-            self.acquisition_mode == "fixed_length"
-        ):
-            n_buffers = min(
+        if self.acquisition_mode == "fixed_length":
+            self.number_image_buffers = self.number_frames
+        else:
+            self.number_image_buffers = min(
                 int((4.0 * 1024 * 1024 * 1024) / self.frame_bytes), 4000
             )
+
+        # The slab of the previous acquisition is reused if the frames are
+        # the same and it has enough buffers.
+        if self.hcam_slab is None or not self.hcam_slab.fits(
+            self.frame_x,
+            self.frame_y,
+            self.frame_bytes,
+            self.number_image_buffers,
+        ):
             logging.info(
                 "Frame size: {} MB.".format(self.frame_bytes / 1024 / 1024)
             )
-            if self.acquisition_mode == "fixed_length":
-                self.number_image_buffers = self.number_frames
-            else:
-                self.number_image_buffers = n_buffers
-
-            # Allocate new image buffers.
-            logging.info(
-                "Number of image buffers: {}".format(
-                    int(self.number_image_buffers)
-                )
+            # Free the old slab before allocating a new one.
+            self.hcam_slab = None
+            self.hcam_slab = HCamBufferSlab(
+                self.frame_x,
+                self.frame_y,
+                self.frame_bytes,
+                self.number_image_buffers,
             )
-            ptr_array = (
-                ctypes.c_void_p * self.number_image_buffers
-            )  # Create pointers to use.
-            self.hcam_ptr = (
-                ptr_array()
-            )  # The array of pointers of attached buffers.
-            self.hcam_data = []
-            for i in range(self.number_image_buffers):
-                hc_data = HCamData(
-                    self.frame_bytes
-                )  # For each frame we allocate a numpy.ascontiguousarray buffer.
-                self.hcam_ptr[
-                    i
-                ] = (
-                    hc_data.getDataPtr()
-                )  # Configure each frame memory pointer.
-                self.hcam_data.append(
-                    hc_data
-                )  # List.append will not take up another memory space.
-
-            self.old_frame_bytes = self.frame_bytes
-
             logging.info(
                 "Buffer assigned: {} Gigabybtes.".format(
-                    self.number_image_buffers
-                    * self.frame_bytes
-                    / 1024
-                    / 1024
-                    / 1024
+                    self.hcam_slab.memory.nbytes / 1024 / 1024 / 1024
                 )
             )
+
+        logging.info(
+            "Number of image buffers: {}".format(
+                int(self.number_image_buffers)
+            )
+        )
+        # The array of pointers of attached buffers.
+        self.hcam_ptr = self.hcam_slab.getPointers(self.number_image_buffers)
+
         # Attach image buffers and start acquisition.
         #
         # We need to attach & release for each acquisition otherwise
@@ -1097,21 +1333,20 @@ class HamamatsuCameraMR(HamamatsuCamera):
 
         # The dcambuf_attach() function assigns allocated memory as the capturing buffer for the host software.
         # DCAM will transfer the image data directly from the device to these buffers.
+        if self.acquisition_mode == "fixed_length":
+            paramattach.buffercount = self.number_frames
+        self.checkStatus(
+            dcam.dcambuf_attach(self.camera_handle, paramattach),
+            "dcambuf_attach",
+        )
+        self.stamps_attached = self.attachStamps(paramattach.buffercount)
+
         if self.acquisition_mode == "run_till_abort":
-            self.checkStatus(
-                dcam.dcambuf_attach(self.camera_handle, paramattach),
-                "dcam_attachbuffer",
-            )
             self.checkStatus(
                 dcam.dcamcap_start(self.camera_handle, DCAMCAP_START_SEQUENCE),
                 "dcamcap_start",
             )
         if self.acquisition_mode == "fixed_length":
-            paramattach.buffercount = self.number_frames
-            self.checkStatus(
-                dcam.dcambuf_attach(self.camera_handle, paramattach),
-                "dcambuf_attach",
-            )
             self.checkStatus(
                 dcam.dcamcap_start(self.camera_handle, DCAMCAP_START_SNAP),
                 "dcamcap_start",
@@ -1137,9 +1372,57 @@ class HamamatsuCameraMR(HamamatsuCamera):
                 ),
                 "dcambuf_release",
             )
+        if self.stamps_attached:
+            for kind in (
+                DCAMBUF_ATTACHKIND_TIMESTAMP,
+                DCAMBUF_ATTACHKIND_FRAMESTAMP,
+            ):
+                self.checkStatus(
+                    dcam.dcambuf_release(self.camera_handle, kind),
+                    "dcambuf_release",
+                )
+            self.stamps_attached = False
 
-        logging.info(f"max camera backlog was: {self.max_backlog}")
-        self.max_backlog = 0
+        logging.info(
+            f"max camera backlog was: {self.max_backlog}, "
+            f"{self.frames_lost} frames lost"
+        )
+
+    def attachStamps(self, number):
+        """
+        Attach the timestamp and framestamp buffers of the slab, so the
+        camera writes them with every frame. Returns False if the camera
+        does not support it, frames are then timed when they are read.
+        """
+        (
+            self.hcam_timestamp_ptr,
+            self.hcam_framestamp_ptr,
+        ) = self.hcam_slab.getStampPointers(number)
+        self.hcam_slab.timestamps[:] = 0
+        self.hcam_slab.framestamps[:] = 0
+
+        attached = []
+        for kind, pointers in (
+            (DCAMBUF_ATTACHKIND_TIMESTAMP, self.hcam_timestamp_ptr),
+            (DCAMBUF_ATTACHKIND_FRAMESTAMP, self.hcam_framestamp_ptr),
+        ):
+            paramattach = DCAMBUF_ATTACH(0, kind, pointers, number)
+            paramattach.size = ctypes.sizeof(paramattach)
+            fn_return = self.checkStatus(
+                dcam.dcambuf_attach(self.camera_handle, paramattach),
+                "dcambuf_attach",
+            )
+            # DCAM errors are negative.
+            if fn_return <= DCAMERR_ERROR:
+                break
+            attached.append(kind)
+
+        if len(attached) < 2:
+            logging.info("Camera gives no frame stamps.")
+            for kind in attached:
+                dcam.dcambuf_release(self.camera_handle, kind)
+            return False
+        return True
 
 
 class HamamatsuCameraRE(HamamatsuCamera):
@@ -1482,9 +1765,9 @@ if __name__ == "__main__":
                         dims,
                     ] = (
                         hcam.getFrames()
-                    )  # frames is a list with HCamData type, with np_array being the image.
+                    )  # frames is a list of 2D views into the camera buffers.
                     for aframe in frames:
-                        video_list.append(aframe.np_array)
+                        video_list.append(aframe.copy())
                         cnt += 1
                 AcquisitionEndTime = time.time()
                 logging.info(f"Frames acquired: {cnt}")
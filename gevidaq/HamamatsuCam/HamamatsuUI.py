@@ -7,7 +7,6 @@ Created on Tue Apr 14 18:47:31 2020
 
 import ctypes
 import ctypes.util
-import importlib.resources
 import logging
 import os
 import sys
@@ -39,10 +38,16 @@ from PyQt5.QtWidgets import (
     QTabWidget,
     QWidget,
 )
-from skimage.measure import block_reduce
 
 from .. import Icons, StylishQT
 from ..HamamatsuCam import HamamatsuDCAM
+from ..HamamatsuCam.frame_recorder import FrameRecorder
+from ..HamamatsuCam.live_view import (
+    FrameMailbox,
+    bin_image,
+    display_binning,
+    subsample_levels,
+)
 
 """
 Some general settings for pyqtgraph, these only have to do with appearance
@@ -70,6 +75,12 @@ class CameraUI(QMainWindow):
         self.ShowROIImgSwitch = False
         self.ROIselector_ispresented = False
         self.Live_sleeptime = 0.06666  # default camera live fps
+        # The live thread puts the newest frame in the mailbox, the render
+        # timer draws it at most every Live_sleeptime.
+        self.live_mailbox = FrameMailbox()
+        self.LiveRenderTimer = QTimer()
+        self.LiveRenderTimer.setInterval(int(self.Live_sleeptime * 1000))
+        self.LiveRenderTimer.timeout.connect(self.RenderLiveFrame)
         self.default_folder = "M:/tnw/ist/do/projects/Neurophotonics/Brinkslab/Data"  # TODO hardcoded path
         # === GUI ===
         self.setWindowTitle("Hamamatsu Orca Flash")
@@ -851,10 +862,8 @@ class CameraUI(QMainWindow):
         # Load dcamapi.dll version: 19.12.641.5901
         """
 
-        files = importlib.resources.files(sys.modules[__package__])
-        traversable = files.joinpath("19_12/dcamapi.dll")
-        with importlib.resources.as_file(traversable) as path:
-            self.dcam = ctypes.WinDLL(str(path))
+        # dcamapi.dll, or the simulator selected by GEVIDAQ_DCAM_BACKEND.
+        self.dcam = HamamatsuDCAM.dcam
 
         paraminit = HamamatsuDCAM.DCAMAPI_INIT(0, 0, 0, 0, None, None)
         paraminit.size = ctypes.sizeof(paraminit)
@@ -1096,7 +1105,7 @@ class CameraUI(QMainWindow):
     def SetExposureTime(self):
         # Change the live fps if the exposure time is set to be larger
         self.Live_sleeptime = max(0.04, self.CamExposureBox.value() + 0.005)
-        # print(self.Live_sleeptime)
+        self.LiveRenderTimer.setInterval(int(self.Live_sleeptime * 1000))
         self.CamExposureTime = self.hcam.setPropertyValue(
             "exposure_time", self.CamExposureBox.value()
         )
@@ -1450,9 +1459,12 @@ class CameraUI(QMainWindow):
                 logging.critical("caught exception", exc_info=exc)
                 logging.info("clear failed.")
 
+            self.live_mailbox.clear()
+            self.LiveRenderTimer.start()
             StartLiveThread = threading.Thread(target=self.LIVE)
             StartLiveThread.start()
         else:
+            self.LiveRenderTimer.stop()
             StopLiveThread = threading.Thread(target=self.StopLIVE)
             StopLiveThread.start()
 
@@ -1475,23 +1487,35 @@ class CameraUI(QMainWindow):
                 dims,
             ] = (
                 self.hcam.getFrames()
-            )  # frames is a list with HCamData type, with np_array being the image.
-            self.Live_image = np.resize(
-                frames[-1].np_array, (dims[1], dims[0])
-            )
+            )  # frames is a list of 2D views into the camera buffers.
+            if len(frames) == 0:
+                continue
+            # Only the newest frame is drawn, it is copied when it is taken.
+            self.live_mailbox.put(frames[-1])
 
             self.subarray_vsize = dims[1]
             self.subarray_hsize = dims[0]
 
-            time.sleep(self.Live_sleeptime)
+    def RenderLiveFrame(self):
+        # Draw the newest live frame, on the GUI thread at the timer rate.
+        frame = self.live_mailbox.take()
+        if frame is None:
+            return
 
-            self.UpdateScreen(self.Live_image)
-
-            self.output_signal_LiveImg.emit(self.Live_image)
+        self.Live_image = frame
+        self.UpdateScreen(self.Live_image)
+        self.output_signal_LiveImg.emit(self.Live_image)
 
     def StopLIVE(self):
         self.isLiving = False
         self.hcam.stopAcquisition()
+        logging.info(
+            "Live view drew {} of {} frames.".format(
+                self.live_mailbox.frames_put
+                - self.live_mailbox.frames_skipped,
+                self.live_mailbox.frames_put,
+            )
+        )
 
     def SaveLiveImg(self):
         """
@@ -1509,24 +1533,19 @@ class CameraUI(QMainWindow):
             tif.save(self.Live_image, description=self.metaData, compress=0)
 
     def UpdateScreen(self, image):
+        # Bin large frames for display, unless an ROI is being selected on
+        # the full resolution image.
+        if self.ROIselector_ispresented is False:
+            image_shown = bin_image(image, display_binning(image.shape))
+        else:
+            image_shown = image
+
         if self.Live_item_autolevel is True:
-            # Down sample the image when it's full resolution
-            if (
-                self.subarray_vsize == 2048
-                and self.subarray_hsize == 2048
-                and self.ROIselector_ispresented is False
-            ):
-                self.Live_item.setImage(
-                    block_reduce(
-                        image,
-                        block_size=(2, 2),
-                        func=np.mean,
-                        cval=np.mean(image),
-                    ),
-                    autoLevels=None,
-                )
-            else:
-                self.Live_item.setImage(image, autoLevels=None)
+            self.Live_item.setImage(
+                image_shown,
+                autoLevels=False,
+                levels=subsample_levels(image_shown),
+            )
 
         elif self.Live_item_autolevel is False:
             """
@@ -1534,23 +1553,7 @@ class CameraUI(QMainWindow):
                 [blackLevel, whiteLevel]
                 [[minRed, maxRed], [minGreen, maxGreen], [minBlue, maxBlue]]
             """
-
-            if (
-                self.subarray_vsize == 2048
-                and self.subarray_hsize == 2048
-                and self.ROIselector_ispresented is False
-            ):
-                self.Live_item.setImage(
-                    block_reduce(
-                        image,
-                        block_size=(2, 2),
-                        func=np.mean,
-                        cval=np.mean(image),
-                    ),
-                    autoLevels=False,
-                )
-            else:
-                self.Live_item.setImage(image, autoLevels=False)
+            self.Live_item.setImage(image_shown, autoLevels=False)
 
         # Update ROI checking screen
         if self.ShowROIImgSwitch is True:
@@ -1582,14 +1585,12 @@ class CameraUI(QMainWindow):
                     self.dims,
                 ] = (
                     self.hcam.getFrames()
-                )  # frames is a list with HCamData type, with np_array being the image.
+                )  # frames is a list of 2D views into the camera buffers.
                 for aframe in frames:
-                    self.video_list.append(aframe.np_array)
+                    self.video_list.append(aframe.copy())
                     self.imageCount += 1
 
-            self.SnapImage = np.resize(
-                self.video_list[-1], (self.dims[1], self.dims[0])
-            )
+            self.SnapImage = self.video_list[-1]
 
             self.hcam.stopAcquisition()
 
@@ -1709,6 +1710,10 @@ class CameraUI(QMainWindow):
     def StartStreaming(self, StopSignal, BufferNumber, StreamDuration):
         # Get propreties and stored as metadata
         self.GetKeyCameraProperties()
+        # Frames are written to disk while recording.
+        self.recorder = FrameRecorder(
+            self.get_file_dir(), description=self.metaData, imagej=True
+        )
         # === Start the acquisition ===
         # Duration hard limit:
         if StopSignal == "Time":
@@ -1724,23 +1729,17 @@ class CameraUI(QMainWindow):
             # self.StreamDuration_timer.start(StreamDuration*1000) # Starts or restarts the timer with a timeout of duration msec milliseconds.
 
             # Start pulling out frames from buffer
-            self.video_list = []
             self.imageCount = 0  # The actual frame number that gets recorded.
             # Record for range() number of images.
             while self.isStreaming is True:
                 [
                     frames,
                     self.dims,
-                ] = (
-                    self.hcam.getFrames()
-                )  # frames is a list with HCamData type, with np_array being the image.
-                for aframe in frames:
-                    self.video_list.append(aframe.np_array)
-                    self.imageCount += 1
-
-                    self.CamStreamingLabel.setText(
-                        "Recording, {} frames..".format(self.imageCount)
-                    )
+                    stamps,
+                ] = self.hcam.getFrames(
+                    stamps=True
+                )  # frames is a list of 2D views into the camera buffers.
+                self.RecordFrames(frames, stamps)
 
         # Frame number hard limit
         elif StopSignal == "Frames":
@@ -1754,30 +1753,45 @@ class CameraUI(QMainWindow):
             self.hcam.startAcquisition()
 
             # Start pulling out frames from buffer
-            self.video_list = []
-
             for _ in range(
                 BufferNumber
             ):  # Record for range() number of images.
                 [
                     frames,
                     self.dims,
-                ] = (
-                    self.hcam.getFrames()
-                )  # frames is a list with HCamData type, with np_array being the image.
-                for aframe in frames:
-                    self.video_list.append(aframe.np_array)
-                    self.imageCount += 1
-
-                    self.CamStreamingLabel.setText(
-                        "Recording, {} frames..".format(self.imageCount)
-                    )
+                    stamps,
+                ] = self.hcam.getFrames(
+                    stamps=True
+                )  # frames is a list of 2D views into the camera buffers.
+                self.RecordFrames(frames, stamps)
 
             self.StopStreamingThread()
 
+    def RecordFrames(self, frames, stamps):
+        for aframe, stamp in zip(frames, stamps):
+            self.recorder.add(aframe, stamp)
+            self.imageCount += 1
+
+        metrics = self.hcam.getAcquisitionMetrics()
+        self.CamStreamingLabel.setText(
+            "Recording, {} frames at {} fps, {} lost, backlog {}, {} written, "
+            "{} dropped..".format(
+                self.imageCount,
+                round(metrics["fps"], 1),
+                metrics["frames_lost"],
+                metrics["backlog"],
+                self.recorder.frames_written,
+                self.recorder.frames_dropped,
+            )
+        )
+
     def StopStreaming(self, saveFile):
-        # Stop the acquisitiondjc
+        # Stop the acquisition
         AcquisitionEndTime = time.time()
+        self.isStreaming = False
+        # Let the last frames be pulled before the buffers are released.
+        if self.StartStream_Thread is not threading.current_thread():
+            self.StartStream_Thread.join()
         logging.info(f"Frames acquired: {self.imageCount}")
         logging.info(
             "Total time is: {} s.".format(
@@ -1793,38 +1807,39 @@ class CameraUI(QMainWindow):
             )
         )
         self.hcam.stopAcquisition()
-        self.isStreaming = False
+        # Frame counts of the camera, saved with the recording.
+        metrics = self.hcam.getAcquisitionMetrics()
+        logging.info(
+            "Camera fps: {} hz, {} frames lost, max backlog {}.".format(
+                round(metrics["fps"], 2),
+                metrics["frames_lost"],
+                metrics["max_backlog"],
+            )
+        )
         self.StreamBusymovie.stop()
         self.StreamStatusStackedWidget.setCurrentIndex(2)
 
-        if saveFile is True:
-            # Save the file.
-            with skimtiff.TiffWriter(
-                self.get_file_dir(), append=True, imagej=True
-            ) as tif:
-                write_starttime = time.time()
-                for eachframe in range(self.imageCount):
-                    image = np.resize(
-                        self.video_list[eachframe],
-                        (self.dims[1], self.dims[0]),
-                    )
-                    tif.save(image, compress=0, description=self.metaData)
-                    # === Update file saving progress bar ===
-                    if (
-                        eachframe / self.imageCount * 100
-                        - int(eachframe / self.imageCount * 100)
-                        <= 0.1
-                    ):
-                        self.CamStreamSaving_progressbar.setValue(
-                            int(eachframe / self.imageCount * 100)
-                        )
+        # Most frames are on disk already, write the ones still waiting.
+        write_starttime = time.time()
+        self.CamStreamSaving_progressbar.setValue(
+            int(self.recorder.frames_written / max(self.imageCount, 1) * 100)
+        )
+        self.recorder.close(metrics)
+        self.CamStreamSaving_progressbar.setValue(100)
 
+        if saveFile is True:
             logging.info(
                 "Done writing "
-                + str(self.imageCount)
-                + " frames, recorded for "
-                + str(round(AcquisitionEndTime, 2))
-                + " seconds, saving video takes {} seconds.".format(
+                + str(self.recorder.frames_written)
+                + " frames, "
+                + str(self.recorder.frames_dropped)
+                + " dropped, recorded for "
+                + str(
+                    round(
+                        AcquisitionEndTime - self.hcam.AcquisitionStartTime, 2
+                    )
+                )
+                + " seconds, saving the rest takes {} seconds.".format(
                     round(time.time() - write_starttime, 2)
                 )
             )
@@ -1832,8 +1847,26 @@ class CameraUI(QMainWindow):
         self.StartStreamButton.setEnabled(False)
         self.CamStreamActionContainer.setEnabled(True)
         self.StreamStatusStackedWidget.setCurrentIndex(0)
+        if self.recorder.error is not None:
+            logging.critical(
+                "Recording to {} failed".format(self.recorder.path),
+                exc_info=self.recorder.error,
+            )
+            self.CamStreamIsFree.setText(
+                "Saving failed: {}. Frames acquired: {}, written: {}.".format(
+                    self.recorder.error,
+                    self.imageCount,
+                    self.recorder.frames_written,
+                )
+            )
+            return
         self.CamStreamIsFree.setText(
-            "Acquisition done. Frames acquired: {}.".format(self.imageCount)
+            "Acquisition done. Frames acquired: {}, lost: {}, "
+            "dropped: {}.".format(
+                self.imageCount,
+                metrics["frames_lost"],
+                self.recorder.frames_dropped,
+            )
         )
 
     def SetSavingDirectory(self):
@@ -0,0 +1,863 @@
+# -*- coding: utf-8 -*-
+"""
+Simulated Hamamatsu camera, for running the camera code without hardware.
+
+SimulatedDCAM has the functions of the DCAM-API dll that HamamatsuDCAM
+calls, with the same ctypes arguments and return codes, so it can replace
+the dll as HamamatsuDCAM.dcam:
+
+- Properties are those of the ORCA-Flash4.0 in "cam supported
+  properties.txt", with their ranges and text options. The image size,
+  frame rate and readout time follow the binning, the subarray and the
+  exposure time like on the camera.
+- Frames are written into the attached or allocated buffers, in a ring, and
+  the DCAM_TIMESTAMP and framestamp of every frame into the attached stamp
+  buffers. Frames that do not fit in the ring overwrite the oldest ones.
+- Frames are synthetic: beads drifting over a noisy background, clipped to
+  the bit depth.
+- Frames can be dropped on purpose, they leave a gap in the framestamps and
+  are never transferred, like frames the camera loses.
+
+In realtime mode a capture thread produces the frames at the frame rate of
+the wall clock. Otherwise every dcamwait_start produces the next batch of
+frames at once, for benchmarking how fast the frames can be taken out.
+
+The environment variable GEVIDAQ_DCAM_BACKEND=simulated makes HamamatsuDCAM
+use a SimulatedDCAM with the default settings instead of the dll.
+
+Usage:
+    HamamatsuDCAM.set_dcam(SimulatedDCAM(fps=400, drop_probability=0.01))
+    hcam = HamamatsuDCAM.HamamatsuCameraMR(camera_id=0)
+    hcam.startAcquisition()
+    frames, dims = hcam.getFrames()
+    hcam.stopAcquisition()
+    hcam.getAcquisitionMetrics()["frames_lost"]
+
+Benchmark with: python -m gevidaq.HamamatsuCam.dcam_simulator
+"""
+import ctypes
+import math
+import threading
+import time
+
+import numpy as np
+from scipy.ndimage import gaussian_filter
+
+from .HamamatsuDCAM import (
+    DCAM_TIMESTAMP,
+    DCAMBUF_ATTACHKIND_FRAME,
+    DCAMBUF_ATTACHKIND_FRAMESTAMP,
+    DCAMBUF_ATTACHKIND_TIMESTAMP,
+    DCAMCAP_START_SNAP,
+    DCAMCAP_STATUS_BUSY,
+    DCAMCAP_STATUS_READY,
+    DCAMCAP_STATUS_STABLE,
+    DCAMERR_ERROR,
+    DCAMERR_NOERROR,
+    DCAMPROP_ATTR_HASVALUETEXT,
+    DCAMPROP_ATTR_READABLE,
+    DCAMPROP_ATTR_WRITABLE,
+    DCAMPROP_OPTION_NEXT,
+    DCAMPROP_TYPE_LONG,
+    DCAMPROP_TYPE_MODE,
+    DCAMPROP_TYPE_REAL,
+    DCAMWAIT_CAPEVENT_FRAMEREADY,
+    DCAMWAIT_CAPEVENT_STOPPED,
+)
+
+# Error codes of the DCAM-API for the same situations, as the signed
+# integers the functions return.
+DCAMERR_BUSY = -0x7FFFFEFF  # 0x80000101
+DCAMERR_NOTREADY = -0x7FFFFEFD  # 0x80000103
+DCAMERR_TIMEOUT = -0x7FFFFEFA  # 0x80000106
+DCAMERR_INVALIDHANDLE = -0x7FFFF7F9  # 0x80000807
+DCAMERR_INVALIDPARAM = -0x7FFFF7F8  # 0x80000808
+DCAMERR_NOTSUPPORT = -0x7FFFF0FD  # 0x80000f03
+
+SENSOR_SIZE = 2048
+# Time to read out one line, the two halves of the sensor are read out at
+# the same time.
+LINE_INTERVAL = 9.74436090225564e-06
+MODEL = "C13440-20CU SIM"
+
+MODE = DCAMPROP_TYPE_MODE
+LONG = DCAMPROP_TYPE_LONG
+REAL = DCAMPROP_TYPE_REAL
+
+# name: (type, writable, default, minimum, maximum, step, text options)
+# The values of the properties that are not writable are computed by
+# SimulatedCamera.updateProperties.
+PROPERTIES = {
+    "binning": (MODE, True, 1, 1, 4, 1, {"1x1": 1, "2x2": 2, "4x4": 4}),
+    "bit_per_channel": (LONG, False, 16, 8, 16, 1, None),
+    "buffer_framebytes": (LONG, False, 0, 0, 2**31 - 1, 1, None),
+    "buffer_rowbytes": (LONG, False, 0, 0, 2**31 - 1, 1, None),
+    "defect_correct_mode": (MODE, True, 1, 1, 2, 1, {"OFF": 1, "ON": 2}),
+    "exposure_time": (REAL, True, 0.01, 3.9e-05, 10.0, 1e-06, None),
+    "image_framebytes": (LONG, False, 0, 0, 2**31 - 1, 1, None),
+    "image_height": (LONG, False, 0, 0, SENSOR_SIZE, 1, None),
+    "image_pixel_type": (MODE, False, 2, 2, 2, 1, {"MONO16": 2}),
+    "image_rowbytes": (LONG, False, 0, 0, 2**31 - 1, 1, None),
+    "image_width": (LONG, False, 0, 0, SENSOR_SIZE, 1, None),
+    "internal_frame_interval": (REAL, False, 0.0, 0.0, 100.0, 0.0, None),
+    "internal_frame_rate": (REAL, False, 0.0, 0.0, 1e6, 0.0, None),
+    "output_trigger_kind[0]": (
+        MODE,
+        True,
+        2,
+        1,
+        5,
+        1,
+        {
+            "LOW": 1,
+            "EXPOSURE": 2,
+            "PROGRAMABLE": 3,
+            "TRIGGER READY": 4,
+            "HIGH": 5,
+        },
+    ),
+    "readout_speed": (LONG, True, 2, 1, 2, 1, None),
+    "subarray_hpos": (LONG, True, 0, 0, SENSOR_SIZE - 4, 4, None),
+    "subarray_hsize": (LONG, True, SENSOR_SIZE, 4, SENSOR_SIZE, 4, None),
+    "subarray_mode": (MODE, True, 1, 1, 2, 1, {"OFF": 1, "ON": 2}),
+    "subarray_vpos": (LONG, True, 0, 0, SENSOR_SIZE - 4, 4, None),
+    "subarray_vsize": (LONG, True, SENSOR_SIZE, 4, SENSOR_SIZE, 4, None),
+    "timing_readout_time": (REAL, False, 0.0, 0.0, 1.0, 0.0, None),
+    "trigger_active": (
+        MODE,
+        True,
+        1,
+        1,
+        3,
+        1,
+        {"EDGE": 1, "LEVEL": 2, "SYNCREADOUT": 3},
+    ),
+    "trigger_source": (
+        MODE,
+        True,
+        1,
+        1,
+        4,
+        1,
+        {"INTERNAL": 1, "EXTERNAL": 2, "SOFTWARE": 3, "MASTER PULSE": 4},
+    ),
+}
+# Property ids, in the order of the names like the camera lists them.
+PROPERTY_IDS = {
+    name: 0x00100010 + 0x10 * index
+    for index, name in enumerate(sorted(PROPERTIES))
+}
+PROPERTY_NAMES = {prop_id: name for name, prop_id in PROPERTY_IDS.items()}
+
+# Properties that change the frames, they cannot be set while capturing.
+GEOMETRY_PROPERTIES = {
+    "binning",
+    "subarray_hpos",
+    "subarray_hsize",
+    "subarray_mode",
+    "subarray_vpos",
+    "subarray_vsize",
+}
+
+
+def argument_object(arg):
+    """The ctypes object an argument refers to, also through byref."""
+    return getattr(arg, "_obj", arg)
+
+
+def argument_value(arg):
+    """The integer value of a ctypes or Python integer argument."""
+    arg = argument_object(arg)
+    value = getattr(arg, "value", arg)
+    return 0 if value is None else int(value)
+
+
+def write_text(structure, field, text, textbytes):
+    """Copy text into the char buffer the field of structure points to."""
+    offset = getattr(type(structure), field).offset
+    address = ctypes.c_void_p.from_buffer(structure, offset).value
+    data = text.encode("utf-8")[: max(textbytes - 1, 0)] + b"\0"
+    ctypes.memmove(address, data, len(data))
+
+
+def synthetic_frames(width, height, bit_depth=16, number=8, seed=0):
+    """
+    Frames of beads drifting over a noisy background.
+
+    Parameters
+    width : int
+        Frame width in pixels.
+    height : int
+        Frame height in pixels.
+    bit_depth : int, optional
+        Bits of the pixel values, they are clipped to 2**bit_depth - 1.
+        The default is 16.
+    number : int, optional
+        Number of different frames, the camera cycles through them. The
+        default is 8.
+    seed : int, optional
+        Seed of the beads and the noise. The default is 0.
+
+    Returns
+    frames : np.ndarray
+        uint16 array of shape (number, height, width).
+
+    """
+    rng = np.random.default_rng(seed)
+    maximum = 2**bit_depth - 1
+    offset = min(100, maximum // 16)
+
+    beads = np.zeros((height, width), dtype=np.float32)
+    bead_number = max(1, width * height // 4000)
+    beads[
+        rng.integers(0, height, bead_number),
+        rng.integers(0, width, bead_number),
+    ] = rng.uniform(0.5, 1.0, bead_number)
+    beads = gaussian_filter(beads, 3)
+    beads *= 0.8 * (maximum - offset) / max(float(beads.max()), 1e-12)
+
+    frames = np.empty((number, height, width), dtype=np.uint16)
+    for index in range(number):
+        frame = np.roll(beads, index, axis=1) + offset
+        frame += rng.standard_normal((height, width), dtype=np.float32) * (
+            np.sqrt(frame) + 2
+        )
+        np.clip(frame, 0, maximum, out=frame)
+        frames[index] = frame
+    return frames
+
+
+class SimulatedCamera:
+    def __init__(self, dcam, index):
+        """
+        The state of one simulated camera, see SimulatedDCAM.
+
+        Returns
+        None.
+
+        """
+        self.dcam = dcam
+        self.index = index
+        self.values = {
+            name: float(spec[2]) for name, spec in PROPERTIES.items()
+        }
+        if dcam.roi is not None:
+            # Like the camera, the subarray is kept while subarray_mode is
+            # OFF. captureSetup turns it on.
+            hpos, vpos, hsize, vsize = dcam.roi
+            self.values.update(
+                subarray_hpos=float(hpos),
+                subarray_vpos=float(vpos),
+                subarray_hsize=float(hsize),
+                subarray_vsize=float(vsize),
+            )
+        self.updateProperties()
+
+        self.condition = threading.Condition()
+        self.capturing = False
+        self.thread = None
+        self.stop_event = threading.Event()
+
+        self.frame_pointers = None
+        self.timestamp_pointers = None
+        self.framestamp_pointers = None
+        self.allocated = None
+        self.buffer_count = 0
+        # Frames transferred into the buffers, and frames the camera took,
+        # including the dropped ones.
+        self.frame_count = 0
+        self.framestamp = 0
+        self.waited_count = 0
+
+    def attribute(self, name):
+        """The DCAMPROP_ATTR attribute flags of a property."""
+        prop_type, writable, *_, options = PROPERTIES[name]
+        attribute = prop_type | DCAMPROP_ATTR_READABLE
+        if writable:
+            attribute |= DCAMPROP_ATTR_WRITABLE
+        if options:
+            attribute |= DCAMPROP_ATTR_HASVALUETEXT
+        return attribute
+
+    def updateProperties(self):
+        """Compute the read only properties from the settings."""
+        values = self.values
+        binning = int(values["binning"])
+        if values["subarray_mode"] == 2:
+            # The subarray is moved back onto the sensor.
+            for position, size in (
+                ("subarray_hpos", "subarray_hsize"),
+                ("subarray_vpos", "subarray_vsize"),
+            ):
+                values[position] = min(
+                    values[position], SENSOR_SIZE - values[size]
+                )
+            width = int(values["subarray_hsize"])
+            height = int(values["subarray_vsize"])
+        else:
+            width = height = SENSOR_SIZE
+
+        values["image_width"] = float(width // binning)
+        values["image_height"] = float(height // binning)
+        values["image_rowbytes"] = values["image_width"] * 2
+        values["image_framebytes"] = (
+            values["image_rowbytes"] * values["image_height"]
+        )
+        values["buffer_rowbytes"] = values["image_rowbytes"]
+        values["buffer_framebytes"] = values["image_framebytes"]
+        values["bit_per_channel"] = float(self.dcam.bit_depth)
+
+        # Both halves of the sensor are read out from the center at once.
+        readout = math.ceil(height / 2) * LINE_INTERVAL
+        if values["readout_speed"] == 1:
+            readout *= 4
+        values["timing_readout_time"] = readout
+        if self.dcam.fps is not None:
+            frame_rate = float(self.dcam.fps)
+        else:
+            frame_rate = 1 / max(values["exposure_time"], readout)
+        values["internal_frame_rate"] = frame_rate
+        values["internal_frame_interval"] = 1 / frame_rate
+
+    def setValue(self, name, value):
+        """
+        Set a property like the camera does.
+
+        Returns
+        value : float
+            The value the property was set to, or None with the error code.
+        error : int
+            DCAMERR_NOERROR or the error.
+
+        """
+        prop_type, writable, _, minimum, maximum, step, options = PROPERTIES[
+            name
+        ]
+        if not writable:
+            return None, DCAMERR_NOTSUPPORT
+        if self.capturing and name in GEOMETRY_PROPERTIES:
+            return None, DCAMERR_BUSY
+
+        if options:
+            if int(value) not in options.values():
+                return None, DCAMERR_INVALIDPARAM
+            value = int(value)
+        else:
+            value = min(max(value, minimum), maximum)
+            if prop_type == LONG:
+                value = round(value / step) * step
+
+        self.values[name] = float(value)
+        self.updateProperties()
+        return self.values[name], DCAMERR_NOERROR
+
+    @property
+    def frame_shape(self):
+        return int(self.values["image_height"]), int(
+            self.values["image_width"]
+        )
+
+    @property
+    def frame_bytes(self):
+        return int(self.values["image_framebytes"])
+
+    def allocate(self, number):
+        """Allocate number frame buffers in the simulated DCAM module."""
+        self.allocated = np.zeros(
+            (number, self.frame_bytes // 2), dtype=np.uint16
+        )
+        self.allocated_timestamps = np.zeros(number)
+        self.allocated_framestamps = np.zeros(number, dtype=np.int64)
+        self.buffer_count = number
+
+    def start(self, mode):
+        """Start capturing, SNAP stops when all buffers are filled."""
+        self.frames = synthetic_frames(
+            self.frame_shape[1],
+            self.frame_shape[0],
+            self.dcam.bit_depth,
+            seed=self.index,
+        )
+        self.frame_interval = self.values["internal_frame_interval"]
+        self.snap = mode == DCAMCAP_START_SNAP
+        self.frame_count = 0
+        self.framestamp = 0
+        self.waited_count = 0
+        self.start_time = time.time()
+        self.start_counter = time.perf_counter()
+
+        self.capturing = True
+        self.stop_event.clear()
+        if self.dcam.realtime:
+            self.thread = threading.Thread(
+                target=self.run, name="simulated-dcam", daemon=True
+            )
+            self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        with self.condition:
+            self.capturing = False
+            self.condition.notify_all()
+
+    def run(self):
+        """Produce the frames on the wall clock until stopped."""
+        while self.capturing and not self.stop_event.is_set():
+            elapsed = time.perf_counter() - self.start_counter
+            self.produce(int(elapsed / self.frame_interval) + 1)
+            next_time = self.start_counter + (
+                self.framestamp * self.frame_interval
+            )
+            self.stop_event.wait(max(0.0, next_time - time.perf_counter()))
+
+    def produce(self, until):
+        """
+        Take the frames up to framestamp until, writing the ones that are
+        not dropped into the buffers.
+        """
+        count = self.frame_count
+        for framestamp in range(self.framestamp, until):
+            if self.snap and count >= self.buffer_count:
+                break
+            self.framestamp = framestamp + 1
+            if self.dcam.isDropped(framestamp):
+                continue
+
+            timestamp = self.start_time + framestamp * self.frame_interval
+            frame = self.frames[framestamp % len(self.frames)]
+            index = count % self.buffer_count
+            if self.frame_pointers is not None:
+                ctypes.memmove(
+                    self.frame_pointers[index],
+                    frame.ctypes.data,
+                    self.frame_bytes,
+                )
+            else:
+                self.allocated[index] = frame.reshape(-1)
+                self.allocated_timestamps[index] = timestamp
+                self.allocated_framestamps[index] = framestamp
+
+            if self.timestamp_pointers is not None:
+                stamp = DCAM_TIMESTAMP.from_address(
+                    self.timestamp_pointers[index]
+                )
+                stamp.sec = int(timestamp)
+                stamp.microsec = int((timestamp % 1) * 1e6)
+            if self.framestamp_pointers is not None:
+                ctypes.c_int32.from_address(
+                    self.framestamp_pointers[index]
+                ).value = framestamp
+            count += 1
+
+        with self.condition:
+            self.frame_count = count
+            if self.snap and count >= self.buffer_count:
+                self.capturing = False
+            self.condition.notify_all()
+
+    def wait(self, eventmask, timeout):
+        """
+        Wait for a frame after the ones of the last wait, or for the stop.
+
+        Returns
+        event : int
+            The DCAMWAIT_CAPEVENT that happened, or 0.
+        error : int
+            DCAMERR_NOERROR or DCAMERR_TIMEOUT.
+
+        """
+        if self.capturing and not self.dcam.realtime:
+            self.produce(self.framestamp + self.dcam.batch_frames)
+
+        def happened():
+            if eventmask & DCAMWAIT_CAPEVENT_FRAMEREADY and (
+                self.frame_count > self.waited_count
+            ):
+                return DCAMWAIT_CAPEVENT_FRAMEREADY
+            if eventmask & DCAMWAIT_CAPEVENT_STOPPED and not self.capturing:
+                return DCAMWAIT_CAPEVENT_STOPPED
+            return 0
+
+        with self.condition:
+            event = self.condition.wait_for(
+                happened, None if timeout < 0 else timeout / 1000
+            )
+            self.waited_count = self.frame_count
+        if not event:
+            return 0, DCAMERR_TIMEOUT
+        return event, DCAMERR_NOERROR
+
+
+class SimulatedDCAM:
+    def __init__(
+        self,
+        fps=None,
+        roi=None,
+        bit_depth=16,
+        drop_probability=0.0,
+        drop_frames=(),
+        realtime=True,
+        batch_frames=16,
+        frame_stamps=True,
+        cameras=1,
+        seed=0,
+    ):
+        """
+        Simulated DCAM-API with simulated cameras.
+
+        Parameters
+        fps : float, optional
+            Frame rate. The default is None, which follows the exposure
+            time and the readout time of the subarray like the camera.
+        roi : tuple, optional
+            (hpos, vpos, hsize, vsize) subarray the cameras start with,
+            used from the next acquisition on. The default is None, the full
+            sensor.
+        bit_depth : int, optional
+            Bits of the pixel values, in 16 bit pixels. The default is 16.
+        drop_probability : float, optional
+            Chance that a frame is dropped. The default is 0.0.
+        drop_frames : iterable, optional
+            Framestamps of the frames to drop. The default is ().
+        realtime : bool, optional
+            Produce the frames at the frame rate. Otherwise frames are
+            produced batch_frames at a time when they are waited for. The
+            default is True.
+        batch_frames : int, optional
+            Frames produced by every dcamwait_start if not realtime. The
+            default is 16.
+        frame_stamps : bool, optional
+            Whether the cameras support attaching timestamp and framestamp
+            buffers. The default is True.
+        cameras : int, optional
+            Number of cameras found by dcamapi_init. The default is 1.
+        seed : int, optional
+            Seed of the dropped frames. The default is 0.
+
+        Returns
+        None.
+
+        """
+        self.fps = fps
+        self.roi = roi
+        self.bit_depth = bit_depth
+        self.drop_probability = drop_probability
+        self.drop_frames = set(drop_frames)
+        self.realtime = realtime
+        self.batch_frames = batch_frames
+        self.frame_stamps = frame_stamps
+        self.camera_number = cameras
+        self.rng = np.random.default_rng(seed)
+
+        self.cameras = {}
+        self.waits = {}
+
+    def isDropped(self, framestamp):
+        if framestamp in self.drop_frames:
+            return True
+        return (
+            self.drop_probability > 0
+            and self.rng.random() < self.drop_probability
+        )
+
+    def camera(self, handle):
+        return self.cameras.get(argument_value(handle))
+
+    # === API and devices ===
+
+    def dcamapi_init(self, paraminit):
+        argument_object(paraminit).iDeviceCount = self.camera_number
+        return DCAMERR_NOERROR
+
+    def dcamapi_uninit(self):
+        for camera in self.cameras.values():
+            camera.stop()
+        self.cameras.clear()
+        self.waits.clear()
+        return DCAMERR_NOERROR
+
+    def dcamdev_open(self, paramopen):
+        paramopen = argument_object(paramopen)
+        if not 0 <= paramopen.index < self.camera_number:
+            return DCAMERR_INVALIDPARAM
+        # Handles cannot be 0, that is a NULL pointer.
+        handle = paramopen.index + 1
+        self.cameras[handle] = SimulatedCamera(self, paramopen.index)
+        paramopen.hdcam = handle
+        return DCAMERR_NOERROR
+
+    def dcamdev_close(self, hdcam):
+        camera = self.cameras.pop(argument_value(hdcam), None)
+        if camera is None:
+            return DCAMERR_INVALIDHANDLE
+        camera.stop()
+        return DCAMERR_NOERROR
+
+    def dcamdev_getstring(self, index, paramstring):
+        paramstring = argument_object(paramstring)
+        write_text(paramstring, "text", MODEL, paramstring.textbytes)
+        return DCAMERR_NOERROR
+
+    # === Properties ===
+
+    def dcamprop_getnextid(self, hdcam, prop_id, option):
+        prop_id = argument_object(prop_id)
+        if argument_value(option) & DCAMPROP_OPTION_NEXT:
+            next_ids = [i for i in PROPERTY_NAMES if i > prop_id.value]
+            if not next_ids:
+                return DCAMERR_ERROR
+            prop_id.value = min(next_ids)
+        return DCAMERR_NOERROR
+
+    def dcamprop_getname(self, hdcam, prop_id, text, textbytes):
+        name = PROPERTY_NAMES.get(argument_value(prop_id))
+        if name is None:
+            return DCAMERR_INVALIDPARAM
+        text.value = name.encode("utf-8")[: argument_value(textbytes) - 1]
+        return DCAMERR_NOERROR
+
+    def dcamprop_getattr(self, hdcam, p_attr):
+        p_attr = argument_object(p_attr)
+        name = PROPERTY_NAMES.get(p_attr.iProp)
+        if self.camera(hdcam) is None or name is None:
+            return DCAMERR_ERROR
+        _, _, default, minimum, maximum, step, _ = PROPERTIES[name]
+        p_attr.attribute = self.camera(hdcam).attribute(name)
+        p_attr.valuemin = minimum
+        p_attr.valuemax = maximum
+        p_attr.valuestep = step
+        p_attr.valuedefault = default
+        return DCAMERR_NOERROR
+
+    def dcamprop_getvalue(self, hdcam, prop_id, value):
+        name = PROPERTY_NAMES.get(argument_value(prop_id))
+        camera = self.camera(hdcam)
+        if camera is None or name is None:
+            return DCAMERR_INVALIDPARAM
+        argument_object(value).value = camera.values[name]
+        return DCAMERR_NOERROR
+
+    def dcamprop_setgetvalue(self, hdcam, prop_id, value, option):
+        name = PROPERTY_NAMES.get(argument_value(prop_id))
+        camera = self.camera(hdcam)
+        if camera is None or name is None:
+            return DCAMERR_INVALIDPARAM
+        value = argument_object(value)
+        new_value, error = camera.setValue(name, value.value)
+        if new_value is not None:
+            value.value = new_value
+        return error
+
+    def dcamprop_getvaluetext(self, hdcam, prop_text):
+        prop_text = argument_object(prop_text)
+        name = PROPERTY_NAMES.get(prop_text.iProp)
+        options = PROPERTIES[name][6] if name is not None else None
+        if not options:
+            return DCAMERR_NOTSUPPORT
+        for text, option_value in options.items():
+            if option_value == int(prop_text.value):
+                write_text(
+                    prop_text,
+                    "text",
+                    text,
+                    prop_text.textbytes,
+                )
+                return DCAMERR_NOERROR
+        return DCAMERR_INVALIDPARAM
+
+    def dcamprop_queryvalue(self, hdcam, prop_id, value, option):
+        name = PROPERTY_NAMES.get(argument_value(prop_id))
+        options = PROPERTIES[name][6] if name is not None else None
+        if not options:
+            return DCAMERR_NOTSUPPORT
+        value = argument_object(value)
+        if argument_value(option) & DCAMPROP_OPTION_NEXT:
+            next_values = [v for v in options.values() if v > value.value]
+            if not next_values:
+                return DCAMERR_INVALIDPARAM
+            value.value = min(next_values)
+        elif int(value.value) not in options.values():
+            return DCAMERR_INVALIDPARAM
+        return DCAMERR_NOERROR
+
+    # === Buffers and capturing ===
+
+    def dcambuf_alloc(self, hdcam, number):
+        camera = self.camera(hdcam)
+        if camera is None:
+            return DCAMERR_INVALIDHANDLE
+        if camera.capturing:
+            return DCAMERR_BUSY
+        camera.allocate(argument_value(number))
+        return DCAMERR_NOERROR
+
+    def dcambuf_attach(self, hdcam, paramattach):
+        camera = self.camera(hdcam)
+        if camera is None:
+            return DCAMERR_INVALIDHANDLE
+        if camera.capturing:
+            return DCAMERR_BUSY
+
+        paramattach = argument_object(paramattach)
+        pointers = [
+            paramattach.buffer[i] for i in range(paramattach.buffercount)
+        ]
+        if paramattach.iKind == DCAMBUF_ATTACHKIND_FRAME:
+            camera.frame_pointers = pointers
+            camera.buffer_count = len(pointers)
+        elif not self.frame_stamps:
+            return DCAMERR_NOTSUPPORT
+        elif paramattach.iKind == DCAMBUF_ATTACHKIND_TIMESTAMP:
+            camera.timestamp_pointers = pointers
+        elif paramattach.iKind == DCAMBUF_ATTACHKIND_FRAMESTAMP:
+            camera.framestamp_pointers = pointers
+        else:
+            return DCAMERR_INVALIDPARAM
+        return DCAMERR_NOERROR
+
+    def dcambuf_release(self, hdcam, kind=DCAMBUF_ATTACHKIND_FRAME):
+        camera = self.camera(hdcam)
+        if camera is None:
+            return DCAMERR_INVALIDHANDLE
+        if camera.capturing:
+            return DCAMERR_BUSY
+
+        kind = argument_value(kind)
+        if kind == DCAMBUF_ATTACHKIND_FRAME:
+            camera.frame_pointers = None
+            camera.allocated = None
+            camera.buffer_count = 0
+        elif kind == DCAMBUF_ATTACHKIND_TIMESTAMP:
+            camera.timestamp_pointers = None
+        elif kind == DCAMBUF_ATTACHKIND_FRAMESTAMP:
+            camera.framestamp_pointers = None
+        return DCAMERR_NOERROR
+
+    def dcambuf_lockframe(self, hdcam, paramlock):
+        camera = self.camera(hdcam)
+        if camera is None or camera.allocated is None:
+            return DCAMERR_NOTREADY
+        paramlock = argument_object(paramlock)
+        index = paramlock.iFrame
+        if index < 0:
+            index = (camera.frame_count - 1) % camera.buffer_count
+        timestamp = camera.allocated_timestamps[index]
+
+        paramlock.buf = camera.allocated[index].ctypes.data
+        paramlock.rowbytes = int(camera.values["image_rowbytes"])
+        paramlock.width, paramlock.height = camera.frame_shape[::-1]
+        paramlock.timestamp.sec = int(timestamp)
+        paramlock.timestamp.microsec = int((timestamp % 1) * 1e6)
+        paramlock.framestamp = int(camera.allocated_framestamps[index])
+        return DCAMERR_NOERROR
+
+    def dcamcap_start(self, hdcam, mode):
+        camera = self.camera(hdcam)
+        if camera is None:
+            return DCAMERR_INVALIDHANDLE
+        if camera.capturing:
+            return DCAMERR_BUSY
+        if camera.buffer_count == 0:
+            return DCAMERR_NOTREADY
+        camera.start(argument_value(mode))
+        return DCAMERR_NOERROR
+
+    def dcamcap_stop(self, hdcam):
+        camera = self.camera(hdcam)
+        if camera is None:
+            return DCAMERR_INVALIDHANDLE
+        camera.stop()
+        return DCAMERR_NOERROR
+
+    def dcamcap_status(self, hdcam, status):
+        camera = self.camera(hdcam)
+        if camera is None:
+            return DCAMERR_INVALIDHANDLE
+        if camera.capturing:
+            value = DCAMCAP_STATUS_BUSY
+        elif camera.buffer_count:
+            value = DCAMCAP_STATUS_READY
+        else:
+            value = DCAMCAP_STATUS_STABLE
+        argument_object(status).value = value
+        return DCAMERR_NOERROR
+
+    def dcamcap_transferinfo(self, hdcam, paramtransfer):
+        camera = self.camera(hdcam)
+        if camera is None:
+            return DCAMERR_INVALIDHANDLE
+        if camera.buffer_count == 0:
+            return DCAMERR_NOTREADY
+        paramtransfer = argument_object(paramtransfer)
+        with camera.condition:
+            count = camera.frame_count
+        paramtransfer.nFrameCount = count
+        paramtransfer.nNewestFrameIndex = (
+            (count - 1) % camera.buffer_count if count else -1
+        )
+        return DCAMERR_NOERROR
+
+    # === Waiting ===
+
+    def dcamwait_open(self, paramwait):
+        paramwait = argument_object(paramwait)
+        handle = argument_value(paramwait.hdcam)
+        if handle not in self.cameras:
+            return DCAMERR_INVALIDHANDLE
+        # The wait handle of a camera is its handle.
+        self.waits[handle] = self.cameras[handle]
+        paramwait.hwait = handle
+        return DCAMERR_NOERROR
+
+    def dcamwait_close(self, hwait):
+        if self.waits.pop(argument_value(hwait), None) is None:
+            return DCAMERR_INVALIDHANDLE
+        return DCAMERR_NOERROR
+
+    def dcamwait_start(self, hwait, paramstart):
+        camera = self.waits.get(argument_value(hwait))
+        if camera is None:
+            return DCAMERR_INVALIDHANDLE
+        paramstart = argument_object(paramstart)
+        event, error = camera.wait(paramstart.eventmask, paramstart.timeout)
+        paramstart.eventhappened = event
+        return error
+
+
+if __name__ == "__main__":
+    # Throughput of taking frames out of the simulated camera into a tif
+    # file, without waiting for the frame rate.
+    import os
+    import tempfile
+
+    from . import HamamatsuDCAM
+    from .frame_recorder import FrameRecorder
+
+    HamamatsuDCAM.set_dcam(SimulatedDCAM(realtime=False))
+    frame_number = 100
+    hcam = HamamatsuDCAM.HamamatsuCameraMR(camera_id=0)
+    for size in (256, 512, 1024, 2048):
+        hcam.setPropertyValue("subarray_hsize", size)
+        hcam.setPropertyValue("subarray_vsize", size)
+        with tempfile.TemporaryDirectory() as directory:
+            hcam.startAcquisition()
+            recorder = FrameRecorder(
+                os.path.join(directory, "benchmark.tif"), timeout=None
+            )
+            start = time.perf_counter()
+            while recorder.frames_added < frame_number:
+                frames, dims, stamps = hcam.getFrames(stamps=True)
+                for frame, stamp in zip(frames, stamps):
+                    recorder.add(frame, stamp)
+            hcam.stopAcquisition()
+            recorder.close(hcam.getAcquisitionMetrics())
+            duration = time.perf_counter() - start
+        print(
+            f"{size}x{size}: {recorder.frames_written} frames in "
+            f"{duration:.3f} s, {recorder.frames_written / duration:.0f} "
+            f"frames/s, {hcam.frames_lost} lost"
+        )
+    hcam.shutdown()
@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+"""
+Writing camera frames to disk while the camera is still acquiring.
+
+A recording used to keep every frame in a list during the acquisition and
+write the tif file only after the camera stopped, so the length of a
+recording was limited by the memory and saving took minutes after every
+run. FrameRecorder copies each frame out of the DCAM buffers into a bounded
+queue, and a writer thread appends the frames to the tif file during the
+acquisition. When the acquisition stops only the frames still in the queue
+are left to write.
+
+If the disk cannot keep up, add() waits for a while for room in the queue,
+which shows as back-pressure, and drops the frame if there is still no
+room. Both are counted, a recording with dropped frames is logged.
+
+The hardware framestamp and timestamp of every written frame are saved
+next to the tif file in <name>_frame_stamps.npz, with the frame counts of
+the camera and the recorder, to align the frames with the DAQ data.
+
+Usage:
+    recorder = FrameRecorder(path, description=metaData)
+    while acquiring:
+        frames, dims, stamps = hcam.getFrames(stamps=True)
+        for frame, stamp in zip(frames, stamps):
+            recorder.add(frame, stamp)
+    recorder.close(hcam.getAcquisitionMetrics())  # The file is complete.
+    recorder.frames_written, recorder.frames_dropped
+
+    stamps = read_frame_stamps(path)
+    stamps["timestamp"], stamps["frames_lost"]
+"""
+import logging
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+import tifffile as skimtiff
+
+from .HamamatsuDCAM import FRAME_STAMP_DTYPE
+
+
+def frame_stamps_path(path):
+    """The file with the frame stamps of the recording at path."""
+    return os.path.splitext(path)[0] + "_frame_stamps.npz"
+
+
+def read_frame_stamps(path):
+    """
+    Read the frame stamps of a recording.
+
+    Parameters
+    path : str
+        The tif file of the recording.
+
+    Returns
+    stamps : dict
+        "framestamp" and "timestamp" of every frame in the tif file, and
+        the frame counts of the recording.
+
+    """
+    with np.load(frame_stamps_path(path)) as stamps:
+        return {key: stamps[key] for key in stamps.files}
+
+
+class FrameRecorder:
+    def __init__(
+        self,
+        path,
+        description=None,
+        max_pending=64,
+        timeout=0.5,
+        imagej=False,
+    ):
+        """
+        Open the tif file and start the writer thread.
+
+        Parameters
+        path : str
+            The tif file, frames are appended if it exists.
+        description : str, optional
+            Description saved with every frame, like the camera metadata.
+            ImageJ files get the ImageJ metadata instead. The default is
+            None.
+        max_pending : int, optional
+            Number of frames that can wait for the writer. The default is
+            64, 512 MB of full 2048x2048 frames.
+        timeout : float, optional
+            Time in s add() waits for room in the queue before it drops a
+            frame. None waits as long as it takes, for frames that are
+            already in memory. The default is 0.5.
+        imagej : bool, optional
+            Write an ImageJ hyperstack compatible file. The default is
+            False.
+
+        Returns
+        None.
+
+        """
+        self.path = path
+        self.description = description
+        self.timeout = timeout
+        self.imagej = imagej
+
+        self.frames_added = 0
+        self.frames_written = 0
+        self.frames_dropped = 0
+        # Number of frames that had to wait for room in the queue, and the
+        # largest number of frames waiting for the writer.
+        self.backpressure_events = 0
+        self.max_pending = 0
+        self.error = None
+        self.stamps = []
+
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._tif = skimtiff.TiffWriter(path, append=True, imagej=imagej)
+        self._writer = threading.Thread(
+            target=self._write, name="frame-recorder", daemon=True
+        )
+        self.start_time = time.time()
+        self._writer.start()
+
+    @property
+    def pending(self):
+        """Number of frames waiting for the writer."""
+        return self._queue.qsize()
+
+    def add(self, frame, stamp=None):
+        """
+        Copy a frame into the queue for writing.
+
+        Parameters
+        frame : np.ndarray
+            The frame, it can be a view of a DCAM buffer that is reused
+            afterwards.
+        stamp : np.void, optional
+            The FRAME_STAMP_DTYPE stamp of the frame from getFrames. The
+            default is None.
+
+        Returns
+        added : bool
+            False if the frame was dropped.
+
+        """
+        if self._writer is None:
+            raise RuntimeError("The recorder is closed")
+
+        self.frames_added += 1
+        if self.error is not None:
+            self.frames_dropped += 1
+            return False
+
+        item = (np.array(frame, copy=True), stamp)
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            self.backpressure_events += 1
+            try:
+                self._queue.put(item, timeout=self.timeout)
+            except queue.Full:
+                self.frames_dropped += 1
+                if self.frames_dropped == 1:
+                    logging.warning(
+                        "Disk too slow, dropping frames of {}".format(
+                            self.path
+                        )
+                    )
+                return False
+
+        self.max_pending = max(self.max_pending, self._queue.qsize())
+        return True
+
+    def _write(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            image, stamp = item
+
+            if self.error is not None:
+                self.frames_dropped += 1
+                continue
+            try:
+                if self.imagej:
+                    # An ImageJ hyperstack is one contiguous series.
+                    self._tif.write(image, contiguous=True)
+                else:
+                    self._tif.write(image, description=self.description)
+                self.frames_written += 1
+                self.stamps.append(stamp)
+            except Exception as exc:
+                # Keep draining the queue, so the acquisition does not
+                # block on a broken file.
+                logging.critical("caught exception", exc_info=exc)
+                self.error = exc
+                self.frames_dropped += 1
+
+    def close(self, metrics=None):
+        """
+        Write the frames left in the queue and close the file.
+
+        If writing failed, the frames from then on are counted as dropped
+        and the exception is kept in self.error, for the caller to report.
+
+        Parameters
+        metrics : dict, optional
+            Frame counts of the camera, like getAcquisitionMetrics, saved
+            with the frame stamps. The default is None.
+
+        Returns
+        None.
+
+        """
+        if self._writer is None:
+            return
+
+        self._queue.put(None)
+        self._writer.join()
+        self._writer = None
+        self._tif.close()
+
+        if metrics is not None or any(s is not None for s in self.stamps):
+            self.save_stamps(metrics)
+
+        logging.info(
+            "Recorded {} of {} frames to {} in {} s, {} dropped, at most "
+            "{} frames waiting for the disk.".format(
+                self.frames_written,
+                self.frames_added,
+                self.path,
+                round(time.time() - self.start_time, 2),
+                self.frames_dropped,
+                self.max_pending,
+            )
+        )
+
+    def save_stamps(self, metrics=None):
+        """Save the stamps of the written frames and the frame counts."""
+        stamps = np.zeros(len(self.stamps), dtype=FRAME_STAMP_DTYPE)
+        stamps["framestamp"] = -1
+        stamps["timestamp"] = np.nan
+        for index, stamp in enumerate(self.stamps):
+            if stamp is not None:
+                stamps[index] = stamp
+
+        counts = dict(metrics or {})
+        counts.update(
+            frames_written=self.frames_written,
+            frames_dropped=self.frames_dropped,
+            backpressure_events=self.backpressure_events,
+            max_pending=self.max_pending,
+        )
+        np.savez(
+            frame_stamps_path(self.path),
+            framestamp=stamps["framestamp"],
+            timestamp=stamps["timestamp"],
+            **counts,
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+Live view of the camera, decoupled from the acquisition.
+
+The live view used to take every frame, downsample it with block_reduce and
+draw it from the acquisition thread, so the drawing throttled the camera.
+Now the acquisition thread only puts the newest frame in a FrameMailbox,
+replacing the frame that was not shown yet. The GUI takes the newest frame
+at its own, capped, rate and draws it. Frames that came in between are
+never copied or drawn.
+
+bin_image reduces full frames for display by integer binning or striding,
+and subsample_levels gets the display levels from a subsample of the frame
+instead of all pixels.
+
+Usage:
+    mailbox = FrameMailbox()
+    # Acquisition thread:
+    frames, dims = hcam.getFrames()
+    mailbox.put(frames[-1])
+    # GUI timer:
+    frame = mailbox.take()
+    if frame is not None:
+        image = bin_image(frame, 2)
+        image_item.setImage(image, levels=subsample_levels(image))
+"""
+import threading
+
+import numpy as np
+
+
+class FrameMailbox:
+    def __init__(self):
+        """
+        One slot for the newest frame, the latest frame wins.
+
+        Returns
+        None.
+
+        """
+        self._lock = threading.Lock()
+        self._frame = None
+        self.frames_put = 0
+        # Frames replaced before they were taken.
+        self.frames_skipped = 0
+
+    def put(self, frame):
+        """
+        Put the newest frame, replacing the one that was not taken yet.
+
+        Parameters
+        frame : np.ndarray
+            The frame, it is not copied. A view of a camera buffer stays
+            valid for as long as the camera does not write that buffer again.
+
+        Returns
+        None.
+
+        """
+        with self._lock:
+            if self._frame is not None:
+                self.frames_skipped += 1
+            self._frame = frame
+            self.frames_put += 1
+
+    def take(self, copy=True):
+        """
+        Take the newest frame out of the mailbox.
+
+        Parameters
+        copy : bool, optional
+            Copy the frame, so it stays valid when the camera reuses its
+            buffer. The default is True.
+
+        Returns
+        frame : np.ndarray
+            The newest frame, or None if there is no new frame.
+
+        """
+        with self._lock:
+            frame = self._frame
+            self._frame = None
+        if frame is not None and copy:
+            frame = frame.copy()
+        return frame
+
+    def clear(self):
+        """Drop the waiting frame and reset the counts."""
+        with self._lock:
+            self._frame = None
+            self.frames_put = 0
+            self.frames_skipped = 0
+
+
+def bin_image(image, factor, mode="mean"):
+    """
+    Reduce an image by an integer factor along both axes.
+
+    Parameters
+    image : np.ndarray
+        2D image.
+    factor : int
+        Binning factor, 1 returns the image itself.
+    mode : str, optional
+        "mean" averages factor x factor blocks in integers, "stride" takes
+        every factor-th pixel, which costs nothing but aliases. The default
+        is "mean".
+
+    Returns
+    binned : np.ndarray
+        The image of shape (height // factor, width // factor), of the same
+        dtype for integer images. Rows and columns that do not fill a block
+        are left out.
+
+    """
+    factor = int(factor)
+    if factor <= 1:
+        return image
+    if mode == "stride":
+        return image[::factor, ::factor]
+
+    height = image.shape[0] // factor
+    width = image.shape[1] // factor
+    if np.issubdtype(image.dtype, np.unsignedinteger):
+        dtype = np.uint32
+    elif np.issubdtype(image.dtype, np.integer):
+        dtype = np.int64
+    else:
+        dtype = np.float64
+
+    # Adding the factor x factor strided views is much faster than summing
+    # a reshaped block array over two axes.
+    binned = np.zeros((height, width), dtype=dtype)
+    for row in range(factor):
+        for column in range(factor):
+            binned += image[
+                row : height * factor : factor,
+                column : width * factor : factor,
+            ]
+
+    if dtype == np.float64:
+        return binned / (factor * factor)
+    binned //= factor * factor
+    return binned.astype(image.dtype)
+
+
+def display_binning(shape, max_size=1024):
+    """Smallest integer binning factor that fits shape within max_size."""
+    return max(1, -(-max(shape) // max_size))
+
+
+def subsample_levels(image, samples=65536, percentiles=None):
+    """
+    Display levels from a subsample of the image.
+
+    Parameters
+    image : np.ndarray
+        2D image.
+    samples : int, optional
+        Approximate number of pixels to look at. The default is 65536.
+    percentiles : tuple, optional
+        Lower and upper percentile for the levels, to ignore hot pixels.
+        The default is None, which takes the minimum and maximum.
+
+    Returns
+    levels : tuple
+        (black level, white level).
+
+    """
+    step = max(1, int(np.sqrt(image.size / samples)))
+    sample = image[::step, ::step]
+    if percentiles is None:
+        low, high = sample.min(), sample.max()
+    else:
+        low, high = np.percentile(sample, percentiles)
+    if high <= low:
+        high = low + 1
+    return float(low), float(high)
@@ -40,7 +40,7 @@ from scipy.optimize import curve_fit
 from skimage.io import imread
 
 from .. import StylishQT
-from ..NIDAQ import waveform_specification
+from ..NIDAQ import waveform_file, waveform_specification
 from .ImageProcessing import PatchAnalysis, ProcessImage
 
 
@@ -434,15 +434,13 @@ class AnalysisWidgetUI(QWidget):
                 self.Waveform_filename_npy = self.main_directory + "/" + file
                 # Read in configured waveforms
                 configwave_wavenpfileName = self.Waveform_filename_npy
-                self.configured_waveforms_container = (
-                    waveform_specification.load(configwave_wavenpfileName)
+                self.configured_waveforms_container = waveform_file.load(
+                    configwave_wavenpfileName
                 )
 
                 # Get the sampling rate
                 self.samplingrate_display_curve = (
-                    waveform_specification.get_sample_rate(
-                        configwave_wavenpfileName
-                    )
+                    waveform_file.get_sample_rate(configwave_wavenpfileName)
                 )
                 logging.info(
                     "Waveforms_sampling rate: {}".format(
@@ -1247,11 +1245,9 @@ class PlotAnalysisGUI(QWidget):
 
         # Read in configured waveforms
         configwave_wavenpfileName = self.wave_fileName
-        temp_loaded_container = waveform_specification.load(
-            configwave_wavenpfileName
-        )
+        temp_loaded_container = waveform_file.load(configwave_wavenpfileName)
 
-        Daq_sample_rate = waveform_specification.get_sample_rate(
+        Daq_sample_rate = waveform_file.get_sample_rate(
             configwave_wavenpfileName
         )
 
@@ -48,7 +48,9 @@ from skimage.restoration import denoise_tv_chambolle
 from skimage.segmentation import clear_border
 from skimage.transform import resize
 
-from ..NIDAQ import waveform_specification
+from ..NIDAQ import galvo_trajectory, waveform_file, waveform_specification
+from ..NIDAQ.constants import HardwareConstants
+from .stack_reduction import StackReducer
 
 # import plotly.express as px
 
@@ -1070,44 +1072,48 @@ class ProcessImage:
                     ) * scanning_voltage * 2 - scanning_voltage
 
                     # === interpolate to get 500 points ===
-                    x_axis = np.arange(0, len(voltage_contour_routine_X))
-                    f_x = interpolate.interp1d(
-                        x_axis, voltage_contour_routine_X, kind="cubic"
-                    )
-                    newx = np.linspace(
-                        x_axis.min(), x_axis.max(), num=points_per_contour
-                    )
-                    X_interpolated = f_x(newx)
-
-                    y_axis = np.arange(0, len(voltage_contour_routine_Y))
-                    f_y = interpolate.interp1d(
-                        y_axis, voltage_contour_routine_Y, kind="cubic"
-                    )
-                    newy = np.linspace(
-                        y_axis.min(), y_axis.max(), num=points_per_contour
+                    # Periodic spline evenly spaced by arc length, so the
+                    # scan speed is the same all around the contour.
+                    (
+                        X_interpolated,
+                        Y_interpolated,
+                    ) = galvo_trajectory.resample_evenly(
+                        np.vstack(
+                            (
+                                voltage_contour_routine_X,
+                                voltage_contour_routine_Y,
+                            )
+                        ),
+                        points_per_contour,
+                        closed=True,
+                        spline=True,
                     )
-                    Y_interpolated = f_y(newy)
 
                     # === speed and accelation check ===
-                    time_gap = 1 / sampling_rate
-                    contour_x_acceleration = (
-                        np.diff(X_interpolated, n=2) / time_gap**2
+                    # Too fast for the galvos, take the time optimal
+                    # trajectory along the same contour instead.
+                    ContourArray_forDaq = np.vstack(
+                        (X_interpolated, Y_interpolated)
                     )
-                    contour_y_acceleration = (
-                        np.diff(Y_interpolated, n=2) / time_gap**2
+                    speed, acceleration = galvo_trajectory.measure_limits(
+                        ContourArray_forDaq, sampling_rate
                     )
-
-                    AccelerationGalvo = (
-                        1.54 * 10**8
-                    )  # Maximum acceleration of galvo mirror in volt/s^2
-                    if AccelerationGalvo < np.amax(
-                        abs(contour_x_acceleration)
-                    ):
-                        logging.info(np.amax(abs(contour_x_acceleration)))
-                    if AccelerationGalvo < np.amax(
-                        abs(contour_y_acceleration)
+                    constants = HardwareConstants()
+                    if np.any(speed > constants.maxGalvoSpeed) or np.any(
+                        acceleration > constants.maxGalvoAccel
                     ):
-                        logging.info(np.amax(abs(contour_y_acceleration)))
+                        trajectory = galvo_trajectory.plan_trajectory(
+                            ContourArray_forDaq, sampling_rate, closed=True
+                        )
+                        logging.info(
+                            "Contour of cell {} too fast, {} points at {:.1f} "
+                            "rounds/s instead".format(
+                                CellSequenceInRegion,
+                                trajectory.signals.shape[1],
+                                trajectory.repetition_rate,
+                            )
+                        )
+                        X_interpolated, Y_interpolated = trajectory.signals
 
                     X_interpolated = np.around(X_interpolated, decimals=3)
                     Y_interpolated = np.around(Y_interpolated, decimals=3)
@@ -1130,100 +1136,100 @@ class ProcessImage:
         """
         Given the binary contour, sort the index so that they are in clockwise sequence for further contour scanning.
 
+        The outer boundary of the contour is traced with Moore neighbour
+        tracing from its top left pixel, stopping when the top left pixel
+        is entered again the same way as at the start (Jacob's stopping
+        criterion). The sequence is then made clockwise from the sign of
+        its enclosed area. Corner pixels next to a diagonal step are kept,
+        other inner pixels of thick parts of the contour and pixels of other
+        contours are left out.
+
         Parameters
         cellmap : ndarray
             Binary contour skeleton.
 
         Returns
-        result : ndarray
-            In clockwise sequence.
+        result : list
+            (row, column) of the contour pixels in clockwise sequence,
+            ending with the top left pixel.
 
         """
+        contour = np.asarray(cellmap) == 1
+        if np.count_nonzero(contour) < 2:
+            rows, columns = np.nonzero(contour)
+            return list(zip(rows.tolist(), columns.tolist()))
+
+        # Padded, so the neighbours of the edge pixels can be looked up in
+        # the flat arrays.
+        width = contour.shape[1] + 2
+        padded = np.zeros((contour.shape[0] + 2, width), dtype=bool)
+        padded[1:-1, 1:-1] = contour
+        is_contour = padded.ravel()
+
+        # Flat offsets of the neighbours in clockwise order as the image is
+        # shown, starting left. The rows go down.
+        offsets = [
+            -1,
+            -width - 1,
+            -width,
+            -width + 1,
+            1,
+            width + 1,
+            width,
+            width - 1,
+        ]
 
-        rawindexlist = list(
-            zip(np.where(cellmap == 1)[0], np.where(cellmap == 1)[1])
-        )
-        rawindexlist.sort()
-
-        cclockwiselist = rawindexlist[
-            0:1
-        ]  # first point in clockwise direction
-        clockwiselist = rawindexlist[
-            1:2
-        ]  # first point in counter clockwise direction
-        # reverse the above assignment depending on how first 2 points relate
-        if rawindexlist[1][1] > rawindexlist[0][1]:
-            clockwiselist = rawindexlist[1:2]
-            cclockwiselist = rawindexlist[0:1]
-
-        coordstorage = rawindexlist[2:]
-        # print(len(rawindexlist))
-        timeout = time.time()
-        while len(clockwiselist + cclockwiselist) != len(rawindexlist):
-            for (
-                p
-            ) in (
-                coordstorage
-            ):  # Try one by one from coords dump until find one that is right next to existing clockwise or counter clockwise liste.
-                # append to the list to which the next point is closest
-                x_last_clockwise = clockwiselist[-1][0]
-                y_last_clockwise = clockwiselist[-1][1]
-                x_last_cclockwise = cclockwiselist[-1][0]
-                y_last_cclockwise = cclockwiselist[-1][1]
-                if (x_last_clockwise - p[0]) ** 2 + (
-                    y_last_clockwise - p[1]
-                ) ** 2 <= 2 and (
-                    (x_last_clockwise - p[0]) ** 2
-                    + (y_last_clockwise - p[1]) ** 2
-                ) <= (
-                    (x_last_cclockwise - p[0]) ** 2
-                    + (y_last_cclockwise - p[1]) ** 2
-                ):
-                    clockwiselist.append(p)
-                    coordstorage.remove(p)
-                    break
-                elif (x_last_cclockwise - p[0]) ** 2 + (
-                    y_last_cclockwise - p[1]
-                ) ** 2 <= 2 and (
-                    (x_last_clockwise - p[0]) ** 2
-                    + (y_last_clockwise - p[1]) ** 2
-                ) > (
-                    (x_last_cclockwise - p[0]) ** 2
-                    + (y_last_cclockwise - p[1]) ** 2
-                ):
-                    cclockwiselist.append(p)
-                    coordstorage.remove(p)
+        # The first pixel in row major order is the top left one, so the
+        # pixel left of it is background to start the search from.
+        start = int(np.flatnonzero(is_contour)[0])
+        position = start
+        backtrack = 0
+        start_entry = None
+        path = []
+        # Every boundary pixel is entered from at most 8 directions.
+        for _ in range(8 * np.count_nonzero(is_contour) + 1):
+            for turn in range(1, 9):
+                direction = (backtrack + turn) % 8
+                if is_contour[position + offsets[direction]]:
                     break
-            # If clockwise and counter clockwise meet each other
-            if (
-                len(clockwiselist + cclockwiselist) > 10
-                and (x_last_clockwise - x_last_cclockwise) ** 2
-                + (y_last_clockwise - y_last_cclockwise) ** 2
-                <= 2
-            ):
+            else:
+                # An isolated pixel.
                 break
-            # If we have a situation like this at the end of enclosure:
-            # 0  0  1
-            # 0  1  1
-            # 1  0  0
-            if (
-                len(clockwiselist + cclockwiselist) > 10
-                and (x_last_clockwise - x_last_cclockwise) ** 2
-                + (y_last_clockwise - y_last_cclockwise) ** 2
-                == 5
-            ):
-                if (cclockwiselist[-2][0] - clockwiselist[-1][0]) ** 2 + (
-                    cclockwiselist[-2][1] - clockwiselist[-1][1]
-                ) ** 2 == 2:
-                    cclockwiselist.remove(cclockwiselist[-1])
-                    break
-
-            if time.time() > timeout + 2:
-                logging.info("timeout")
+            entry = (position, direction)
+            if start_entry is None:
+                start_entry = entry
+            elif entry == start_entry:
                 break
-        logging.info(coordstorage)
-        cclockwiselist.reverse()
-        result = clockwiselist + cclockwiselist
+            corner = position + offsets[(direction + 1) % 8]
+            if direction % 2 == 1 and is_contour[corner]:
+                # Keep the corner pixel next to a diagonal step as well,
+                # the other corner was searched and is background.
+                path.append(corner)
+            position += offsets[direction]
+            path.append(position)
+            # Search on from the background pixel checked last, as seen
+            # from the new position.
+            previous = (
+                position - offsets[direction] + offsets[(direction - 1) % 8]
+            )
+            backtrack = offsets.index(previous - position)
+
+        if not path:
+            path = [start]
+
+        rows, columns = np.divmod(np.array(path), width)
+        rows, columns = rows - 1, columns - 1
+
+        # With the rows going down, a clockwise sequence has a positive
+        # shoelace sum.
+        area = np.sum(
+            columns * np.roll(rows, -1) - np.roll(columns, -1) * rows
+        )
+        if area < 0:
+            rows = np.append(rows[-2::-1], rows[-1])
+            columns = np.append(columns[-2::-1], columns[-1])
+
+        result = list(zip(rows.tolist(), columns.tolist()))
 
         return result
 
@@ -1233,15 +1239,9 @@ class ProcessImage:
         """
         # Given the clockwise sorted binary contour, interploate and filter for further contour scanning.
         """
-        Unfiltered_contour_routine_X = np.array([])
-        Unfiltered_contour_routine_Y = np.array([])
-        for rawcoord in clockwise_sorted_raw_trace:
-            Unfiltered_contour_routine_X = np.append(
-                Unfiltered_contour_routine_X, rawcoord[0]
-            )
-            Unfiltered_contour_routine_Y = np.append(
-                Unfiltered_contour_routine_Y, rawcoord[1]
-            )
+        raw_trace = np.array(clockwise_sorted_raw_trace, dtype=float)
+        Unfiltered_contour_routine_X = raw_trace[:, 0]
+        Unfiltered_contour_routine_Y = raw_trace[:, 1]
 
         X_routine = filters.gaussian_filter1d(
             Unfiltered_contour_routine_X, sigma=filtering_kernel
@@ -1251,8 +1251,7 @@ class ProcessImage:
         )
 
         filtered_cellmap = np.zeros((cellmap.shape[0], cellmap.shape[1]))
-        for i in range(len(X_routine)):
-            filtered_cellmap[int(X_routine[i]), int(Y_routine[i])] = 1
+        filtered_cellmap[X_routine.astype(int), Y_routine.astype(int)] = 1
 
         return [X_routine, Y_routine], filtered_cellmap
 
@@ -1306,23 +1305,14 @@ class ProcessImage:
             ) * scanning_voltage * 2 - scanning_voltage
 
             # -----interpolate to get desired number of points in one contour---
-            x_axis = np.arange(0, len(voltage_contour_routine_X))
-            f_x = interpolate.interp1d(
-                x_axis, voltage_contour_routine_X, kind="cubic"
-            )
-            newx = np.linspace(
-                x_axis.min(), x_axis.max(), num=points_per_contour
-            )
-            X_interpolated = f_x(newx)
-
-            y_axis = np.arange(0, len(voltage_contour_routine_Y))
-            f_y = interpolate.interp1d(
-                y_axis, voltage_contour_routine_Y, kind="cubic"
-            )
-            newy = np.linspace(
-                y_axis.min(), y_axis.max(), num=points_per_contour
+            X_interpolated, Y_interpolated = galvo_trajectory.resample_evenly(
+                np.vstack(
+                    (voltage_contour_routine_X, voltage_contour_routine_Y)
+                ),
+                points_per_contour,
+                closed=True,
+                spline=True,
             )
-            Y_interpolated = f_y(newy)
 
             # === speed and accelation check ===
             time_gap = 1 / sampling_rate
@@ -3899,23 +3889,16 @@ class ProcessImage:
             DESCRIPTION.
 
         """
-        image_index = 0
+        # Reduce the images one by one instead of stacking them.
+        reducer = StackReducer()
         for image_file_name in image_file_names:
-            single_image = imread(image_file_name)
-
-            # stack the images
-            if image_index == 0:
-                image_stack = single_image[np.newaxis, :, :]
-            else:
-                image_stack = np.concatenate(
-                    (image_stack, single_image[np.newaxis, :, :]), axis=0
-                )
+            reducer.add(imread(image_file_name))
 
         if operation == "mean":
-            output = np.mean(image_stack, axis=0).astype(np.uint16)
+            output = reducer.mean.astype(np.uint16)
             logging.info(output.dtype)
         elif operation == "max projection":
-            output = np.max(image_stack, axis=0).astype(np.uint16)
+            output = reducer.max.astype(np.uint16)
 
         return output
 
@@ -4121,6 +4104,8 @@ class ProcessImage:
             fileNameList,
         ) = ProcessImage.retrive_scanning_scheme(directory, file_keyword="Cam")
 
+        # The same buffers are used for the stack of every coordinate.
+        reducer = StackReducer()
         for each_round in RoundNumberList:
             # Do Z-stack max projection
             for each_coordinate in CoordinatesList:
@@ -4136,30 +4121,15 @@ class ProcessImage:
                 coordinate_infor = each_coordinate
 
                 # === Calculate the z max projection ===
-                ZStackOrder = 0
+                reducer.reset()
                 for each_z_img_filename in img_zstack_list:
-                    each_z_img = imread(
-                        os.path.join(directory, each_z_img_filename)
+                    reducer.add(
+                        imread(os.path.join(directory, each_z_img_filename))
                     )
-                    if ZStackOrder == 0:
-                        Cam_image_maxprojection_stack = each_z_img[
-                            np.newaxis, :, :
-                        ]
-                    else:
-                        Cam_image_maxprojection_stack = np.concatenate(
-                            (
-                                Cam_image_maxprojection_stack,
-                                each_z_img[np.newaxis, :, :],
-                            ),
-                            axis=0,
-                        )
-                    ZStackOrder += 1
 
                 # Save the max projection image
-                if ZStackOrder == len(img_zstack_list):
-                    Cam_image_maxprojection = np.max(
-                        Cam_image_maxprojection_stack, axis=0
-                    ).astype(np.uint16)
+                if reducer.count > 0:
+                    Cam_image_maxprojection = reducer.max.astype(np.uint16)
 
                     if seperate_folder is True:
                         if not os.path.exists(
@@ -4543,12 +4513,10 @@ class ProcessImage:
                     found_correct_waveform_spelling = True
 
                 wave_fileName = os.path.join(main_directory, file)
-                temp_wave_container = waveform_specification.load(
+                temp_wave_container = waveform_file.load(wave_fileName)
+                wave_file_sampling_rate = waveform_file.get_sample_rate(
                     wave_fileName
                 )
-                wave_file_sampling_rate = (
-                    waveform_specification.get_sample_rate(wave_fileName)
-                )
 
             if "Ip" in file and "npy" in file:
                 current_fileName = os.path.join(main_directory, file)
@@ -4571,7 +4539,9 @@ class ProcessImage:
         # Get the blanking waveform as indication of laser on and off.
         for i in temp_wave_container:
             if i["Specification"] == marker:
-                blanking_waveform = i["Waveform"][1 : len(i["Waveform"]) - 1]
+                # Digital waveforms of .wvf files are run-length encoded.
+                waveform = np.asarray(i["Waveform"])
+                blanking_waveform = waveform[1 : len(waveform) - 1]
 
         laser_on_phases, laser_off_phases = ProcessImage.threshold_seperator(
             blanking_waveform, 1
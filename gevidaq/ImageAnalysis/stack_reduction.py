@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming reduction of image stacks.
+
+The z max projections used to concatenate every plane onto a growing stack
+and take the maximum at the end, so memory and time grew with the depth of
+the stack. StackReducer updates its results in place as each plane comes
+in, with a fixed amount of memory whatever the number of planes:
+
+    - the maximum projection,
+    - the mean,
+    - the plane with the highest focus degree,
+    - optionally the top_k planes with the highest focus degree,
+    - optionally the maximum projection without the worst focused plane.
+
+Usage:
+    reducer = StackReducer(focus_measure=ProcessImage.local_entropy)
+    for image in planes:
+        reducer.add(image)
+    reducer.max, reducer.mean, reducer.best, reducer.best_focus_degree
+
+    reducer = StackReducer(top_k=2)
+    for image, focus_degree in zip(planes, focus_degrees):
+        reducer.add(image, focus_degree)
+    reducer.top_k_max()
+
+    reducer = StackReducer(ditch_worst=True)
+    for image, focus_degree in zip(planes, focus_degrees):
+        reducer.add(image, focus_degree)
+    reducer.max_without_worst
+"""
+import numpy as np
+
+
+class StackReducer:
+    def __init__(self, top_k=0, focus_measure=None, ditch_worst=False):
+        """
+        Running maximum, mean and best focused planes of a stack.
+
+        Parameters
+        top_k : int, optional
+            Number of best focused planes to keep. The default is 0.
+        focus_measure : callable, optional
+            Function giving the focus degree of an image, used when add()
+            gets no focus degree. The default is None, planes without focus
+            degree are then only in the maximum and the mean.
+        ditch_worst : bool, optional
+            Whether to keep the maximum projection without the worst
+            focused plane. The default is False.
+
+        Returns
+        None.
+
+        """
+        self.top_k = int(top_k)
+        self.focus_measure = focus_measure
+        self.ditch_worst = ditch_worst
+        self._max = None
+        self.reset()
+
+    def reset(self):
+        """Start a new stack, the buffers are reused if the shape is equal."""
+        self.count = 0
+        self.best_focus_degree = None
+        self.best_index = None
+        self._top_k_focus_degrees = []
+        self._top_k_indices = []
+        self.worst_focus_degree = None
+        self.worst_index = None
+        self._without_worst_count = 0
+
+    def _allocate(self, image):
+        shape_changed = (
+            self._max is None
+            or self._max.shape != image.shape
+            or self._max.dtype != image.dtype
+        )
+        if shape_changed:
+            self._max = np.empty_like(image)
+            self._sum = np.empty(image.shape, dtype=np.float64)
+            self._best = np.empty_like(image)
+            self._top_k_images = [
+                np.empty_like(image) for _ in range(self.top_k)
+            ]
+            if self.ditch_worst:
+                self._worst = np.empty_like(image)
+                self._without_worst = np.empty_like(image)
+
+        np.copyto(self._max, image)
+        self._sum[...] = 0
+
+    def add(self, image, focus_degree=None):
+        """
+        Add a plane to the results.
+
+        Parameters
+        image : np.ndarray
+            The plane, every plane of a stack has the same shape.
+        focus_degree : float, optional
+            Focus degree of the plane, the higher the better. The default
+            is None, which uses focus_measure if given.
+
+        Returns
+        focus_degree : float
+            The focus degree used for the plane, or None.
+
+        """
+        image = np.asarray(image)
+        if self.count == 0:
+            self._allocate(image)
+        elif image.shape != self._max.shape:
+            raise ValueError(
+                f"Plane of shape {image.shape} does not fit a stack of "
+                f"{self._max.shape}"
+            )
+        else:
+            np.maximum(self._max, image, out=self._max)
+        np.add(self._sum, image, out=self._sum)
+
+        if focus_degree is None and self.focus_measure is not None:
+            focus_degree = self.focus_measure(image)
+
+        if focus_degree is not None:
+            if (
+                self.best_focus_degree is None
+                or focus_degree > self.best_focus_degree
+            ):
+                self.best_focus_degree = focus_degree
+                self.best_index = self.count
+                np.copyto(self._best, image)
+
+            self._add_top_k(image, focus_degree)
+            self._add_without_worst(image, focus_degree)
+
+        self.count += 1
+        return focus_degree
+
+    def _add_top_k(self, image, focus_degree):
+        if self.top_k == 0:
+            return
+
+        degrees = self._top_k_focus_degrees
+        if len(degrees) < self.top_k:
+            slot = len(degrees)
+            degrees.append(focus_degree)
+            self._top_k_indices.append(self.count)
+        else:
+            # Replace the worst kept plane if this one is better.
+            slot = int(np.argmin(degrees))
+            if focus_degree <= degrees[slot]:
+                return
+            degrees[slot] = focus_degree
+            self._top_k_indices[slot] = self.count
+        np.copyto(self._top_k_images[slot], image)
+
+    def _add_without_worst(self, image, focus_degree):
+        if not self.ditch_worst:
+            return
+
+        if self.worst_index is None:
+            np.copyto(self._worst, image)
+        elif focus_degree < self.worst_focus_degree:
+            # The previous worst plane joins the others.
+            self._merge_without_worst(self._worst)
+            np.copyto(self._worst, image)
+        else:
+            self._merge_without_worst(image)
+            return
+        self.worst_focus_degree = focus_degree
+        self.worst_index = self.count
+
+    def _merge_without_worst(self, image):
+        if self._without_worst_count == 0:
+            np.copyto(self._without_worst, image)
+        else:
+            np.maximum(self._without_worst, image, out=self._without_worst)
+        self._without_worst_count += 1
+
+    @property
+    def max(self):
+        """Maximum projection of the planes added so far."""
+        if self.count == 0:
+            return None
+        return self._max
+
+    @property
+    def mean(self):
+        """Mean of the planes added so far, as float64."""
+        if self.count == 0:
+            return None
+        return self._sum / self.count
+
+    @property
+    def best(self):
+        """The plane with the highest focus degree."""
+        if self.best_index is None:
+            return None
+        return self._best
+
+    @property
+    def max_without_worst(self):
+        """
+        Maximum projection of the planes with a focus degree, except the
+        worst focused one. None before there are two of them.
+        """
+        if self._without_worst_count == 0:
+            return None
+        return self._without_worst
+
+    def top_k_planes(self):
+        """
+        The kept best focused planes.
+
+        Returns
+        planes : list
+            (focus degree, plane index, image) of each kept plane, the
+            best focused first.
+        """
+        planes = [
+            (degree, index, self._top_k_images[slot])
+            for slot, (degree, index) in enumerate(
+                zip(self._top_k_focus_degrees, self._top_k_indices)
+            )
+        ]
+        return sorted(planes, key=lambda plane: plane[0], reverse=True)
+
+    def top_k_max(self):
+        """Maximum projection of the kept best focused planes."""
+        kept = len(self._top_k_focus_degrees)
+        if kept == 0:
+            return None
+
+        output = self._top_k_images[0].copy()
+        for image in self._top_k_images[1:kept]:
+            np.maximum(output, image, out=output)
+        return output
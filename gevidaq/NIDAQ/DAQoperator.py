@@ -7,17 +7,48 @@ Created on Fri May 29 15:29:22 2020
 """
 # READIN TASK HAS TO START AHEAD OF READ MANY SAMPLES, OTHERWISE ITS NOT in SYN!!!
 
+import collections
 import logging
 import os
+import tempfile
+import threading
 from datetime import datetime
 
 import nidaqmx
 import numpy as np
-from nidaqmx.constants import AcquisitionType, LineGrouping
-from nidaqmx.stream_readers import AnalogMultiChannelReader
+from nidaqmx.constants import (
+    AcquisitionType,
+    LineGrouping,
+    RegenerationMode,
+    WriteRelativeTo,
+)
 from PyQt5.QtCore import QThread, pyqtSignal
 
+from . import daq_backend, static_outputs
 from .constants import NiDaqChannels
+from .digital_waveform import PortWaveform, RunLengthWaveform
+from .waveform_stream import CycleStream
+
+# Everything needed to run a set of waveforms, see DAQmission.compileWaveforms.
+# The sample arrays are read-only, so a plan can be run many times.
+TaskPlan = collections.namedtuple(
+    "TaskPlan",
+    [
+        "clock_source",
+        "sampling_rate",
+        "samples_number",
+        "repeats",
+        "dev1_analog_channels",
+        "dev1_analog_samples",
+        "dev2_analog_channels",
+        "dev2_analog_samples",
+        "digital_samples",
+        "readin_channels",
+        "ai_channels",
+        "averagenumber",
+        "ypixelnumber",
+    ],
+)
 
 
 class DAQmission(QThread):
@@ -26,6 +57,8 @@ class DAQmission(QThread):
     """
 
     collected_data = pyqtSignal(np.ndarray)
+    # In streaming mode, each chunk of recorded data and its first sample index.
+    collected_chunk = pyqtSignal(np.ndarray, int)
     finishSignal = pyqtSignal()
 
     def __init__(self, channel_LUT=None, *args, **kwargs):
@@ -41,14 +74,35 @@ class DAQmission(QThread):
         else:
             self.channel_LUT = channel_LUT
 
+        # Number of chunks held in the ring buffer when streaming recordings.
+        self.stream_ring_size = 8
+        self.stream_chunk_size = None
+        self.output_chunk_size = None
+        # Run-length encoded samples are written in chunks of this size.
+        self.write_chunk_size = 2**20
+        self.output_streams = None
+        self.output_stream_thread = None
+
+        # Tasks configured for self.configured_plan, kept open between runs,
+        # and the daq_backend they were created with.
+        self.daq = None
+        self.open_tasks = []
+        self.output_tasks = []
+        self.readin_task = None
+        self.reader = None
+        self.configured_plan = None
+
     def sendSingleAnalog(self, channel, value):
         """
-        Write one single digital signal.
+        Write one single analog signal.
+
+        The task of the channel stays open for the next call, see
+        static_outputs.
 
         Parameters
         channel : str
             Purpose of the channel.
-        value : bool
+        value : float
             Value to send.
 
         Returns
@@ -59,19 +113,21 @@ class DAQmission(QThread):
         self.channelname = self.channel_LUT[channel]
         self.writting_value = value
 
-        # Assume that dev1 is always employed
-        with nidaqmx.Task() as writingtask:
-            writingtask.ao_channels.add_ao_voltage_chan(self.channelname)
-            writingtask.write(self.writting_value)
+        static_outputs.shared_outputs.write_analog(
+            self.channelname, self.writting_value
+        )
 
     def sendSingleDigital(self, channel, value):
         """
-        Write one single analog signal.
+        Write one single digital signal.
+
+        The task of the channel stays open for the next call, see
+        static_outputs.
 
         Parameters
         channel : str
             Purpose of the channel.
-        value : float
+        value : bool
             Value to send.
 
         Returns
@@ -80,14 +136,10 @@ class DAQmission(QThread):
         """
 
         self.channelname = self.channel_LUT[channel]
-        if value is True:
-            writting_value = np.array([1], dtype=bool)
-        else:
-            writting_value = np.array([0], dtype=bool)
 
-        with nidaqmx.Task() as writingtask:
-            writingtask.do_channels.add_do_chan(self.channelname)
-            writingtask.write(writting_value)
+        static_outputs.shared_outputs.write_digital(
+            self.channelname, value is True
+        )
 
     def runWaveforms(
         self,
@@ -96,6 +148,10 @@ class DAQmission(QThread):
         analog_signals,
         digital_signals,
         readin_channels,
+        stream_chunk_size=None,
+        stream_file=None,
+        repeats=1,
+        output_chunk_size=None,
     ):
         """
         Input:
@@ -117,818 +173,700 @@ class DAQmission(QThread):
               It's a structured array with two fields: 1) 'Waveform': Raw 1-D np.array of type bool.
                                                        2) 'Specification': string that specifies the NI-daq port.
                                                           for example: dtype = np.dtype([('Waveform', float, (self.reference_length,)), ('Specification', 'U20')])
+              Or a digital_waveform.DigitalSignals with run-length encoded waveforms.
            -readinchannels:
               A list that contains the readin channels wanted.
+
+           -stream_chunk_size:
+              If given, the recording is read in chunks of this many samples
+              through a ring buffer into a memory-mapped .npy file, instead of
+              in one go into memory. Each chunk is emitted with collected_chunk.
+
+           -stream_file:
+              Path of the .npy file for streaming. By default an unnamed
+              temporary file is used, which is removed when the recording
+              is no longer referenced.
+
+           -repeats:
+              Number of times the waveforms are played. The waveforms are
+              then one cycle of the protocol, which is expanded while the
+              tasks run instead of being tiled in memory.
+
+           -output_chunk_size:
+              If given, or if repeats is more than 1, the output buffers are
+              filled in chunks of this many samples while the tasks run.
+              By default chunks of 0.1 s. The recording is only streamed
+              if stream_chunk_size is given.
+
+        To run the same waveforms several times, use compileWaveforms once
+        and runPlan for every run instead.
         """
+        plan = self.compileWaveforms(
+            clock_source,
+            sampling_rate,
+            analog_signals,
+            digital_signals,
+            readin_channels,
+            repeats,
+        )
+        try:
+            self.runPlan(
+                plan, stream_chunk_size, stream_file, output_chunk_size
+            )
+        finally:
+            self.closeTasks()
 
-        # Setting up waveforms
-
-        Analog_channel_number = len(analog_signals)
-        Digital_channel_number = len(digital_signals)
-        self.readin_channels = readin_channels
-        self.sampling_rate = sampling_rate
-
-        # galvosx and galvosy as specification key words are already enough.
-
-        # Get the average number and y pixel number information from data
-        self.galvosx_originalkey = "galvosx"
-        self.galvosy_originalkey = "galvosy"
-
-        # If there are kyes with information like 'galvosxavgnum', extract the
-        # information and then convert the key to 'galvosx'.
-        if Analog_channel_number != 0:
-            for i in range(len(analog_signals["Specification"])):
-                if "galvosxavgnum" in analog_signals["Specification"][i]:
-                    self.averagenumber = int(
-                        analog_signals["Specification"][i][
-                            analog_signals["Specification"][i].index("_")
-                            + 1 : len(analog_signals["Specification"][i])
-                        ]
-                    )
-                    self.galvosx_originalkey = analog_signals["Specification"][
-                        i
-                    ]
-                    analog_signals["Specification"][i] = "galvosx"
-                elif "galvosyypixels" in analog_signals["Specification"][i]:
-                    self.ypixelnumber = int(
-                        analog_signals["Specification"][i][
-                            analog_signals["Specification"][i].index("_")
-                            + 1 : len(analog_signals["Specification"][i])
-                        ]
-                    )
-                    self.galvosy_originalkey = analog_signals["Specification"][
-                        i
-                    ]
-                    analog_signals["Specification"][i] = "galvosy"
-                elif "galvos_X_contour" in analog_signals["Specification"][i]:
-                    self.galvosx_originalkey = analog_signals["Specification"][
-                        i
-                    ]
-                    analog_signals["Specification"][i] = "galvosx"
-
-                elif "galvos_Y_contour" in analog_signals["Specification"][i]:
-                    self.galvosy_originalkey = analog_signals["Specification"][
-                        i
-                    ]
-                    analog_signals["Specification"][i] = "galvosy"
+    def compileWaveforms(
+        self,
+        clock_source,
+        sampling_rate,
+        analog_signals,
+        digital_signals,
+        readin_channels,
+        repeats=1,
+    ):
+        """
+        Turn waveforms into a TaskPlan that can be run many times.
 
-        # === Devide samples from Dev1 or 2 ===
-        self.Dev1_analog_channel_list = []
-        self.Dev2_analog_channel_list = []
+        The parameters are those of runWaveforms. The channels are divided
+        over the devices, the samples are stacked per task and the digital
+        lines are packed into port values here, once.
 
+        Returns
+        plan : TaskPlan
+        """
+        # Get the average number and y pixel number information from the
+        # specification keys like 'galvosxavgnum_2' and 'galvosyypixels_500'.
+        averagenumber = None
+        ypixelnumber = None
+
+        # === Devide samples from Dev1 or 2 ===
+        Dev1_analog_channel_list = []
+        Dev2_analog_channel_list = []
         Dev1_analog_waveforms_list = []
         Dev2_analog_waveforms_list = []
 
-        if Analog_channel_number != 0:
-            if len(analog_signals["Waveform"]) != 0:
-                num_rows, num_cols = analog_signals["Waveform"].shape
-                for i in range(int(num_rows)):
-                    specification = analog_signals["Specification"][i]
-                    channel = self.channel_LUT[specification]
-                    waveform = analog_signals["Waveform"][i]
-                    if "Dev1" in channel:
-                        self.Dev1_analog_channel_list.append(channel)
-                        Dev1_analog_waveforms_list.append(waveform)
-                    else:
-                        self.Dev2_analog_channel_list.append(channel)
-                        Dev2_analog_waveforms_list.append(waveform)
-
-        Dev1_analog_channel_number = len(self.Dev1_analog_channel_list)
-        Dev2_analog_channel_number = len(self.Dev2_analog_channel_list)
-
-        # See if only digital signal is involved.
-        if Analog_channel_number == 0 and Digital_channel_number != 0:
-            self.Only_Digital_signals = True
-        else:
-            self.Only_Digital_signals = False
-
-        # See if Dev1 is involved. If only Dev2 is involved in sending analog
-        # signals then the timing configs are different.
+        if len(analog_signals) != 0:
+            for specification, waveform in zip(
+                analog_signals["Specification"], analog_signals["Waveform"]
+            ):
+                # galvosx and galvosy as specification key words are already
+                # enough to find the channel.
+                if "galvosxavgnum" in specification:
+                    averagenumber = int(
+                        specification[specification.index("_") + 1 :]
+                    )
+                    specification = "galvosx"
+                elif "galvosyypixels" in specification:
+                    ypixelnumber = int(
+                        specification[specification.index("_") + 1 :]
+                    )
+                    specification = "galvosy"
+                elif "galvos_X_contour" in specification:
+                    specification = "galvosx"
+                elif "galvos_Y_contour" in specification:
+                    specification = "galvosy"
+
+                channel = self.channel_LUT[specification]
+                if "Dev1" in channel:
+                    Dev1_analog_channel_list.append(channel)
+                    Dev1_analog_waveforms_list.append(waveform)
+                else:
+                    Dev2_analog_channel_list.append(channel)
+                    Dev2_analog_waveforms_list.append(waveform)
 
         # === Number of samples in each waveform ===
-        if self.Only_Digital_signals is False:
-            self.Waveforms_length = len(analog_signals["Waveform"][0])
-            num_rows, num_cols = analog_signals["Waveform"].shape
-            logging.info(f"row number of analog signals:  {num_rows}")
-        elif self.Only_Digital_signals is True:
-            self.Waveforms_length = len(digital_signals["Waveform"][0])
-
-        # === Stack the Analog samples of dev1 and dev2 individually ===
-        # IN CASE OF ONLY ONE ARRAY, WE NEED TO CONVERT THE SHAPE TO (1,N) BY USING np.array([]) OUTSIDE THE ARRAY!!
-        if Dev1_analog_channel_number == 1:
-            Dev1_analog_samples_to_write = np.array(
-                [Dev1_analog_waveforms_list[0]]
-            )
-
-        elif Dev1_analog_channel_number == 0:
-            Dev1_analog_samples_to_write = []
-        else:
-            Dev1_analog_samples_to_write = Dev1_analog_waveforms_list[0]
-            for i in range(1, Dev1_analog_channel_number):
-                Dev1_analog_samples_to_write = np.vstack(
-                    (
-                        Dev1_analog_samples_to_write,
-                        Dev1_analog_waveforms_list[i],
-                    )
-                )
-
-        if Dev2_analog_channel_number == 1:
-            Dev2_analog_samples_to_write = np.array(
-                [Dev2_analog_waveforms_list[0]]
+        if len(analog_signals) != 0:
+            cycle_length = len(analog_signals["Waveform"][0])
+            logging.info(
+                f"row number of analog signals:  {len(analog_signals)}"
             )
-        elif Dev2_analog_channel_number == 0:
-            Dev2_analog_samples_to_write = []
+        elif len(digital_signals) != 0:
+            cycle_length = len(digital_signals["Waveform"][0])
         else:
-            Dev2_analog_samples_to_write = Dev2_analog_waveforms_list[0]
-            for i in range(1, Dev2_analog_channel_number):
-                Dev2_analog_samples_to_write = np.vstack(
-                    (
-                        Dev2_analog_samples_to_write,
-                        Dev2_analog_waveforms_list[i],
-                    )
-                )
+            raise ValueError("There are no waveforms to run")
 
-        # Stack the digital samples
-        if Digital_channel_number == 1:
-            Digital_samples_to_write = np.array(
-                [digital_signals["Waveform"][0]]
-            )
+        # === Stack the Analog samples of dev1 and dev2 individually ===
+        Dev1_analog_samples = None
+        if len(Dev1_analog_waveforms_list) != 0:
+            Dev1_analog_samples = np.stack(Dev1_analog_waveforms_list)
+            Dev1_analog_samples.flags.writeable = False
 
-        elif Digital_channel_number == 0:
-            Digital_samples_to_write = []
-        else:
-            Digital_samples_to_write = digital_signals["Waveform"][0]
-            for i in range(1, Digital_channel_number):
-                Digital_samples_to_write = np.vstack(
-                    (Digital_samples_to_write, digital_signals["Waveform"][i])
-                )
+        Dev2_analog_samples = None
+        if len(Dev2_analog_waveforms_list) != 0:
+            Dev2_analog_samples = np.stack(Dev2_analog_waveforms_list)
+            Dev2_analog_samples.flags.writeable = False
 
-        # === Set the dtype of digital signals ===
+        # === Pack the digital samples ===
         # For each digital waveform sample, it 0 or 1. To write to NI-daq, you
         # need to send int number corresponding to the channel binary value,
-        # like write 8(2^3, 0001) to channel 4.
-        # The same as (0b1 << n)
-        Digital_samples_to_write = np.array(
-            Digital_samples_to_write, dtype="uint32"
-        )
-
-        for i in range(Digital_channel_number):
-            specification = digital_signals["Specification"][i]
-            channel = self.channel_LUT[specification]
-            lineindex = channel.index("line")
-            convernum = int(channel[lineindex + 4 : len(channel)])
-            Digital_samples_to_write[i] = Digital_samples_to_write[i] * (
-                2 ** (convernum)
-            )
-
-        # For example, to send commands to line 0 and line 3, you hava to write
-        # 1001 to digital port, convert to uint32 that is 9.
-        if Digital_channel_number > 1:
-            Digital_samples_to_write = np.sum(
-                Digital_samples_to_write, axis=0
-            )  # sum along the columns, for multiple lines
-            Digital_samples_to_write = np.array(
-                [Digital_samples_to_write]
-            )  # here convert the shape from (n,) to (1,n)
-
-        # === Set up data holder for recording data ===
-        if len(self.readin_channels) != 0:
-            self.has_recording_channel = True
+        # like write 8(2^3, 0001) to channel 4. To send commands to line 0
+        # and line 3, you hava to write 1001 to digital port, that is 9.
+        # The words are kept run-length encoded and only expanded chunk by
+        # chunk when they are written.
+        Digital_samples = None
+        if len(digital_signals) != 0:
+            lines = []
+            for specification, waveform in zip(
+                digital_signals["Specification"], digital_signals["Waveform"]
+            ):
+                channel = self.channel_LUT[specification]
+                lineindex = channel.index("line")
+                convernum = int(channel[lineindex + 4 :])
+                lines.append((waveform, convernum))
+            Digital_samples = PortWaveform.pack(lines)
+
+        # === Read-in channels ===
+        if len(analog_signals) == 0:
+            ai_channels = ()
+        elif len(readin_channels) == 0:
+            # If no read-in channel is added, vp channel is added to keep
+            # code alive.
+            ai_channels = (self.channel_LUT["Vp"],)
         else:
-            self.has_recording_channel = False
-
-        if self.has_recording_channel is True:
-            self.Dataholder = np.zeros(
-                (len(self.readin_channels), self.Waveforms_length)
+            # For the current measurement, we use the voltage channel in DAQ
+            # and convert to current later devided by current gain and patch
+            # probe resistance.
+            ai_channels = tuple(
+                self.channel_LUT[name]
+                for name in ("PMT", "Vp", "Ip")
+                if name in readin_channels
             )
-        else:
-            self.Dataholder = np.zeros((1, self.Waveforms_length))
 
-        # Configure DAQ channels and execute waveforms
+        return TaskPlan(
+            clock_source=clock_source,
+            sampling_rate=sampling_rate,
+            samples_number=cycle_length * int(repeats),
+            repeats=int(repeats),
+            dev1_analog_channels=tuple(Dev1_analog_channel_list),
+            dev1_analog_samples=Dev1_analog_samples,
+            dev2_analog_channels=tuple(Dev2_analog_channel_list),
+            dev2_analog_samples=Dev2_analog_samples,
+            digital_samples=Digital_samples,
+            readin_channels=tuple(readin_channels),
+            ai_channels=ai_channels,
+            averagenumber=averagenumber,
+            ypixelnumber=ypixelnumber,
+        )
 
+    def runPlan(
+        self,
+        plan,
+        stream_chunk_size=None,
+        stream_file=None,
+        output_chunk_size=None,
+    ):
         """
-        # Analog signal in Dev 1 is involved
-        """
-        if Dev1_analog_channel_number != 0:
-            with nidaqmx.Task() as slave_Task_1_analog_dev1, nidaqmx.Task() as slave_Task_1_analog_dev2, nidaqmx.Task() as master_Task_readin, nidaqmx.Task() as slave_Task_2_digitallines:
-                # === adding channels ===
-                # Set tasks from different devices apart
-                for i in range(Dev1_analog_channel_number):
-                    slave_Task_1_analog_dev1.ao_channels.add_ao_voltage_chan(
-                        self.Dev1_analog_channel_list[i]
-                    )
-
-                slave_Task_2_digitallines.do_channels.add_do_chan(
-                    "/Dev1/port0",
-                    line_grouping=LineGrouping.CHAN_FOR_ALL_LINES,
-                )
-
-                if self.has_recording_channel is True:
-                    self.Dataholder = np.zeros(
-                        (len(self.readin_channels), self.Waveforms_length)
-                    )
-                else:
-                    self.Dataholder = np.zeros((1, self.Waveforms_length))
-                    master_Task_readin.ai_channels.add_ai_voltage_chan(
-                        self.channel_LUT["Vp"]
-                    )  # If no read-in channel is added, vp channel is added to keep code alive.
-
-                # print(self.Dataholder.shape)
-                if "PMT" in self.readin_channels:
-                    master_Task_readin.ai_channels.add_ai_voltage_chan(
-                        self.channel_LUT["PMT"]
-                    )
-                if "Vp" in self.readin_channels:
-                    master_Task_readin.ai_channels.add_ai_voltage_chan(
-                        self.channel_LUT["Vp"]
-                    )
-                # For the current measurement, we use the voltage channel in DAQ
-                # and convert to current later devided by current gain and patch
-                # probe resistance.
-                if "Ip" in self.readin_channels:
-                    master_Task_readin.ai_channels.add_ai_voltage_chan(
-                        self.channel_LUT["Ip"]
-                    )
-
-                # === get scaling coefficients ===
-                self.aichannelnames = (
-                    master_Task_readin.ai_channels.channel_names
-                )
-
-                self.ai_dev_scaling_coeff_vp = []
-                self.ai_dev_scaling_coeff_ip = []
-                if "Vp" in self.readin_channels:
-                    self.ai_dev_scaling_coeff_vp = (
-                        nidaqmx._task_modules.channels.ai_channel.AIChannel(
-                            master_Task_readin._handle, self.channel_LUT["Vp"]
-                        )
-                    )
-                    # https://knowledge.ni.com/KnowledgeArticleDetails?id=kA00Z0000019TuoSAE&l=nl-NL
-                    # self.ai_dev_scaling_coeff.ai_dev_scaling_coeff
-                    self.ai_dev_scaling_coeff_vp = np.array(
-                        self.ai_dev_scaling_coeff_vp.ai_dev_scaling_coeff
-                    )
-
-                if "Ip" in self.readin_channels:
-                    self.ai_dev_scaling_coeff_ip = (
-                        nidaqmx._task_modules.channels.ai_channel.AIChannel(
-                            master_Task_readin._handle, self.channel_LUT["Ip"]
-                        )
-                    )
-                    # https://knowledge.ni.com/KnowledgeArticleDetails?id=kA00Z0000019TuoSAE&l=nl-NL
-                    # self.ai_dev_scaling_coeff.ai_dev_scaling_coeff
-                    self.ai_dev_scaling_coeff_ip = np.array(
-                        self.ai_dev_scaling_coeff_ip.ai_dev_scaling_coeff
-                    )
-
-                self.ai_dev_scaling_coeff_list = np.append(
-                    self.ai_dev_scaling_coeff_vp, self.ai_dev_scaling_coeff_ip
-                )
-
-                # === setting clock ===
-                if (
-                    clock_source == "DAQ"
-                ):  # If NI-DAQ is set as master clock source
-                    # Analog clock  USE clock on Dev1 as center clock
-                    slave_Task_1_analog_dev1.timing.cfg_samp_clk_timing(
-                        self.sampling_rate,
-                        source="ai/SampleClock",
-                        sample_mode=AcquisitionType.FINITE,
-                        samps_per_chan=self.Waveforms_length,
-                    )
-                    master_Task_readin.timing.cfg_samp_clk_timing(
-                        self.sampling_rate,
-                        sample_mode=AcquisitionType.FINITE,
-                        samps_per_chan=self.Waveforms_length,
-                    )
-
-                    # Export the clock timing of Dev1 to specific port, use BNC cable to bridge this port
-                    # and clock receiving port on Dev2.
-                    master_Task_readin.export_signals.samp_clk_output_term = (
-                        self.channel_LUT["clock1Channel"]
-                    )  # '/Dev1/PFI1'#
-                    master_Task_readin.export_signals.start_trig_output_term = self.channel_LUT[
-                        "trigger1Channel"
-                    ]  # '/Dev1/PFI2'
-
-                    # If dev2 is involved, set the timing for dev2.
-                    if Dev2_analog_channel_number != 0:
-                        # By default assume that read master task is in dev1
-
-                        for i in range(Dev2_analog_channel_number):
-                            slave_Task_1_analog_dev2.ao_channels.add_ao_voltage_chan(
-                                self.Dev2_analog_channel_list[i]
-                            )
-
-                        # Set the clock of Dev2 to the receiving port from Dev1.
-                        dev2Clock = self.channel_LUT[
-                            "clock2Channel"
-                        ]  # /Dev2/PFI1
-                        slave_Task_1_analog_dev2.timing.cfg_samp_clk_timing(
-                            self.sampling_rate,
-                            source=dev2Clock,
-                            sample_mode=AcquisitionType.FINITE,
-                            samps_per_chan=self.Waveforms_length,
-                        )
-
-                        AnalogWriter = (
-                            nidaqmx.stream_writers.AnalogMultiChannelWriter(
-                                slave_Task_1_analog_dev1.out_stream,
-                                auto_start=False,
-                            )
-                        )
-                        AnalogWriter.auto_start = False
-
-                        AnalogWriter_dev2 = (
-                            nidaqmx.stream_writers.AnalogMultiChannelWriter(
-                                slave_Task_1_analog_dev2.out_stream,
-                                auto_start=False,
-                            )
-                        )
-                        AnalogWriter_dev2.auto_start = False
-
-                    # === Digital clock ===
-                    if Digital_channel_number != 0:
-                        slave_Task_2_digitallines.timing.cfg_samp_clk_timing(
-                            self.sampling_rate,
-                            source="ai/SampleClock",
-                            sample_mode=AcquisitionType.FINITE,
-                            samps_per_chan=self.Waveforms_length,
-                        )
-                        # slave_Task_2_digitallines.triggers.sync_type.SLAVE = True
-
-                elif (
-                    clock_source == "Camera"
-                ):  # All the clock should refer to camera output trigger
-                    # Set all clock source to camera trigger receiving port.
-                    self.cam_trigger_receiving_port = "/Dev1/PFI0"
-
-                    slave_Task_1_analog_dev1.timing.cfg_samp_clk_timing(
-                        self.sampling_rate,
-                        source=self.cam_trigger_receiving_port,
-                        sample_mode=AcquisitionType.FINITE,
-                        samps_per_chan=self.Waveforms_length,
-                    )
-                    slave_Task_1_analog_dev1.triggers.start_trigger.cfg_dig_edge_start_trig(
-                        self.cam_trigger_receiving_port
-                    )
+        Execute a TaskPlan from compileWaveforms.
 
-                    master_Task_readin.timing.cfg_samp_clk_timing(
-                        self.sampling_rate,
-                        source=self.cam_trigger_receiving_port,
-                        sample_mode=AcquisitionType.FINITE,
-                        samps_per_chan=self.Waveforms_length,
-                    )
-                    master_Task_readin.export_signals.samp_clk_output_term = (
-                        self.channel_LUT["clock1Channel"]
-                    )  # '/Dev1/PFI1'#
-                    master_Task_readin.export_signals.start_trig_output_term = self.channel_LUT[
-                        "trigger1Channel"
-                    ]  # '/Dev1/PFI2'
-                    master_Task_readin.triggers.start_trigger.cfg_dig_edge_start_trig(
-                        self.cam_trigger_receiving_port
-                    )
-
-                    if Dev2_analog_channel_number != 0:
-                        # By default assume that read master task is in dev1
+        The tasks of the plan are configured on the first run and kept open,
+        so running the same plan again only writes and starts them. They are
+        released by closeTasks, or when another plan is run. Streaming runs
+        change the buffer configuration, so their tasks are not kept.
 
-                        for i in range(Dev2_analog_channel_number):
-                            slave_Task_1_analog_dev2.ao_channels.add_ao_voltage_chan(
-                                self.Dev2_analog_channel_list[i]
-                            )
+        The other parameters are those of runWaveforms.
+        """
+        self.readin_channels = plan.readin_channels
+        self.sampling_rate = plan.sampling_rate
+        self.Waveforms_length = plan.samples_number
+        self.repeats = plan.repeats
+        self.has_recording_channel = len(plan.readin_channels) != 0
+        self.Only_Digital_signals = len(plan.ai_channels) == 0
+        self.averagenumber = plan.averagenumber
+        self.ypixelnumber = plan.ypixelnumber
+        self.stream_chunk_size = stream_chunk_size
+        self.stream_file = stream_file
+
+        if self.repeats > 1 or output_chunk_size is not None:
+            if output_chunk_size is None:
+                output_chunk_size = max(int(self.sampling_rate / 10), 1)
+            # The output is fed on its own thread, so the recording can
+            # still be read in one go unless streaming is asked for.
+            self.output_chunk_size = int(output_chunk_size)
+        else:
+            self.output_chunk_size = None
+        if self.Only_Digital_signals:
+            self.stream_chunk_size = None
 
-                        # Set clock of dev2 to the input from dev1 timing output.
-                        dev2Clock = self.channel_LUT[
-                            "clock2Channel"
-                        ]  # /Dev2/PFI1
-                        slave_Task_1_analog_dev2.timing.cfg_samp_clk_timing(
-                            self.sampling_rate,
-                            source=dev2Clock,
-                            sample_mode=AcquisitionType.FINITE,
-                            samps_per_chan=self.Waveforms_length,
-                        )
-                        # slave_Task_1_analog_dev2.triggers.sync_type.SLAVE = True
+        # === Set up data holder for recording data ===
+        self.allocate_dataholder()
+
+        if self.configured_plan is not plan:
+            self.configureTasks(plan)
+
+        try:
+            self.executeTasks()
+        except Exception:
+            self.closeTasks()
+            raise
+
+        if (
+            self.stream_chunk_size is not None
+            or self.output_chunk_size is not None
+        ):
+            self.closeTasks()
+
+    def open_task(self):
+        task = self.daq.Task()
+        self.open_tasks.append(task)
+        return task
+
+    def open_output_task(self, physical_channels, kind="ao", **kwargs):
+        """Open a task with output channels, see timed_output_task."""
+        task = static_outputs.timed_output_task(
+            physical_channels, kind, **kwargs
+        )
+        self.open_tasks.append(task)
+        return task
 
-                        # slave_Task_1_analog_dev2.triggers.start_trigger.cfg_dig_edge_start_trig(self.channel_LUT["trigger2Channel"])#'/Dev2/PFI7'
+    def configureTasks(self, plan):
+        """
+        Create the nidaqmx tasks of a plan and set their channels and timing.
 
-                        AnalogWriter = (
-                            nidaqmx.stream_writers.AnalogMultiChannelWriter(
-                                slave_Task_1_analog_dev1.out_stream,
-                                auto_start=False,
-                            )
-                        )
-                        AnalogWriter.auto_start = False
+        The output tasks are kept in self.output_tasks, in the order they
+        have to be started, together with their write function and samples.
+        """
+        self.closeTasks()
+        self.daq = daq_backend.get_backend()
+        try:
+            self.add_plan_tasks(plan)
+        except Exception:
+            self.closeTasks()
+            raise
+        self.configured_plan = plan
+
+    def plan_output_channels(self, plan):
+        """Physical output channels used by the tasks of a plan."""
+        channels = list(plan.dev1_analog_channels) + list(
+            plan.dev2_analog_channels
+        )
+        if plan.digital_samples is not None:
+            channels.append("/Dev1/port0")
+        return channels
 
-                        AnalogWriter_dev2 = (
-                            nidaqmx.stream_writers.AnalogMultiChannelWriter(
-                                slave_Task_1_analog_dev2.out_stream,
-                                auto_start=False,
-                            )
-                        )
-                        AnalogWriter_dev2.auto_start = False
-
-                    # === Digital clock ===
-                    if Digital_channel_number != 0:
-                        slave_Task_2_digitallines.timing.cfg_samp_clk_timing(
-                            self.sampling_rate,
-                            source=self.cam_trigger_receiving_port,
-                            sample_mode=AcquisitionType.FINITE,
-                            samps_per_chan=self.Waveforms_length,
-                        )
-                        slave_Task_2_digitallines.triggers.start_trigger.cfg_dig_edge_start_trig(
-                            self.cam_trigger_receiving_port
-                        )
-                        # slave_Task_2_digitallines.triggers.sync_type.SLAVE = True
+    def add_plan_tasks(self, plan):
+        samples_number = plan.samples_number
 
-                # === Configure the writer and reader ===
-                AnalogWriter = nidaqmx.stream_writers.AnalogMultiChannelWriter(
-                    slave_Task_1_analog_dev1.out_stream, auto_start=False
+        """
+        # Only digital signals
+        """
+        if len(plan.ai_channels) == 0:
+            # Assume that dev1 is always employed
+            slave_Task_2_digitallines = self.open_output_task(
+                "/Dev1/port0",
+                "do",
+                line_grouping=LineGrouping.CHAN_FOR_ALL_LINES,
+            )
+            # Digital clock
+            slave_Task_2_digitallines.timing.cfg_samp_clk_timing(
+                plan.sampling_rate,
+                sample_mode=AcquisitionType.FINITE,
+                samps_per_chan=samples_number,
+            )
+            DigitalWriter = self.daq.DigitalMultiChannelWriter(
+                slave_Task_2_digitallines.out_stream, auto_start=False
+            )
+            self.output_tasks.append(
+                (
+                    slave_Task_2_digitallines,
+                    DigitalWriter.write_many_sample_port_uint32,
+                    plan.digital_samples,
                 )
-                AnalogWriter.auto_start = False
-                if Digital_channel_number != 0:
-                    DigitalWriter = (
-                        nidaqmx.stream_writers.DigitalMultiChannelWriter(
-                            slave_Task_2_digitallines.out_stream,
-                            auto_start=False,
-                        )
-                    )
-                    DigitalWriter.auto_start = False
-                reader = AnalogMultiChannelReader(master_Task_readin.in_stream)
-                reader.auto_start = False
+            )
+            return
+
+        # === setting clock ===
+        if plan.clock_source == "DAQ":
+            # If NI-DAQ is set as master clock source, use clock on Dev1 as
+            # center clock.
+            sample_clock = "ai/SampleClock"
+            self.cam_trigger_receiving_port = None
+        elif plan.clock_source == "Camera":
+            # All the clock should refer to camera output trigger, set all
+            # clock source to camera trigger receiving port.
+            self.cam_trigger_receiving_port = "/Dev1/PFI0"
+            sample_clock = self.cam_trigger_receiving_port
+        else:
+            raise ValueError(f"Unknown clock source {plan.clock_source}")
+
+        # === Read-in channels ===
+        master_Task_readin = self.open_task()
+        for channel in plan.ai_channels:
+            master_Task_readin.ai_channels.add_ai_voltage_chan(channel)
+
+        if self.cam_trigger_receiving_port is None:
+            master_Task_readin.timing.cfg_samp_clk_timing(
+                plan.sampling_rate,
+                sample_mode=AcquisitionType.FINITE,
+                samps_per_chan=samples_number,
+            )
+        else:
+            master_Task_readin.timing.cfg_samp_clk_timing(
+                plan.sampling_rate,
+                source=self.cam_trigger_receiving_port,
+                sample_mode=AcquisitionType.FINITE,
+                samps_per_chan=samples_number,
+            )
+            master_Task_readin.triggers.start_trigger.cfg_dig_edge_start_trig(
+                self.cam_trigger_receiving_port
+            )
 
-                # === Begin to execute in DAQ ===
-                AnalogWriter.write_many_sample(
-                    Dev1_analog_samples_to_write, timeout=605.0
-                )
+        # Export the clock timing of Dev1 to specific port, use BNC cable to
+        # bridge this port and clock receiving port on Dev2.
+        master_Task_readin.export_signals.samp_clk_output_term = (
+            self.channel_LUT["clock1Channel"]
+        )  # '/Dev1/PFI1'
+        master_Task_readin.export_signals.start_trig_output_term = (
+            self.channel_LUT["trigger1Channel"]
+        )  # '/Dev1/PFI2'
+
+        # === get scaling coefficients ===
+        self.aichannelnames = master_Task_readin.ai_channels.channel_names
+
+        self.ai_dev_scaling_coeff_vp = []
+        self.ai_dev_scaling_coeff_ip = []
+        # https://knowledge.ni.com/KnowledgeArticleDetails?id=kA00Z0000019TuoSAE&l=nl-NL
+        if "Vp" in plan.readin_channels:
+            self.ai_dev_scaling_coeff_vp = self.daq.ai_scaling_coeff(
+                master_Task_readin, self.channel_LUT["Vp"]
+            )
+        if "Ip" in plan.readin_channels:
+            self.ai_dev_scaling_coeff_ip = self.daq.ai_scaling_coeff(
+                master_Task_readin, self.channel_LUT["Ip"]
+            )
+        self.ai_dev_scaling_coeff_list = np.append(
+            self.ai_dev_scaling_coeff_vp, self.ai_dev_scaling_coeff_ip
+        )
 
-                if Dev2_analog_channel_number != 0:
-                    AnalogWriter_dev2.write_many_sample(
-                        Dev2_analog_samples_to_write, timeout=605.0
-                    )
+        self.readin_task = master_Task_readin
+        self.reader = self.daq.AnalogMultiChannelReader(
+            master_Task_readin.in_stream
+        )
+        self.reader.auto_start = False
 
-                if Digital_channel_number != 0:
-                    DigitalWriter.write_many_sample_port_uint32(
-                        Digital_samples_to_write, timeout=605.0
-                    )
+        # === Analog outputs on Dev2 ===
+        if len(plan.dev2_analog_channels) != 0:
+            slave_Task_1_analog_dev2 = self.open_output_task(
+                list(plan.dev2_analog_channels)
+            )
 
-                logging.info(
-                    "^^^^^^^^^^^^^^^^^^Daq tasks start^^^^^^^^^^^^^^^^^^"
+            # Set the clock of Dev2 to the receiving port from Dev1.
+            slave_Task_1_analog_dev2.timing.cfg_samp_clk_timing(
+                plan.sampling_rate,
+                source=self.channel_LUT["clock2Channel"],  # /Dev2/PFI1
+                sample_mode=AcquisitionType.FINITE,
+                samps_per_chan=samples_number,
+            )
+            if (
+                self.cam_trigger_receiving_port is not None
+                and len(plan.dev1_analog_channels) == 0
+            ):
+                slave_Task_1_analog_dev2.triggers.start_trigger.cfg_dig_edge_start_trig(
+                    self.cam_trigger_receiving_port
                 )
-                if Dev2_analog_channel_number != 0:
-                    slave_Task_1_analog_dev2.start()
-                slave_Task_1_analog_dev1.start()
 
-                if Digital_channel_number != 0:
-                    slave_Task_2_digitallines.start()
+            AnalogWriter_dev2 = self.daq.AnalogMultiChannelWriter(
+                slave_Task_1_analog_dev2.out_stream, auto_start=False
+            )
+            self.output_tasks.append(
+                (
+                    slave_Task_1_analog_dev2,
+                    AnalogWriter_dev2.write_many_sample,
+                    plan.dev2_analog_samples,
+                )
+            )
 
-                master_Task_readin.start()  # !!!!!!!!!!!!!!!!!!!! READIN TASK HAS TO START AHEAD OF READ MANY SAMPLES, OTHERWISE ITS NOT SYN!!!
+        # === Analog outputs on Dev1 ===
+        if len(plan.dev1_analog_channels) != 0:
+            slave_Task_1_analog_dev1 = self.open_output_task(
+                list(plan.dev1_analog_channels)
+            )
 
-                reader.read_many_sample(
-                    data=self.Dataholder,
-                    number_of_samples_per_channel=self.Waveforms_length,
-                    timeout=605.0,
-                )
-                # self.data_PMT = []
-
-                slave_Task_1_analog_dev1.wait_until_done()
-                if Dev2_analog_channel_number != 0:
-                    slave_Task_1_analog_dev2.wait_until_done()
-                if Digital_channel_number != 0:
-                    slave_Task_2_digitallines.wait_until_done()
-                master_Task_readin.wait_until_done()
-
-                slave_Task_1_analog_dev1.stop()
-                if Dev2_analog_channel_number != 0:
-                    slave_Task_1_analog_dev2.stop()
-                if Digital_channel_number != 0:
-                    slave_Task_2_digitallines.stop()
-                master_Task_readin.stop()
-
-                if self.has_recording_channel is True:
-                    self.collected_data.emit(self.Dataholder)
-                self.finishSignal.emit()
-                logging.info(
-                    "^^^^^^^^^^^^^^^^^^Daq tasks finish^^^^^^^^^^^^^^^^^^"
+            slave_Task_1_analog_dev1.timing.cfg_samp_clk_timing(
+                plan.sampling_rate,
+                source=sample_clock,
+                sample_mode=AcquisitionType.FINITE,
+                samps_per_chan=samples_number,
+            )
+            if self.cam_trigger_receiving_port is not None:
+                slave_Task_1_analog_dev1.triggers.start_trigger.cfg_dig_edge_start_trig(
+                    self.cam_trigger_receiving_port
                 )
 
-            # set the keys of galvos back for next round
-            if Analog_channel_number != 0:
-                for i in range(len(analog_signals["Specification"])):
-                    if "galvosx" in analog_signals["Specification"][i]:
-                        analog_signals["Specification"][
-                            i
-                        ] = self.galvosx_originalkey
-                    elif "galvosy" in analog_signals["Specification"][i]:
-                        analog_signals["Specification"][
-                            i
-                        ] = self.galvosy_originalkey
-
-            """
-            # Only Dev 2 is involved  in sending analog signals
-            """
-        elif Dev2_analog_channel_number != 0:
-            with nidaqmx.Task() as slave_Task_1_analog_dev2, nidaqmx.Task() as master_Task_readin, nidaqmx.Task() as slave_Task_2_digitallines:
-                # adding channels
-                # Set tasks from different devices apart
-                slave_Task_2_digitallines.do_channels.add_do_chan(
-                    "/Dev1/port0",
-                    line_grouping=LineGrouping.CHAN_FOR_ALL_LINES,
+            AnalogWriter = self.daq.AnalogMultiChannelWriter(
+                slave_Task_1_analog_dev1.out_stream, auto_start=False
+            )
+            self.output_tasks.append(
+                (
+                    slave_Task_1_analog_dev1,
+                    AnalogWriter.write_many_sample,
+                    plan.dev1_analog_samples,
                 )
+            )
 
-                if self.has_recording_channel is True:
-                    self.Dataholder = np.zeros(
-                        (len(self.readin_channels), self.Waveforms_length)
-                    )
-                else:
-                    self.Dataholder = np.zeros((1, self.Waveforms_length))
-                    master_Task_readin.ai_channels.add_ai_voltage_chan(
-                        self.channel_LUT["Vp"]
-                    )  # If no read-in channel is added, vp channel is added to keep code alive.
-
-                # print(self.Dataholder.shape)
-                if "PMT" in self.readin_channels:
-                    master_Task_readin.ai_channels.add_ai_voltage_chan(
-                        self.channel_LUT["PMT"]
-                    )
-                if "Vp" in self.readin_channels:
-                    master_Task_readin.ai_channels.add_ai_voltage_chan(
-                        self.channel_LUT["Vp"]
-                    )
-                if "Ip" in self.readin_channels:
-                    master_Task_readin.ai_channels.add_ai_voltage_chan(
-                        self.channel_LUT["Ip"]
-                    )
-
-                # get scaling coefficients
-                self.aichannelnames = (
-                    master_Task_readin.ai_channels.channel_names
+        # === Digital clock ===
+        if plan.digital_samples is not None:
+            slave_Task_2_digitallines = self.open_output_task(
+                "/Dev1/port0",
+                "do",
+                line_grouping=LineGrouping.CHAN_FOR_ALL_LINES,
+            )
+            slave_Task_2_digitallines.timing.cfg_samp_clk_timing(
+                plan.sampling_rate,
+                source=sample_clock,
+                sample_mode=AcquisitionType.FINITE,
+                samps_per_chan=samples_number,
+            )
+            if self.cam_trigger_receiving_port is not None:
+                slave_Task_2_digitallines.triggers.start_trigger.cfg_dig_edge_start_trig(
+                    self.cam_trigger_receiving_port
                 )
 
-                self.ai_dev_scaling_coeff_vp = []
-                self.ai_dev_scaling_coeff_ip = []
-                if "Vp" in self.readin_channels:
-                    self.ai_dev_scaling_coeff_vp = (
-                        nidaqmx._task_modules.channels.ai_channel.AIChannel(
-                            master_Task_readin._handle, self.channel_LUT["Vp"]
-                        )
-                    )
-                    # self.ai_dev_scaling_coeff.ai_dev_scaling_coeff
-                    self.ai_dev_scaling_coeff_vp = np.array(
-                        self.ai_dev_scaling_coeff_vp.ai_dev_scaling_coeff
-                    )
-
-                if "Ip" in self.readin_channels:
-                    self.ai_dev_scaling_coeff_ip = (
-                        nidaqmx._task_modules.channels.ai_channel.AIChannel(
-                            master_Task_readin._handle, self.channel_LUT["Ip"]
-                        )
-                    )
-                    # self.ai_dev_scaling_coeff.ai_dev_scaling_coeff
-                    self.ai_dev_scaling_coeff_ip = np.array(
-                        self.ai_dev_scaling_coeff_ip.ai_dev_scaling_coeff
-                    )
-
-                self.ai_dev_scaling_coeff_list = np.append(
-                    self.ai_dev_scaling_coeff_vp, self.ai_dev_scaling_coeff_ip
+            DigitalWriter = self.daq.DigitalMultiChannelWriter(
+                slave_Task_2_digitallines.out_stream, auto_start=False
+            )
+            self.output_tasks.append(
+                (
+                    slave_Task_2_digitallines,
+                    DigitalWriter.write_many_sample_port_uint32,
+                    plan.digital_samples,
                 )
+            )
 
-                # === setting clock ===
-                if (
-                    clock_source == "DAQ"
-                ):  # If NI-DAQ is set as master clock source
-                    # setting clock
-                    master_Task_readin.timing.cfg_samp_clk_timing(
-                        self.sampling_rate,
-                        sample_mode=AcquisitionType.FINITE,
-                        samps_per_chan=self.Waveforms_length,
-                    )
-
-                    master_Task_readin.export_signals.samp_clk_output_term = (
-                        self.channel_LUT["clock1Channel"]
-                    )  # '/Dev1/PFI1'#
-                    master_Task_readin.export_signals.start_trig_output_term = self.channel_LUT[
-                        "trigger1Channel"
-                    ]  # '/Dev1/PFI2'
-
-                    if Dev2_analog_channel_number != 0:
-                        # By default assume that read master task is in dev1
-
-                        for i in range(Dev2_analog_channel_number):
-                            slave_Task_1_analog_dev2.ao_channels.add_ao_voltage_chan(
-                                self.Dev2_analog_channel_list[i]
-                            )
-
-                        dev2Clock = self.channel_LUT[
-                            "clock2Channel"
-                        ]  # /Dev2/PFI1
-                        slave_Task_1_analog_dev2.timing.cfg_samp_clk_timing(
-                            self.sampling_rate,
-                            source=dev2Clock,
-                            sample_mode=AcquisitionType.FINITE,
-                            samps_per_chan=self.Waveforms_length,
-                        )
-
-                        AnalogWriter_dev2 = (
-                            nidaqmx.stream_writers.AnalogMultiChannelWriter(
-                                slave_Task_1_analog_dev2.out_stream,
-                                auto_start=False,
-                            )
-                        )
-                        AnalogWriter_dev2.auto_start = False
-
-                    # Digital clock
-                    if Digital_channel_number != 0:
-                        slave_Task_2_digitallines.timing.cfg_samp_clk_timing(
-                            self.sampling_rate,
-                            source="ai/SampleClock",
-                            sample_mode=AcquisitionType.FINITE,
-                            samps_per_chan=self.Waveforms_length,
-                        )
-
-                elif clock_source == "Camera":
-                    # All the clock should refer to camera output trigger
-                    self.cam_trigger_receiving_port = "/Dev1/PFI0"
-
-                    master_Task_readin.timing.cfg_samp_clk_timing(
-                        self.sampling_rate,
-                        source=self.cam_trigger_receiving_port,
-                        sample_mode=AcquisitionType.FINITE,
-                        samps_per_chan=self.Waveforms_length,
-                    )
-                    master_Task_readin.triggers.start_trigger.cfg_dig_edge_start_trig(
-                        self.cam_trigger_receiving_port
-                    )
-                    master_Task_readin.export_signals.samp_clk_output_term = (
-                        self.channel_LUT["clock1Channel"]
-                    )  # '/Dev1/PFI1'#
-                    master_Task_readin.export_signals.start_trig_output_term = self.channel_LUT[
-                        "trigger1Channel"
-                    ]  # '/Dev1/PFI2'
-
-                    if Dev2_analog_channel_number != 0:
-                        # By default assume that read master task is in dev1
-
-                        for i in range(Dev2_analog_channel_number):
-                            slave_Task_1_analog_dev2.ao_channels.add_ao_voltage_chan(
-                                self.Dev2_analog_channel_list[i]
-                            )
-
-                        dev2Clock = self.channel_LUT[
-                            "clock2Channel"
-                        ]  # /Dev2/PFI1
-                        slave_Task_1_analog_dev2.timing.cfg_samp_clk_timing(
-                            self.sampling_rate,
-                            source=dev2Clock,
-                            sample_mode=AcquisitionType.FINITE,
-                            samps_per_chan=self.Waveforms_length,
-                        )
-                        slave_Task_1_analog_dev2.triggers.start_trigger.cfg_dig_edge_start_trig(
-                            self.cam_trigger_receiving_port
-                        )
-                        AnalogWriter_dev2 = (
-                            nidaqmx.stream_writers.AnalogMultiChannelWriter(
-                                slave_Task_1_analog_dev2.out_stream,
-                                auto_start=False,
-                            )
-                        )
-                        AnalogWriter_dev2.auto_start = False
-
-                    # === Digital clock ===
-                    if Digital_channel_number != 0:
-                        slave_Task_2_digitallines.timing.cfg_samp_clk_timing(
-                            self.sampling_rate,
-                            source=self.cam_trigger_receiving_port,
-                            sample_mode=AcquisitionType.FINITE,
-                            samps_per_chan=self.Waveforms_length,
-                        )
-                        slave_Task_2_digitallines.triggers.start_trigger.cfg_dig_edge_start_trig(
-                            self.cam_trigger_receiving_port
-                        )
+    def executeTasks(self):
+        """Write, start and wait for the configured tasks."""
+        # The tasks are kept open between runs of a plan, and single writes
+        # in between, like the AOTF and blanking of the autofocus, reserve
+        # the channels again with static tasks.
+        static_outputs.release(
+            *self.plan_output_channels(self.configured_plan)
+        )
+        if self.readin_task is not None:
+            self.configure_input_buffer(self.readin_task)
+
+        # === Begin to execute in DAQ ===
+        self.write_outputs(self.output_tasks)
+
+        logging.info("^^^^^^^^^^^^^^^^^^Daq tasks start^^^^^^^^^^^^^^^^^^")
+        for task, write, samples in self.output_tasks:
+            task.start()
+
+        if self.readin_task is not None:
+            # READIN TASK HAS TO START AHEAD OF READ MANY SAMPLES, OTHERWISE
+            # ITS NOT SYN!!!
+            self.readin_task.start()
+        self.start_output_stream()
+
+        if self.readin_task is not None:
+            self.read_recording(self.reader)
+        self.wait_output_stream()
+
+        for task, write, samples in self.output_tasks:
+            task.wait_until_done(timeout=605.0)
+        if self.readin_task is not None:
+            self.readin_task.wait_until_done(timeout=605.0)
+
+        for task, write, samples in self.output_tasks:
+            task.stop()
+        if self.readin_task is not None:
+            self.readin_task.stop()
+
+            if self.has_recording_channel is True:
+                self.collected_data.emit(self.Dataholder)
+            self.finishSignal.emit()
+        logging.info("^^^^^^^^^^^^^^^^^^Daq tasks finish^^^^^^^^^^^^^^^^^^")
+
+    def closeTasks(self):
+        """Release the tasks kept open by runPlan."""
+        for task in self.open_tasks:
+            try:
+                task.close()
+            except nidaqmx.DaqError as exc:
+                logging.warning("Could not close DAQ task", exc_info=exc)
+
+        self.open_tasks = []
+        self.output_tasks = []
+        self.readin_task = None
+        self.reader = None
+        self.configured_plan = None
+
+    def write_outputs(self, outputs):
+        """
+        Write the output samples to the task buffers before starting.
 
-                # Configure the writer and reader
+        Parameters
+        outputs : list of tuple
+            (task, write function, samples) for every output task.
 
-                if Digital_channel_number != 0:
-                    DigitalWriter = (
-                        nidaqmx.stream_writers.DigitalMultiChannelWriter(
-                            slave_Task_2_digitallines.out_stream,
-                            auto_start=False,
+        Without streaming all samples are written at once. In streaming
+        mode the samples are one cycle of the protocol; the output buffers
+        are limited to the ring size and only the first chunks are written
+        here, the rest follows in start_output_stream.
+        """
+        self.output_streams = None
+        if self.output_chunk_size is None:
+            for task, write, samples in outputs:
+                # Tasks of a plan that already ran get their buffer
+                # written again from the start.
+                task.out_stream.relative_to = WriteRelativeTo.FIRST_SAMPLE
+                task.out_stream.offset = 0
+                if not isinstance(samples, RunLengthWaveform):
+                    write(samples, timeout=605.0)
+                    continue
+
+                chunks = CycleStream(samples, 1, self.write_chunk_size)
+                for index, chunk in enumerate(chunks):
+                    if index == 1:
+                        task.out_stream.relative_to = (
+                            WriteRelativeTo.CURRENT_WRITE_POSITION
                         )
-                    )
-                    DigitalWriter.auto_start = False
-                reader = AnalogMultiChannelReader(master_Task_readin.in_stream)
-                reader.auto_start = False
-
-                # === Begin to execute in DAQ ===
-
-                if Dev2_analog_channel_number != 0:
-                    AnalogWriter_dev2.write_many_sample(
-                        Dev2_analog_samples_to_write, timeout=605.0
-                    )
+                    write(chunk, timeout=605.0)
+            return
+
+        buffer_size = self.stream_ring_size * self.output_chunk_size
+        streams = []
+        for task, write, samples in outputs:
+            task.out_stream.regen_mode = (
+                RegenerationMode.DONT_ALLOW_REGENERATION
+            )
+            if buffer_size < self.Waveforms_length:
+                task.out_stream.output_buf_size = buffer_size
+            stream = CycleStream(samples, self.repeats, self.output_chunk_size)
+            streams.append((write, iter(stream)))
+        logging.info(
+            f"Streaming {self.Waveforms_length} output samples "
+            f"in chunks of {self.output_chunk_size}"
+        )
 
-                if Digital_channel_number != 0:
-                    DigitalWriter.write_many_sample_port_uint32(
-                        Digital_samples_to_write, timeout=605.0
-                    )
+        # All streams are chunked the same way, fill the buffers up front.
+        for i in range(self.stream_ring_size):
+            if not self.write_output_chunk(streams):
+                break
+        self.output_streams = streams
+
+    def write_output_chunk(self, streams):
+        """Write the next chunk of every stream, False when they are done."""
+        for write, stream in streams:
+            chunk = next(stream, None)
+            if chunk is None:
+                return False
+            write(chunk, timeout=605.0)
+        return True
+
+    def start_output_stream(self):
+        """Keep feeding the output buffers on a separate thread."""
+        self.output_stream_thread = None
+        if self.output_streams is None:
+            return
+
+        self.output_stream_thread = threading.Thread(
+            target=self.run_output_stream, daemon=True
+        )
+        self.output_stream_thread.start()
 
-                logging.info(
-                    "^^^^^^^^^^^^^^^^^^Daq tasks start^^^^^^^^^^^^^^^^^^"
-                )
-                if Dev2_analog_channel_number != 0:
-                    slave_Task_1_analog_dev2.start()
+    def run_output_stream(self):
+        try:
+            while self.write_output_chunk(self.output_streams):
+                pass
+        except Exception as exc:
+            logging.critical("caught exception", exc_info=exc)
 
-                if Digital_channel_number != 0:
-                    slave_Task_2_digitallines.start()
+    def wait_output_stream(self):
+        if self.output_stream_thread is not None:
+            self.output_stream_thread.join()
+            self.output_stream_thread = None
 
-                master_Task_readin.start()  # !!!!!!!!!!!!!!!!!!!! READIN TASK HAS TO START AHEAD OF READ MANY SAMPLES, OTHERWISE ITS NOT SYN!!!
+    def allocate_dataholder(self):
+        """
+        Create self.Dataholder for the recorded samples.
 
-                reader.read_many_sample(
-                    data=self.Dataholder,
-                    number_of_samples_per_channel=self.Waveforms_length,
-                    timeout=605.0,
-                )
-                # self.data_PMT = []
-
-                if Dev2_analog_channel_number != 0:
-                    slave_Task_1_analog_dev2.wait_until_done()
-                if Digital_channel_number != 0:
-                    slave_Task_2_digitallines.wait_until_done()
-                master_Task_readin.wait_until_done()
-
-                if Dev2_analog_channel_number != 0:
-                    slave_Task_1_analog_dev2.stop()
-                if Digital_channel_number != 0:
-                    slave_Task_2_digitallines.stop()
-                master_Task_readin.stop()
-
-                if self.has_recording_channel is True:
-                    self.collected_data.emit(self.Dataholder)
-                self.finishSignal.emit()
-                logging.info(
-                    "^^^^^^^^^^^^^^^^^^Daq tasks finish^^^^^^^^^^^^^^^^^^"
+        In streaming mode it is memory-mapped to self.stream_file or to a
+        temporary file, so the recording does not have to fit in memory. Without recording channels the
+        streamed samples are not kept.
+        """
+        channel_number = max(len(self.readin_channels), 1)
+        shape = (channel_number, self.Waveforms_length)
+
+        if self.stream_chunk_size is None:
+            self.Dataholder = np.zeros(shape)
+            return
+        elif not self.has_recording_channel:
+            self.Dataholder = np.zeros((channel_number, 0))
+            return
+
+        if self.stream_file is None:
+            # Every run gets its own unnamed file, which the system removes
+            # once the recording is no longer mapped.
+            with tempfile.TemporaryFile(prefix="DAQ_recording_") as file:
+                self.Dataholder = np.memmap(
+                    file, dtype=np.float64, mode="w+", shape=shape
                 )
+            logging.info("Streaming recording to a temporary file")
+            return
 
-            # set the keys of galvos back for next round
-            if Analog_channel_number != 0:
-                for i in range(len(analog_signals["Specification"])):
-                    if "galvosx" in analog_signals["Specification"][i]:
-                        analog_signals["Specification"][
-                            i
-                        ] = self.galvosx_originalkey
-                    elif "galvosy" in analog_signals["Specification"][i]:
-                        analog_signals["Specification"][
-                            i
-                        ] = self.galvosy_originalkey
-
-            """
-            # Only digital signals
-            """
-        elif self.Only_Digital_signals is True:
-            # some preparations for digital lines
-            Waveforms_length = len(digital_signals["Waveform"][0])
-
-            digitalsignalslinenumber = len(
-                digital_signals["Waveform"]
-            )  # TODO unused
-
-            # Assume that dev1 is always employed
-            with nidaqmx.Task() as slave_Task_2_digitallines:
-                # adding channels
-                # Set tasks from different devices apart
-                slave_Task_2_digitallines.do_channels.add_do_chan(
-                    "/Dev1/port0",
-                    line_grouping=LineGrouping.CHAN_FOR_ALL_LINES,
-                )
-                # Digital clock
-                slave_Task_2_digitallines.timing.cfg_samp_clk_timing(
-                    self.sampling_rate,
-                    sample_mode=AcquisitionType.FINITE,
-                    samps_per_chan=Waveforms_length,
-                )
+        self.Dataholder = np.lib.format.open_memmap(
+            self.stream_file, mode="w+", dtype=np.float64, shape=shape
+        )
+        logging.info(f"Streaming recording to {self.stream_file}")
 
-                # Configure the writer and reader
-                DigitalWriter = (
-                    nidaqmx.stream_writers.DigitalMultiChannelWriter(
-                        slave_Task_2_digitallines.out_stream, auto_start=False
-                    )
-                )
-                DigitalWriter.auto_start = False
+    def configure_input_buffer(self, task):
+        """
+        In streaming mode, limit the input buffer of the reading task to
+        the ring buffer instead of the whole waveform length.
+        """
+        if self.stream_chunk_size is None:
+            return
 
-                # === Begin to execute in DAQ ===
-                logging.info(
-                    "^^^^^^^^^^^^^^^^^^Daq tasks start^^^^^^^^^^^^^^^^^^"
-                )
-                DigitalWriter.write_many_sample_port_uint32(
-                    Digital_samples_to_write, timeout=605.0
-                )
+        buffer_size = self.stream_ring_size * int(self.stream_chunk_size)
+        if buffer_size < self.Waveforms_length:
+            task.in_stream.input_buf_size = buffer_size
 
-                slave_Task_2_digitallines.start()
+    def read_recording(self, reader):
+        """
+        Read the recording channels into self.Dataholder.
 
-                slave_Task_2_digitallines.wait_until_done(timeout=605.0)
+        Without streaming all samples are read at once. In streaming mode
+        fixed-size chunks are read into a ring buffer, copied to the
+        memory-mapped file and emitted with collected_chunk as they arrive.
+        """
+        if self.stream_chunk_size is None:
+            reader.read_many_sample(
+                data=self.Dataholder,
+                number_of_samples_per_channel=self.Waveforms_length,
+                timeout=605.0,
+            )
+            return
+
+        channel_number = self.Dataholder.shape[0]
+        chunk_size = int(self.stream_chunk_size)
+        # Each slot is contiguous, so also a shorter last chunk can be read
+        # into it directly.
+        ring_buffer = np.empty(
+            (self.stream_ring_size, channel_number * chunk_size)
+        )
 
-                slave_Task_2_digitallines.stop()
-                logging.info(
-                    "^^^^^^^^^^^^^^^^^^Daq tasks finish^^^^^^^^^^^^^^^^^^"
-                )
+        for chunk_index, start in enumerate(
+            range(0, self.Waveforms_length, chunk_size)
+        ):
+            samples_number = min(chunk_size, self.Waveforms_length - start)
+            chunk = ring_buffer[
+                chunk_index % self.stream_ring_size,
+                : channel_number * samples_number,
+            ].reshape(channel_number, samples_number)
+
+            reader.read_many_sample(
+                data=chunk,
+                number_of_samples_per_channel=samples_number,
+                timeout=605.0,
+            )
+            if self.has_recording_channel:
+                self.Dataholder[:, start : start + samples_number] = chunk
+                # The ring slot is overwritten by a later chunk, while the
+                # receivers may run on another thread.
+                self.collected_chunk.emit(chunk.copy(), start)
+
+        if self.has_recording_channel:
+            self.Dataholder.flush()
 
     def get_raw_data(self):
         return self.Dataholder
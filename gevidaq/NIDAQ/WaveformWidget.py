@@ -44,14 +44,16 @@ from pyqtgraph import PlotDataItem
 
 from .. import StylishQT
 from ..ThorlabsFilterSlider.filterpyserial import ELL9Filter
-from . import waveform_specification
+from . import raster_cache, waveform_file, waveform_specification
 from .DAQoperator import DAQmission
+from .digital_waveform import DigitalSignals, DigitalWaveform
+from .plot_decimation import DecimatedPlotDataItem
+from .pmt_reconstruction import PMTReconstruction
 from .wavegenerator import (
     generate_AO,
     generate_AO_for640,
     generate_digital_waveform,
     generate_ramp,
-    waveRecPic,
 )
 
 CAMERA_TRIGGER_INSERT_ARRAY = np.array(
@@ -142,10 +144,17 @@ class WaveformGenerator(QWidget):
             "Perfusion_2": [255, 215, 0],
             "2Pshutter": [229, 204, 255],
             "DMD_trigger": [255, 215, 0],
+            "PMT": [255, 128, 0],
+            "Vp": [255, 255, 255],
+            "Ip": [200, 200, 200],
         }
 
         self.PlotDataItem_dict = {}
         self.waveform_data_dict = {}
+        # Envelope of a streamed recording, drawn while it runs.
+        self.recording_PlotDataItem_dict = {}
+        self.recording_envelope = None
+        self.recording_points = 0
 
         self.setMinimumSize(1000, 650)
         self.setWindowTitle("Buon appetito!")
@@ -254,6 +263,15 @@ class WaveformGenerator(QWidget):
         record_channel_container_layout.addWidget(self.ReadChanIpTextbox, 1, 3)
         self.patchRecordingGroup.addButton(self.ReadChanIpTextbox)
 
+        self.StreamRecordingTextbox = QCheckBox("Stream to disk")
+        self.StreamRecordingTextbox.setToolTip(
+            "Read the recording in chunks into a file on disk,\n"
+            "for recordings that do not fit in memory."
+        )
+        record_channel_container_layout.addWidget(
+            self.StreamRecordingTextbox, 3, 3
+        )
+
         record_channel_container.setLayout(record_channel_container_layout)
 
         self.ReadLayout.addWidget(record_channel_container, 0, 2, 3, 1)
@@ -266,6 +284,17 @@ class WaveformGenerator(QWidget):
 
         self.button_import_np_load = QPushButton("Load waveforms", self)
         self.ReadLayout.addWidget(self.button_import_np_load, 2, 5)
+
+        self.ReadLayout.addWidget(QLabel("Protocol repeats:"), 3, 4)
+        self.ProtocolRepeatsTextbox = QSpinBox(self)
+        self.ProtocolRepeatsTextbox.setMinimum(1)
+        self.ProtocolRepeatsTextbox.setMaximum(1000000)
+        self.ProtocolRepeatsTextbox.setValue(1)
+        self.ProtocolRepeatsTextbox.setToolTip(
+            "Number of times the waveforms are played.\n"
+            "Repeats are streamed to the DAQ, not stored in memory."
+        )
+        self.ReadLayout.addWidget(self.ProtocolRepeatsTextbox, 3, 5)
         self.button_import_np_load.clicked.connect(self.load_wave_np)
 
         self.saving_prefix = ""
@@ -901,15 +930,15 @@ class WaveformGenerator(QWidget):
             self,
             "Single File",
             "",
-            "(*.npy)",
+            "(*{} *.npy)".format(waveform_file.EXTENSION),
         )
 
         try:
-            temp_loaded_container = waveform_specification.load(
-                self.wavenpfileName
-            )
+            # Files in the new format are memory-mapped, only the channels
+            # are read here.
+            temp_loaded_container = waveform_file.load(self.wavenpfileName)
 
-            self.uiDaq_sample_rate = waveform_specification.get_sample_rate(
+            self.uiDaq_sample_rate = waveform_file.get_sample_rate(
                 self.wavenpfileName
             )
 
@@ -921,7 +950,13 @@ class WaveformGenerator(QWidget):
 
             for item in temp_loaded_container:
                 channel_keyword = item["Specification"]
-                self.waveform_data_dict[channel_keyword] = item["Waveform"]
+                waveform = item["Waveform"]
+                if (
+                    not isinstance(waveform, DigitalWaveform)
+                    and waveform.dtype == bool
+                ):
+                    waveform = DigitalWaveform.from_array(waveform)
+                self.waveform_data_dict[channel_keyword] = waveform
                 self.generate_graphy(
                     channel_keyword, self.waveform_data_dict[channel_keyword]
                 )
@@ -1055,10 +1090,13 @@ class WaveformGenerator(QWidget):
         """
         channel_keyword = self.Digital_channel_combox.currentText()
 
+        # Digital waveforms are kept run-length encoded.
         if channel_keyword != "galvotrigger":
             waveform_to_add = self.generate_digital(channel_keyword)
         else:
-            waveform_to_add = self.generate_galvotrigger()
+            waveform_to_add = DigitalWaveform.from_array(
+                self.generate_galvotrigger()
+            )
 
         if self.Append_Mode is False:
             self.waveform_data_dict[channel_keyword] = waveform_to_add
@@ -1066,7 +1104,9 @@ class WaveformGenerator(QWidget):
             # === In Append mode ===
             # If the waveform exists already
             if channel_keyword in self.waveform_data_dict.keys():
-                self.waveform_data_dict[channel_keyword] = np.append(
+                self.waveform_data_dict[
+                    channel_keyword
+                ] = DigitalWaveform.concatenate(
                     self.waveform_data_dict[channel_keyword], waveform_to_add
                 )
             # The first to append
@@ -1076,8 +1116,8 @@ class WaveformGenerator(QWidget):
         if channel_keyword == "cameratrigger":
             # For camera triggers,
             # set to zeros so that it does not block canvas.
-            rectified_waveform = np.zeros(
-                len(self.waveform_data_dict[channel_keyword]), dtype=bool
+            rectified_waveform = DigitalWaveform.constant(
+                False, len(self.waveform_data_dict[channel_keyword])
             )
             self.generate_graphy(channel_keyword, rectified_waveform)
         else:
@@ -1187,24 +1227,32 @@ class WaveformGenerator(QWidget):
             self.offsetsamples_galvo = np.zeros(
                 self.offsetsamples_number_galvo
             )  # Be default offsetsamples_number is an integer.
-        # Generate galvo samples
-        self.samples_1, self.samples_2 = waveRecPic(
-            sampleRate=self.uiDaq_sample_rate,
-            imAngle=0,
-            voltXMin=Value_voltXMin,
-            voltXMax=Value_voltXMax,
-            voltYMin=Value_voltYMin,
-            voltYMax=Value_voltYMax,
-            xPixels=Value_xPixels,
-            yPixels=Value_yPixels,
-            sawtooth=True,
-        )
+        # Generate galvo samples, repeated settings come from the cache
+        self.pmt_scan_parameters = {
+            "sampleRate": self.uiDaq_sample_rate,
+            "voltXMin": Value_voltXMin,
+            "voltXMax": Value_voltXMax,
+            "voltYMin": Value_voltYMin,
+            "voltYMax": Value_voltYMax,
+            "xPixels": Value_xPixels,
+            "yPixels": Value_yPixels,
+            "imAngle": 0,
+            "sawtooth": True,
+            "averagenum": self.averagenum,
+        }
+        raster = raster_cache.get_raster(**self.pmt_scan_parameters)
+        self.samples_1 = raster.samples_X
+        self.samples_2 = raster.samples_Y
         # Totalscansamples = len(self.samples_1)*self.averagenum
         # Calculate number of samples to feed to scanner,
         # by default it's one frame
         self.ScanArrayXnum = int(
             len(self.samples_1) / Value_yPixels
         )  # number of samples of each individual line of x scanning
+        # The recorded PMT data is inverted on reception.
+        self.pmt_reconstruction = PMTReconstruction.from_scan_parameters(
+            **self.pmt_scan_parameters, invert=False
+        )
         if not self.GalvoGapTextbox.text():
             gap_sample = 0
             self.gapsamples_number_galvo = 0
@@ -1215,10 +1263,8 @@ class WaveformGenerator(QWidget):
                 (gap_sample / 1000) * self.uiDaq_sample_rate
             )
 
-        self.repeated_samples_1 = np.tile(self.samples_1, self.averagenum)
-        self.repeated_samples_2_yaxis = np.tile(
-            self.samples_2, self.averagenum
-        )
+        self.repeated_samples_1 = raster.galvo_samples[0]
+        self.repeated_samples_2_yaxis = raster.galvo_samples[1]
 
         # In index array, indexes where there's the first image are 1.
         self.PMT_data_index_array = np.ones(len(self.repeated_samples_1))
@@ -1312,18 +1358,21 @@ class WaveformGenerator(QWidget):
             self.offsetsamples_galvo = np.zeros(
                 self.offsetsamples_number_galvo
             )  # Be default offsetsamples_number is an integer.
-        # Generate galvo samples
-        self.samples_1, self.samples_2 = waveRecPic(
+        # Generate galvo samples, repeated settings come from the cache
+        raster = raster_cache.get_raster(
             sampleRate=self.uiDaq_sample_rate,
-            imAngle=0,
             voltXMin=Value_voltXMin,
             voltXMax=Value_voltXMax,
             voltYMin=Value_voltYMin,
             voltYMax=Value_voltYMax,
             xPixels=Value_xPixels,
             yPixels=Value_yPixels,
+            imAngle=0,
             sawtooth=True,
+            averagenum=self.averagenum,
         )
+        self.samples_1 = raster.samples_X
+        self.samples_2 = raster.samples_Y
         self.ScanArrayXnum = int(
             len(self.samples_1) / Value_yPixels
         )  # number of samples of each individual line of x scanning
@@ -1338,10 +1387,8 @@ class WaveformGenerator(QWidget):
             )
         # print(self.Digital_container_feeder[:, 0])
 
-        self.repeated_samples_1 = np.tile(self.samples_1, self.averagenum)
-        self.repeated_samples_2_yaxis = np.tile(
-            self.samples_2, self.averagenum
-        )
+        self.repeated_samples_1 = raster.galvo_samples[0]
+        self.repeated_samples_2_yaxis = raster.galvo_samples[1]
 
         # Adding gap between scans
         self.gap_samples_1 = self.repeated_samples_1[-1] * np.ones(
@@ -1513,7 +1560,7 @@ class WaveformGenerator(QWidget):
             self.uiwavegap_digital_waveform,
         )
 
-        return digital_waveform.generate()
+        return digital_waveform.generate_compact()
 
     # %%
     # === for generating ramp voltage signals ===
@@ -1640,11 +1687,18 @@ class WaveformGenerator(QWidget):
     # %%
     def generate_graphy(self, channel, waveform):
         self.uiDaq_sample_rate = int(self.SamplingRateTextbox.value())
-        if waveform.dtype == "bool":
-            waveform = waveform.astype(int)
-
-        x_label = np.arange(len(waveform)) / self.uiDaq_sample_rate
-        current_PlotDataItem = PlotDataItem(x_label, waveform, name=channel)
+        if isinstance(waveform, DigitalWaveform):
+            # Only the corners of the steps are plotted.
+            current_PlotDataItem = PlotDataItem(
+                *waveform.plot_data(self.uiDaq_sample_rate), name=channel
+            )
+        else:
+            if waveform.dtype == "bool":
+                waveform = waveform.astype(int)
+            # Long waveforms are drawn decimated to the visible range.
+            current_PlotDataItem = DecimatedPlotDataItem(
+                waveform, self.uiDaq_sample_rate, name=channel
+            )
         current_PlotDataItem.setPen(self.color_dictionary[channel])
 
         if self.Append_Mode is True:
@@ -1656,6 +1710,12 @@ class WaveformGenerator(QWidget):
 
         self.PlotDataItem_dict[channel] = current_PlotDataItem
 
+    def insert_front(self, waveform, insert_array):
+        """Put insert_array in front of an analog or digital waveform."""
+        if isinstance(waveform, DigitalWaveform):
+            return DigitalWaveform.concatenate(insert_array, waveform)
+        return np.insert(waveform, 0, insert_array)
+
     # %%
 
     def clear_canvas(self):
@@ -1723,8 +1783,10 @@ class WaveformGenerator(QWidget):
                         insert_array = CAMERA_TRIGGER_INSERT_ARRAY
 
                         # Add False in the end
-                        self.waveform_data_dict[waveform_key] = np.append(
-                            self.waveform_data_dict[waveform_key], False
+                        self.waveform_data_dict[
+                            waveform_key
+                        ] = DigitalWaveform.concatenate(
+                            self.waveform_data_dict[waveform_key], [False]
                         )
                     elif waveform_key in self.AnalogChannelList:
                         # === Padding at the end ===
@@ -1769,13 +1831,15 @@ class WaveformGenerator(QWidget):
                         )
 
                         # Add False in the end
-                        self.waveform_data_dict[waveform_key] = np.append(
-                            self.waveform_data_dict[waveform_key], False
+                        self.waveform_data_dict[
+                            waveform_key
+                        ] = DigitalWaveform.concatenate(
+                            self.waveform_data_dict[waveform_key], [False]
                         )
 
                     # Insert the appendix
-                    self.waveform_data_dict[waveform_key] = np.insert(
-                        self.waveform_data_dict[waveform_key], 0, insert_array
+                    self.waveform_data_dict[waveform_key] = self.insert_front(
+                        self.waveform_data_dict[waveform_key], insert_array
                     )
             else:
                 for waveform_key in self.waveform_data_dict:
@@ -1804,13 +1868,15 @@ class WaveformGenerator(QWidget):
                             self.padding_number, dtype=bool
                         )
                         # Add False in the end
-                        self.waveform_data_dict[waveform_key] = np.append(
-                            self.waveform_data_dict[waveform_key], False
+                        self.waveform_data_dict[
+                            waveform_key
+                        ] = DigitalWaveform.concatenate(
+                            self.waveform_data_dict[waveform_key], [False]
                         )
 
                     # Insert the appendix
-                    self.waveform_data_dict[waveform_key] = np.insert(
-                        self.waveform_data_dict[waveform_key], 0, insert_array
+                    self.waveform_data_dict[waveform_key] = self.insert_front(
+                        self.waveform_data_dict[waveform_key], insert_array
                     )
         else:
             logging.info("No Auto-padding to reset channels.")
@@ -1856,6 +1922,17 @@ class WaveformGenerator(QWidget):
                     ] = self.waveform_data_dict[waveform_key][
                         0 : self.reference_length
                     ]
+                elif isinstance(
+                    self.waveform_data_dict[waveform_key], DigitalWaveform
+                ):
+                    self.waveform_data_dict[
+                        waveform_key
+                    ] = DigitalWaveform.concatenate(
+                        self.waveform_data_dict[waveform_key],
+                        DigitalWaveform.constant(
+                            False, self.reference_length - len_waveform_data
+                        ),
+                    )
                 else:
                     if (
                         self.waveform_data_dict[waveform_key].dtype
@@ -1949,63 +2026,57 @@ class WaveformGenerator(QWidget):
         dataType_analog = waveform_specification.make_dtype(
             self.reference_length, float
         )
-        dataType_digital = waveform_specification.make_dtype(
-            self.reference_length, bool
-        )
 
         # === Reset the PlotDataItem ===
-        x_label = np.arange(self.reference_length) / self.uiDaq_sample_rate
-
         for waveform_key in self.waveform_data_dict:
             #
             if self.waveform_data_dict[waveform_key].dtype == "float64":
                 # In case of galvos re-drawing
                 if "galvos_contour" in waveform_key:
-                    self.PlotDataItem_dict["galvos_contour"].setData(
-                        x_label,
+                    self.PlotDataItem_dict["galvos_contour"].set_waveform(
                         self.waveform_data_dict[waveform_key],
+                        self.uiDaq_sample_rate,
                         name=waveform_key,
                     )
                 elif "galvosx" in waveform_key or "galvosy" in waveform_key:
-                    self.PlotDataItem_dict["galvos"].setData(
-                        x_label,
+                    self.PlotDataItem_dict["galvos"].set_waveform(
                         self.waveform_data_dict[waveform_key],
+                        self.uiDaq_sample_rate,
                         name=waveform_key,
                     )
                 elif "galvos_X" in waveform_key or "galvos_Y" in waveform_key:
-                    self.PlotDataItem_dict["galvos_contour"].setData(
-                        x_label,
+                    self.PlotDataItem_dict["galvos_contour"].set_waveform(
                         self.waveform_data_dict[waveform_key],
+                        self.uiDaq_sample_rate,
                         name=waveform_key,
                     )
                 else:
-                    self.PlotDataItem_dict[waveform_key].setData(
-                        x_label,
+                    self.PlotDataItem_dict[waveform_key].set_waveform(
                         self.waveform_data_dict[waveform_key],
+                        self.uiDaq_sample_rate,
                         name=waveform_key,
                     )
             else:
                 if waveform_key != "cameratrigger":
-                    # In case of digital boolean signals, convert to int before
-                    # plotting.
-                    self.PlotDataItem_dict[waveform_key].setData(
-                        x_label,
-                        self.waveform_data_dict[waveform_key].astype(int),
-                        name=waveform_key,
-                    )
+                    # In case of digital signals, plot the corners of the
+                    # steps.
+                    digital_waveform = self.waveform_data_dict[waveform_key]
                 else:
                     # For camera triggers, set to zeros so that it does not
                     # block canvas.
-                    rectified_waveform = np.zeros(
-                        len(self.waveform_data_dict[waveform_key]), dtype=bool
+                    digital_waveform = DigitalWaveform.constant(
+                        False, len(self.waveform_data_dict[waveform_key])
                     )
-
-                    self.PlotDataItem_dict[waveform_key].setData(
-                        x_label,
-                        rectified_waveform.astype(int),
-                        name=waveform_key,
+                if not isinstance(digital_waveform, DigitalWaveform):
+                    digital_waveform = DigitalWaveform.from_array(
+                        digital_waveform
                     )
 
+                self.PlotDataItem_dict[waveform_key].setData(
+                    *digital_waveform.plot_data(self.uiDaq_sample_rate),
+                    name=waveform_key,
+                )
+
         # === Making containers ===
         digital_line_num = 0
         for waveform_key in self.waveform_data_dict:
@@ -2016,9 +2087,10 @@ class WaveformGenerator(QWidget):
         )
 
         self.analog_array = np.zeros(analog_line_num, dtype=dataType_analog)
-        self.digital_array = np.zeros(digital_line_num, dtype=dataType_digital)
+        # The digital waveforms stay run-length encoded until they are
+        # written to the DAQ.
+        self.digital_array = DigitalSignals([], [])
 
-        digital_line_num = 0
         analog_line_num = 0
         for waveform_key in self.waveform_data_dict:
             if (
@@ -2033,31 +2105,36 @@ class WaveformGenerator(QWidget):
                 analog_line_num += 1
 
             elif waveform_key in self.DigitalChannelList:
-                self.digital_array[digital_line_num] = np.array(
-                    [(self.waveform_data_dict[waveform_key], waveform_key)],
-                    dtype=dataType_digital,
-                )
-                digital_line_num += 1
+                waveform = self.waveform_data_dict[waveform_key]
+                if not isinstance(waveform, DigitalWaveform):
+                    waveform = DigitalWaveform.from_array(waveform)
+                self.digital_array.waveforms.append(waveform)
+                self.digital_array.specifications.append(waveform_key)
         logging.info(
             "Writing channels: {}".format(self.waveform_data_dict.keys())
         )
 
         # === Saving configed waveforms ===
         if self.checkbox_saveWaveforms.isChecked():
-            ciao = []  # Variable name 'ciao' was defined by Nicolo Ceffa.
-
-            for i in range(len(self.analog_array["Specification"])):
-                ciao.append(self.analog_array[i])
-
-            for i in range(len(self.digital_array["Specification"])):
-                ciao.append(self.digital_array[i])
+            channels = list(
+                zip(
+                    self.analog_array["Specification"],
+                    self.analog_array["Waveform"],
+                )
+            ) + list(
+                zip(
+                    self.digital_array["Specification"],
+                    self.digital_array["Waveform"],
+                )
+            )
 
             filename = waveform_specification.create_filename(
                 self.saving_prefix, self.SamplingRateTextbox.value()
             )
-            np.save(
+            waveform_file.save(
                 os.path.join(self.savedirectory, filename),
-                ciao,
+                self.SamplingRateTextbox.value(),
+                channels,
             )
 
             self.save_plot_figure()
@@ -2089,6 +2166,9 @@ class WaveformGenerator(QWidget):
                 self.averagenum,
                 len(self.samples_1),
                 self.ScanArrayXnum,
+                # The reconstruction is rebuilt from the scan parameters,
+                # instead of saving its pixel index with the pipeline.
+                self.pmt_scan_parameters,
             )  # Emit a tuple
             self.GalvoScanInfor.emit(self.GalvoScanInforPackage)
         except Exception as exc:
@@ -2162,17 +2242,78 @@ class WaveformGenerator(QWidget):
     def run_DAQ_Waveforms(self):
         # Execute the runWaveforms function from NIdaq
         self.adcollector = DAQmission()
+        if self.StreamRecordingTextbox.isChecked():
+            # Chunks of 0.1 s
+            stream_chunk_size = max(int(self.uiDaq_sample_rate / 10), 1)
+            self.adcollector.collected_chunk.connect(self.plot_recording_chunk)
+        else:
+            stream_chunk_size = None
         self.adcollector.runWaveforms(
             clock_source=self.clock_source.currentText(),
             sampling_rate=self.uiDaq_sample_rate,
             analog_signals=self.analog_array,
             digital_signals=self.digital_array,
             readin_channels=self.readinchan,
+            stream_chunk_size=stream_chunk_size,
+            repeats=self.ProtocolRepeatsTextbox.value(),
         )
         self.adcollector.save_as_binary(self.savedirectory)
 
         # self.button_execute.setEnabled(False)
 
+    def plot_recording_chunk(self, chunk, start):
+        """
+        Add a streamed chunk of the recording to the waveform plot.
+
+        Only the minimum and maximum of every chunk are drawn, so the plot
+        stays light for hour-long recordings.
+
+        Parameters
+        chunk : np.ndarray
+            Recorded samples of every recording channel.
+        start : int
+            Index of the first sample of the chunk.
+
+        Returns
+        None.
+
+        """
+        if start == 0:
+            chunks_number = -(
+                -self.adcollector.Waveforms_length // chunk.shape[1]
+            )
+            self.recording_envelope = (
+                np.zeros(2 * chunks_number),
+                np.zeros((len(self.readinchan), 2 * chunks_number)),
+            )
+            self.recording_points = 0
+            for item in self.recording_PlotDataItem_dict.values():
+                self.pw_PlotItem.removeItem(item)
+            self.recording_PlotDataItem_dict = {}
+            for channel in self.readinchan:
+                item = PlotDataItem(name=channel + " recording")
+                item.setPen(self.color_dictionary[channel])
+                self.pw_PlotItem.addItem(item)
+                self.recording_PlotDataItem_dict[channel] = item
+        elif self.recording_envelope is None:
+            return
+
+        times, values = self.recording_envelope
+        index = self.recording_points
+        times[index : index + 2] = (
+            np.array([start, start + chunk.shape[1] - 1])
+            / self.uiDaq_sample_rate
+        )
+        values[:, index] = chunk.min(axis=1)
+        values[:, index + 1] = chunk.max(axis=1)
+        self.recording_points = index + 2
+
+        for row, channel in enumerate(self.readinchan):
+            self.recording_PlotDataItem_dict[channel].setData(
+                times[: self.recording_points],
+                values[row, : self.recording_points],
+            )
+
     def load_waveforms(self, WaveformTuple):
         self.WaveformSamplingRate = WaveformTuple[0]
         self.WaveformAnalogContainer = WaveformTuple[1]
@@ -2204,8 +2345,8 @@ class WaveformGenerator(QWidget):
             if "Vp" in self.readinchan:
                 self.data_collected_0 = data_waveformreceived[0]
 
-                self.PlotDataItem_patch_voltage = PlotDataItem(
-                    self.xlabelhere_all, self.data_collected_0
+                self.PlotDataItem_patch_voltage = DecimatedPlotDataItem(
+                    self.data_collected_0, self.uiDaq_sample_rate
                 )
                 # use the same color as before, taking advantages of employing
                 # same keys in dictionary
@@ -2220,8 +2361,8 @@ class WaveformGenerator(QWidget):
             elif "Ip" in self.readinchan:
                 self.data_collected_0 = data_waveformreceived[0]
 
-                self.PlotDataItem_patch_current = PlotDataItem(
-                    self.xlabelhere_all, self.data_collected_0
+                self.PlotDataItem_patch_current = DecimatedPlotDataItem(
+                    self.data_collected_0, self.uiDaq_sample_rate
                 )
                 # use the same color as before, taking advantages of employing
                 # same keys in dictionary
@@ -2252,18 +2393,11 @@ class WaveformGenerator(QWidget):
                                 )
                             ]
                         )
-                        Dataholder_average = np.mean(
-                            self.PMT_image_reconstructed_array.reshape(
-                                self.averagenum, -1
-                            ),
-                            axis=0,
-                        )
-                        Value_yPixels = int(
-                            len(self.samples_1) / self.ScanArrayXnum
-                        )
-                        self.PMT_image_reconstructed = np.reshape(
-                            Dataholder_average,
-                            (Value_yPixels, self.ScanArrayXnum),
+                        # Average the frames and cut off the flying back.
+                        self.PMT_image_reconstructed = (
+                            self.pmt_reconstruction.reconstruct(
+                                self.PMT_image_reconstructed_array
+                            )
                         )
 
                         # Stack the arrays into a 3d array
@@ -2320,8 +2454,8 @@ class WaveformGenerator(QWidget):
             if "PMT" not in self.readinchan:
                 self.data_collected_0 = data_waveformreceived[0]
 
-                self.PlotDataItem_patch_voltage = PlotDataItem(
-                    self.xlabelhere_all, self.data_collected_0
+                self.PlotDataItem_patch_voltage = DecimatedPlotDataItem(
+                    self.data_collected_0, self.uiDaq_sample_rate
                 )
                 # use the same color as before, taking advantage of employing
                 # same keys in dictionary
@@ -2336,8 +2470,8 @@ class WaveformGenerator(QWidget):
 
                 self.data_collected_1 = data_waveformreceived[1]
 
-                self.PlotDataItem_patch_current = PlotDataItem(
-                    self.xlabelhere_all, self.data_collected_1
+                self.PlotDataItem_patch_current = DecimatedPlotDataItem(
+                    self.data_collected_1, self.uiDaq_sample_rate
                 )
                 # use the same color as before, taking advantage of employing
                 # same keys in dictionary
@@ -2364,18 +2498,11 @@ class WaveformGenerator(QWidget):
                                 )
                             ]
                         )
-                        Dataholder_average = np.mean(
-                            self.PMT_image_reconstructed_array.reshape(
-                                self.averagenum, -1
-                            ),
-                            axis=0,
-                        )
-                        Value_yPixels = int(
-                            len(self.samples_1) / self.ScanArrayXnum
-                        )
-                        self.PMT_image_reconstructed = np.reshape(
-                            Dataholder_average,
-                            (Value_yPixels, self.ScanArrayXnum),
+                        # Average the frames and cut off the flying back.
+                        self.PMT_image_reconstructed = (
+                            self.pmt_reconstruction.reconstruct(
+                                self.PMT_image_reconstructed_array
+                            )
                         )
 
                         # Stack the arrays into a 3d array
@@ -2431,8 +2558,8 @@ class WaveformGenerator(QWidget):
                 if "Vp" in self.readinchan:
                     self.data_collected_1 = data_waveformreceived[1]
 
-                    self.PlotDataItem_patch_voltage = PlotDataItem(
-                        self.xlabelhere_all, self.data_collected_1
+                    self.PlotDataItem_patch_voltage = DecimatedPlotDataItem(
+                        self.data_collected_1, self.uiDaq_sample_rate
                     )
                     # use the same color as before, taking advantage of
                     # employing same keys in dictionary
@@ -2447,8 +2574,8 @@ class WaveformGenerator(QWidget):
                 elif "Ip" in self.readinchan:
                     self.data_collected_1 = data_waveformreceived[1]
 
-                    self.PlotDataItem_patch_current = PlotDataItem(
-                        self.xlabelhere_all, self.data_collected_1
+                    self.PlotDataItem_patch_current = DecimatedPlotDataItem(
+                        self.data_collected_1, self.uiDaq_sample_rate
                     )
                     # use the same color as before, taking advantage of
                     # employing same keys in dictionary
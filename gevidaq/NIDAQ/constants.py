@@ -25,6 +25,8 @@ class HardwareConstants:
         self.maxGalvoAccel = 1.54 * 10**8  # Acceleration galvo in volt/s^2
 
         self.pmt_3v_indentation_pixels = 52
+        # Delay between galvo command and recorded PMT signal, in s
+        self.pmtLagTime = 100e-6
 
 
 class NiDaqChannels:
@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+"""
+Route planning for contour scans of several cells.
+
+The contours of several cells are scanned one after the other in a single
+scan period. Concatenated in the order they were drawn or found, the galvos
+jump back and forth across the field between cells. plan_contour_route
+orders the contours with a nearest neighbour tour improved by 2-opt, and
+picks where every contour starts and in which direction it is scanned, so
+the jumps between contours are as short as possible.
+
+With a sample rate, the jumps are replaced by straight moves that stay
+within the maximum galvo speed and acceleration of HardwareConstants, so
+the galvos follow the waveform instead of ringing after a step.
+
+Usage:
+    route = contour_route.plan_contour_route(
+        [roi_1_signals, roi_2_signals, roi_3_signals], sampleRate=50000
+    )
+    route.signals  # (2, n) x and y galvo samples of one scan period
+    route.contour_slices[1]  # samples of roi_2_signals in route.signals
+"""
+import math
+
+import numpy as np
+from scipy.spatial.distance import cdist
+
+from .constants import HardwareConstants
+
+
+def transition_samples(start, end, sampleRate, maxSpeed=None, maxAccel=None):
+    """
+    Samples of the fastest straight galvo move from start to end.
+
+    The move starts and stops at rest, with a trapezoidal speed profile on
+    the axis that moves the most. The other axis follows the same profile
+    scaled down.
+
+    Parameters
+    start : array_like
+        x and y voltage at the start.
+    end : array_like
+        x and y voltage at the end.
+    sampleRate : int
+        Sample rate of the waveform.
+    maxSpeed : float, optional
+        Maximum galvo speed in volt/s. The default is from
+        HardwareConstants.
+    maxAccel : float, optional
+        Maximum galvo acceleration in volt/s^2. The default is from
+        HardwareConstants.
+
+    Returns
+    samples : np.ndarray
+        Array of shape (2, n), without the start and end points.
+
+    """
+    constants = HardwareConstants()
+    if maxSpeed is None:
+        maxSpeed = constants.maxGalvoSpeed
+    if maxAccel is None:
+        maxAccel = constants.maxGalvoAccel
+
+    start = np.asarray(start, dtype=float)
+    end = np.asarray(end, dtype=float)
+    distance = float(np.max(np.abs(end - start)))
+    if distance == 0:
+        return np.empty((2, 0))
+
+    # Without reaching the maximum speed the profile is a triangle.
+    peakSpeed = min(maxSpeed, math.sqrt(distance * maxAccel))
+    accelTime = peakSpeed / maxAccel
+    duration = distance / peakSpeed + accelTime
+
+    # Whole sample periods, slowing the move down a little to fit.
+    intervals = max(math.ceil(duration * sampleRate - 1e-9), 1)
+    t = np.arange(1, intervals) * (duration / intervals)
+    travelled = np.where(
+        t < accelTime,
+        0.5 * maxAccel * t**2,
+        np.where(
+            t <= duration - accelTime,
+            peakSpeed * (t - accelTime / 2),
+            distance - 0.5 * maxAccel * (duration - t) ** 2,
+        ),
+    )
+
+    return start[:, np.newaxis] + np.outer(end - start, travelled / distance)
+
+
+def nearest_neighbour_tour(distances, first=0):
+    """Tour that always goes to the nearest contour not visited yet."""
+    number = distances.shape[0]
+    tour = [first]
+    unvisited = np.ones(number, dtype=bool)
+    unvisited[first] = False
+    for _ in range(number - 1):
+        candidates = np.flatnonzero(unvisited)
+        nearest = candidates[np.argmin(distances[tour[-1], candidates])]
+        tour.append(int(nearest))
+        unvisited[nearest] = False
+    return np.array(tour)
+
+
+def two_opt(tour, distances):
+    """
+    Improve a closed tour by reversing parts of it while that shortens it.
+
+    Parameters
+    tour : np.ndarray
+        Order of the contours, the first one stays first.
+    distances : np.ndarray
+        Symmetric distance matrix between the contours.
+
+    Returns
+    tour : np.ndarray
+        The improved tour.
+
+    """
+    tour = np.array(tour)
+    number = tour.size
+    improved = number > 3
+    while improved:
+        improved = False
+        for i in range(1, number - 1):
+            # Gain of reversing tour[i:j + 1] for every j at once.
+            j = np.arange(i + 1, number)
+            a, b = tour[i - 1], tour[i]
+            c, d = tour[j], tour[(j + 1) % number]
+            gain = (
+                distances[a, b]
+                + distances[c, d]
+                - distances[a, c]
+                - distances[b, d]
+            )
+            best = int(np.argmax(gain))
+            if gain[best] > 1e-12:
+                tour[i : j[best] + 1] = tour[i : j[best] + 1][::-1]
+                improved = True
+    return tour
+
+
+def oriented_contour(contour, start, reverse=False):
+    """The closed contour starting at sample start, optionally reversed."""
+    number = contour.shape[1]
+    step = -1 if reverse else 1
+    return contour[:, (start + step * np.arange(number)) % number]
+
+
+class ContourRoute:
+    def __init__(self, contours, order, starts, reverse, signals, slices):
+        """
+        Scan route through several contours, see plan_contour_route.
+
+        Attributes
+        order : np.ndarray
+            Indices of the contours in the order they are scanned.
+        starts : np.ndarray
+            Start sample of every contour, by contour index.
+        reverse : np.ndarray
+            Whether every contour is scanned backwards, by contour index.
+        signals : np.ndarray
+            x and y galvo samples of the route, of shape (2, n).
+        contour_slices : list
+            Slice of every contour's samples in signals, by contour index.
+        """
+        self.contours = contours
+        self.order = order
+        self.starts = starts
+        self.reverse = reverse
+        self.signals = signals
+        self.contour_slices = slices
+
+    @property
+    def contour_samples_number(self):
+        return sum(contour.shape[1] for contour in self.contours)
+
+    @property
+    def transition_samples_number(self):
+        return self.signals.shape[1] - self.contour_samples_number
+
+    def jump_distance(self):
+        """Summed largest axis jump between consecutive contours."""
+        ends = []
+        for index in self.order:
+            contour = oriented_contour(
+                self.contours[index], self.starts[index], self.reverse[index]
+            )
+            ends.append((contour[:, 0], contour[:, -1]))
+        return sum(
+            float(np.max(np.abs(ends[(i + 1) % len(ends)][0] - ends[i][1])))
+            for i in range(len(ends))
+        )
+
+
+def plan_contour_route(
+    contours, sampleRate=None, maxSpeed=None, maxAccel=None, passes=3
+):
+    """
+    Order closed contours, their start points and directions for scanning.
+
+    Parameters
+    contours : list of np.ndarray
+        x and y voltages of every closed contour, arrays of shape (2, n).
+    sampleRate : int, optional
+        Sample rate of the scan. If given, limited transitions are put
+        between the contours, see transition_samples. The default is None,
+        which concatenates the contours directly.
+    maxSpeed : float, optional
+        Maximum galvo speed in volt/s, see transition_samples.
+    maxAccel : float, optional
+        Maximum galvo acceleration in volt/s^2, see transition_samples.
+    passes : int, optional
+        Number of passes choosing the start points. The default is 3.
+
+    Returns
+    route : ContourRoute
+        The first contour is scanned first, from its first sample.
+
+    """
+    contours = [np.asarray(contour, dtype=float) for contour in contours]
+    number = len(contours)
+    if number == 0:
+        raise ValueError("No contours to plan a route through")
+
+    # Closest points between every two contours, on the axis that moves most.
+    distances = np.zeros((number, number))
+    closest = np.zeros((number, number), dtype=int)
+    for i in range(number):
+        for j in range(i + 1, number):
+            pair_distances = cdist(
+                contours[i].T, contours[j].T, metric="chebyshev"
+            )
+            k_i, k_j = np.unravel_index(
+                np.argmin(pair_distances), pair_distances.shape
+            )
+            distances[i, j] = distances[j, i] = pair_distances[k_i, k_j]
+            closest[i, j], closest[j, i] = k_i, k_j
+
+    order = two_opt(nearest_neighbour_tour(distances), distances)
+
+    # Enter every contour where it is closest to the previous one, then
+    # improve the start points and directions against both neighbours.
+    starts = np.zeros(number, dtype=int)
+    reverse = np.zeros(number, dtype=bool)
+    if number > 1:
+        for position in range(1, number):
+            starts[order[position]] = closest[
+                order[position], order[position - 1]
+            ]
+
+        def entry_point(index):
+            return contours[index][:, starts[index]]
+
+        def exit_point(index):
+            step = 1 if reverse[index] else -1
+            points = contours[index].shape[1]
+            return contours[index][:, (starts[index] + step) % points]
+
+        for _ in range(passes):
+            # The first contour keeps its first sample.
+            for position in range(1, number):
+                index = order[position]
+                previous_exit = exit_point(order[position - 1])
+                next_entry = entry_point(order[(position + 1) % number])
+
+                points = contours[index]
+                entry_cost = np.max(
+                    np.abs(points - previous_exit[:, np.newaxis]), axis=0
+                )
+                exit_cost = np.max(
+                    np.abs(points - next_entry[:, np.newaxis]), axis=0
+                )
+                # Starting at k, the last sample is k - 1 forwards and
+                # k + 1 backwards.
+                forward = entry_cost + np.roll(exit_cost, 1)
+                backward = entry_cost + np.roll(exit_cost, -1)
+                if backward.min() < forward.min():
+                    starts[index] = int(np.argmin(backward))
+                    reverse[index] = True
+                else:
+                    starts[index] = int(np.argmin(forward))
+                    reverse[index] = False
+
+    # Put the route together.
+    pieces = []
+    slices = [None] * number
+    length = 0
+    for position, index in enumerate(order):
+        contour = oriented_contour(
+            contours[index], starts[index], reverse[index]
+        )
+        slices[index] = slice(length, length + contour.shape[1])
+        pieces.append(contour)
+        length += contour.shape[1]
+
+        if sampleRate is not None and number > 1:
+            next_index = order[(position + 1) % number]
+            transition = transition_samples(
+                contour[:, -1],
+                contours[next_index][:, starts[next_index]],
+                sampleRate,
+                maxSpeed,
+                maxAccel,
+            )
+            pieces.append(transition)
+            length += transition.shape[1]
+
+    return ContourRoute(
+        contours,
+        order,
+        starts,
+        reverse,
+        np.concatenate(pieces, axis=1),
+        slices,
+    )
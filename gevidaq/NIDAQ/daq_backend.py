@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+Selectable backend for the NI-DAQ tasks.
+
+The acquisition code creates its tasks, stream readers and stream writers
+through the backend from get_backend() instead of from nidaqmx directly.
+Normally this is the NI-DAQmx driver, but it can be swapped for the
+simulator in daq_simulator to run and benchmark the acquisitions on a
+computer without DAQ devices.
+
+The environment variable GEVIDAQ_DAQ_BACKEND=simulated selects the simulator
+when the first task is created, or it is set explicitly.
+
+Usage:
+    daq = daq_backend.get_backend()
+    with daq.Task() as task:
+        task.ai_channels.add_ai_voltage_chan("Dev1/ai0")
+        reader = daq.AnalogSingleChannelReader(task.in_stream)
+
+    daq_backend.set_backend(daq_simulator.SimulatedBackend(realtime=False))
+"""
+import os
+import threading
+
+import nidaqmx
+import numpy as np
+from nidaqmx import stream_readers, stream_writers
+
+BACKEND_VARIABLE = "GEVIDAQ_DAQ_BACKEND"
+
+
+class NidaqmxBackend:
+    """The NI-DAQmx driver, through the nidaqmx package."""
+
+    name = "nidaqmx"
+    DaqError = nidaqmx.DaqError
+
+    Task = nidaqmx.Task
+    AnalogSingleChannelReader = stream_readers.AnalogSingleChannelReader
+    AnalogMultiChannelReader = stream_readers.AnalogMultiChannelReader
+    AnalogSingleChannelWriter = stream_writers.AnalogSingleChannelWriter
+    AnalogMultiChannelWriter = stream_writers.AnalogMultiChannelWriter
+    DigitalMultiChannelWriter = stream_writers.DigitalMultiChannelWriter
+
+    def ai_scaling_coeff(self, task, physical_channel):
+        """
+        Polynomial coefficients from raw ADC values to volt of an analog
+        input channel of the task.
+        """
+        # https://knowledge.ni.com/KnowledgeArticleDetails?id=kA00Z0000019TuoSAE&l=nl-NL
+        return np.array(
+            nidaqmx._task_modules.channels.ai_channel.AIChannel(
+                task._handle, physical_channel
+            ).ai_dev_scaling_coeff
+        )
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    """The backend in use, chosen from BACKEND_VARIABLE the first time."""
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            name = os.environ.get(BACKEND_VARIABLE, NidaqmxBackend.name)
+            if name == "simulated":
+                from . import daq_simulator
+
+                _backend = daq_simulator.SimulatedBackend()
+            elif name == NidaqmxBackend.name:
+                _backend = NidaqmxBackend()
+            else:
+                raise ValueError(
+                    f"Unknown DAQ backend {name!r} in {BACKEND_VARIABLE}"
+                )
+        return _backend
+
+
+def set_backend(backend):
+    """Use backend for all tasks created from now on."""
+    global _backend
+    with _backend_lock:
+        _backend = backend
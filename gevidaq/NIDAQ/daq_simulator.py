@@ -0,0 +1,1169 @@
+# -*- coding: utf-8 -*-
+"""
+Simulated NI-DAQ devices, for running the acquisitions without hardware.
+
+SimulatedBackend offers the same tasks, stream readers and stream writers as
+daq_backend.NidaqmxBackend, implemented with numpy:
+
+- Timed tasks follow the sample clock they are configured with. Clocks on
+  "ai/SampleClock" or on a terminal that another task exports to are
+  resolved to that task, so all tasks of an acquisition run on the samples
+  of one master task. Terminals on different devices are connected through
+  the wiring, by default the PFI cables between Dev1 and Dev2.
+- Finite tasks stop after their number of samples, continuous tasks run
+  until they are stopped. Start triggers from other tasks delay the start.
+- Regenerated output buffers are played cyclically, streamed ones block the
+  writer while the buffer is full. Reading continuous inputs later than the
+  input buffer size raises the same overflow error as the driver.
+- Analog inputs are generated by signal models from what the simulated
+  outputs generate on the same clock: PhantomPMT scans a phantom image with
+  the galvo voltages and PatchRCModel responds to the patch clamp command
+  like a cell behind a series resistance.
+
+In realtime mode the master clocks run on the wall clock. Otherwise samples
+are generated as fast as they are read, for benchmarking the processing.
+
+Usage:
+    daq_backend.set_backend(SimulatedBackend(realtime=False))
+    image = RasterScan(500000, 5, 500, 2).run()
+
+Benchmark with: python -m gevidaq.NIDAQ.daq_simulator
+"""
+import itertools
+import math
+import re
+import threading
+import time
+
+import nidaqmx
+import numpy as np
+from nidaqmx.constants import (
+    READ_ALL_AVAILABLE,
+    AcquisitionType,
+    LineGrouping,
+    RegenerationMode,
+    WriteRelativeTo,
+)
+from scipy.signal import lfilter
+
+from .constants import HardwareConstants, NiDaqChannels
+
+DaqError = nidaqmx.DaqError
+
+# Error codes of the NI-DAQmx driver for the same situations.
+READ_OVERFLOW_ERROR = -200279
+READ_PAST_END_ERROR = -200278
+TIMEOUT_ERROR = -200284
+WRITE_TIMEOUT_ERROR = -200292
+TASK_NOT_DONE_ERROR = -200560
+
+# Samples kept of streamed outputs after they were generated, for the inputs
+# that look back in time like the PMT lag.
+OUTPUT_HISTORY = 65536
+
+
+def default_wiring():
+    """Terminals connected between the devices, both directions."""
+    configs = NiDaqChannels().look_up_table
+    wiring = {}
+    for one, other in (
+        (configs["clock1Channel"], configs["clock2Channel"]),
+        (configs["trigger1Channel"], configs["trigger2Channel"]),
+    ):
+        wiring[one] = other
+        wiring[other] = one
+    return wiring
+
+
+def expand_channels(physical_channels):
+    """
+    Separate physical channel names, without leading slash.
+
+    "/Dev1/ao0:1, Dev1/ao3" gives ["Dev1/ao0", "Dev1/ao1", "Dev1/ao3"].
+    """
+    channels = []
+    for name in physical_channels.split(","):
+        name = name.strip().strip("/")
+        match = re.fullmatch(r"(.*?)(\d+):(\d+)", name)
+        if match is None:
+            channels.append(name)
+            continue
+
+        prefix, first, last = match.group(1), int(match[2]), int(match[3])
+        step = 1 if last >= first else -1
+        channels.extend(
+            f"{prefix}{number}" for number in range(first, last + step, step)
+        )
+    return channels
+
+
+def normalize_terminal(terminal, device):
+    """Terminal with device, like "/Dev1/ai/SampleClock"."""
+    terminal = terminal.strip()
+    if not terminal.startswith("/"):
+        terminal = f"/{device}/{terminal}"
+    return terminal
+
+
+def default_input_buffer_size(rate, samples_per_channel):
+    """Input buffer size the driver picks for continuous acquisitions."""
+    if rate <= 100:
+        size = 1000
+    elif rate <= 10000:
+        size = 10000
+    elif rate <= 1000000:
+        size = 100000
+    else:
+        size = 1000000
+    return max(size, samples_per_channel or 0)
+
+
+def phantom_image(size=512, beads=80, seed=0):
+    """
+    Deterministic test sample: gaussian beads of random size and brightness
+    on a weak background, values between 0 and about 1.
+    """
+    rng = np.random.default_rng(seed)
+    coordinates = np.arange(size)
+    image = np.full((size, size), 0.05)
+    for row, column, radius, brightness in zip(
+        rng.uniform(0, size, beads),
+        rng.uniform(0, size, beads),
+        rng.uniform(size / 200, size / 40, beads),
+        rng.uniform(0.3, 1.0, beads),
+    ):
+        image += brightness * np.outer(
+            np.exp(-(((coordinates - row) / radius) ** 2)),
+            np.exp(-(((coordinates - column) / radius) ** 2)),
+        )
+    return image
+
+
+class PhantomPMT:
+    def __init__(
+        self,
+        image=None,
+        volt_range=(-10.0, 10.0),
+        gain=-1.0,
+        noise=0.01,
+        lag_time=None,
+        seed=0,
+    ):
+        """
+        PMT signal of a galvo scan over a phantom image.
+
+        Parameters
+        image : np.ndarray, optional
+            2-D image that is scanned, rows along galvo Y. The default is
+            phantom_image().
+        volt_range : tuple, optional
+            Galvo voltages of the image edges. The default is (-10, 10), so
+            smaller scans zoom into the image.
+        gain : float, optional
+            Volt per image value, negative like the PMT amplifier. The
+            default is -1.
+        noise : float, optional
+            Standard deviation of the added noise in volt. The default is
+            0.01.
+        lag_time : float, optional
+            Delay between galvo command and PMT signal in seconds. The
+            default is HardwareConstants().pmtLagTime.
+        seed : int, optional
+            Seed of the noise.
+
+        Returns
+        None.
+
+        """
+        configs = NiDaqChannels().look_up_table
+        self.channel = configs["PMT"]
+        self.x_channel = configs["galvosx"]
+        self.y_channel = configs["galvosy"]
+        self.channels = (self.channel,)
+
+        self.image = phantom_image() if image is None else np.asarray(image)
+        self.volt_range = volt_range
+        self.gain = gain
+        self.noise = noise
+        if lag_time is None:
+            lag_time = HardwareConstants().pmtLagTime
+        self.lag_time = lag_time
+        self.rng = np.random.default_rng(seed)
+
+    def pixel_index(self, volts, pixels):
+        volt_min, volt_max = self.volt_range
+        index = np.rint((volts - volt_min) / (volt_max - volt_min) * pixels)
+        return np.clip(index, 0, pixels - 1).astype(np.intp)
+
+    def generate(self, first, last, outputs, sample_rate):
+        lag = int(round(self.lag_time * sample_rate))
+        rows = self.pixel_index(
+            outputs(self.y_channel, first - lag, last - lag),
+            self.image.shape[0],
+        )
+        columns = self.pixel_index(
+            outputs(self.x_channel, first - lag, last - lag),
+            self.image.shape[1],
+        )
+
+        signal = self.gain * self.image[rows, columns]
+        if self.noise:
+            signal += self.rng.normal(0, self.noise, signal.size)
+        return {self.channel: signal}
+
+
+class PatchRCModel:
+    def __init__(
+        self,
+        series_resistance=10e6,
+        membrane_resistance=1e9,
+        membrane_capacitance=30e-12,
+        command_gain=0.1,
+        voltage_gain=10.0,
+        current_gain=1e8,
+        noise=0.001,
+        seed=0,
+    ):
+        """
+        Patch clamp amplifier with a cell in voltage clamp.
+
+        The command output sets the pipette potential, the membrane is
+        charged through the series resistance and leaks through the
+        membrane resistance. The filter state is kept between reads.
+
+        Parameters
+        series_resistance, membrane_resistance : float, optional
+            In ohm. The defaults are 10 MOhm and 1 GOhm.
+        membrane_capacitance : float, optional
+            In farad. The default is 30 pF.
+        command_gain : float, optional
+            Pipette volt per volt of command output. The default is 0.1.
+        voltage_gain : float, optional
+            Volt of the voltage inputs per pipette volt. The default is 10.
+        current_gain : float, optional
+            Volt of the current input per ampere. The default is 1e8.
+        noise : float, optional
+            Standard deviation of the added noise in volt.
+        seed : int, optional
+            Seed of the noise.
+
+        Returns
+        None.
+
+        """
+        configs = NiDaqChannels().look_up_table
+        self.command_channel = configs["patchAO"]
+        self.voltage_channels = (configs["VpPatch"],)
+        self.current_channels = (configs["Ip"],)
+        self.channels = self.voltage_channels + self.current_channels
+
+        self.series_resistance = series_resistance
+        self.membrane_resistance = membrane_resistance
+        self.membrane_capacitance = membrane_capacitance
+        self.command_gain = command_gain
+        self.voltage_gain = voltage_gain
+        self.current_gain = current_gain
+        self.noise = noise
+        self.rng = np.random.default_rng(seed)
+
+        self.end = None
+        self.state = None
+
+    def generate(self, first, last, outputs, sample_rate):
+        pipette = self.command_gain * outputs(
+            self.command_channel, first, last
+        )
+
+        # Membrane potential relaxes to the resistor divider of the pipette
+        # potential, with the time constant of both resistances in parallel.
+        tau = self.membrane_capacitance / (
+            1 / self.series_resistance + 1 / self.membrane_resistance
+        )
+        decay = math.exp(-1 / (sample_rate * tau))
+        divider = self.membrane_resistance / (
+            self.series_resistance + self.membrane_resistance
+        )
+        if first != self.end or self.state is None:
+            # Not continuing the previous read, start at steady state.
+            start = pipette[0] if pipette.size else 0.0
+            self.state = np.array([decay * divider * start])
+        membrane, self.state = lfilter(
+            [(1 - decay) * divider], [1, -decay], pipette, zi=self.state
+        )
+        self.end = last
+
+        current = (pipette - membrane) / self.series_resistance
+        signals = {}
+        for channel in self.voltage_channels:
+            signals[channel] = self.voltage_gain * pipette
+        for channel in self.current_channels:
+            signals[channel] = self.current_gain * current
+        if self.noise:
+            for channel in signals:
+                signals[channel] += self.rng.normal(
+                    0, self.noise, last - first
+                )
+        return signals
+
+
+def default_models():
+    return [PhantomPMT(), PatchRCModel()]
+
+
+class SimulatedChannels:
+    def __init__(self, task):
+        """Channels of one type in a task."""
+        self._task = task
+        self.channel_names = []
+        self.ranges = {}
+        self.line_grouping = {}
+
+    def _add(self, channels, min_val, max_val):
+        for channel in channels:
+            self.channel_names.append(channel)
+            self.ranges[channel] = (min_val, max_val)
+
+    def add_ai_voltage_chan(
+        self, physical_channel, *args, min_val=-5.0, max_val=5.0, **kwargs
+    ):
+        self._add(expand_channels(physical_channel), min_val, max_val)
+
+    def add_ao_voltage_chan(
+        self, physical_channel, *args, min_val=-10.0, max_val=10.0, **kwargs
+    ):
+        self._add(expand_channels(physical_channel), min_val, max_val)
+
+    def add_do_chan(
+        self,
+        lines,
+        name_to_assign_to_lines="",
+        line_grouping=LineGrouping.CHAN_FOR_ALL_LINES,
+    ):
+        if line_grouping == LineGrouping.CHAN_PER_LINE:
+            self._add(expand_channels(lines), 0, 1)
+        else:
+            # One channel for all lines, like a port written as words.
+            self._add([lines.strip().strip("/")], 0, 1)
+
+    def __len__(self):
+        return len(self.channel_names)
+
+    def __iter__(self):
+        return iter(self.channel_names)
+
+
+class SimulatedTiming:
+    def __init__(self):
+        self.samp_clk_rate = None
+        self.samp_clk_src = ""
+        self.samp_quant_samp_mode = None
+        self.samp_quant_samp_per_chan = None
+
+    def cfg_samp_clk_timing(
+        self,
+        rate,
+        source="",
+        active_edge=None,
+        sample_mode=AcquisitionType.FINITE,
+        samps_per_chan=1000,
+    ):
+        self.samp_clk_rate = float(rate)
+        self.samp_clk_src = source or ""
+        self.samp_quant_samp_mode = sample_mode
+        self.samp_quant_samp_per_chan = int(samps_per_chan)
+
+
+class SimulatedStartTrigger:
+    def __init__(self):
+        self.dig_edge_src = ""
+
+    def cfg_dig_edge_start_trig(self, trigger_source, trigger_edge=None):
+        self.dig_edge_src = trigger_source
+
+    def disable_start_trig(self):
+        self.dig_edge_src = ""
+
+
+class SimulatedTriggers:
+    def __init__(self):
+        self.start_trigger = SimulatedStartTrigger()
+
+
+class SimulatedExportSignals:
+    def __init__(self):
+        self.samp_clk_output_term = ""
+        self.start_trig_output_term = ""
+
+
+class SimulatedInStream:
+    def __init__(self, task):
+        self._task = task
+        self._input_buf_size = None
+        self.curr_read_pos = 0
+
+    @property
+    def input_buf_size(self):
+        if self._input_buf_size is not None:
+            return self._input_buf_size
+        timing = self._task.timing
+        if timing.samp_quant_samp_mode == AcquisitionType.FINITE:
+            return timing.samp_quant_samp_per_chan
+        return default_input_buffer_size(
+            timing.samp_clk_rate or 0, timing.samp_quant_samp_per_chan
+        )
+
+    @input_buf_size.setter
+    def input_buf_size(self, size):
+        self._input_buf_size = int(size)
+
+
+class SimulatedOutStream:
+    def __init__(self, task):
+        self._task = task
+        self.regen_mode = RegenerationMode.ALLOW_REGENERATION
+        self.relative_to = WriteRelativeTo.CURRENT_WRITE_POSITION
+        self.offset = 0
+        self._output_buf_size = None
+
+    @property
+    def output_buf_size(self):
+        """Set size, or what was written before the start like the driver."""
+        if self._output_buf_size is not None:
+            return self._output_buf_size
+        return self._task._buffered_before_start or None
+
+    @output_buf_size.setter
+    def output_buf_size(self, size):
+        self._output_buf_size = int(size)
+
+
+class SimulatedTask:
+    _numbers = itertools.count()
+
+    def __init__(self, backend, new_task_name=""):
+        """
+        Task on simulated devices, with the attributes and methods of
+        nidaqmx.Task that the acquisitions use.
+        """
+        self._backend = backend
+        self.name = new_task_name or f"_unnamedTask<{next(self._numbers)}>"
+        self.ai_channels = SimulatedChannels(self)
+        self.ao_channels = SimulatedChannels(self)
+        self.do_channels = SimulatedChannels(self)
+        self.timing = SimulatedTiming()
+        self.triggers = SimulatedTriggers()
+        self.export_signals = SimulatedExportSignals()
+        self.in_stream = SimulatedInStream(self)
+        self.out_stream = SimulatedOutStream(self)
+
+        self._running = False
+        self._waiting_for_trigger = False
+        self._closed = False
+        self._master = None
+        # Master clock tick of the first sample of this task.
+        self._offset = 0
+        # Master clock state, only used while this task is a master.
+        self._start_time = None
+        self._ticks = 0
+
+        # Output buffer: chunks of (first sample, samples of all channels).
+        self._chunks = []
+        self._written = 0
+        self._buffered_before_start = 0
+        self._cycle = None
+
+        backend._register(self)
+
+    # Properties used by the backend
+
+    @property
+    def channel_names(self):
+        return (
+            self.ai_channels.channel_names
+            + self.ao_channels.channel_names
+            + self.do_channels.channel_names
+        )
+
+    @property
+    def device(self):
+        names = self.channel_names
+        return names[0].split("/")[0] if names else ""
+
+    @property
+    def channel_type(self):
+        for channel_type in ("ai", "ao", "do"):
+            if len(getattr(self, f"{channel_type}_channels")):
+                return channel_type
+        return None
+
+    @property
+    def is_timed(self):
+        return self.timing.samp_clk_rate is not None
+
+    @property
+    def is_finite(self):
+        return self.timing.samp_quant_samp_mode == AcquisitionType.FINITE
+
+    @property
+    def total_samples(self):
+        """Samples of a finite task, infinite for continuous ones."""
+        if self.is_finite:
+            return self.timing.samp_quant_samp_per_chan
+        return math.inf
+
+    @property
+    def is_regenerating(self):
+        return (
+            self.out_stream.regen_mode == RegenerationMode.ALLOW_REGENERATION
+        )
+
+    @property
+    def is_streaming(self):
+        """Output task whose buffer is refilled while running."""
+        return (
+            self.channel_type in ("ao", "do")
+            and self.is_timed
+            and not self.is_regenerating
+        )
+
+    def _output_channels(self):
+        if self.channel_type == "ao":
+            return self.ao_channels
+        return self.do_channels
+
+    # nidaqmx.Task interface
+
+    def start(self):
+        self._check_open()
+        self._backend._start(self)
+
+    def stop(self):
+        self._backend._stop(self)
+
+    def close(self):
+        if self._closed:
+            return
+        self.stop()
+        self._backend._unregister(self)
+        self._closed = True
+
+    def control(self, action):
+        self._check_open()
+
+    def is_task_done(self):
+        return self._backend._is_done(self)
+
+    def wait_until_done(self, timeout=10.0):
+        self._backend._wait_until_done(self, timeout)
+
+    def write(self, data, auto_start=False, timeout=10.0):
+        samples_number = self._backend._write(self, data, timeout)
+        if auto_start and not self._running:
+            self.start()
+        return samples_number
+
+    def read(
+        self, number_of_samples_per_channel=READ_ALL_AVAILABLE, timeout=10.0
+    ):
+        channels_number = len(self.ai_channels)
+        if number_of_samples_per_channel == READ_ALL_AVAILABLE:
+            samples_number = self._backend._available(self)
+        else:
+            samples_number = number_of_samples_per_channel
+        data = np.zeros((channels_number, samples_number))
+        self._backend._read(self, data, samples_number, timeout)
+        if channels_number == 1:
+            return data[0].tolist()
+        return data.tolist()
+
+    def _check_open(self):
+        if self._closed:
+            raise DaqError("The task was closed", -200088, self.name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __repr__(self):
+        return f"SimulatedTask(name={self.name})"
+
+
+class _StreamReader:
+    def __init__(self, task_in_stream):
+        self._in_stream = task_in_stream
+        self._task = task_in_stream._task
+        self.auto_start = False
+
+
+class _StreamWriter:
+    def __init__(self, task_out_stream, auto_start=False):
+        self._out_stream = task_out_stream
+        self._task = task_out_stream._task
+        self.auto_start = auto_start
+
+    def _write(self, data, timeout):
+        samples_number = self._task._backend._write(self._task, data, timeout)
+        if self.auto_start and not self._task._running:
+            self._task.start()
+        return samples_number
+
+
+class SimulatedAnalogSingleChannelReader(_StreamReader):
+    def read_many_sample(
+        self,
+        data,
+        number_of_samples_per_channel=READ_ALL_AVAILABLE,
+        timeout=10.0,
+    ):
+        return self._task._backend._read(
+            self._task,
+            data[np.newaxis, :],
+            number_of_samples_per_channel,
+            timeout,
+        )
+
+
+class SimulatedAnalogMultiChannelReader(_StreamReader):
+    def read_many_sample(
+        self,
+        data,
+        number_of_samples_per_channel=READ_ALL_AVAILABLE,
+        timeout=10.0,
+    ):
+        return self._task._backend._read(
+            self._task, data, number_of_samples_per_channel, timeout
+        )
+
+
+class SimulatedAnalogSingleChannelWriter(_StreamWriter):
+    def write_many_sample(self, data, timeout=10.0):
+        return self._write(np.asarray(data)[np.newaxis, :], timeout)
+
+
+class SimulatedAnalogMultiChannelWriter(_StreamWriter):
+    def write_many_sample(self, data, timeout=10.0):
+        return self._write(data, timeout)
+
+
+class SimulatedDigitalMultiChannelWriter(_StreamWriter):
+    def write_many_sample_port_uint32(self, data, timeout=10.0):
+        return self._write(data, timeout)
+
+
+class SimulatedBackend:
+    name = "simulated"
+    DaqError = DaqError
+
+    AnalogSingleChannelReader = SimulatedAnalogSingleChannelReader
+    AnalogMultiChannelReader = SimulatedAnalogMultiChannelReader
+    AnalogSingleChannelWriter = SimulatedAnalogSingleChannelWriter
+    AnalogMultiChannelWriter = SimulatedAnalogMultiChannelWriter
+    DigitalMultiChannelWriter = SimulatedDigitalMultiChannelWriter
+
+    def __init__(self, realtime=True, models=None, wiring=None):
+        """
+        Simulated devices for the tasks of daq_backend.
+
+        Parameters
+        realtime : bool, optional
+            Run the sample clocks on the wall clock. Otherwise samples are
+            produced as soon as they are read. The default is True.
+        models : list, optional
+            Signal models generating the analog inputs, see PhantomPMT. The
+            default is default_models().
+        wiring : dict, optional
+            Connected terminals, like {"/Dev2/PFI1": "/Dev1/PFI1"}. The
+            default is default_wiring().
+
+        Returns
+        None.
+
+        """
+        self.realtime = realtime
+        self.models = default_models() if models is None else list(models)
+        self.wiring = default_wiring() if wiring is None else dict(wiring)
+
+        self.tasks = []
+        # Levels of the outputs that are not generated by a timed task.
+        self.static_levels = {}
+        # One condition for all state, waiting readers and writers are
+        # woken up whenever clocks or buffers change.
+        self.condition = threading.Condition(threading.RLock())
+
+    def Task(self, new_task_name=""):
+        return SimulatedTask(self, new_task_name)
+
+    def ai_scaling_coeff(self, task, physical_channel):
+        # Simulated inputs are read in volt already.
+        return np.array([0.0, 1.0, 0.0, 0.0])
+
+    def _register(self, task):
+        with self.condition:
+            self.tasks.append(task)
+
+    def _unregister(self, task):
+        with self.condition:
+            self.tasks.remove(task)
+
+    # Clocks and triggers
+
+    def _terminal_task(self, terminal, device, signal):
+        """Timed task that provides a clock or start trigger terminal."""
+        terminal = normalize_terminal(terminal, device)
+        terminals = {terminal, self.wiring.get(terminal)}
+        for task in self.tasks:
+            if not task.is_timed or task.channel_type is None:
+                continue
+            if signal == "clock":
+                provided = {
+                    f"/{task.device}/{task.channel_type}/SampleClock",
+                    task.export_signals.samp_clk_output_term,
+                }
+            else:
+                provided = {
+                    f"/{task.device}/{task.channel_type}/StartTrigger",
+                    task.export_signals.start_trig_output_term,
+                }
+            if terminals & provided:
+                return task
+        # External signal, like the camera clock, that is not simulated.
+        return None
+
+    def _find_master(self, task):
+        """Task whose sample clock ends up driving task."""
+        chain = [task]
+        while task.timing.samp_clk_src:
+            source = self._terminal_task(
+                task.timing.samp_clk_src, task.device, "clock"
+            )
+            if source is None or source in chain:
+                break
+            chain.append(source)
+            task = source
+        return task
+
+    def _clock_ticks(self, master):
+        """Samples the master clock has produced up to now."""
+        if not master._running or master._waiting_for_trigger:
+            return master._ticks
+        if self.realtime:
+            elapsed = time.monotonic() - master._start_time
+            ticks = min(
+                int(elapsed * master.timing.samp_clk_rate),
+                master.total_samples,
+                self._output_limit(master),
+            )
+            master._ticks = max(master._ticks, ticks)
+        return master._ticks
+
+    def _output_limit(self, master):
+        """
+        Last tick the streamed outputs on the clock have samples for. The
+        clock waits for them instead of underflowing.
+        """
+        limit = math.inf
+        for task in self.tasks:
+            if (
+                task._master is master
+                and task._running
+                and not task._waiting_for_trigger
+                and task.is_streaming
+                and task._written < task.total_samples
+            ):
+                limit = min(limit, task._offset + task._written)
+        return limit
+
+    def _advance(self, master, ticks, timeout):
+        """Wait until the master clock has produced ticks samples."""
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while True:
+                if not self.realtime and master._running:
+                    master._ticks = max(
+                        master._ticks,
+                        min(
+                            ticks,
+                            master.total_samples,
+                            self._output_limit(master),
+                        ),
+                    )
+                    self.condition.notify_all()
+                if self._clock_ticks(master) >= ticks:
+                    return
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or (
+                    master._running and master._ticks >= master.total_samples
+                ):
+                    raise DaqError(
+                        "Some or all of the samples requested have not yet "
+                        "been acquired.",
+                        TIMEOUT_ERROR,
+                        master.name,
+                    )
+                wait = remaining
+                if self.realtime and master._running:
+                    missing = ticks - master._ticks
+                    wait = min(wait, missing / master.timing.samp_clk_rate)
+                self.condition.wait(max(min(wait, 0.05), 1e-4))
+
+    def _start(self, task):
+        with self.condition:
+            if task._running:
+                return
+            if task.is_timed and not len(task.channel_names):
+                raise DaqError("The task has no channels", -200478, task.name)
+
+            task._running = True
+            task._master = self._find_master(task) if task.is_timed else None
+            if task._master is not None:
+                # The output buffer is fixed from here on.
+                task._buffered_before_start = task._written
+                task._cycle = None
+
+            trigger = None
+            if task.triggers.start_trigger.dig_edge_src:
+                trigger = self._terminal_task(
+                    task.triggers.start_trigger.dig_edge_src,
+                    task.device,
+                    "trigger",
+                )
+            if trigger is not None and trigger is not task:
+                task._waiting_for_trigger = not trigger._running
+            if not task._waiting_for_trigger:
+                self._begin(task)
+
+            # Tasks waiting for this one, to start or for its clock.
+            for other in self.tasks:
+                if other is task or not other._running:
+                    continue
+                if other._waiting_for_trigger and (
+                    other.triggers.start_trigger.dig_edge_src
+                    and self._terminal_task(
+                        other.triggers.start_trigger.dig_edge_src,
+                        other.device,
+                        "trigger",
+                    )
+                    is task
+                ):
+                    other._waiting_for_trigger = False
+                    self._begin(other)
+                elif other.is_timed and other._master is not other:
+                    other._master = self._find_master(other)
+                    if other._master is task:
+                        other._offset = 0
+            self.condition.notify_all()
+
+    def _begin(self, task):
+        """Start generating or acquiring, after the trigger."""
+        master = task._master
+        if master is None:
+            return
+        if master is task:
+            task._start_time = time.monotonic()
+            task._ticks = 0
+            task._offset = 0
+        else:
+            task._offset = self._clock_ticks(master)
+
+    def _stop(self, task):
+        with self.condition:
+            if not task._running:
+                return
+            if task.channel_type in ("ao", "do") and task._master is not None:
+                # Outputs keep their last value.
+                last = self._generated_ticks(task) - 1
+                if last >= 0:
+                    for row, channel in enumerate(task.channel_names):
+                        self.static_levels[channel] = task_samples(
+                            task, row, last, last + 1, 0.0
+                        )[0]
+            task._running = False
+            task._waiting_for_trigger = False
+            task._ticks = 0
+            task._master = None
+            task.in_stream.curr_read_pos = 0
+            task._chunks = []
+            task._written = 0
+            task._cycle = None
+            self.condition.notify_all()
+
+    def _generated_ticks(self, task):
+        """Samples task has generated or acquired so far."""
+        if task._master is None or task._waiting_for_trigger:
+            return 0
+        ticks = self._clock_ticks(task._master) - task._offset
+        return int(min(max(ticks, 0), task.total_samples))
+
+    def _is_done(self, task):
+        with self.condition:
+            if not task._running or task._master is None:
+                return True
+            return self._generated_ticks(task) >= task.total_samples
+
+    def _wait_until_done(self, task, timeout):
+        if not task._running or task._master is None:
+            return
+        if not task.is_finite:
+            if self.realtime:
+                time.sleep(timeout)
+            raise DaqError(
+                "Wait Until Done did not indicate all samples were acquired "
+                "or generated before the specified timeout.",
+                TASK_NOT_DONE_ERROR,
+                task.name,
+            )
+        self._advance(task._master, task._offset + task.total_samples, timeout)
+
+    # Outputs
+
+    def _write(self, task, data, timeout):
+        task._check_open()
+        channels = task._output_channels()
+        data = np.asarray(data)
+
+        if not task.is_timed:
+            # On-demand output, one value per channel.
+            levels = np.ravel(data[..., -1] if data.ndim > 1 else data)
+            if levels.size == 1:
+                levels = np.repeat(levels, len(channels))
+            with self.condition:
+                for channel, level in zip(channels, levels):
+                    self.static_levels[channel] = level
+            return 1
+
+        data = np.array(data, ndmin=2)
+        if data.shape[0] != len(channels):
+            raise DaqError(
+                f"Write data has {data.shape[0]} channels, the task "
+                f"{len(channels)}",
+                -200524,
+                task.name,
+            )
+        samples_number = data.shape[1]
+
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            if (
+                task.out_stream.relative_to == WriteRelativeTo.FIRST_SAMPLE
+                and task.out_stream.offset == 0
+                and not task._running
+            ):
+                task._chunks = []
+                task._written = 0
+
+            if task._running and task.is_streaming:
+                buffer_size = task.out_stream.output_buf_size or math.inf
+                while (
+                    task._written
+                    + samples_number
+                    - self._generated_ticks(task)
+                    > buffer_size
+                ):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise DaqError(
+                            "Write cannot be performed, because the buffer "
+                            "had no space for the samples before the "
+                            "timeout.",
+                            WRITE_TIMEOUT_ERROR,
+                            task.name,
+                        )
+                    self.condition.wait(min(remaining, 0.05))
+                self._trim(task)
+
+            task._chunks.append((task._written, data))
+            task._written += samples_number
+            task._cycle = None
+            self.condition.notify_all()
+        return samples_number
+
+    def _trim(self, task):
+        """Drop streamed samples that are generated and out of history."""
+        keep_from = self._generated_ticks(task) - OUTPUT_HISTORY
+        while task._chunks and (
+            task._chunks[0][0] + task._chunks[0][1].shape[1] < keep_from
+        ):
+            task._chunks.pop(0)
+
+    def _output_samples(self, master, channel, first, last):
+        """Output samples of a channel at master ticks first to last."""
+        port, separator, line = channel.rpartition("/line")
+        for task in self.tasks:
+            if task._master is not master or task.channel_type not in (
+                "ao",
+                "do",
+            ):
+                continue
+            names = task.channel_names
+            if channel in names:
+                level = self.static_levels.get(channel, 0.0)
+                return task_samples(
+                    task,
+                    names.index(channel),
+                    first - task._offset,
+                    last - task._offset,
+                    level,
+                ).astype(float)
+            if separator and port in names:
+                words = task_samples(
+                    task,
+                    names.index(port),
+                    first - task._offset,
+                    last - task._offset,
+                    0,
+                ).astype(np.uint32)
+                return ((words >> np.uint32(int(line))) & 1).astype(float)
+
+        level = self.static_levels.get(channel, 0.0)
+        return np.full(last - first, float(level))
+
+    # Inputs
+
+    def _available(self, task):
+        with self.condition:
+            position = task.in_stream.curr_read_pos
+            if self.realtime:
+                available = self._generated_ticks(task)
+            else:
+                # Everything up to a full buffer can be produced right away.
+                available = min(
+                    task.total_samples,
+                    position + task.in_stream.input_buf_size,
+                )
+            return max(int(available) - position, 0)
+
+    def _read(self, task, data, number_of_samples_per_channel, timeout):
+        task._check_open()
+        if number_of_samples_per_channel == READ_ALL_AVAILABLE:
+            number_of_samples_per_channel = min(
+                self._available(task), data.shape[1]
+            )
+        samples_number = int(number_of_samples_per_channel)
+        channels = task.ai_channels.channel_names
+        if data.shape[0] != len(channels) or data.shape[1] < samples_number:
+            raise DaqError(
+                f"Read array of shape {data.shape} does not fit "
+                f"{len(channels)} channels and {samples_number} samples",
+                -200229,
+                task.name,
+            )
+
+        with self.condition:
+            if not task._running:
+                self._start(task)
+            master = task._master
+            position = task.in_stream.curr_read_pos
+            if position + samples_number > task.total_samples:
+                raise DaqError(
+                    "Attempted to read samples beyond the final sample "
+                    "acquired.",
+                    READ_PAST_END_ERROR,
+                    task.name,
+                )
+            if (
+                self._generated_ticks(task) - position
+                > task.in_stream.input_buf_size
+            ):
+                raise DaqError(
+                    "The application is not able to keep up with the "
+                    "hardware acquisition.",
+                    READ_OVERFLOW_ERROR,
+                    task.name,
+                )
+
+            first = task._offset + position
+            last = first + samples_number
+            self._advance(master, last, timeout)
+
+            rate = master.timing.samp_clk_rate
+
+            def outputs(channel, first, last):
+                return self._output_samples(master, channel, first, last)
+
+            signals = {}
+            for model in self.models:
+                if any(channel in model.channels for channel in channels):
+                    signals.update(model.generate(first, last, outputs, rate))
+
+            for row, channel in enumerate(channels):
+                signal = signals.get(channel)
+                if signal is None:
+                    data[row, :samples_number] = 0
+                else:
+                    data[row, :samples_number] = np.clip(
+                        signal, *task.ai_channels.ranges[channel]
+                    )
+
+            task.in_stream.curr_read_pos += samples_number
+            for other in self.tasks:
+                if other._master is master and other.is_streaming:
+                    self._trim(other)
+        return samples_number
+
+
+def task_samples(task, row, first, last, level):
+    """
+    Samples of one output channel of a task, from sample first to last.
+
+    Before the start the output is at level, after the end of a finite task
+    and where a streamed buffer ran empty it holds the last sample.
+    """
+    out = np.full(last - first, level, dtype=float)
+    if not task._chunks or last <= 0:
+        return out
+
+    end = min(task.total_samples, task._written)
+    if task.is_regenerating:
+        end = task.total_samples
+        if task._cycle is None:
+            task._cycle = np.concatenate(
+                [chunk for start, chunk in task._chunks], axis=1
+            )
+    start = max(first, 0)
+    stop = min(last, end)
+
+    if stop > start:
+        if task.is_regenerating:
+            out[start - first : stop - first] = np.take(
+                task._cycle[row], np.arange(start, stop), mode="wrap"
+            )
+        else:
+            for chunk_start, chunk in task._chunks:
+                chunk_stop = chunk_start + chunk.shape[1]
+                if chunk_stop <= start or chunk_start >= stop:
+                    continue
+                a = max(start, chunk_start)
+                b = min(stop, chunk_stop)
+                out[a - first : b - first] = chunk[
+                    row, a - chunk_start : b - chunk_start
+                ]
+
+    # Hold the last generated sample.
+    if last > end > 0:
+        if end - 1 >= first:
+            held = out[end - 1 - first]
+        else:
+            held = task_samples(task, row, end - 1, end, level)[0]
+        out[max(end, first) - first :] = held
+    return out
+
+
+if __name__ == "__main__":
+    # Throughput of a simulated raster scan, from galvo samples to image.
+    from ..GalvoWidget.GalvoScan_backend import RasterScan
+    from . import daq_backend
+
+    daq_backend.set_backend(SimulatedBackend(realtime=False))
+    for pixel_number in (256, 512, 1024):
+        scan = RasterScan(500000, 5, pixel_number, 2)
+        start = time.perf_counter()
+        scan.run()
+        duration = time.perf_counter() - start
+        print(
+            f"{pixel_number} pixels: {scan.Totalscansamples} samples in "
+            f"{duration:.3f} s, "
+            f"{scan.Totalscansamples / duration / 1e6:.1f} MS/s"
+        )
@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+"""
+Run-length encoded digital waveforms.
+
+Digital signals are long stretches of the same value, so instead of one
+bool per sample they are stored as runs: the value of each run and the
+sample index where it ends. A 10 minute pulse train at 100 kS/s then takes
+a few kB instead of 60 MB per line.
+
+DigitalWaveform holds one line and is what generate_digital_waveform and the
+waveform widget work with. PortWaveform holds the uint32 words written to a
+digital port, packed from several lines at once, and is only expanded to
+samples chunk by chunk when it is written to the DAQ.
+
+Usage:
+    led = DigitalWaveform.from_array(bool_samples)
+    port = PortWaveform.pack([(led, 19), (shutter, 21)])
+    port.read(start, out)
+"""
+import numpy as np
+
+from . import waveform_specification
+
+
+def merge_runs(values, ends):
+    """Drop empty runs and join neighbouring runs with the same value."""
+    lengths = np.diff(ends, prepend=0)
+    keep = lengths > 0
+    values = values[keep]
+    ends = ends[keep]
+
+    if values.size > 1:
+        run_last = np.append(values[1:] != values[:-1], True)
+        values = values[run_last]
+        ends = ends[run_last]
+
+    return values, ends
+
+
+class RunLengthWaveform:
+    value_dtype = np.uint32
+
+    def __init__(self, values, ends):
+        """
+        Waveform stored as runs of equal samples.
+
+        Parameters
+        values : np.ndarray
+            Value of each run.
+        ends : np.ndarray
+            Sample index after the last sample of each run, increasing.
+
+        Returns
+        None.
+
+        """
+        values = np.asarray(values, dtype=self.value_dtype).ravel()
+        ends = np.asarray(ends, dtype=np.int64).ravel()
+        if values.size != ends.size:
+            raise ValueError("Every run needs a value and an end")
+
+        self.values, self.ends = merge_runs(values, ends)
+
+    @classmethod
+    def from_array(cls, array):
+        """Encode an array of samples."""
+        array = np.asarray(array).ravel()
+        if array.size == 0:
+            return cls([], [])
+
+        changes = np.flatnonzero(array[1:] != array[:-1]) + 1
+        ends = np.append(changes, array.size)
+        return cls(array[ends - 1], ends)
+
+    @classmethod
+    def constant(cls, value, length):
+        return cls([value], [length])
+
+    @classmethod
+    def concatenate(cls, *waveforms):
+        """Join waveforms, plain sample arrays are encoded first."""
+        values = []
+        ends = []
+        offset = 0
+        for waveform in waveforms:
+            if not isinstance(waveform, RunLengthWaveform):
+                waveform = cls.from_array(waveform)
+            values.append(waveform.values)
+            ends.append(waveform.ends + offset)
+            offset += len(waveform)
+
+        return cls(np.concatenate(values), np.concatenate(ends))
+
+    def tile(self, repeats):
+        """The waveform repeated a number of times."""
+        offsets = np.arange(int(repeats))[:, np.newaxis] * len(self)
+        return type(self)(
+            np.tile(self.values, int(repeats)),
+            (self.ends + offsets).ravel(),
+        )
+
+    def __len__(self):
+        return int(self.ends[-1]) if self.ends.size else 0
+
+    def __getitem__(self, key):
+        """Samples by index, or a waveform for a slice with step 1."""
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step != 1:
+                raise IndexError("Only slices with step 1 are supported")
+            stop = max(stop, start)
+            first = np.searchsorted(self.ends, start, side="right")
+            last = np.searchsorted(self.ends, stop, side="left")
+            ends = np.minimum(self.ends[first : last + 1], stop) - start
+            return type(self)(self.values[first : last + 1], ends)
+
+        index = int(key)
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("Sample index out of range")
+        return self.values[np.searchsorted(self.ends, index, side="right")]
+
+    def read(self, start, out):
+        """
+        Expand samples into out.
+
+        Parameters
+        start : int
+            Index of the first sample.
+        out : np.ndarray
+            1-D array that is filled with out.size samples.
+        """
+        stop = start + out.size
+        if start < 0 or stop > len(self):
+            raise IndexError(
+                f"Samples {start}:{stop} are outside the waveform of "
+                f"{len(self)} samples"
+            )
+        if out.size == 0:
+            return
+
+        first = np.searchsorted(self.ends, start, side="right")
+        last = np.searchsorted(self.ends, stop, side="left")
+        run_ends = np.minimum(self.ends[first : last + 1], stop)
+        run_starts = np.empty_like(run_ends)
+        run_starts[0] = start
+        run_starts[1:] = self.ends[first:last]
+        out[:] = np.repeat(
+            self.values[first : last + 1], run_ends - run_starts
+        )
+
+    def read_cyclic(self, start, out):
+        """Like read, continuing at the beginning after the last sample."""
+        length = len(self)
+        filled = 0
+        while filled < out.size:
+            position = (start + filled) % length
+            samples_number = min(out.size - filled, length - position)
+            self.read(position, out[filled : filled + samples_number])
+            filled += samples_number
+
+    def to_array(self):
+        return np.repeat(self.values, np.diff(self.ends, prepend=0))
+
+    def __array__(self, dtype=None, copy=None):
+        array = self.to_array()
+        if dtype is not None:
+            array = array.astype(dtype)
+        return array
+
+    def astype(self, dtype):
+        return self.to_array().astype(dtype)
+
+    def __eq__(self, other):
+        if not isinstance(other, RunLengthWaveform):
+            return NotImplemented
+        return np.array_equal(self.values, other.values) and np.array_equal(
+            self.ends, other.ends
+        )
+
+    @property
+    def nbytes(self):
+        return self.values.nbytes + self.ends.nbytes
+
+    def __repr__(self):
+        return (
+            f"{type(self).__name__}({len(self)} samples, "
+            f"{self.ends.size} runs)"
+        )
+
+
+class DigitalWaveform(RunLengthWaveform):
+    """Boolean samples of one digital line, run-length encoded."""
+
+    value_dtype = bool
+    # The waveform widget tells digital from analog waveforms by dtype.
+    dtype = np.dtype(bool)
+    ndim = 1
+
+    def plot_data(self, sample_rate):
+        """
+        Corner points of the waveform as a step plot.
+
+        Returns
+        x : np.ndarray
+            Time of each point in seconds.
+        y : np.ndarray
+            Value of each point, 0 or 1.
+        """
+        starts = np.append(0, self.ends[:-1])
+        x = np.empty(2 * self.ends.size)
+        x[0::2] = starts
+        x[1::2] = self.ends
+        y = np.repeat(self.values.astype(int), 2)
+        return x / sample_rate, y
+
+
+class PortWaveform(RunLengthWaveform):
+    """uint32 words of a digital port, run-length encoded."""
+
+    value_dtype = np.uint32
+
+    @classmethod
+    def pack(cls, lines):
+        """
+        Combine digital lines into the words for their port.
+
+        To send commands to line 0 and line 3 you write 1001 to the port,
+        that is 9. The runs of all lines are merged, so the words are
+        calculated once per run, not per sample.
+
+        Parameters
+        lines : list of tuple
+            (waveform, line number) for every line. Waveforms can be
+            DigitalWaveform or bool arrays of the same length.
+
+        Returns
+        port : PortWaveform
+        """
+        lines = [
+            (DigitalWaveform.concatenate(waveform), int(line))
+            for waveform, line in lines
+        ]
+        if len({len(waveform) for waveform, line in lines}) > 1:
+            raise ValueError("All digital waveforms need the same length")
+
+        ends = np.unique(
+            np.concatenate([waveform.ends for waveform, line in lines])
+        )
+        starts = np.append(0, ends[:-1])
+        words = np.zeros(ends.size, dtype=np.uint32)
+        for waveform, line in lines:
+            run = np.searchsorted(waveform.ends, starts, side="right")
+            words |= waveform.values[run].astype(np.uint32) << np.uint32(line)
+
+        return cls(words, ends)
+
+    def to_array(self):
+        """All words, of shape (1, N) as the port writer takes them."""
+        return super().to_array()[np.newaxis, :]
+
+
+class DigitalSignals:
+    def __init__(self, waveforms, specifications):
+        """
+        Digital waveforms with their channel specification.
+
+        Takes the place of the structured array from
+        waveform_specification.make_dtype, without expanding the waveforms:
+        signals["Waveform"] and signals["Specification"] give the waveforms
+        and channel names, signals[i] the expanded record of one channel.
+        """
+        self.waveforms = list(waveforms)
+        self.specifications = list(specifications)
+
+    def __len__(self):
+        return len(self.waveforms)
+
+    def __getitem__(self, key):
+        if key == "Waveform":
+            return self.waveforms
+        elif key == "Specification":
+            return self.specifications
+
+        waveform = self.waveforms[key]
+        dtype = waveform_specification.make_dtype(len(waveform), bool)
+        return np.array(
+            [(np.asarray(waveform), self.specifications[key])], dtype=dtype
+        )[0]
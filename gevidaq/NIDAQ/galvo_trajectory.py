@@ -0,0 +1,448 @@
+# -*- coding: utf-8 -*-
+"""
+Time-optimal galvo trajectories along a path.
+
+A contour used to be sampled with a fixed number of points per round and
+only checked against the galvo limits afterwards, so a contour that was too
+fast had to be fixed by lowering the sample rate by hand. plan_trajectory
+takes the path itself, a polyline or closed contour, and gives the samples
+that go around it in the shortest time within the maximum galvo speed and
+acceleration of HardwareConstants.
+
+The path is parametrized by arc length on a fine grid. The largest speed
+along the path is limited by the speed of each galvo, and by the
+acceleration that each galvo needs to follow the curvature. A forward and a
+backward pass then limit the speed further so that each galvo can speed up
+and slow down in time, and the speed profile is scaled to whole samples.
+The curvature is measured over the distance between two samples, as the
+galvos see it, so the corners of a polyline slow the scan down without
+stopping it. A smooth contour through a few nodes can use spline=True.
+
+Usage:
+    trajectory = galvo_trajectory.plan_trajectory(
+        contour_signals, sampleRate=50000, closed=True
+    )
+    trajectory.signals  # (2, n) x and y galvo samples of one round
+    trajectory.repetition_rate  # Rounds per second
+
+    speed, acceleration = galvo_trajectory.measure_limits(
+        contour_signals, sampleRate=50000
+    )
+
+    # 100 points evenly spaced along the contour through the roi handles.
+    contour = galvo_trajectory.resample_evenly(handle_positions, 100)
+"""
+import math
+
+import numpy as np
+from scipy.interpolate import CubicSpline
+
+from .constants import HardwareConstants
+
+# Times the sampled trajectory is slowed down to fit the galvo limits
+# before plan_trajectory gives up. A handful is enough in practice.
+TRAJECTORY_ITERATIONS = 50
+
+
+def measure_limits(signals, sampleRate, closed=True):
+    """
+    Largest galvo speed and acceleration of sampled x and y signals.
+
+    Parameters
+    signals : np.ndarray
+        x and y voltages, of shape (2, n).
+    sampleRate : int
+        Sample rate of the signals.
+    closed : bool, optional
+        Whether the signals are repeated, so the last sample is followed by
+        the first one. The default is True.
+
+    Returns
+    speed : np.ndarray
+        Largest speed of the x and y galvo in volt/s.
+    acceleration : np.ndarray
+        Largest acceleration of the x and y galvo in volt/s^2.
+
+    """
+    signals = np.asarray(signals, dtype=float)
+    if closed:
+        signals = np.concatenate((signals, signals[:, :2]), axis=1)
+    speed = np.diff(signals, axis=1) * sampleRate
+    acceleration = np.diff(speed, axis=1) * sampleRate
+
+    def largest(values):
+        if values.shape[1] == 0:
+            return np.zeros(values.shape[0])
+        return np.max(np.abs(values), axis=1)
+
+    return largest(speed), largest(acceleration)
+
+
+def arc_length_path(points, closed=True, spline=False, resolution=None):
+    """
+    Points along a path, evenly spaced by arc length.
+
+    Parameters
+    points : np.ndarray
+        x and y of the path nodes, of shape (2, n).
+    closed : bool, optional
+        Whether the path goes back from the last node to the first one.
+        The default is True.
+    spline : bool, optional
+        Follow a cubic spline through the nodes, periodic if closed,
+        instead of straight lines. The default is False.
+    resolution : int, optional
+        Number of grid intervals along the path. The default is four per
+        node, at least 2000.
+
+    Returns
+    path : np.ndarray
+        x and y on the grid, of shape (2, resolution + 1). A closed path
+        ends where it starts.
+    step : float
+        Arc length between the grid points.
+
+    """
+    points = np.asarray(points, dtype=float)
+    if closed:
+        points = np.concatenate((points, points[:, :1]), axis=1)
+    # Repeated nodes have no direction.
+    keep = np.ones(points.shape[1], dtype=bool)
+    keep[1:] = np.any(np.diff(points, axis=1) != 0, axis=0)
+    points = points[:, keep]
+    if points.shape[1] < 2:
+        raise ValueError("The path needs at least two different points")
+
+    if resolution is None:
+        resolution = max(4 * points.shape[1], 2000)
+
+    lengths = np.hypot(*np.diff(points, axis=1))
+    distance = np.concatenate(([0], np.cumsum(lengths)))
+
+    if spline and points.shape[1] > 2:
+        curve = CubicSpline(
+            distance,
+            points,
+            axis=1,
+            bc_type="periodic" if closed else "not-a-knot",
+        )
+        # The spline is parametrized by the chord length, measure the arc
+        # length on a finer grid and go back to even arc length steps.
+        fine = curve(
+            np.linspace(0, distance[-1], max(4 * resolution, 4000) + 1)
+        )
+        fine_distance = np.concatenate(
+            ([0], np.cumsum(np.hypot(*np.diff(fine, axis=1))))
+        )
+        points, distance = fine, fine_distance
+
+    grid = np.linspace(0, distance[-1], resolution + 1)
+    path = np.vstack(
+        [np.interp(grid, distance, coordinate) for coordinate in points]
+    )
+    return path, distance[-1] / resolution
+
+
+def resample_evenly(points, number, closed=True, spline=False):
+    """
+    A number of points evenly spaced by arc length along a path.
+
+    Parameters
+    points : np.ndarray
+        x and y of the path nodes, of shape (2, n).
+    number : int
+        Number of points wanted.
+    closed : bool, optional
+        Whether the path goes back from the last node to the first one, the
+        first node is then not repeated at the end. The default is True.
+    spline : bool, optional
+        Follow a cubic spline through the nodes, periodic if closed,
+        instead of straight lines. The default is False.
+
+    Returns
+    resampled : np.ndarray
+        x and y of the points, of shape (2, number), starting at the first
+        node.
+
+    """
+    if closed:
+        path, _ = arc_length_path(points, closed, spline, resolution=number)
+        return path[:, :-1]
+    path, _ = arc_length_path(
+        points, closed, spline, resolution=max(number - 1, 1)
+    )
+    return path[:, :number]
+
+
+def _forward_pass(limit, alpha, beta, step, start):
+    """Largest squared speed reachable speeding up from the start."""
+    squared = [start]
+    for i in range(len(limit) - 1):
+        u = squared[-1]
+        acceleration = min(
+            alpha[0][i] - beta[0][i] * u, alpha[1][i] - beta[1][i] * u
+        )
+        squared.append(
+            min(limit[i + 1], max(u + 2 * step * acceleration, 0.0))
+        )
+    return squared
+
+
+def _speed_profile(path, step, closed, span, sampleRate, maxSpeed, maxAccel):
+    """
+    Largest squared path speed on the grid within the galvo limits.
+
+    The curvature at every grid point is measured over span grid steps on
+    both sides, the distance between two samples. That is how the galvos
+    see the path, so a polyline corner is not a point of infinite
+    curvature.
+    """
+    intervals = path.shape[1] - 1
+    index = np.arange(intervals + 1)
+    if closed:
+        ahead = path[:, (index + span) % intervals]
+        behind = path[:, (index - span) % intervals]
+        reach_ahead = reach_behind = span * step
+    else:
+        ahead = path[:, np.minimum(index + span, intervals)]
+        behind = path[:, np.maximum(index - span, 0)]
+        reach_ahead = (np.minimum(index + span, intervals) - index) * step
+        reach_behind = (index - np.maximum(index - span, 0)) * step
+
+    # Direction and curvature per galvo. Around a corner the direction on
+    # either side differs, the larger one bounds the galvo speed.
+    with np.errstate(divide="ignore", invalid="ignore"):
+        slope_ahead = np.where(
+            reach_ahead > 0, (ahead - path) / reach_ahead, 0
+        )
+        slope_behind = np.where(
+            reach_behind > 0, (path - behind) / reach_behind, 0
+        )
+    direction = np.sign(slope_ahead + slope_behind) * np.maximum(
+        np.abs(slope_ahead), np.abs(slope_behind)
+    )
+    # The ends of an open path are at rest anyway.
+    inside = (reach_ahead > 0) & (reach_behind > 0)
+    curvature = np.where(
+        inside,
+        2 * (slope_ahead - slope_behind) / (reach_ahead + reach_behind),
+        0,
+    )
+
+    # Largest squared path speed, from the galvo speed and from following
+    # the curvature without speeding up. Samples closer together than the
+    # span see a corner as a sharper turn, and also change speed between
+    # two samples.
+    turn = np.max(np.abs(curvature), axis=0)
+    with np.errstate(divide="ignore"):
+        limit = np.minimum.reduce(
+            [
+                maxSpeed**2 / np.max(direction**2, axis=0),
+                maxAccel / turn,
+                np.maximum(
+                    maxAccel / (sampleRate * span * step * turn)
+                    - maxAccel / (2 * sampleRate),
+                    0,
+                )
+                ** 2,
+            ]
+        )
+
+    # Along the path each galvo accelerates with
+    # curvature * u + direction * path acceleration, where u is the
+    # squared path speed. Every galvo bounds the path acceleration between
+    # -alpha - beta * u and alpha - beta * u.
+    magnitude = np.abs(direction)
+    moving = magnitude > 1e-9
+    alpha = np.full(direction.shape, np.inf)
+    beta = np.zeros(direction.shape)
+    np.divide(maxAccel, magnitude, out=alpha, where=moving)
+    np.divide(
+        np.sign(direction) * curvature, magnitude, out=beta, where=moving
+    )
+
+    if closed:
+        # Three rounds, so the middle one is periodic.
+        laps = 3
+        limit = np.concatenate([limit[:-1]] * laps + [limit[:1]])
+        alpha = np.concatenate([alpha[:, :-1]] * laps + [alpha[:, :1]], axis=1)
+        beta = np.concatenate([beta[:, :-1]] * laps + [beta[:, :1]], axis=1)
+        start = end = limit[0]
+    else:
+        start = end = 0.0
+
+    limit = limit.tolist()
+    squared = _forward_pass(limit, alpha.tolist(), beta.tolist(), step, start)
+    # Slowing down is speeding up when going backwards.
+    squared = np.minimum(
+        squared,
+        _forward_pass(
+            limit[::-1],
+            (alpha[:, ::-1]).tolist(),
+            (-beta[:, ::-1]).tolist(),
+            step,
+            min(end, squared[-1]),
+        )[::-1],
+    )
+    if closed:
+        squared = squared[intervals : 2 * intervals + 1]
+        squared[0] = squared[-1] = min(squared[0], squared[-1])
+    return squared
+
+
+class GalvoTrajectory:
+    def __init__(self, signals, sampleRate, closed, path_length):
+        """
+        Samples of a time-optimal trajectory, see plan_trajectory.
+
+        Attributes
+        signals : np.ndarray
+            x and y galvo samples, of shape (2, n). A closed trajectory
+            leaves out the last sample, which is the first one again.
+        sampleRate : int
+            Sample rate of the signals.
+        closed : bool
+            Whether the signals are one round of a closed path.
+        path_length : float
+            Length of the path in volt.
+        """
+        self.signals = signals
+        self.sampleRate = sampleRate
+        self.closed = closed
+        self.path_length = path_length
+
+    @property
+    def duration(self):
+        """Time of one round or of the whole path, in s."""
+        intervals = self.signals.shape[1] - (0 if self.closed else 1)
+        return intervals / self.sampleRate
+
+    @property
+    def repetition_rate(self):
+        """Number of rounds per second."""
+        return 1 / self.duration
+
+    def measure_limits(self):
+        """Largest galvo speed and acceleration, see measure_limits."""
+        return measure_limits(self.signals, self.sampleRate, self.closed)
+
+
+def plan_trajectory(
+    points,
+    sampleRate,
+    closed=True,
+    spline=False,
+    maxSpeed=None,
+    maxAccel=None,
+    resolution=None,
+):
+    """
+    Shortest galvo trajectory along a path within the galvo limits.
+
+    Parameters
+    points : np.ndarray
+        x and y voltages of the path nodes, of shape (2, n).
+    sampleRate : int
+        Sample rate of the trajectory.
+    closed : bool, optional
+        Whether the path is a contour that is scanned round and round. An
+        open path starts and stops at rest. The default is True.
+    spline : bool, optional
+        Follow a cubic spline through the nodes instead of straight lines,
+        see arc_length_path. The default is False.
+    maxSpeed : float, optional
+        Maximum galvo speed in volt/s. The default is from
+        HardwareConstants.
+    maxAccel : float, optional
+        Maximum galvo acceleration in volt/s^2. The default is from
+        HardwareConstants.
+    resolution : int, optional
+        Number of grid intervals along the path, see arc_length_path.
+
+    Returns
+    trajectory : GalvoTrajectory
+        The trajectory, starting at the first node. Its samples are
+        within maxSpeed and maxAccel, otherwise ValueError is raised.
+
+    """
+    constants = HardwareConstants()
+    if maxSpeed is None:
+        maxSpeed = constants.maxGalvoSpeed
+    if maxAccel is None:
+        maxAccel = constants.maxGalvoAccel
+
+    path, step = arc_length_path(points, closed, spline, resolution)
+    intervals = path.shape[1] - 1
+
+    # The distance between two samples depends on the speed, start from the
+    # curvature between grid points and measure it again over the
+    # distance between the samples of the last profile.
+    span = np.ones(intervals + 1, dtype=int)
+    for _ in range(3):
+        squared = _speed_profile(
+            path, step, closed, span, sampleRate, maxSpeed, maxAccel
+        )
+        span = np.clip(
+            np.floor(np.sqrt(squared) / (sampleRate * step)).astype(int),
+            1,
+            max(intervals // 4, 1),
+        )
+
+    # Time along the path, with a constant acceleration in every grid
+    # interval.
+    speed = np.sqrt(squared)
+    with np.errstate(divide="ignore"):
+        time = np.concatenate(
+            ([0], np.cumsum(2 * step / (speed[:-1] + speed[1:])))
+        )
+    path_acceleration = np.diff(squared) / (2 * step)
+    grid = np.arange(intervals + 1) * step
+
+    def distance_at(sample_time):
+        interval = np.clip(
+            np.searchsorted(time, sample_time, side="right") - 1,
+            0,
+            intervals - 1,
+        )
+        elapsed = sample_time - time[interval]
+        return np.minimum(
+            grid[interval]
+            + speed[interval] * elapsed
+            + 0.5 * path_acceleration[interval] * elapsed**2,
+            grid[-1],
+        )
+
+    # Whole samples, slowing the trajectory down a little to fit. The
+    # samples only approximate the speed profile around sharp corners, the
+    # trajectory is slowed down further if they still break the limits.
+    duration = time[-1]
+    for _ in range(TRAJECTORY_ITERATIONS):
+        samples = max(math.ceil(duration * sampleRate - 1e-9), 1)
+        sample_time = np.linspace(0, time[-1], samples + 1)
+        distance = distance_at(sample_time)
+        signals = np.vstack(
+            [np.interp(distance, grid, coordinate) for coordinate in path]
+        )
+        if closed:
+            signals = signals[:, :-1]
+
+        galvo_speed, galvo_acceleration = measure_limits(
+            signals, sampleRate, closed
+        )
+        excess = max(
+            np.max(galvo_speed) / maxSpeed,
+            math.sqrt(np.max(galvo_acceleration) / maxAccel),
+        )
+        if excess <= 1 + 1e-6:
+            break
+        # Where the samples fall on sharp corners changes with their
+        # number, so the excess does not shrink steadily. At least one
+        # sample is added every time.
+        duration = max(samples * excess, samples + 1) / sampleRate
+    else:
+        raise ValueError(
+            "No trajectory within the galvo limits found, the samples are "
+            f"still {excess:.3f} times too fast"
+        )
+
+    return GalvoTrajectory(signals, sampleRate, closed, intervals * step)
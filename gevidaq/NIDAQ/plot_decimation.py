@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+Min/max decimation of long waveforms for plotting.
+
+Drawing every sample of a 10^7 sample protocol makes each redraw and zoom
+stall the GUI, while the screen only has about a thousand pixels across.
+MinMaxPyramid keeps the minimum and maximum of bins of 4, 16, 64, ...
+samples, built once per waveform. For the visible range the finest level
+with about two points per pixel is drawn, so spikes and edges stay visible
+at every zoom level.
+
+Usage:
+    item = DecimatedPlotDataItem(samples, sample_rate, name="640AO")
+    plot_item.addItem(item)
+    item.set_waveform(new_samples, sample_rate)
+"""
+import math
+
+import numpy as np
+from pyqtgraph import PlotDataItem
+
+
+class MinMaxPyramid:
+    def __init__(self, samples, sample_rate, factor=4, min_bins=1024):
+        """
+        Minima and maxima of the samples on several bin sizes.
+
+        Parameters
+        samples : np.ndarray
+            1-D samples, can be a memory-mapped array.
+        sample_rate : float
+            Sample rate, to convert between time and sample index.
+        factor : int, optional
+            Bin size ratio between two levels. The default is 4.
+        min_bins : int, optional
+            No levels are added once a level has fewer bins than this.
+            The default is 1024.
+
+        Returns
+        None.
+
+        """
+        self.samples = np.asarray(samples).ravel()
+        self.sample_rate = float(sample_rate)
+        self.factor = int(factor)
+
+        # Level 0 are the samples themselves, level k has bins of
+        # factor**k samples. Each level is reduced from the one below.
+        self.levels = [(self.samples, self.samples)]
+        mins = maxs = self.samples
+        while mins.size > min_bins:
+            starts = np.arange(0, mins.size, self.factor)
+            mins = np.minimum.reduceat(mins, starts)
+            maxs = np.maximum.reduceat(maxs, starts)
+            self.levels.append((mins, maxs))
+
+    def __len__(self):
+        return self.samples.size
+
+    @property
+    def x_range(self):
+        """Time of the first and last sample."""
+        return 0.0, max(len(self) - 1, 0) / self.sample_rate
+
+    def bin_size(self, level):
+        return self.factor**level
+
+    def points_number(self, level, samples_number):
+        """Points drawn for samples_number samples at a level."""
+        # Level 0 gives one point per sample, the others two per bin.
+        if level == 0:
+            return samples_number
+        return 2 * math.ceil(samples_number / self.bin_size(level))
+
+    def window(self, x_min, x_max, max_points):
+        """
+        Level and bins to draw for a visible time range.
+
+        The bins extend one visible width on both sides and are rounded to
+        whole widths, so panning does not need new data every time.
+
+        Returns
+        window : tuple
+            (level, first bin, last bin + 1), see data.
+        """
+        start = min(max(math.floor(x_min * self.sample_rate), 0), len(self))
+        stop = min(max(math.ceil(x_max * self.sample_rate) + 1, 0), len(self))
+        span = max(stop - start, 1)
+
+        level = 0
+        while (
+            level < len(self.levels) - 1
+            and self.points_number(level, span) > max_points
+        ):
+            level += 1
+
+        size = self.bin_size(level)
+        span_bins = math.ceil(span / size)
+        bins = self.levels[level][0].size
+        first = max((start // size // span_bins - 1) * span_bins, 0)
+        last = min((math.ceil(stop / size / span_bins) + 1) * span_bins, bins)
+        return level, first, last
+
+    def data(self, level, first, last):
+        """
+        Points of a window to plot.
+
+        Returns
+        x : np.ndarray
+            Time of each point in seconds.
+        y : np.ndarray
+            Samples, or the minimum and maximum of every bin.
+        """
+        if level == 0:
+            x = np.arange(first, last) / self.sample_rate
+            return x, self.samples[first:last]
+
+        mins, maxs = self.levels[level]
+        size = self.bin_size(level)
+        bin_starts = np.arange(first, last) * size
+
+        x = np.empty(2 * bin_starts.size)
+        x[0::2] = bin_starts
+        x[1::2] = bin_starts + size / 2
+        y = np.empty(2 * bin_starts.size, dtype=mins.dtype)
+        y[0::2] = mins[first:last]
+        y[1::2] = maxs[first:last]
+        return x / self.sample_rate, y
+
+
+class DecimatedPlotDataItem(PlotDataItem):
+    def __init__(self, samples=None, sample_rate=1, *args, **kwargs):
+        """
+        PlotDataItem that draws a MinMaxPyramid level for the view range.
+
+        Other arguments are passed to PlotDataItem.
+        """
+        self.pyramid = None
+        self.shown_window = None
+        super().__init__(*args, **kwargs)
+        if samples is not None:
+            self.set_waveform(samples, sample_rate)
+
+    def set_waveform(self, samples, sample_rate, **kwargs):
+        """
+        Replace the plotted samples, kwargs are passed to setData.
+        """
+        self.pyramid = MinMaxPyramid(samples, sample_rate)
+        self.shown_window = None
+
+        x_min, x_max = self.pyramid.x_range
+        self.update_decimation(x_min, x_max, self.max_points(), **kwargs)
+
+    def max_points(self):
+        """Two points per pixel of the view."""
+        view_box = self.getViewBox()
+        if view_box is None or view_box.width() < 1:
+            return 4096
+        return 2 * int(view_box.width())
+
+    def update_decimation(self, x_min, x_max, max_points, **kwargs):
+        window = self.pyramid.window(x_min, x_max, max_points)
+        if window == self.shown_window and not kwargs:
+            return
+
+        self.shown_window = window
+        self.setData(*self.pyramid.data(*window), **kwargs)
+
+    def viewRangeChanged(self):
+        super().viewRangeChanged()
+        view_box = self.getViewBox()
+        if self.pyramid is None or view_box is None:
+            return
+
+        (x_min, x_max), _ = view_box.viewRange()
+        self.update_decimation(x_min, x_max, self.max_points())
+
+    def dataBounds(self, ax, frac=1.0, orthoRange=None):
+        # Auto range on the whole waveform, not on the shown window.
+        if ax == 0 and self.pyramid is not None and len(self.pyramid):
+            return self.pyramid.x_range
+        return super().dataBounds(ax, frac, orthoRange)
@@ -0,0 +1,569 @@
+# -*- coding: utf-8 -*-
+"""
+Reconstruction of PMT images from raster scan recordings.
+
+The image pixels are the samples recorded on the linear ramp of every
+galvo line, delayed by the response lag of the galvos and the PMT. Their
+positions follow from the raster geometry generated by
+wavegenerator.waveRecPic, so one gather index is calculated per scan
+setting and every frame is reconstructed with a single take and mean,
+for any pixel number, sample rate or average number.
+
+Usage:
+    reconstruction = PMTReconstruction.from_scan_parameters(
+        sampleRate=500000,
+        voltXMin=-5,
+        voltXMax=5,
+        voltYMin=-5,
+        voltYMax=5,
+        xPixels=500,
+        yPixels=500,
+        averagenum=2,
+    )
+    image = reconstruction.reconstruct(recorded_pmt_samples)
+
+Sub-region rasters and repeated line scans are read out as kymographs of
+shape (time, pixels), without averaging:
+    kymograph = reconstruction.kymograph(recorded_pmt_samples, lines=True)
+
+For live imaging every frame is reconstructed on its own and shown as the
+running average of the last frames:
+    average = RollingAverage(reconstruction.shape, window=averagenum)
+    image = average.add(reconstruction.reconstruct_frame(frame_samples))
+
+Bidirectional scans (sawtooth=False) record pixels on the ramp down of the
+odd lines as well. A wrong lag shifts the odd lines against the even ones,
+so the lag is measured from the first clear frame by cross-correlating the
+lines, see PMTReconstruction.update_line_phase. It is measured again after
+PMTReconstruction.remeasure_line_phase.
+"""
+import numpy as np
+
+from . import raster_cache
+from .constants import HardwareConstants
+
+# Lags in samples measured on the setup for the commonly used settings,
+# {(sample rate, x pixel number): lag}.
+# Based on: M:\tnw\ist\do\projects\Neurophotonics\Brinkslab\Data\Xin\2019-12-30 2p beads area test 4um
+CALIBRATED_LAG_SAMPLES = {
+    (500000, 500): 50,
+    (500000, 256): 70,
+    (250000, 500): 25,
+}
+
+# Lags of bidirectional scans measured from the line phase in this session,
+# {(sample rate, x pixel number): lag}.
+LINE_PHASE_LAG_SAMPLES = {}
+
+# Line phases less significant than this are not used, see line_phase_shift.
+LINE_PHASE_MIN_SIGNIFICANCE = 10
+
+
+def lag_samples(sampleRate, xPixels, sawtooth=True):
+    """
+    Number of samples between the galvo command and the recorded pixel.
+
+    Uses the measured line phase lag for bidirectional scans or the
+    calibrated value if there is one, otherwise the lag time in the
+    hardware constants.
+    """
+    key = (int(sampleRate), int(xPixels))
+    if sawtooth is False and key in LINE_PHASE_LAG_SAMPLES:
+        return LINE_PHASE_LAG_SAMPLES[key]
+    try:
+        return CALIBRATED_LAG_SAMPLES[key]
+    except KeyError:
+        lag_time = HardwareConstants().pmtLagTime
+        return int(round(lag_time * sampleRate))
+
+
+def line_phase_shift(image, shift_range=None):
+    """
+    Shift in pixels of the odd lines of a bidirectional image against the
+    even lines.
+
+    Each even line is cross-correlated with the next odd line. For every
+    shift the summed correlation is normalized over the overlapping part of
+    the lines, the most significant peak is refined with a parabola fit.
+
+    Parameters
+    image : np.ndarray
+        Image of shape (yPixels, xPixels) with at least two lines.
+    shift_range : tuple of int, optional
+        Smallest and largest shift searched for. Shifts that leave less
+        than a quarter of the line overlapping are never searched. The
+        default is every other shift.
+
+    Returns
+    shift : float
+        d such that the odd lines best match the even lines shifted by d,
+        even[:, j] ~ odd[:, j + d].
+    significance : float
+        Correlation at the shift in standard deviations of the correlation
+        of unrelated lines. Frames of noise only reach a few.
+    """
+    lines_number = image.shape[0] // 2 * 2
+    if lines_number < 2:
+        raise ValueError("The line phase needs at least two lines")
+    width = image.shape[1]
+    largest_shift = width - max(width // 4, 1)
+    if shift_range is None:
+        shift_range = (-largest_shift, largest_shift)
+    shifts = np.arange(
+        max(int(np.ceil(shift_range[0])), -largest_shift),
+        min(int(np.floor(shift_range[1])), largest_shift) + 1,
+    )
+    if not shifts.size:
+        raise ValueError(f"No shifts to search in {shift_range}")
+
+    even = image[0:lines_number:2]
+    odd = image[1:lines_number:2]
+    even = even - even.mean(axis=1, keepdims=True)
+    odd = odd - odd.mean(axis=1, keepdims=True)
+
+    # Zero padded, so the circular correlation has no wrap around.
+    size = 2 * width
+    correlation = np.fft.irfft(
+        (
+            np.conj(np.fft.rfft(even, size, axis=1))
+            * np.fft.rfft(odd, size, axis=1)
+        ).sum(axis=0),
+        size,
+    )[shifts]
+
+    # Energy of the overlapping columns, even[:, j] with odd[:, j + d].
+    even_energy = np.concatenate(([0], np.cumsum((even**2).sum(axis=0))))
+    odd_energy = np.concatenate(([0], np.cumsum((odd**2).sum(axis=0))))
+    overlap = width - np.abs(shifts)
+    even_start = np.maximum(-shifts, 0)
+    odd_start = np.maximum(shifts, 0)
+    energy = even_energy[even_start + overlap] - even_energy[even_start]
+    energy *= odd_energy[odd_start + overlap] - odd_energy[odd_start]
+    coefficients = np.divide(
+        correlation,
+        np.sqrt(energy),
+        out=np.zeros(shifts.size),
+        where=energy > 0,
+    )
+    # Unrelated lines give coefficients with a standard deviation of one
+    # over the square root of the number of products.
+    significances = coefficients * np.sqrt(lines_number // 2 * overlap)
+    peak = int(np.argmax(significances))
+
+    shift = float(shifts[peak])
+    if 0 < peak < shifts.size - 1:
+        left, center, right = coefficients[peak - 1 : peak + 2]
+        curvature = left - 2 * center + right
+        if curvature < 0:
+            shift += 0.5 * (left - right) / curvature
+    return shift, float(significances[peak])
+
+
+class PMTReconstruction:
+    def __init__(
+        self,
+        pmt_index,
+        frame_size,
+        averagenum=1,
+        lag=0,
+        invert=True,
+        bidirectional=False,
+        sampleRate=None,
+    ):
+        """
+        Gather index to turn recorded PMT samples into an image.
+
+        Parameters
+        pmt_index : np.ndarray
+            Flat sample index of each pixel within one frame, of shape
+            (yPixels, xPixels), see raster_cache.raster_pixel_index.
+        frame_size : int
+            Number of samples of one frame.
+        averagenum : int, optional
+            Number of frames recorded to average on. The default is 1.
+        lag : int, optional
+            Delay of the recorded signal in samples. The default is 0.
+        invert : bool, optional
+            Whether to invert the PMT signal. The default is True.
+        bidirectional : bool, optional
+            Whether the odd lines are scanned backwards, so that the lag
+            can be measured with update_line_phase. The default is False.
+        sampleRate : int, optional
+            Sample rate, to remember the measured lag of bidirectional
+            scans in LINE_PHASE_LAG_SAMPLES.
+
+        Returns
+        None.
+
+        """
+        self.pmt_index = np.asarray(pmt_index)
+        self.frame_size = int(frame_size)
+        self.averagenum = int(averagenum)
+        self.invert = invert
+        self.bidirectional = bidirectional
+        self.sampleRate = sampleRate
+        self.line_phase_measured = False
+
+        self.set_lag(lag)
+
+    def set_lag(self, lag):
+        """Gather the pixels lag samples later."""
+        lag = int(lag)
+        gather_index = self.pmt_index + lag
+        if gather_index.size and (
+            gather_index.min() < 0 or gather_index.max() >= self.frame_size
+        ):
+            raise ValueError(
+                f"A lag of {lag} samples falls outside the frame of "
+                f"{self.frame_size} samples"
+            )
+        self.lag = lag
+        self.gather_index = gather_index
+
+    @property
+    def lag_range(self):
+        """Smallest and largest lag that stay within the frame."""
+        if not self.pmt_index.size:
+            return 0, 0
+        return (
+            -int(self.pmt_index.min()),
+            self.frame_size - 1 - int(self.pmt_index.max()),
+        )
+
+    def update_line_phase(self, data):
+        """
+        Correct the lag of a bidirectional scan from a recorded frame.
+
+        The lag is measured from the line phase of the first frame in data,
+        see line_phase_shift, once per sample rate and pixel number in a
+        session. Every lag in lag_range is searched. Frames without a
+        significant line phase, like blank ones, are skipped and the next
+        frame is tried. Does nothing for sawtooth scans.
+
+        Returns
+        lag : int
+            The lag in samples used from now on.
+        """
+        if not self.bidirectional or self.line_phase_measured:
+            return self.lag
+
+        key = self.line_phase_key
+        lag = LINE_PHASE_LAG_SAMPLES.get(key)
+        if lag is None:
+            # Odd lines are shifted by twice the lag error, the other way
+            # than the even lines.
+            lag_min, lag_max = self.lag_range
+            shift, significance = line_phase_shift(
+                self.reconstruct_frame(data),
+                (2 * (self.lag - lag_max), 2 * (self.lag - lag_min)),
+            )
+            if significance < LINE_PHASE_MIN_SIGNIFICANCE:
+                return self.lag
+            lag = int(round(self.lag - shift / 2))
+            if key is not None:
+                LINE_PHASE_LAG_SAMPLES[key] = lag
+
+        lag_min, lag_max = self.lag_range
+        self.set_lag(min(max(lag, lag_min), lag_max))
+        self.line_phase_measured = True
+        return self.lag
+
+    def remeasure_line_phase(self):
+        """
+        Forget the measured lag of this scan setting, so that
+        update_line_phase measures it again on the next frame.
+        """
+        LINE_PHASE_LAG_SAMPLES.pop(self.line_phase_key, None)
+        self.line_phase_measured = False
+
+    @property
+    def line_phase_key(self):
+        """Key of the measured lag in LINE_PHASE_LAG_SAMPLES, or None."""
+        if self.sampleRate is None:
+            return None
+        return (int(self.sampleRate), self.shape[1])
+
+    @classmethod
+    def from_scan_parameters(
+        cls,
+        sampleRate,
+        voltXMin,
+        voltXMax,
+        voltYMin,
+        voltYMax,
+        xPixels,
+        yPixels,
+        imAngle=0,
+        sawtooth=True,
+        averagenum=1,
+        lag=None,
+        invert=True,
+    ):
+        """
+        Reconstruction for a raster from wavegenerator.waveRecPic.
+
+        The parameters are those of raster_cache.get_raster, lag defaults
+        to lag_samples(sampleRate, xPixels).
+        """
+        raster = raster_cache.get_raster(
+            sampleRate=sampleRate,
+            voltXMin=voltXMin,
+            voltXMax=voltXMax,
+            voltYMin=voltYMin,
+            voltYMax=voltYMax,
+            xPixels=xPixels,
+            yPixels=yPixels,
+            imAngle=imAngle,
+            sawtooth=sawtooth,
+            averagenum=averagenum,
+        )
+        if lag is None:
+            lag = lag_samples(sampleRate, xPixels, sawtooth)
+
+        return cls(
+            raster.pmt_index,
+            raster.frame_size,
+            averagenum,
+            lag,
+            invert,
+            bidirectional=sawtooth is False,
+            sampleRate=sampleRate,
+        )
+
+    @classmethod
+    def from_line_geometry(
+        cls,
+        sampleRate,
+        line_size,
+        xPixels,
+        yPixels,
+        sawtooth=True,
+        averagenum=1,
+        lag=None,
+        invert=True,
+    ):
+        """
+        Reconstruction when only the line size of the raster is known.
+
+        Used for scans that were configured before the scan parameters
+        were stored with them.
+        """
+        pmt_index = raster_cache.raster_pixel_index(
+            xPixels, yPixels, line_size, sawtooth
+        )
+        if lag is None:
+            lag = lag_samples(sampleRate, xPixels, sawtooth)
+
+        return cls(
+            pmt_index,
+            line_size * yPixels,
+            averagenum,
+            lag,
+            invert,
+            bidirectional=sawtooth is False,
+            sampleRate=sampleRate,
+        )
+
+    @property
+    def shape(self):
+        """Shape of the reconstructed image, (yPixels, xPixels)."""
+        return self.gather_index.shape
+
+    @property
+    def samples_number(self):
+        """Number of samples needed for one averaged image."""
+        return self.frame_size * self.averagenum
+
+    def reconstruct(self, data):
+        """
+        Average the frames in data and gather the image pixels.
+
+        Parameters
+        data : np.ndarray
+            Recorded PMT samples, at least samples_number long. Extra
+            samples at the end are ignored.
+
+        Returns
+        image : np.ndarray
+            The averaged image of shape (yPixels, xPixels).
+
+        """
+        data = np.asarray(data)
+        if data.size < self.samples_number:
+            raise ValueError(
+                f"Got {data.size} samples, {self.samples_number} are needed"
+            )
+
+        frames = data[: self.samples_number].reshape(self.averagenum, -1)
+        image = frames.take(self.gather_index, axis=1).mean(axis=0)
+        if self.invert:
+            np.negative(image, out=image)
+
+        return image
+
+    def reconstruct_frame(self, data, out=None):
+        """
+        Gather the image pixels of a single frame, without averaging.
+
+        Parameters
+        data : np.ndarray
+            Recorded PMT samples of one frame, at least frame_size long.
+        out : np.ndarray, optional
+            Array of shape self.shape to put the image in, so that no new
+            array is allocated for every frame.
+
+        Returns
+        image : np.ndarray
+            The image of shape (yPixels, xPixels), out if given.
+
+        """
+        data = np.asarray(data)
+        if data.size < self.frame_size:
+            raise ValueError(
+                f"Got {data.size} samples, {self.frame_size} are needed"
+            )
+
+        if out is None:
+            out = np.empty(self.shape)
+        np.take(data, self.gather_index, out=out)
+        if self.invert:
+            np.negative(out, out=out)
+
+        return out
+
+    def reconstruct_frames(self, data, out=None):
+        """
+        Gather the image pixels of every whole frame in data, without
+        averaging.
+
+        Parameters
+        data : np.ndarray
+            Recorded PMT samples. Samples after the last whole frame are
+            ignored.
+        out : np.ndarray, optional
+            Array of shape (frames, yPixels, xPixels) to put the images in.
+
+        Returns
+        images : np.ndarray
+            The images of shape (frames, yPixels, xPixels), out if given.
+
+        """
+        data = np.asarray(data)
+        frames_number = data.size // self.frame_size
+        if frames_number == 0:
+            raise ValueError(
+                f"Got {data.size} samples, {self.frame_size} are needed"
+            )
+
+        frames = data[: frames_number * self.frame_size].reshape(
+            frames_number, self.frame_size
+        )
+        if out is None:
+            out = np.empty((frames_number,) + self.shape)
+        np.take(frames, self.gather_index, axis=1, out=out)
+        if self.invert:
+            np.negative(out, out=out)
+
+        return out
+
+    def kymograph(self, data, lines=False):
+        """
+        Pixels over time of every whole frame in data.
+
+        Parameters
+        data : np.ndarray
+            Recorded PMT samples.
+        lines : bool, optional
+            Whether every line is a time point, for repeated line scans.
+            The default is False, one row per frame of a sub-region.
+
+        Returns
+        kymograph : np.ndarray
+            Array of shape (time, pixels), (frames * yPixels, xPixels) for
+            lines and (frames, yPixels * xPixels) otherwise.
+
+        """
+        images = self.reconstruct_frames(data)
+        if lines:
+            return images.reshape(-1, self.shape[1])
+        return images.reshape(images.shape[0], -1)
+
+
+class RollingAverage:
+    MODES = ("sliding", "exponential")
+
+    def __init__(self, shape, window=1, mode="sliding", buffers=3):
+        """
+        Running average of frames, updated with every new frame.
+
+        Parameters
+        shape : tuple
+            Shape of the frames.
+        window : int, optional
+            Number of frames averaged on. For the exponential average the
+            weight of a new frame is 1 / window. The default is 1.
+        mode : str, optional
+            "sliding" averages the last window frames, kept in a ring
+            buffer, "exponential" decays the older frames. The default is
+            "sliding".
+        buffers : int, optional
+            Number of output arrays that are used in turn. An average
+            returned by add stays valid until buffers - 1 more frames were
+            added, enough for a display that lags a frame behind. The
+            default is 3.
+
+        Returns
+        None.
+
+        """
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown averaging mode {mode!r}")
+        self.shape = tuple(shape)
+        self.window = max(int(window), 1)
+        self.mode = mode
+
+        # The exponential average only uses the ring as scratch space.
+        ring_size = self.window if mode == "sliding" else 1
+        self.ring = np.zeros((ring_size,) + self.shape)
+        self.total = np.zeros(self.shape)
+        self.outputs = np.zeros((max(int(buffers), 1),) + self.shape)
+        self.frames_number = 0
+
+    def reset(self):
+        """Forget the frames added so far."""
+        self.total[:] = 0
+        self.frames_number = 0
+
+    def add(self, frame):
+        """
+        Add a frame and return the new average.
+
+        The returned array is one of the preallocated outputs, see buffers.
+        """
+        output = self.outputs[self.frames_number % len(self.outputs)]
+        self.frames_number += 1
+
+        if self.mode == "sliding":
+            slot = self.ring[(self.frames_number - 1) % self.window]
+            if self.frames_number > self.window:
+                self.total -= slot
+            slot[:] = frame
+            if self.frames_number % (1000 * self.window) == 0:
+                # Start over from the frames in the ring every now and then,
+                # so rounding errors of the subtractions do not add up.
+                np.sum(self.ring, axis=0, out=self.total)
+            else:
+                self.total += slot
+            np.divide(
+                self.total, min(self.frames_number, self.window), out=output
+            )
+        else:
+            # The first frames get a larger weight, so the average does not
+            # start from zero.
+            weight = 1 / min(self.frames_number, self.window)
+            self.total *= 1 - weight
+            np.multiply(frame, weight, out=self.ring[0])
+            self.total += self.ring[0]
+            output[:] = self.total
+
+        return output
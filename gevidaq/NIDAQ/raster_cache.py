@@ -0,0 +1,379 @@
+# -*- coding: utf-8 -*-
+"""
+Cache of generated galvo raster waveforms.
+
+Generating the raster for a large image and tiling it for averaging takes
+time and memory, while only a handful of scan settings are used in
+practice. The rasters are kept in an in-memory LRU cache and stored on disk
+as .npy files that are memory-mapped when they are needed again, also in
+a later session. The least recently used files are removed when the files
+take more than max_disk_bytes.
+
+Usage:
+    raster = raster_cache.get_raster(
+        sampleRate=500000,
+        voltXMin=-5,
+        voltXMax=5,
+        voltYMin=-5,
+        voltYMax=5,
+        xPixels=500,
+        yPixels=500,
+        averagenum=2,
+    )
+    writer.write_many_sample(raster.galvo_samples)
+
+The returned arrays are shared between all callers and are read-only.
+"""
+import collections
+import hashlib
+import logging
+import os
+import threading
+
+import numpy as np
+
+from . import wavegenerator
+from .constants import HardwareConstants
+
+# Increase when the generated samples change, so old files are not used.
+CACHE_VERSION = 1
+
+DEFAULT_CACHE_DIR = os.path.join(
+    os.path.expanduser("~"), ".gevidaq", "raster_cache"
+)
+
+RasterKey = collections.namedtuple(
+    "RasterKey",
+    [
+        "version",
+        "maxGalvoSpeed",
+        "maxGalvoAccel",
+        "sampleRate",
+        "imAngle",
+        "voltXMin",
+        "voltXMax",
+        "voltYMin",
+        "voltYMax",
+        "xPixels",
+        "yPixels",
+        "sawtooth",
+        "averagenum",
+    ],
+)
+
+
+def raster_pixel_index(xPixels, yPixels, lineSize, sawtooth=True):
+    """
+    Flat sample index within one frame of every image pixel.
+
+    The pixels are the samples on the linear ramp at the start of every
+    line. For the triangle wave the odd lines are scanned backwards, so
+    their pixel order is reversed.
+
+    Returns
+    pixel_index : np.ndarray
+        Array of shape (yPixels, xPixels).
+    """
+    line_start = np.arange(yPixels)[:, np.newaxis] * lineSize
+    pixel_index = np.broadcast_to(
+        np.arange(xPixels), (yPixels, xPixels)
+    ).copy()
+    if sawtooth is False:
+        pixel_index[1::2] = pixel_index[1::2, ::-1]
+
+    return pixel_index + line_start
+
+
+class GalvoRaster:
+    def __init__(self, galvo_samples, pmt_index, line_size, averagenum):
+        """
+        Galvo waveforms of a raster scan and their PMT pixel map.
+
+        Parameters
+        galvo_samples : np.ndarray
+            X and Y galvo samples of shape (2, frame_size * averagenum).
+        pmt_index : np.ndarray
+            Flat sample index of each pixel within one frame,
+            see raster_pixel_index.
+        line_size : int
+            Number of samples of each line, including fly back.
+        averagenum : int
+            Number of frames in galvo_samples.
+        """
+        self.galvo_samples = galvo_samples
+        self.pmt_index = pmt_index
+        self.line_size = line_size
+        self.averagenum = averagenum
+        self.frame_size = galvo_samples.shape[1] // averagenum
+
+    @property
+    def samples_X(self):
+        """X galvo samples of one frame."""
+        return self.galvo_samples[0, : self.frame_size]
+
+    @property
+    def samples_Y(self):
+        """Y galvo samples of one frame."""
+        return self.galvo_samples[1, : self.frame_size]
+
+    @property
+    def nbytes(self):
+        return self.galvo_samples.nbytes + self.pmt_index.nbytes
+
+
+class RasterCache:
+    def __init__(
+        self, cache_dir=DEFAULT_CACHE_DIR, max_entries=8, max_disk_bytes=2**31
+    ):
+        """
+        LRU cache of GalvoRaster objects, backed by .npy files on disk.
+
+        Parameters
+        cache_dir : str or None, optional
+            Directory for the memory-mapped files. None keeps the cache in
+            memory only.
+        max_entries : int, optional
+            Number of rasters held in memory.
+        max_disk_bytes : int or None, optional
+            Size of the files on disk above which the least recently used
+            ones are removed. None never removes files. The default is
+            2 GiB.
+        """
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.max_disk_bytes = max_disk_bytes
+        self._entries = collections.OrderedDict()
+        # The lock guards the entries only, rasters are generated under the
+        # lock of their key, so other settings can be looked up meanwhile.
+        self._lock = threading.Lock()
+        self._key_locks = {}
+
+    def get_raster(
+        self,
+        sampleRate,
+        voltXMin,
+        voltXMax,
+        voltYMin,
+        voltYMax,
+        xPixels,
+        yPixels,
+        imAngle=0,
+        sawtooth=True,
+        averagenum=1,
+    ):
+        """
+        Get the raster for these settings, generating it only once.
+
+        The parameters are those of wavegenerator.waveRecPic, the frame is
+        tiled averagenum times.
+
+        Returns
+        raster : GalvoRaster
+        """
+        constants = HardwareConstants()
+        key = RasterKey(
+            CACHE_VERSION,
+            constants.maxGalvoSpeed,
+            constants.maxGalvoAccel,
+            int(sampleRate),
+            float(imAngle),
+            float(voltXMin),
+            float(voltXMax),
+            float(voltYMin),
+            float(voltYMax),
+            int(xPixels),
+            int(yPixels),
+            bool(sawtooth),
+            int(averagenum),
+        )
+
+        with self._lock:
+            raster = self._lookup(key)
+            if raster is not None:
+                return raster
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            try:
+                # Another thread may have made it while this one waited.
+                with self._lock:
+                    raster = self._lookup(key)
+                if raster is not None:
+                    return raster
+
+                raster = self._load(key)
+                if raster is None:
+                    raster = self._generate(key)
+                    saved = self._save(key, raster)
+                    if saved is not None:
+                        raster = saved
+                        self._remove_old_files(key)
+
+                with self._lock:
+                    self._entries[key] = raster
+                    while len(self._entries) > self.max_entries:
+                        self._entries.popitem(last=False)
+            finally:
+                with self._lock:
+                    self._key_locks.pop(key, None)
+
+        return raster
+
+    def _lookup(self, key):
+        raster = self._entries.get(key)
+        if raster is not None:
+            self._entries.move_to_end(key)
+        return raster
+
+    def clear(self, remove_files=False):
+        """Empty the memory cache and optionally delete the files on disk."""
+        with self._lock:
+            self._entries.clear()
+            if remove_files and self.cache_dir is not None:
+                if os.path.isdir(self.cache_dir):
+                    for filename in os.listdir(self.cache_dir):
+                        if filename.endswith(".npy"):
+                            os.remove(os.path.join(self.cache_dir, filename))
+
+    def _generate(self, key):
+        samples_X, samples_Y = wavegenerator.waveRecPic(
+            sampleRate=key.sampleRate,
+            imAngle=key.imAngle,
+            voltXMin=key.voltXMin,
+            voltXMax=key.voltXMax,
+            voltYMin=key.voltYMin,
+            voltYMax=key.voltYMax,
+            xPixels=key.xPixels,
+            yPixels=key.yPixels,
+            sawtooth=key.sawtooth,
+        )
+        averagenum = key.averagenum
+        line_size = samples_X.size // key.yPixels
+
+        # Tile the frame directly into the (2, N) array written to the DAQ.
+        galvo_samples = np.empty((2, samples_X.size * averagenum))
+        galvo_samples[0].reshape(averagenum, -1)[:] = samples_X
+        galvo_samples[1].reshape(averagenum, -1)[:] = samples_Y
+        pmt_index = raster_pixel_index(
+            key.xPixels, key.yPixels, line_size, key.sawtooth
+        )
+
+        galvo_samples.flags.writeable = False
+        pmt_index.flags.writeable = False
+        return GalvoRaster(galvo_samples, pmt_index, line_size, averagenum)
+
+    def _file_names(self, key):
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()[:16]
+        name = "raster_sr{}_{}x{}_avg{}_{}".format(
+            key.sampleRate, key.xPixels, key.yPixels, key.averagenum, digest
+        )
+        return (
+            os.path.join(self.cache_dir, name + "_galvo.npy"),
+            os.path.join(self.cache_dir, name + "_index.npy"),
+        )
+
+    def _load(self, key):
+        if self.cache_dir is None:
+            return None
+
+        galvo_file, index_file = self._file_names(key)
+        if not (os.path.exists(galvo_file) and os.path.exists(index_file)):
+            return None
+
+        try:
+            galvo_samples = np.load(galvo_file, mmap_mode="r")
+            pmt_index = np.load(index_file, mmap_mode="r")
+        except (OSError, ValueError) as exc:
+            logging.warning("Could not load cached raster", exc_info=exc)
+            return None
+
+        # The modification time orders the files for _remove_old_files.
+        for filename in (galvo_file, index_file):
+            try:
+                os.utime(filename)
+            except OSError:
+                pass
+
+        line_size = galvo_samples.shape[1] // (key.averagenum * key.yPixels)
+        return GalvoRaster(galvo_samples, pmt_index, line_size, key.averagenum)
+
+    def _save(self, key, raster):
+        """Write the raster to disk and return its memory-mapped version."""
+        if self.cache_dir is None:
+            return None
+
+        galvo_file, index_file = self._file_names(key)
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            for filename, array in (
+                (galvo_file, raster.galvo_samples),
+                (index_file, raster.pmt_index),
+            ):
+                # Write to a temporary file first so that an interrupted
+                # write never leaves a truncated cache file behind.
+                temporary_file = filename + ".tmp"
+                with open(temporary_file, "wb") as file:
+                    np.save(file, array)
+                os.replace(temporary_file, filename)
+        except OSError as exc:
+            logging.warning("Could not store raster in cache", exc_info=exc)
+            return None
+
+        return self._load(key)
+
+    def _remove_old_files(self, key):
+        """
+        Remove the least recently used rasters from disk until the files
+        take at most max_disk_bytes, except the raster of key.
+        """
+        if self.max_disk_bytes is None:
+            return
+
+        # The galvo and index file of a raster are removed together.
+        rasters = {}
+        try:
+            filenames = os.listdir(self.cache_dir)
+        except OSError:
+            return
+        for filename in filenames:
+            if not filename.endswith(".npy"):
+                continue
+            path = os.path.join(self.cache_dir, filename)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            name = filename.rsplit("_", 1)[0]
+            size, used, paths = rasters.get(name, (0, 0, []))
+            rasters[name] = (
+                size + stat.st_size,
+                max(used, stat.st_mtime),
+                paths + [path],
+            )
+
+        total = sum(size for size, used, paths in rasters.values())
+        kept = set(self._file_names(key))
+        for size, used, paths in sorted(
+            rasters.values(), key=lambda raster: raster[1]
+        ):
+            if total <= self.max_disk_bytes:
+                break
+            if kept.intersection(paths):
+                continue
+            try:
+                for path in paths:
+                    os.remove(path)
+            except OSError as exc:
+                # Files that are still memory-mapped cannot be removed on
+                # Windows.
+                logging.warning("Could not remove cached raster", exc_info=exc)
+                continue
+            total -= size
+
+
+shared_cache = RasterCache()
+
+
+def get_raster(*args, **kwargs):
+    """Get a raster from the shared cache, see RasterCache.get_raster."""
+    return shared_cache.get_raster(*args, **kwargs)
@@ -16,6 +16,7 @@ defaults = {
         "maxGalvoSpeed": 20000.0,  # Volt/s
         "maxGalvoAccel": 1.54 * 10**8,  # Acceleration galvo in volt/s^2
         "pmt_3v_indentation_pixels": 52,
+        "pmtLagTime": 100e-6,  # Delay between galvo and PMT signal in s
     },
     "Channels":
     # Ports specification
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent on-demand tasks for static DAQ outputs.
+
+Creating, committing and clearing a nidaqmx task for every single value
+takes tens of milliseconds, while the AOTF sliders, shutters, perfusion
+lines and galvo positioning write single values all the time. StaticOutputs
+keeps one committed on-demand task per channel, so a write only updates
+the output.
+
+The tasks reserve their channels, so hardware-timed tasks on the same
+device outputs are created with timed_output_task, which releases them
+first:
+
+    with static_outputs.timed_output_task("/Dev1/ao0:1") as task:
+        task.timing.cfg_samp_clk_timing(rate, samps_per_chan=samples)
+
+Tasks that are kept open and started again later have to call release
+before every start, the static outputs may have been written in between.
+Released channels get a new task at their next write.
+"""
+import atexit
+import logging
+import threading
+
+import nidaqmx
+import numpy as np
+from nidaqmx.constants import TaskMode
+
+from . import daq_backend
+
+
+def output_resource(physical_channel):
+    """
+    Part of the device that tasks on a physical channel use.
+
+    Analog outputs share the device's output timing, digital lines their
+    port, so "Dev1/ao3" gives ("Dev1", "ao") and "/Dev1/port0/line4" gives
+    ("Dev1", "port0").
+    """
+    parts = physical_channel.strip("/").split("/")
+    if len(parts) < 2:
+        return tuple(parts)
+    if parts[1].startswith("ao"):
+        return parts[0], "ao"
+    return parts[0], parts[1]
+
+
+class StaticOutputs:
+    def __init__(self):
+        """
+        One open on-demand task per output channel, safe to share between
+        threads.
+        """
+        self._tasks = {}
+        self._lock = threading.RLock()
+
+    def write_analog(self, physical_channel, value):
+        """Set an analog output, like "Dev1/ao0", to value in volt."""
+        self._write(physical_channel, "ao", float(value))
+
+    def write_digital(self, physical_channel, value):
+        """Set a digital line, like "Dev1/port0/line4", to value."""
+        self._write(
+            physical_channel, "do", np.array([bool(value)], dtype=bool)
+        )
+
+    def _write(self, physical_channel, kind, value):
+        with self._lock:
+            task = self._tasks.get(physical_channel)
+            if task is None:
+                task = self._open_task(physical_channel, kind)
+                self._tasks[physical_channel] = task
+
+            try:
+                task.write(value)
+            except nidaqmx.DaqError:
+                # The next write starts over with a new task, for example
+                # after the device was reset.
+                self._close_task(physical_channel)
+                raise
+
+    def _open_task(self, physical_channel, kind):
+        task = daq_backend.get_backend().Task()
+        try:
+            if kind == "ao":
+                task.ao_channels.add_ao_voltage_chan(physical_channel)
+            else:
+                task.do_channels.add_do_chan(physical_channel)
+            # Reserve and commit now, so writes skip these steps.
+            task.control(TaskMode.TASK_COMMIT)
+        except Exception:
+            task.close()
+            raise
+        return task
+
+    def _close_task(self, physical_channel):
+        task = self._tasks.pop(physical_channel)
+        try:
+            task.close()
+        except nidaqmx.DaqError as exc:
+            logging.warning("Could not close static output", exc_info=exc)
+
+    def release(self, *physical_channels):
+        """
+        Close the tasks that would conflict with the given channels.
+
+        All static tasks on the same analog outputs device or digital port
+        are closed, the outputs keep their last value.
+        """
+        resources = {output_resource(channel) for channel in physical_channels}
+        with self._lock:
+            for physical_channel in list(self._tasks):
+                if output_resource(physical_channel) in resources:
+                    self._close_task(physical_channel)
+
+    def close(self):
+        """Close all static tasks."""
+        with self._lock:
+            for physical_channel in list(self._tasks):
+                self._close_task(physical_channel)
+
+
+shared_outputs = StaticOutputs()
+atexit.register(shared_outputs.close)
+
+
+def release(*physical_channels):
+    """Release channels of the shared outputs, see StaticOutputs.release."""
+    shared_outputs.release(*physical_channels)
+
+
+def timed_output_task(physical_channels, kind="ao", **channel_kwargs):
+    """
+    Create a task of the daq_backend for hardware-timed outputs.
+
+    The static tasks on the same outputs are released first, they would
+    block the task from starting.
+
+    Parameters
+    physical_channels : str or list of str
+        The output channels, like "/Dev1/ao0:1".
+    kind : str, optional
+        "ao" for analog voltage outputs, "do" for digital lines or ports.
+        The default is "ao".
+    **channel_kwargs
+        Passed on to add_ao_voltage_chan or add_do_chan.
+
+    Returns
+    task : Task
+        The task with the channels added, to be closed by the caller.
+
+    """
+    if isinstance(physical_channels, str):
+        physical_channels = [physical_channels]
+    release(*physical_channels)
+
+    task = daq_backend.get_backend().Task()
+    try:
+        for physical_channel in physical_channels:
+            if kind == "ao":
+                task.ao_channels.add_ao_voltage_chan(
+                    physical_channel, **channel_kwargs
+                )
+            else:
+                task.do_channels.add_do_chan(
+                    physical_channel, **channel_kwargs
+                )
+    except Exception:
+        task.close()
+        raise
+    return task
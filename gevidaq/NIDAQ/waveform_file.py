@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+"""
+Memory-mappable waveform files.
+
+The old waveform files are numpy object arrays that have to be unpickled
+completely, even to list the channels. A waveform file instead starts with
+a small JSON header describing every channel, followed by the raw samples
+of each channel in its own aligned block:
+
+    MAGIC | header size (uint64) | JSON header | padding | block | ...
+
+The header holds the sample rate and, per channel, the name, dtype, number
+of samples and where its blocks are. Analog channels are stored as samples,
+digital channels as the runs of digital_waveform.DigitalWaveform. Opening a
+file only reads the header, the blocks are memory-mapped when a channel is
+accessed.
+
+Usage:
+    waveforms = waveform_file.load(filename)
+    for channel in waveforms:
+        channel["Specification"], channel["Waveform"]
+
+    waveform_file.convert(old_npy_filename)
+"""
+import json
+import logging
+import os
+import sys
+
+import numpy as np
+
+from . import waveform_specification
+from .digital_waveform import DigitalWaveform
+
+MAGIC = b"GEVIDAQ-WAVEFORMS"
+FORMAT_VERSION = 1
+EXTENSION = ".wvf"
+BLOCK_ALIGNMENT = 64
+
+
+def is_waveform_file(filename):
+    """Check if filename is in the memory-mappable format."""
+    return os.path.splitext(filename)[1] == EXTENSION
+
+
+def load(filename):
+    """
+    Waveforms of a file in either format.
+
+    Returns a WaveformFile for the new format and the array of
+    waveform_specification.load for old .npy files, both give the channels
+    as items with "Waveform" and "Specification".
+    """
+    if is_waveform_file(filename):
+        return WaveformFile(filename)
+    return waveform_specification.load(filename)
+
+
+def get_sample_rate(filename):
+    """Sample rate from the header, or from the name of old files."""
+    if is_waveform_file(filename):
+        return WaveformFile(filename).sample_rate
+    return waveform_specification.get_sample_rate(filename)
+
+
+def save(filename, sample_rate, channels):
+    """
+    Write waveforms to a memory-mappable waveform file.
+
+    Parameters
+    filename : str
+        Path of the file, EXTENSION is added if missing.
+    sample_rate : int
+        Sample rate of the waveforms.
+    channels : list of tuple
+        (channel name, waveform) of every channel. Waveforms are arrays or
+        DigitalWaveform, bool arrays are stored run-length encoded.
+
+    Returns
+    filename : str
+        Path of the written file.
+    """
+    if not is_waveform_file(filename):
+        filename += EXTENSION
+
+    header_channels = []
+    blocks = []
+    offset = 0
+    for name, waveform in channels:
+        if not isinstance(waveform, DigitalWaveform):
+            waveform = np.asarray(waveform)
+            if waveform.dtype == bool:
+                waveform = DigitalWaveform.from_array(waveform)
+
+        if isinstance(waveform, DigitalWaveform):
+            channel_blocks = (waveform.values, waveform.ends)
+            channel = {"encoding": "runs", "shape": [len(waveform)]}
+        else:
+            channel_blocks = (np.ascontiguousarray(waveform),)
+            channel = {"encoding": "samples", "shape": list(waveform.shape)}
+
+        channel["name"] = str(name)
+        channel["dtype"] = channel_blocks[0].dtype.str
+        channel["length"] = channel["shape"][-1]
+        channel["blocks"] = []
+        for block in channel_blocks:
+            offset = -(-offset // BLOCK_ALIGNMENT) * BLOCK_ALIGNMENT
+            channel["blocks"].append(
+                {
+                    "offset": offset,
+                    "dtype": block.dtype.str,
+                    "size": int(block.size),
+                }
+            )
+            blocks.append((offset, block))
+            offset += block.nbytes
+        header_channels.append(channel)
+
+    header = json.dumps(
+        {
+            "version": FORMAT_VERSION,
+            "sample_rate": int(sample_rate),
+            "channels": header_channels,
+        }
+    ).encode()
+    # The blocks start after the header, aligned as well.
+    data_start = len(MAGIC) + 8 + len(header)
+    data_start = -(-data_start // BLOCK_ALIGNMENT) * BLOCK_ALIGNMENT
+
+    # Write to a temporary file first so that an interrupted write never
+    # leaves a truncated waveform file behind.
+    temporary_file = filename + ".tmp"
+    with open(temporary_file, "wb") as file:
+        file.write(MAGIC)
+        file.write(np.uint64(len(header)).tobytes())
+        file.write(header)
+        for block_offset, block in blocks:
+            file.seek(data_start + block_offset)
+            file.write(block.tobytes())
+        file.truncate(data_start + offset)
+    os.replace(temporary_file, filename)
+
+    return filename
+
+
+def convert(filename, new_filename=None):
+    """
+    Convert an old *_Waveforms_sr_*.npy file to the new format.
+
+    The sample rate is taken from the file name. new_filename defaults to
+    the old name with EXTENSION instead of .npy.
+
+    Returns
+    new_filename : str
+        Path of the written file.
+    """
+    if new_filename is None:
+        new_filename = os.path.splitext(filename)[0] + EXTENSION
+
+    sample_rate = waveform_specification.get_sample_rate(
+        os.path.basename(filename)
+    )
+    channels = [
+        (item["Specification"], item["Waveform"])
+        for item in waveform_specification.load(filename)
+    ]
+
+    return save(new_filename, sample_rate, channels)
+
+
+class WaveformChannel:
+    def __init__(self, waveform_file, header):
+        """
+        One channel of a waveform file, read when the waveform is needed.
+
+        Can be used like the records of the old format:
+        channel["Specification"] and channel["Waveform"].
+        """
+        self.waveform_file = waveform_file
+        self.name = header["name"]
+        self.dtype = np.dtype(header["dtype"])
+        self.length = header["length"]
+        self.header = header
+
+    @property
+    def is_digital(self):
+        return self.header["encoding"] == "runs"
+
+    @property
+    def waveform(self):
+        """Read-only samples, or a DigitalWaveform for digital channels."""
+        blocks = [
+            self.waveform_file.block(block) for block in self.header["blocks"]
+        ]
+        if self.is_digital:
+            return DigitalWaveform(*blocks)
+        return blocks[0].reshape(self.header["shape"])
+
+    def __getitem__(self, key):
+        if key == "Waveform":
+            return self.waveform
+        elif key == "Specification":
+            return self.name
+        raise KeyError(key)
+
+    def __len__(self):
+        return self.length
+
+    def __repr__(self):
+        return (
+            f"WaveformChannel({self.name!r}, {self.dtype}, "
+            f"{self.length} samples)"
+        )
+
+
+class WaveformFile:
+    def __init__(self, filename):
+        """
+        Lazily opened waveform file.
+
+        Only the header is read here. The file is memory-mapped the first
+        time samples are accessed and stays mapped until close().
+        """
+        self.filename = filename
+        with open(filename, "rb") as file:
+            if file.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{filename} is not a waveform file")
+            header_size = int(np.frombuffer(file.read(8), dtype=np.uint64)[0])
+            header = json.loads(file.read(header_size).decode())
+
+        if header["version"] > FORMAT_VERSION:
+            raise ValueError(
+                f"{filename} has version {header['version']}, only up to "
+                f"{FORMAT_VERSION} is supported"
+            )
+
+        self.sample_rate = header["sample_rate"]
+        self.data_start = (
+            -(-(len(MAGIC) + 8 + header_size) // BLOCK_ALIGNMENT)
+            * BLOCK_ALIGNMENT
+        )
+        self.channels = [
+            WaveformChannel(self, channel) for channel in header["channels"]
+        ]
+        self._mapped = None
+
+    @property
+    def channel_names(self):
+        return [channel.name for channel in self.channels]
+
+    def block(self, block):
+        """Memory-mapped array of a block described in the header."""
+        dtype = np.dtype(block["dtype"])
+        if block["size"] == 0:
+            return np.empty(0, dtype=dtype)
+
+        if self._mapped is None:
+            self._mapped = np.memmap(self.filename, dtype=np.uint8, mode="r")
+        start = self.data_start + block["offset"]
+        stop = start + block["size"] * dtype.itemsize
+        return self._mapped[start:stop].view(dtype)
+
+    def close(self):
+        """Release the memory map, arrays taken from it stay valid."""
+        self._mapped = None
+
+    def __len__(self):
+        return len(self.channels)
+
+    def __iter__(self):
+        return iter(self.channels)
+
+    def __getitem__(self, key):
+        """Channel by index or by name."""
+        if isinstance(key, str):
+            for channel in self.channels:
+                if channel.name == key:
+                    return channel
+            raise KeyError(key)
+        return self.channels[key]
+
+    def __repr__(self):
+        return (
+            f"WaveformFile({self.filename!r}, {self.sample_rate} S/s, "
+            f"{self.channel_names})"
+        )
+
+
+if __name__ == "__main__":
+    # Convert old waveform files given on the command line.
+    logging.basicConfig(level=logging.INFO)
+    for old_filename in sys.argv[1:]:
+        logging.info(f"Converted to {convert(old_filename)}")
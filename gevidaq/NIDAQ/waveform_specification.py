@@ -3,7 +3,8 @@ import re
 
 import numpy as np
 
-WAVEFORM_SR_RX = re.compile(r"(.*)Wavef(or|ro)ms_sr_(\d+)\.npy")
+# .wvf are the memory-mappable files of waveform_file.
+WAVEFORM_SR_RX = re.compile(r"(.*)Wavef(or|ro)ms_sr_(\d+)\.(npy|wvf)")
 
 
 def make_dtype(length, type_=bool):
@@ -21,7 +22,8 @@ def fix_sepcification(array):
     for i, item in enumerate(array):
         try:
             channel_keyword = item["Sepcification"]
-        except KeyError:
+        except (KeyError, ValueError):
+            # numpy raises ValueError for missing fields of a record
             return array  # array contents are not misspelled
 
         waveform = item["Waveform"]
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+Lazy expansion of repeated waveforms for streaming output.
+
+Long stimulation protocols are mostly one cycle repeated many times. Instead
+of tiling the cycle into one array for the whole protocol, CycleStream keeps
+a single cycle and hands out the samples chunk by chunk while the DAQ task is
+running, so memory use does not grow with the protocol length. Run-length
+encoded cycles, like digital_waveform.PortWaveform, are only expanded one
+chunk at a time.
+
+Usage:
+    stream = CycleStream(cycle_samples, repeats=3600, chunk_size=50000)
+    for chunk in stream:
+        writer.write_many_sample(chunk)
+"""
+import math
+
+import numpy as np
+
+from .digital_waveform import RunLengthWaveform
+
+
+class CycleStream:
+    def __init__(self, cycle, repeats, chunk_size):
+        """
+        Chunks of a cycle of samples repeated a number of times.
+
+        Parameters
+        cycle : np.ndarray or RunLengthWaveform
+            Samples of one cycle, of shape (channels, cycle length), or a
+            run-length encoded waveform of one channel.
+        repeats : int
+            Number of times the cycle is played.
+        chunk_size : int
+            Maximal number of samples per channel in each chunk.
+
+        Returns
+        None.
+
+        """
+        self.repeats = int(repeats)
+        self.chunk_size = int(chunk_size)
+
+        if isinstance(cycle, RunLengthWaveform):
+            self.compact_cycle = cycle
+            self.cycle_length = len(cycle)
+        else:
+            self.compact_cycle = None
+            cycle = np.asarray(cycle)
+            if cycle.ndim != 2:
+                raise ValueError("The cycle has to be of shape (channels, N)")
+            self.cycle_length = cycle.shape[1]
+        self.total_length = self.cycle_length * self.repeats
+
+        # Tile short cycles up to at least one chunk. The chunks of such a
+        # block are the same every time, so they are made contiguous once,
+        # as the DAQ writers need, and reused for every block.
+        block_repeats = max(math.ceil(self.chunk_size / self.cycle_length), 1)
+        self.block_length = self.cycle_length * block_repeats
+        self.chunk_starts = range(0, self.block_length, self.chunk_size)
+
+        if self.compact_cycle is None:
+            block = np.tile(cycle, (1, block_repeats))
+            self.block_chunks = [
+                np.ascontiguousarray(block[:, start : start + self.chunk_size])
+                for start in self.chunk_starts
+            ]
+        else:
+            # Compact cycles are expanded into this buffer, a chunk is only
+            # valid until the next one is taken.
+            self.block_chunks = None
+            self.buffer = np.empty(
+                (1, self.chunk_size), dtype=cycle.value_dtype
+            )
+
+    def __len__(self):
+        """Number of chunks in the stream."""
+        full_blocks, remainder = divmod(self.total_length, self.block_length)
+        return full_blocks * len(self.chunk_starts) + math.ceil(
+            remainder / self.chunk_size
+        )
+
+    def __iter__(self):
+        full_blocks, remainder = divmod(self.total_length, self.block_length)
+
+        for i in range(full_blocks):
+            for index, start in enumerate(self.chunk_starts):
+                yield self.block_chunk(index, self.block_length - start)
+
+        for index, start in enumerate(self.chunk_starts):
+            if start >= remainder:
+                break
+            yield self.block_chunk(index, remainder - start)
+
+    def block_chunk(self, index, samples_left):
+        """Chunk at index within the block, at most samples_left long."""
+        samples_number = min(self.chunk_size, samples_left)
+
+        if self.compact_cycle is not None:
+            chunk = self.buffer[:, :samples_number]
+            self.compact_cycle.read_cyclic(self.chunk_starts[index], chunk[0])
+            return chunk
+
+        chunk = self.block_chunks[index]
+        if chunk.shape[1] > samples_number:
+            chunk = np.ascontiguousarray(chunk[:, :samples_number])
+        return chunk
+
+    @property
+    def nbytes(self):
+        """Memory held by the stream."""
+        if self.compact_cycle is not None:
+            return self.compact_cycle.nbytes + self.buffer.nbytes
+        return sum(chunk.nbytes for chunk in self.block_chunks)
@@ -6,6 +6,7 @@ from scipy import signal
 
 from . import waveform_specification
 from .constants import HardwareConstants
+from .digital_waveform import DigitalWaveform
 
 
 def xValuesSingleSawtooth(
@@ -18,6 +19,9 @@ def xValuesSingleSawtooth(
     Second part: accelerating to the rampdown speed (maximum galvo speed for sawtooth)
     Third part: linearly moving down
     Fourth part: accelerating to rampup speed
+
+    The segment lengths are computed up front and every part is written
+    into one preallocated array.
     """
     # === Defining standard variables ===
     constants = HardwareConstants()
@@ -26,7 +30,6 @@ def xValuesSingleSawtooth(
     aGalvoPix = aGalvo / (
         sampleRate**2
     )  # Acceleration galvo in volt/pixel^2
-    xArray = np.array([])  # Array for x voltages
     rampUpSpeed = (
         voltXMax - voltXMin
     ) / xPixels  # Ramp up speed in volt/pixel
@@ -38,44 +41,33 @@ def xValuesSingleSawtooth(
     if sawtooth is False:
         rampDownSpeed = -rampUpSpeed
 
-    # === x pixel wave function ===
-
     # === Defining the ramp up (x) ===
     rampUp = np.linspace(voltXMin, voltXMax, xPixels)
-    xArray = np.append(
-        xArray, rampUp
-    )  # Adding the voltage values for the ramp up
-
-    # === Defining the inertial part ===
-    inertialPart = np.array(
-        []
-    )  # Making a temporary array for storing the voltage values of the inertial part
-    vIn = rampUpSpeed  # Speed of "incoming" ramp (volt/pixel)
-    vOut = rampDownSpeed  # Speed of "outgoing" ramp (volt/pixel)
-    a = -aGalvoPix  # Acceleration in volt/pixel^2
-    timespanInertial = abs(
-        math.floor((vOut - vIn) / a)
-    )  # Calculating the timespan needed
-    t = np.arange(timespanInertial)
-    inertialPart = (
-        0.5 * a * t[1::] ** 2 + vIn * t[1::] + xArray[-1]
-    )  # Making the array with the voltage values, we are not taking into acount the first value as this is the value of the previous sample
-    xArray = np.append(
-        xArray, inertialPart
-    )  # Adding the array to the total path
 
-    if sawtooth is False:
-        lineSizeStepFunction = (
-            xArray.size
-        )  # Defining the linesize for the yArray in case of a triangle wave
+    # === Timespan of the inertial parts ===
+    # Speed of "incoming" ramp is rampUpSpeed and of "outgoing" ramp
+    # rampDownSpeed (volt/pixel), the acceleration is in volt/pixel^2.
+    timespanInertial = abs(
+        math.floor((rampDownSpeed - rampUpSpeed) / -aGalvoPix)
+    )
+    # We are not taking into acount the first value of the inertial parts
+    # as this is the value of the previous sample.
+    t = np.arange(timespanInertial)[1::]
+    inertialSize = t.size
 
     # === Defining the ramp down ===
-    a = aGalvoPix
-    startVoltage = xArray[-1] + rampDownSpeed
+    # The ramp down starts one step after the end of the first inertial part.
+    if inertialSize > 0:
+        inertialEnd = (
+            0.5 * -aGalvoPix * t[-1] ** 2 + rampUpSpeed * t[-1] + rampUp[-1]
+        )
+    else:
+        inertialEnd = rampUp[-1]
+    startVoltage = inertialEnd + rampDownSpeed
     # We calculate the endvoltage by using the timespan for the intertial part and
     # the starting voltage
     endVoltage = (
-        0.5 * a * timespanInertial**2
+        0.5 * aGalvoPix * timespanInertial**2
         - rampUpSpeed * timespanInertial
         + voltXMin
     )
@@ -92,22 +84,33 @@ def xValuesSingleSawtooth(
             rampUp.size
         )  # If it is a triangle wave the ramp down part should be as big as the ramp up part
 
-    rampDown = np.linspace(
+    # === Filling the preallocated period ===
+    upEnd = rampUp.size
+    inertialEnd1 = upEnd + inertialSize
+    downEnd = inertialEnd1 + timespanRampDown
+    xArray = np.empty(downEnd + inertialSize)
+
+    xArray[:upEnd] = rampUp
+    # First inertial part, decelerating from the ramp up speed
+    np.multiply(t**2, 0.5 * -aGalvoPix, out=xArray[upEnd:inertialEnd1])
+    xArray[upEnd:inertialEnd1] += rampUpSpeed * t
+    xArray[upEnd:inertialEnd1] += rampUp[-1]
+    # Specifying the linear path of the ramp down
+    xArray[inertialEnd1:downEnd] = np.linspace(
         startVoltage, endVoltage, timespanRampDown
-    )  # Specifying the linear path
-    xArray = np.append(xArray, rampDown)  # Adding the array to the total path
-
-    # === Defining the second inertial part ===
-    inertialPart2 = np.array([])
-    vIn = rampDownSpeed  # Speed of "incoming" ramp (volt/pixel)
-    a = aGalvoPix  # Acceleration in volt/pixel^2
-    inertialPart2 = (
-        0.5 * a * t[1::] ** 2 + vIn * t[1::] + xArray[-1]
-    )  # We can use the same time units as the first inertial part but not including the last value, as this is part of the next iteration
-    xArray = np.append(xArray, inertialPart2)
+    )
+    # Second inertial part, we can use the same time units as the first
+    # inertial part but not including the last value, as this is part of
+    # the next iteration
+    np.multiply(t**2, 0.5 * aGalvoPix, out=xArray[downEnd:])
+    xArray[downEnd:] += rampDownSpeed * t
+    xArray[downEnd:] += xArray[downEnd - 1]
 
     if sawtooth is True:
         lineSizeStepFunction = xArray.size
+    else:
+        # Defining the linesize for the yArray in case of a triangle wave
+        lineSizeStepFunction = inertialEnd1
 
     return xArray, lineSizeStepFunction
 
@@ -123,21 +126,21 @@ def yValuesFullSawtooth(
     the full wavelength.
     """
     stepSize = (voltYMax - voltYMin) / yPixels
-
-    # Creating the 'stairs'
-    extendedYArray = (
-        np.ones(xPixels) * voltYMin
-    )  # The first line is created manually as this is shorter
-    # The step is starting at the beginning of the intertial part
-    for i in np.arange(yPixels - 1) + 1:
-        extendedYArray = np.append(
-            extendedYArray, np.ones(lineSize) * i * stepSize + voltYMin
+    stairsEnd = xPixels + (yPixels - 1) * lineSize
+    if lineSize < xPixels:
+        raise ValueError(
+            f"lineSize ({lineSize}) can not be shorter than xPixels ({xPixels})"
         )
 
-    extraPixels = (
-        lineSize * yPixels - extendedYArray.size
-    )  # Some extra pixels are needed to make x and y the same size
-    extendedYArray = np.append(extendedYArray, np.ones(extraPixels) * voltYMin)
+    extendedYArray = np.empty(lineSize * yPixels)
+    # The first line is shorter as the step is starting at the beginning of
+    # the intertial part
+    extendedYArray[:xPixels] = voltYMin
+    # Creating the 'stairs', each row of the view is one step
+    stairs = extendedYArray[xPixels:stairsEnd].reshape(yPixels - 1, lineSize)
+    stairs[:] = (np.arange(1, yPixels) * stepSize + voltYMin)[:, np.newaxis]
+    # Some extra pixels are needed to make x and y the same size
+    extendedYArray[stairsEnd:] = voltYMin
 
     return extendedYArray
 
@@ -148,31 +151,73 @@ def rotateXandY(
     """
     Rotates x and corresponding y array for galvos around its center point.
     """
-    radAngle = math.pi / 180 * imAngle  # Converting degrees to radians
+    finalXArray = np.array(xArray, dtype=float)
+    finalYArray = np.array(yArray, dtype=float)
+    rotateXandYInPlace(
+        finalXArray,
+        finalYArray,
+        voltXMin,
+        voltXMax,
+        voltYMin,
+        voltYMax,
+        imAngle,
+    )
 
-    # Shifting to the center
-    xArray = xArray - ((voltXMax - voltXMin) / 2 + voltXMin)
-    yArray = yArray - ((voltYMax - voltYMin) / 2 + voltYMin)
+    return finalXArray, finalYArray
 
-    # Converting the x and y arrays
-    rotatedXArray = xArray * math.cos(radAngle) - yArray * math.sin(radAngle)
-    rotatedYArray = xArray * math.sin(radAngle) + yArray * math.cos(radAngle)
 
-    # Shifting it back
-    finalXArray = rotatedXArray + ((voltXMax - voltXMin) / 2 + voltXMin)
-    finalYArray = rotatedYArray + ((voltYMax - voltYMin) / 2 + voltYMin)
+def rotateXandYInPlace(
+    xArray,
+    yArray,
+    voltXMin,
+    voltXMax,
+    voltYMin,
+    voltYMax,
+    imAngle,
+    blockSize=2**16,
+):
+    """
+    Rotates the float arrays x and y around their center point in place.
 
-    return finalXArray, finalYArray
+    The arrays are processed in blocks of blockSize samples so only two
+    small scratch buffers are needed, whatever the length of the raster.
+    """
+    radAngle = math.pi / 180 * imAngle  # Converting degrees to radians
+    cosAngle = math.cos(radAngle)
+    sinAngle = math.sin(radAngle)
+    centerX = (voltXMax - voltXMin) / 2 + voltXMin
+    centerY = (voltYMax - voltYMin) / 2 + voltYMin
+
+    scratchX = np.empty(min(blockSize, xArray.size))
+    scratchY = np.empty(min(blockSize, yArray.size))
+    for start in range(0, xArray.size, blockSize):
+        x = xArray[start : start + blockSize]
+        y = yArray[start : start + blockSize]
+        xSinAngle = scratchX[: x.size]
+        ySinAngle = scratchY[: y.size]
+
+        # Shifting to the center
+        x -= centerX
+        y -= centerY
+
+        # Converting the x and y arrays
+        np.multiply(x, sinAngle, out=xSinAngle)
+        np.multiply(y, sinAngle, out=ySinAngle)
+        x *= cosAngle
+        x -= ySinAngle
+        y *= cosAngle
+        y += xSinAngle
+
+        # Shifting it back
+        x += centerX
+        y += centerY
 
 
 def repeatWave(wave, repeats):
     """
     Repeats the wave a set number of times and returns a new repeated wave.
     """
-    extendedWave = np.array([])
-    for i in range(repeats):
-        extendedWave = np.append(extendedWave, wave)
-    return extendedWave
+    return np.tile(np.asarray(wave, dtype=float), repeats)
 
 
 def waveRecPic(
@@ -188,28 +233,31 @@ def waveRecPic(
 ):
     """
     Generates a the x and y values for making rectangular picture with a scanning laser.
+
+    Only one period of the x wave is calculated, it is broadcast over a
+    (yPixels, lineSize) view of the preallocated output and rotated in place.
     """
     xArray, lineSize = xValuesSingleSawtooth(
         sampleRate, voltXMin, voltXMax, xPixels, sawtooth
     )
-    yArray = yValuesFullSawtooth(
+    finalY = yValuesFullSawtooth(
         sampleRate, voltYMin, voltYMax, xPixels, yPixels, lineSize
     )
 
-    # Looping it to get the desired amount of periods for x
+    # Every y line gets one line of x
+    finalX = np.empty(lineSize * yPixels)
+    xLines = finalX.reshape(yPixels, lineSize)
     if sawtooth is True:
-        extendedXArray = repeatWave(xArray, yPixels)
+        xLines[:] = xArray
     else:
-        repeats = int(math.ceil(yPixels / 2))
-        extendedXArray = repeatWave(xArray, repeats)
-
-        # Checking if we should remove the last ramp down
-        if yPixels % 2 == 1:
-            extendedXArray = extendedXArray[0:-lineSize]
-
-    # Rotatin
-    finalX, finalY = rotateXandY(
-        extendedXArray, yArray, voltXMin, voltXMax, voltYMin, voltYMax, imAngle
+        # For the triangle wave the even lines are the ramp up and the odd
+        # lines the ramp down, the last ramp down is dropped for odd yPixels
+        xLines[0::2] = xArray[:lineSize]
+        xLines[1::2] = xArray[lineSize:]
+
+    # Rotating
+    rotateXandYInPlace(
+        finalX, finalY, voltXMin, voltXMax, voltYMin, voltYMax, imAngle
     )
     return finalX, finalY
 
@@ -402,6 +450,45 @@ class generate_digital_waveform:
 
         return self.finalwave
 
+    def generate_compact(self):
+        """
+        The same waveform as generate, as a run-length encoded
+        DigitalWaveform, without creating the samples.
+        """
+        offsetsamples_number = int(
+            (self.waveoffset / 1000) * self.Daq_sample_rate
+        )
+        sample_num_singleperiod = round(
+            self.Daq_sample_rate / self.wavefrequency
+        )
+        true_sample_num_singleperiod = round(
+            (self.waveDC / 100) * sample_num_singleperiod
+        )
+        false_sample_num_singleperiod = (
+            sample_num_singleperiod - true_sample_num_singleperiod
+        )
+        repeatnumberintotal = int(
+            self.wavefrequency * (self.waveperiod / 1000)
+        )
+
+        # Runs of one cycle: the pulses followed by the gap.
+        cycle_values = np.append(
+            np.tile([True, False], repeatnumberintotal), False
+        )
+        cycle_lengths = np.append(
+            np.tile(
+                [true_sample_num_singleperiod, false_sample_num_singleperiod],
+                repeatnumberintotal,
+            ),
+            self.wavegap,
+        )
+
+        values = np.append(False, np.tile(cycle_values, self.waverepeat))
+        lengths = np.append(
+            offsetsamples_number, np.tile(cycle_lengths, self.waverepeat)
+        )
+        return DigitalWaveform(values, np.cumsum(lengths))
+
 
 class generate_ramp:
     def __init__(
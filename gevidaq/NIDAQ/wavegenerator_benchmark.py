@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the galvo raster synthesis in wavegenerator.
+
+Compares waveRecPic with the former np.append based implementation, checks
+that both give exactly the same samples and reports the speedup for a range
+of pixel numbers and sample rates.
+
+Run with: python -m gevidaq.NIDAQ.wavegenerator_benchmark
+"""
+import math
+import time
+
+import numpy as np
+
+from . import wavegenerator
+
+
+def legacy_yValuesFullSawtooth(
+    sampleRate, voltYMin, voltYMax, xPixels, yPixels, lineSize
+):
+    """The stair function as it was built before, one np.append per line."""
+    stepSize = (voltYMax - voltYMin) / yPixels
+
+    extendedYArray = np.ones(xPixels) * voltYMin
+    for i in np.arange(yPixels - 1) + 1:
+        extendedYArray = np.append(
+            extendedYArray, np.ones(lineSize) * i * stepSize + voltYMin
+        )
+
+    extraPixels = lineSize * yPixels - extendedYArray.size
+    extendedYArray = np.append(extendedYArray, np.ones(extraPixels) * voltYMin)
+
+    return extendedYArray
+
+
+def legacy_repeatWave(wave, repeats):
+    """The repeated wave as it was built before, one np.append per period."""
+    extendedWave = np.array([])
+    for i in range(repeats):
+        extendedWave = np.append(extendedWave, wave)
+    return extendedWave
+
+
+def legacy_rotateXandY(
+    xArray, yArray, voltXMin, voltXMax, voltYMin, voltYMax, imAngle
+):
+    """The out of place rotation as it was done before."""
+    radAngle = math.pi / 180 * imAngle
+
+    xArray = xArray - ((voltXMax - voltXMin) / 2 + voltXMin)
+    yArray = yArray - ((voltYMax - voltYMin) / 2 + voltYMin)
+
+    rotatedXArray = xArray * math.cos(radAngle) - yArray * math.sin(radAngle)
+    rotatedYArray = xArray * math.sin(radAngle) + yArray * math.cos(radAngle)
+
+    finalXArray = rotatedXArray + ((voltXMax - voltXMin) / 2 + voltXMin)
+    finalYArray = rotatedYArray + ((voltYMax - voltYMin) / 2 + voltYMin)
+
+    return finalXArray, finalYArray
+
+
+def legacy_waveRecPic(
+    sampleRate=4000,
+    imAngle=0,
+    voltXMin=0,
+    voltXMax=5,
+    voltYMin=0,
+    voltYMax=5,
+    xPixels=1024,
+    yPixels=512,
+    sawtooth=True,
+):
+    """waveRecPic as it was before the raster was built in one pass."""
+    xArray, lineSize = wavegenerator.xValuesSingleSawtooth(
+        sampleRate, voltXMin, voltXMax, xPixels, sawtooth
+    )
+    yArray = legacy_yValuesFullSawtooth(
+        sampleRate, voltYMin, voltYMax, xPixels, yPixels, lineSize
+    )
+
+    if sawtooth is True:
+        extendedXArray = legacy_repeatWave(xArray, yPixels)
+    else:
+        repeats = int(math.ceil(yPixels / 2))
+        extendedXArray = legacy_repeatWave(xArray, repeats)
+
+        if yPixels % 2 == 1:
+            extendedXArray = extendedXArray[0:-lineSize]
+
+    return legacy_rotateXandY(
+        extendedXArray, yArray, voltXMin, voltXMax, voltYMin, voltYMax, imAngle
+    )
+
+
+def time_function(function, repeats, **kwargs):
+    """Return the best wall time of repeats calls and the last result."""
+    best = math.inf
+    for i in range(repeats):
+        start = time.perf_counter()
+        result = function(**kwargs)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def run_benchmark(
+    pixel_numbers=(256, 500, 1024),
+    sample_rates=(250000, 500000, 1000000),
+    edge_volt=5,
+    repeats=3,
+):
+    """
+    Time the galvo raster generation the way RasterScan uses it.
+
+    Parameters
+    pixel_numbers : tuple of int, optional
+        Square image sizes to generate.
+    sample_rates : tuple of int, optional
+        DAQ sample rates to generate.
+    edge_volt : float, optional
+        The bounding raster scan voltage.
+    repeats : int, optional
+        Number of runs per setting, the fastest one is reported.
+
+    Returns
+    results : list of dict
+        Timings in seconds per setting.
+
+    """
+    results = []
+    print(
+        f"{'pixels':>7} {'rate':>8} {'samples':>10} "
+        f"{'legacy (s)':>11} {'new (s)':>9} {'speedup':>8}"
+    )
+    for sample_rate in sample_rates:
+        for pixel_number in pixel_numbers:
+            kwargs = dict(
+                sampleRate=sample_rate,
+                imAngle=0,
+                voltXMin=-1 * edge_volt,
+                voltXMax=edge_volt,
+                voltYMin=-1 * edge_volt,
+                voltYMax=edge_volt,
+                xPixels=pixel_number,
+                yPixels=pixel_number,
+                sawtooth=True,
+            )
+
+            legacy_time, legacy_samples = time_function(
+                legacy_waveRecPic, repeats, **kwargs
+            )
+            new_time, new_samples = time_function(
+                wavegenerator.waveRecPic, repeats, **kwargs
+            )
+            for legacy_wave, new_wave in zip(legacy_samples, new_samples):
+                if not np.array_equal(legacy_wave, new_wave):
+                    raise AssertionError(
+                        f"Raster differs at {pixel_number} pixels, "
+                        f"{sample_rate} S/s"
+                    )
+
+            result = {
+                "pixel_number": pixel_number,
+                "sample_rate": sample_rate,
+                "samples": new_samples[0].size,
+                "legacy": legacy_time,
+                "new": new_time,
+            }
+            results.append(result)
+            print(
+                f"{pixel_number:>7} {sample_rate:>8} "
+                f"{result['samples']:>10} {legacy_time:>11.4f} "
+                f"{new_time:>9.4f} {legacy_time / new_time:>7.1f}x"
+            )
+
+    return results
+
+
+if __name__ == "__main__":
+    run_benchmark()
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+Pipelined processing of z-stack planes.
+
+A z-stack used to move the objective, scan, reconstruct, score and save a
+plane before the next move. PlanePipeline takes the reconstruction, focus
+scoring and writing of a plane to worker threads, so the acquisition loop
+can move the objective to the next plane and scan it while the previous
+planes are processed. Planes wait in a bounded queue: when the workers fall
+behind, submit() blocks until there is room again, so a slow disk holds up
+the scanning instead of filling the memory with raw samples.
+
+Usage:
+    with PlanePipeline(process_plane, workers=2) as pipeline:
+        for index, position in enumerate(positions):
+            motor.move(position)
+            samples = scan.acquire()
+            pipeline.submit(index, position, samples)
+    # All planes are processed here.
+
+Each submit() returns a concurrent.futures.Future with the result of
+process_plane, for example to wait for the focus degree of a plane.
+"""
+import logging
+import queue
+import threading
+from concurrent.futures import Future
+
+
+class PlanePipeline:
+    def __init__(self, process, workers=2, max_pending=2, name="zstack"):
+        """
+        Worker threads processing the submitted planes.
+
+        Parameters
+        process : callable
+            Called on a worker thread with the arguments of submit().
+        workers : int, optional
+            Number of worker threads. With one worker the planes are
+            processed in the order they were submitted. The default is 2.
+        max_pending : int, optional
+            Number of planes that can wait for a worker before submit()
+            blocks. The default is 2.
+        name : str, optional
+            Prefix of the thread names. The default is "zstack".
+
+        Returns
+        None.
+
+        """
+        self.process = process
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._threads = [
+            threading.Thread(
+                target=self._work, name=f"{name}-{index}", daemon=True
+            )
+            for index in range(workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, *args, **kwargs):
+        """
+        Queue a plane, blocking while the queue is full.
+
+        Returns
+        future : concurrent.futures.Future
+            Result of process(*args, **kwargs).
+        """
+        if not self._threads:
+            raise RuntimeError("The plane pipeline is closed")
+
+        future = Future()
+        self._queue.put((future, args, kwargs))
+        return future
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+
+                future, args, kwargs = item
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    future.set_result(self.process(*args, **kwargs))
+                except Exception as exc:
+                    # The other planes go on, like a failed image in a
+                    # sequential stack.
+                    logging.critical("caught exception", exc_info=exc)
+                    future.set_exception(exc)
+            finally:
+                self._queue.task_done()
+
+    def join(self):
+        """Wait until all submitted planes are processed."""
+        self._queue.join()
+
+    def close(self):
+        """Process the remaining planes and stop the workers."""
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
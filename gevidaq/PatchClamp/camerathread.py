@@ -73,7 +73,7 @@ class CameraThread(QThread):
             try:
                 [frames, dims] = self.camera.hcam.getFrames()
                 self.mutex.lock()
-                self.frame = np.resize(frames[-1].np_array, (dims[1], dims[0]))
+                self.frame = frames[-1].copy()
                 self.livesignal.emit(self.frame)
                 self.mutex.unlock()
             except Exception as exc:
@@ -9,10 +9,9 @@ Notes:
 """
 import nidaqmx
 import numpy as np
-from nidaqmx.stream_readers import AnalogMultiChannelReader
-from nidaqmx.stream_writers import AnalogSingleChannelWriter
 from PyQt5.QtCore import QThread, pyqtSignal
 
+from ..NIDAQ import daq_backend, static_outputs
 from ..NIDAQ.constants import MeasurementConstants, NiDaqChannels
 from ..NIDAQ.wavegenerator import blockWave
 
@@ -91,15 +90,17 @@ class ContinuousPatchThread(QThread):
         self.patchVoltInChan = self.configs["patchAO"]
 
         # DAQ
-        with nidaqmx.Task() as writeTask, nidaqmx.Task() as readTask:
-            writeTask.ao_channels.add_ao_voltage_chan(self.patchVoltInChan)
+        daq = daq_backend.get_backend()
+        with static_outputs.timed_output_task(
+            self.patchVoltInChan
+        ) as writeTask, daq.Task() as readTask:
             readTask.ai_channels.add_ai_voltage_chan(self.patchVoltOutChan)
             readTask.ai_channels.add_ai_voltage_chan(self.patchCurOutChan)
 
             self.setTiming(writeTask, readTask)
 
-            reader = AnalogMultiChannelReader(readTask.in_stream)
-            writer = AnalogSingleChannelWriter(writeTask.out_stream)
+            reader = daq.AnalogMultiChannelReader(readTask.in_stream)
+            writer = daq.AnalogSingleChannelWriter(writeTask.out_stream)
 
             writer.write_many_sample(self.wave)
 
@@ -247,15 +248,17 @@ class ContinuousPatchThread_hold(QThread):
         self.patchVoltInChan = self.configs["patchAO"]
 
         # DAQ
-        with nidaqmx.Task() as writeTask, nidaqmx.Task() as readTask:
-            writeTask.ao_channels.add_ao_voltage_chan(self.patchVoltInChan)
+        daq = daq_backend.get_backend()
+        with static_outputs.timed_output_task(
+            self.patchVoltInChan
+        ) as writeTask, daq.Task() as readTask:
             readTask.ai_channels.add_ai_voltage_chan(self.patchVoltOutChan)
             readTask.ai_channels.add_ai_voltage_chan(self.patchCurOutChan)
 
             self.setTiming(writeTask, readTask)
 
-            reader = AnalogMultiChannelReader(readTask.in_stream)
-            writer = AnalogSingleChannelWriter(writeTask.out_stream)
+            reader = daq.AnalogMultiChannelReader(readTask.in_stream)
+            writer = daq.AnalogSingleChannelWriter(writeTask.out_stream)
 
             writer.write_many_sample(self.wave)
 
@@ -404,15 +407,17 @@ class ContinuousPatchThread_currentclamp(QThread):
         self.patchCurInChan = self.configs["patchAO"]
 
         # DAQ
-        with nidaqmx.Task() as writeTask, nidaqmx.Task() as readTask:
-            writeTask.ao_channels.add_ao_voltage_chan(self.patchCurInChan)
+        daq = daq_backend.get_backend()
+        with static_outputs.timed_output_task(
+            self.patchCurInChan
+        ) as writeTask, daq.Task() as readTask:
             readTask.ai_channels.add_ai_voltage_chan(self.patchVoltOutChan)
             readTask.ai_channels.add_ai_voltage_chan(self.patchCurOutChan)
 
             self.setTiming(writeTask, readTask)
 
-            reader = AnalogMultiChannelReader(readTask.in_stream)
-            writer = AnalogSingleChannelWriter(writeTask.out_stream)
+            reader = daq.AnalogMultiChannelReader(readTask.in_stream)
+            writer = daq.AnalogSingleChannelWriter(writeTask.out_stream)
 
             writer.write_many_sample(self.wave)
 
@@ -559,17 +564,19 @@ class ContinuousPatchThread_zap(QThread):
         self.patchVoltInChan = self.configs["patchAO"]
 
         # DAQ
-        with nidaqmx.Task() as writeTask, nidaqmx.Task() as readTask:
-            writeTask.ao_channels.add_ao_voltage_chan(self.patchVoltInChan)
+        daq = daq_backend.get_backend()
+        with static_outputs.timed_output_task(
+            self.patchVoltInChan
+        ) as writeTask, daq.Task() as readTask:
             readTask.ai_channels.add_ai_voltage_chan(self.patchVoltOutChan)
             readTask.ai_channels.add_ai_voltage_chan(self.patchCurOutChan)
 
             self.setTiming(writeTask, readTask)
 
-            reader = AnalogMultiChannelReader(
+            reader = daq.AnalogMultiChannelReader(
                 readTask.in_stream
             )  # TODO unused
-            writer = AnalogSingleChannelWriter(writeTask.out_stream)
+            writer = daq.AnalogSingleChannelWriter(writeTask.out_stream)
 
             writer.write_many_sample(self.wave)
 
@@ -9,6 +9,7 @@ import logging
 import math
 import os
 import time
+from types import SimpleNamespace
 
 import numpy as np
 import tifffile as skimtiff
@@ -18,10 +19,13 @@ from skimage.io import imread
 
 from ..HamamatsuCam.HamamatsuActuator import CamActuator
 from ..ImageAnalysis.ImageProcessing import ProcessImage
+from ..ImageAnalysis.stack_reduction import StackReducer
 from ..InsightX3.TwoPhotonLaser_backend import InsightX3
 from ..NIDAQ.DAQoperator import DAQmission
+from ..NIDAQ.pmt_reconstruction import PMTReconstruction
 from ..PI_ObjectiveMotor.AutoFocus import FocusFinder
 from ..PI_ObjectiveMotor.focuser import PIMotor
+from ..PI_ObjectiveMotor.zstack_pipeline import PlanePipeline
 from ..SampleStageControl.stage import LudlStage
 from ..ThorlabsFilterSlider.filterpyserial import ELL9Filter
 
@@ -50,6 +54,11 @@ class ScanningExecutionThread(QThread):
 
         self.clock_source = "DAQ"  # Should be set by GUI.
 
+        # The waveform packages are compiled once and the DAQ tasks are
+        # kept configured while the same package runs at every coordinate.
+        self.adcollector = DAQmission()
+        self.daq_plans = {}
+
         self.scansavedirectory = self.GeneralSettingDict["savedirectory"]
         self.meshgridnumber = int(self.GeneralSettingDict["Meshgrid"])
 
@@ -72,6 +81,12 @@ class ScanningExecutionThread(QThread):
         )
         self.pi_device_instance = PIMotor()
         logging.info("Objective motor connected.")
+
+        # The PMT images are reconstructed, evaluated and saved on a worker
+        # thread, in order, while the objective moves to the next plane.
+        self.plane_pipeline = PlanePipeline(
+            self.process_PMT_plane, workers=1, max_pending=1
+        )
         self.errornum = 0
         self.init_focus_position = self.pi_device_instance.pidevice.qPOS(
             self.pi_device_instance.pidevice.axes
@@ -327,6 +342,8 @@ class ScanningExecutionThread(QThread):
                     )
 
                     self.stack_focus_degree_list = []
+                    # Focus degrees of the planes being processed.
+                    self.stack_focus_degree_futures = {}
 
                     logging.info(
                         "*******************************************Round {}. Current index: {}.**************************************************".format(
@@ -354,19 +371,11 @@ class ScanningExecutionThread(QThread):
                             ]  # + self.wavelength_offset
 
                             # Add the focus degree of previous image to the list.
-                            # For stack of 3 only.
-                            if EachZStackPos > 0:
-                                try:
-                                    self.stack_focus_degree_list.append(
-                                        self.FocusDegree_img_reconstructed
-                                    )
-
-                                except Exception as exc:
-                                    logging.critical(
-                                        "caught exception", exc_info=exc
-                                    )
-                                    # FocusDegree_img_reconstructed is not generated with camera imaging.
-                                    pass
+                            # For stack of 3 only, so only the 3rd position
+                            # waits for the processing of the first two.
+                            if EachZStackPos == 2:
+                                for ZStackOrder in (1, 2):
+                                    self.append_focus_degree(ZStackOrder)
                             logging.info(
                                 "stack_focus_degree_list is {}".format(
                                     self.stack_focus_degree_list
@@ -376,7 +385,10 @@ class ScanningExecutionThread(QThread):
                             # Check if focus degree decreased on the 2nd pos,
                             # if so change the obj moveing direction.
                             self.focus_degree_decreasing = False
-                            if len(self.stack_focus_degree_list) == 2:
+                            if (
+                                EachZStackPos == 2
+                                and len(self.stack_focus_degree_list) == 2
+                            ):
                                 if (
                                     self.stack_focus_degree_list[-1]
                                     < self.stack_focus_degree_list[-2]
@@ -524,6 +536,12 @@ class ScanningExecutionThread(QThread):
 
             self.Laserinstance.Turn_Off_PumpLaser()
 
+        # Finish processing the last planes.
+        self.plane_pipeline.close()
+
+        # Release the DAQ tasks
+        self.adcollector.closeTasks()
+
         # Disconnect camera
         if self._use_camera is True:
             self.HamamatsuCam.Exit()
@@ -1133,8 +1151,17 @@ class ScanningExecutionThread(QThread):
         ):  # if camera operations are configured
             _camera_isUsed = True
             CamSettigList = CameraPackageToBeExecute["Settings"]
+            # Frames are written to the file while the waveforms run.
+            img_text = (
+                "_Cam_"
+                + str(self.RoundWaveformIndex[1])
+                + "_Zpos"
+                + str(self.ZStackOrder)
+            )
+            self.cam_tif_name = self.generate_tif_name(extra_text=img_text)
             self.HamamatsuCam.StartStreaming(
                 BufferNumber=CameraPackageToBeExecute["Buffer_number"],
+                saving_dir=self.cam_tif_name,
                 trigger_source=CamSettigList[
                     CamSettigList.index("trigger_source") + 1
                 ],
@@ -1174,16 +1201,38 @@ class ScanningExecutionThread(QThread):
             self.averagenum = WaveformPackageGalvoInfor[3]
             self.lenSample_1 = WaveformPackageGalvoInfor[4]
             self.ScanArrayXnum = WaveformPackageGalvoInfor[5]
+            if len(WaveformPackageGalvoInfor) > 6:
+                self.pmt_reconstruction = (
+                    PMTReconstruction.from_scan_parameters(
+                        **WaveformPackageGalvoInfor[6], invert=False
+                    )
+                )
+            else:
+                # Pipelines saved before the scan parameters were stored
+                # with them are square rasters.
+                Value_yPixels = int(self.lenSample_1 / self.ScanArrayXnum)
+                self.pmt_reconstruction = (
+                    PMTReconstruction.from_line_geometry(
+                        self.daq_sampling_rate,
+                        self.ScanArrayXnum,
+                        Value_yPixels,
+                        Value_yPixels,
+                        averagenum=self.averagenum,
+                        invert=False,
+                    )
+                )
 
-        self.adcollector = DAQmission()
         # self.adcollector.collected_data.connect(self.ProcessData)
-        self.adcollector.runWaveforms(
-            clock_source=self.clock_source,
-            sampling_rate=WaveformPackageToBeExecute[0],
-            analog_signals=WaveformPackageToBeExecute[1],
-            digital_signals=WaveformPackageToBeExecute[2],
-            readin_channels=WaveformPackageToBeExecute[3],
-        )
+        plan_key = tuple(self.RoundWaveformIndex)
+        if plan_key not in self.daq_plans:
+            self.daq_plans[plan_key] = self.adcollector.compileWaveforms(
+                clock_source=self.clock_source,
+                sampling_rate=WaveformPackageToBeExecute[0],
+                analog_signals=WaveformPackageToBeExecute[1],
+                digital_signals=WaveformPackageToBeExecute[2],
+                readin_channels=WaveformPackageToBeExecute[3],
+            )
+        self.adcollector.runPlan(self.daq_plans[plan_key])
         self.adcollector.save_as_binary(self.scansavedirectory)
         self.recorded_raw_data = self.adcollector.get_raw_data()
 
@@ -1193,14 +1242,7 @@ class ScanningExecutionThread(QThread):
         # === Camera saving ===
         if _camera_isUsed is True:
             self.HamamatsuCam.isSaving = True
-            img_text = (
-                "_Cam_"
-                + str(self.RoundWaveformIndex[1])
-                + "_Zpos"
-                + str(self.ZStackOrder)
-            )
-            self.cam_tif_name = self.generate_tif_name(extra_text=img_text)
-            self.HamamatsuCam.StopStreaming(saving_dir=self.cam_tif_name)
+            self.HamamatsuCam.StopStreaming()
             # Make sure that the saving process is finished.
             while self.HamamatsuCam.isSaving is True:
                 logging.info("Camera saving...")
@@ -1209,6 +1251,18 @@ class ScanningExecutionThread(QThread):
 
         time.sleep(0.5)
 
+    def append_focus_degree(self, ZStackOrder):
+        """
+        Wait for the focus degree of a plane and add it to
+        self.stack_focus_degree_list.
+        """
+        future = self.stack_focus_degree_futures.get(ZStackOrder)
+        if future is None or future.exception() is not None:
+            # There is no focus degree with camera imaging.
+            return
+        if future.result() is not None:
+            self.stack_focus_degree_list.append(future.result())
+
     def Process_raw_data(self):
         self.channel_number = len(self.recorded_raw_data)
 
@@ -1239,53 +1293,61 @@ class ScanningExecutionThread(QThread):
 
     def PMT_image_processing(self):
         """
-        Reconstruct the image from np array and save it.
+        Queue the recorded PMT samples to be reconstructed and saved.
+
+        The images are processed on the worker of self.plane_pipeline, so
+        the objective can move to the next plane in the meantime. The
+        settings of the current plane are passed along, as they change
+        before the worker gets to the plane.
 
         Returns
         None.
 
         """
-        for imageSequence in range(self.repeatnum):
+        plane = SimpleNamespace(
+            data_collected_0=self.data_collected_0,
+            PMT_data_index_array=self.PMT_data_index_array,
+            pmt_reconstruction=self.pmt_reconstruction,
+            repeatnum=self.repeatnum,
+            RoundWaveformIndex=list(self.RoundWaveformIndex),
+            Grid_index=self.Grid_index,
+            currentCoordsSeq=self.currentCoordsSeq,
+            CurrentPosIndex=list(self.CurrentPosIndex),
+            ZStackOrder=self.ZStackOrder,
+            ZStackNum=self.ZStackNum,
+            FocusPos=self.FocusPos,
+        )
+        # Blocks while the worker is more than a plane behind.
+        future = self.plane_pipeline.submit(plane)
+        self.stack_focus_degree_futures[self.ZStackOrder] = future
+
+    def process_PMT_plane(self, plane):
+        """
+        Reconstruct the images of a plane, evaluate and save them.
+
+        Parameters
+        plane : SimpleNamespace
+            The samples and settings of the plane, see PMT_image_processing.
+
+        Returns
+        focus_degree : float
+            The focus degree of the last image, None if there is none.
+
+        """
+        focus_degree = None
+        for imageSequence in range(plane.repeatnum):
             try:
-                self.PMT_image_reconstructed_array = self.data_collected_0[
-                    np.where(self.PMT_data_index_array == imageSequence + 1)
+                self.PMT_image_reconstructed_array = plane.data_collected_0[
+                    np.where(plane.PMT_data_index_array == imageSequence + 1)
                 ]
 
-                Dataholder_average = np.mean(
-                    self.PMT_image_reconstructed_array.reshape(
-                        self.averagenum, -1
-                    ),
-                    axis=0,
-                )
-
-                Value_yPixels = int(self.lenSample_1 / self.ScanArrayXnum)
-                self.PMT_image_reconstructed = np.reshape(
-                    Dataholder_average, (Value_yPixels, self.ScanArrayXnum)
+                # Average the frames and cut off the flying back part.
+                self.PMT_image_reconstructed = (
+                    plane.pmt_reconstruction.reconstruct(
+                        self.PMT_image_reconstructed_array
+                    )
                 )
 
-                # self.PMT_image_reconstructed = self.PMT_image_reconstructed[
-                # :, 50:550]
-                # Cut off the flying back part.
-                if self.daq_sampling_rate == 500000:
-                    if Value_yPixels == 500:
-                        self.PMT_image_reconstructed = (
-                            self.PMT_image_reconstructed[:, 50:550]
-                        )
-                    elif Value_yPixels == 256:
-                        self.PMT_image_reconstructed = (
-                            self.PMT_image_reconstructed[:, 70:326]
-                        )
-                elif self.daq_sampling_rate == 250000:
-                    if Value_yPixels == 500:
-                        self.PMT_image_reconstructed = (
-                            self.PMT_image_reconstructed[:, 25:525]
-                        )
-                    elif Value_yPixels == 256:
-                        self.PMT_image_reconstructed = (
-                            self.PMT_image_reconstructed[:, 25:525]
-                        )
-                # Crop size based on: M:\tnw\ist\do\projects\Neurophotonics\Brinkslab\Data\Xin\2019-12-30 2p beads area test 4um
-
                 # === Evaluate the focus degree of re-constructed image. =======
                 self.FocusDegree_img_reconstructed = (
                     ProcessImage.local_entropy(
@@ -1297,25 +1359,26 @@ class ScanningExecutionThread(QThread):
                         self.FocusDegree_img_reconstructed
                     )
                 )
+                focus_degree = self.FocusDegree_img_reconstructed
 
                 # Save the individual file.
                 with skimtiff.TiffWriter(
                     os.path.join(
                         self.scansavedirectory,
                         "Round"
-                        + str(self.RoundWaveformIndex[0])
+                        + str(plane.RoundWaveformIndex[0])
                         + "_Grid"
-                        + str(self.Grid_index)
+                        + str(plane.Grid_index)
                         + "_Coords"
-                        + str(self.currentCoordsSeq)
+                        + str(plane.currentCoordsSeq)
                         + "_R"
-                        + str(self.CurrentPosIndex[0])
+                        + str(plane.CurrentPosIndex[0])
                         + "C"
-                        + str(self.CurrentPosIndex[1])
+                        + str(plane.CurrentPosIndex[1])
                         + "_PMT_"
                         + str(imageSequence)
                         + "Zpos"
-                        + str(self.ZStackOrder)
+                        + str(plane.ZStackOrder)
                         + ".tif",
                     ),
                     imagej=True,
@@ -1323,7 +1386,7 @@ class ScanningExecutionThread(QThread):
                     tif.save(
                         self.PMT_image_reconstructed.astype("float32"),
                         compress=0,
-                        metadata={"FocusPos: ": str(self.FocusPos)},
+                        metadata={"FocusPos: ": str(plane.FocusPos)},
                     )
 
                 plt.figure()
@@ -1333,74 +1396,46 @@ class ScanningExecutionThread(QThread):
                 plt.show()
 
                 # === Calculate the z max projection ===
-                if self.repeatnum == 1:  # Consider one repeat image situlation
-                    if self.ZStackNum > 1:
-                        if self.ZStackOrder == 1:
-                            self.PMT_image_maxprojection_stack = (
-                                self.PMT_image_reconstructed[np.newaxis, :, :]
-                            )
-
-                        else:
-                            # Before stack the 3rd image, if focus degree of the 2nd image
-                            # is increasing, delete the 1st image from the max-projection
-                            # stack as it's the worst, else if focus degree of the 2nd image
-                            # is decreasing, delete the 2nd as it's the worst.
-
-                            if self.ditch_worst_focus is True:
-                                if self.ZStackOrder >= 3:
-                                    if self.focus_degree_decreasing is False:
-                                        # Delete the first image.
-                                        self.PMT_image_maxprojection_stack = np.delete(
-                                            self.PMT_image_maxprojection_stack,
-                                            0,
-                                            axis=0,
-                                        )
-                                    else:
-                                        # Delete the 2nd image.
-                                        self.PMT_image_maxprojection_stack = np.delete(
-                                            self.PMT_image_maxprojection_stack,
-                                            1,
-                                            axis=0,
-                                        )
+                if plane.repeatnum == 1:  # Consider one repeat image situlation
+                    if plane.ZStackOrder == 1:
+                        # When ditching the worst focus, the max projection
+                        # is of all planes but the worst focused one.
+                        self.PMT_stack_reducer = StackReducer(
+                            ditch_worst=self.ditch_worst_focus is True
+                            and plane.ZStackNum >= 3
+                        )
 
-                            # Stack the newest image onto the max-projection stack.
-                            self.PMT_image_maxprojection_stack = (
-                                np.concatenate(
-                                    (
-                                        self.PMT_image_maxprojection_stack,
-                                        self.PMT_image_reconstructed[
-                                            np.newaxis, :, :
-                                        ],
-                                    ),
-                                    axis=0,
-                                )
-                            )
+                    # Update the max projection in place.
+                    self.PMT_stack_reducer.add(
+                        self.PMT_image_reconstructed,
+                        self.FocusDegree_img_reconstructed,
+                    )
 
+                # === Save the max projection image ===
+                if plane.ZStackOrder == plane.ZStackNum:
+                    if self.PMT_stack_reducer.ditch_worst:
+                        self.PMT_image_maxprojection = (
+                            self.PMT_stack_reducer.max_without_worst
+                        )
                     else:
-                        self.PMT_image_maxprojection_stack = (
-                            self.PMT_image_reconstructed[np.newaxis, :, :]
+                        self.PMT_image_maxprojection = (
+                            self.PMT_stack_reducer.max
                         )
 
-                # === Save the max projection image ===
-                if self.ZStackOrder == self.ZStackNum:
-                    self.PMT_image_maxprojection = np.max(
-                        self.PMT_image_maxprojection_stack, axis=0
-                    )
-
                     # Save the zmax file.
                     with skimtiff.TiffWriter(
                         os.path.join(
                             self.scansavedirectory,
                             "Round"
-                            + str(self.RoundWaveformIndex[0])
+                            + str(plane.RoundWaveformIndex[0])
                             + "_Grid"
-                            + str(self.Grid_index)
+                            + str(plane.Grid_index)
                             + "_Coords"
-                            + str(self.currentCoordsSeq)
+                            + str(plane.currentCoordsSeq)
                             + "_R"
-                            + str(self.CurrentPosIndex[0])
+                            + str(plane.CurrentPosIndex[0])
                             + "C"
-                            + str(self.CurrentPosIndex[1])
+                            + str(plane.CurrentPosIndex[1])
                             + "_PMT_"
                             + str(imageSequence)
                             + "Zmax"
@@ -1411,7 +1446,7 @@ class ScanningExecutionThread(QThread):
                         tif.save(
                             self.PMT_image_maxprojection.astype("float32"),
                             compress=0,
-                            metadata={"FocusPos: ": str(self.FocusPos)},
+                            metadata={"FocusPos: ": str(plane.FocusPos)},
                         )
 
             except Exception as exc:
@@ -1420,6 +1455,8 @@ class ScanningExecutionThread(QThread):
                     "No.{} image failed to generate.".format(imageSequence)
                 )
 
+        return focus_degree
+
     def generate_tif_name(self, extra_text="_"):
         tif_name = os.path.join(
             self.scansavedirectory,